@@ -23,6 +23,7 @@ import traceback
 import threading
 import csv
 import warnings
+import functools
 
 import numpy as np
 from datetime import date
@@ -62,6 +63,9 @@ DUMMY_IDS = ['dummy/dummy-1.5B', 'dummy/dummy-4B']
 
 results = []
 excludes = []
+# export the profile of every generate call to this directory if set
+profile_dir = None
+profile_layers = False
 
 def run_model_in_thread(model, in_out, tokenizer, result, warm_up, num_beams, input_ids, out_len, actual_in_len, num_trials, load_time, lookahead):
     for i in range(num_trials + warm_up):
@@ -146,6 +150,11 @@ def preprocess_prompt(tokenizer, in_len, task):
     return input_ids
 
 def run_model(repo_id, test_api, in_out_pairs, local_model_hub=None, warm_up=1, num_trials=3, num_beams=1, low_bit='sym_int4', cpu_embedding=False, batch_size=1, streaming=False, use_fp16_torch_dtype=False, lookahead=False, task='continuation', optimize_model=False, transpose_value_cache=True, group_size=64):
+    global BenchmarkWrapper
+    if profile_dir:
+        from ipex_llm.utils.benchmark_util import BenchmarkWrapper as _BenchmarkWrapper
+        run_profile_dir = os.path.join(profile_dir, test_api, repo_id.replace('/', '--'), f'batch_{batch_size}')
+        BenchmarkWrapper = functools.partial(_BenchmarkWrapper, profile_dir=run_profile_dir, profile_layers=profile_layers)
     # TODO: make a parameter
     result= {}
     if test_api == 'transformer_int4':
@@ -2314,6 +2323,10 @@ if __name__ == '__main__':
     transpose_value_cache = True
     if 'transpose_value_cache' in conf:
         transpose_value_cache = conf['transpose_value_cache']
+    if 'profile_dir' in conf:
+        profile_dir = conf['profile_dir']
+    if 'profile_layers' in conf:
+        profile_layers = conf['profile_layers']
     
     import pandas as pd
     for api in conf.test_api:
@@ -0,0 +1,94 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the cold import time of ipex_llm, the slowest imported modules, and which
+# `ipex_llm.transformers.models` modules are imported when converting a model.
+
+import argparse
+import statistics
+import subprocess
+import sys
+
+
+IMPORT_CODE = """
+import time
+st = time.perf_counter()
+import {module}
+print(time.perf_counter() - st)
+"""
+
+CONVERT_CODE = """
+import sys
+import time
+from transformers import AutoConfig, AutoModelForCausalLM
+from ipex_llm import optimize_model
+config = AutoConfig.for_model("{model_type}", num_hidden_layers=2, hidden_size=256,
+                              intermediate_size=512, num_attention_heads=4,
+                              num_key_value_heads=4, vocab_size=1024)
+model = AutoModelForCausalLM.from_config(config)
+before = set(sys.modules)
+st = time.perf_counter()
+optimize_model(model, low_bit="sym_int4")
+print(time.perf_counter() - st)
+print(" ".join(sorted(m for m in set(sys.modules) - before
+                      if m.startswith("ipex_llm.transformers.models."))))
+"""
+
+
+def run(code):
+    return subprocess.run([sys.executable, "-c", code], check=True,
+                          capture_output=True, text=True).stdout.splitlines()
+
+
+def slowest_imports(module, top):
+    # `-X importtime` reports `self | cumulative | name` in us on stderr
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            check=True, capture_output=True, text=True).stderr
+    records = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        records.append((int(cumulative_us), int(self_us), name.rstrip()))
+    return sorted(records, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ipex_llm import time benchmark")
+    parser.add_argument("--module", type=str, default="ipex_llm.transformers")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15,
+                        help="Number of slowest imports to print")
+    parser.add_argument("--model-types", type=str, nargs="*", default=["llama", "qwen2"],
+                        help="Randomly initialized tiny models of these types are converted")
+    args = parser.parse_args()
+
+    times = [float(run(IMPORT_CODE.format(module=args.module))[-1])
+             for _ in range(args.repeat)]
+    print(f"import {args.module}: median {statistics.median(times):.3f}s, "
+          f"min {min(times):.3f}s over {args.repeat} runs")
+
+    print(f"\n{'cumulative (ms)':>16} {'self (ms)':>10}  module")
+    for cumulative_us, self_us, name in slowest_imports(args.module, args.top):
+        print(f"{cumulative_us / 1000:>16.1f} {self_us / 1000:>10.1f}  {name}")
+
+    for model_type in args.model_types:
+        lines = run(CONVERT_CODE.format(model_type=model_type))
+        print(f"\nconvert {model_type}: {float(lines[-2]):.3f}s, imported: {lines[-1]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare memory and latency of `DynamicPagedCache` with the growth strategy of
+# `DynamicNormalCache` by replaying the kv cache updates of a generation.
+
+import argparse
+import multiprocessing
+import resource
+import time
+import torch
+
+
+def peak_memory_mb(device):
+    if device == "xpu":
+        return torch.xpu.max_memory_allocated() / 1024 ** 2
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def replay(args, cache_name, queue):
+    from ipex_llm.transformers.kv import DynamicNormalCache, DynamicPagedCache
+    cache_cls = {"normal": DynamicNormalCache, "paged": DynamicPagedCache}[cache_name]
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+    torch.manual_seed(0)
+    shape = (args.batch_size, args.num_heads, 1, args.head_dim)
+    # one query per step, the attention reads the whole cache like a real decoder does
+    query = torch.randn(shape, dtype=dtype, device=device)
+    base_memory = peak_memory_mb(args.device)
+
+    latency = []
+    for _ in range(args.num_requests):
+        cache = cache_cls()
+        prompt = torch.randn((args.batch_size, args.num_heads, args.in_len, args.head_dim),
+                             dtype=dtype, device=device)
+        token = torch.randn(shape, dtype=dtype, device=device)
+        for layer_idx in range(args.num_layers):
+            cache.update(prompt, prompt, layer_idx)
+        for _ in range(args.out_len):
+            st = time.perf_counter()
+            for layer_idx in range(args.num_layers):
+                if cache_name == "paged":
+                    # like the optimized forwards, attend to the blocks in place
+                    cache.write(token, token, layer_idx)
+                    cache.attention(query, layer_idx)
+                else:
+                    k, v = cache.update(token, token, layer_idx)
+                    torch.matmul(torch.matmul(query, k.transpose(2, 3)).softmax(-1), v)
+            if args.device == "xpu":
+                torch.xpu.synchronize()
+            latency.append(time.perf_counter() - st)
+        del cache
+    queue.put((sum(latency) / len(latency) * 1000, peak_memory_mb(args.device) - base_memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Paged kv cache benchmark")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--dtype", type=str, default="float16")
+    parser.add_argument("--num-layers", type=int, default=32)
+    parser.add_argument("--num-heads", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--in-len", type=int, default=1024)
+    parser.add_argument("--out-len", type=int, default=2048)
+    parser.add_argument("--num-requests", type=int, default=2,
+                        help="Requests run one after another, the paged cache reuses blocks")
+    args = parser.parse_args()
+
+    # run every strategy in its own process so that peak memory is not shared
+    ctx = multiprocessing.get_context("spawn")
+    print(f"{'cache':>8} {'latency/token (ms)':>20} {'peak memory (MB)':>18}")
+    for cache_name in ["normal", "paged"]:
+        queue = ctx.Queue()
+        p = ctx.Process(target=replay, args=(args, cache_name, queue))
+        p.start()
+        latency, memory = queue.get()
+        p.join()
+        print(f"{cache_name:>8} {latency:>20.3f} {memory:>18.1f}")
+
+
+if __name__ == "__main__":
+    main()
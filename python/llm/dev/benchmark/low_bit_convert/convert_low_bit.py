@@ -0,0 +1,93 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare wall time and peak RSS of `from_pretrained(load_in_low_bit=...)` with the
+# default conversion and the streaming conversion.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def convert(model_path, low_bit, streaming, num_threads, queue):
+    os.environ["IPEX_LLM_QUANTIZE_THREADS"] = str(num_threads)
+    import torch
+    from ipex_llm.transformers import AutoModelForCausalLM
+    base_rss = peak_rss_mb()
+    st = time.perf_counter()
+    model = AutoModelForCausalLM.from_pretrained(model_path,
+                                                 load_in_low_bit=low_bit,
+                                                 streaming_convert=streaming,
+                                                 trust_remote_code=True)
+    convert_time = time.perf_counter() - st
+    with torch.inference_mode():
+        logits = model(torch.tensor([[1, 2, 3, 4]])).logits
+    queue.put((convert_time, peak_rss_mb() - base_rss, logits.float()))
+
+
+def save(save_dir):
+    from transformers import LlamaConfig, LlamaForCausalLM
+    config = LlamaConfig(num_hidden_layers=8, hidden_size=2048, intermediate_size=5504,
+                         num_attention_heads=16, vocab_size=32000)
+    LlamaForCausalLM(config).save_pretrained(save_dir, max_shard_size="500MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Low-bit conversion benchmark")
+    parser.add_argument("--model-path", type=str, default=None,
+                        help="Original model, a randomly initialized llama is used if not set")
+    parser.add_argument("--low-bit", type=str, default="sym_int4")
+    parser.add_argument("--num-threads", type=int, default=min(8, os.cpu_count() or 1),
+                        help="Quantization threads of the streaming conversion")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        ctx = multiprocessing.get_context("spawn")
+        model_path = args.model_path
+        if model_path is None:
+            model_path = os.path.join(tempdir, "origin")
+            p = ctx.Process(target=save, args=(model_path,))
+            p.start()
+            p.join()
+
+        # every conversion runs in its own process so that peak RSS is not shared
+        print(f"{'mode':>10} {'threads':>8} {'time (s)':>10} {'peak RSS (MB)':>14}")
+        results = {}
+        for mode, streaming, num_threads in [("default", False, 1),
+                                             ("streaming", True, 1),
+                                             ("streaming", True, args.num_threads)]:
+            queue = ctx.Queue()
+            p = ctx.Process(target=convert,
+                            args=(model_path, args.low_bit, streaming, num_threads, queue))
+            p.start()
+            convert_time, peak_rss, logits = queue.get()
+            p.join()
+            results.setdefault(mode, logits)
+            print(f"{mode:>10} {num_threads:>8} {convert_time:>10.2f} {peak_rss:>14.1f}")
+        diff = (results["default"] - results["streaming"]).abs().max().item()
+        print(f"max logits difference: {diff:.6f}")
+
+
+if __name__ == "__main__":
+    main()
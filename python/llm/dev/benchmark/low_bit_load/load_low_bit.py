@@ -0,0 +1,94 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare cold-start time and peak RSS of `load_low_bit` for the pickled
+# checkpoint and the memory mapped low-bit safetensors checkpoint.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load(path, queue):
+    import torch
+    from ipex_llm.transformers import AutoModelForCausalLM
+    base_rss = peak_rss_mb()
+    st = time.perf_counter()
+    model = AutoModelForCausalLM.load_low_bit(path, trust_remote_code=True)
+    load_time = time.perf_counter() - st
+    load_rss = peak_rss_mb() - base_rss
+    # the first forward touches every weight, i.e. reads the mapped pages
+    with torch.inference_mode():
+        model(torch.tensor([[1, 2, 3, 4]]))
+    first_token_time = time.perf_counter() - st
+    queue.put((load_time, first_token_time, load_rss, peak_rss_mb() - base_rss))
+
+
+def save(args, save_dir):
+    from ipex_llm.transformers import AutoModelForCausalLM
+    model_path = args.model_path
+    if model_path is None:
+        from transformers import LlamaConfig, LlamaForCausalLM
+        config = LlamaConfig(num_hidden_layers=8, hidden_size=2048, intermediate_size=5504,
+                             num_attention_heads=16, vocab_size=32000)
+        model_path = os.path.join(save_dir, "origin")
+        LlamaForCausalLM(config).save_pretrained(model_path)
+    model = AutoModelForCausalLM.from_pretrained(model_path,
+                                                 load_in_low_bit=args.low_bit,
+                                                 trust_remote_code=True)
+    model.save_low_bit(os.path.join(save_dir, "pickle"))
+    model.save_low_bit(os.path.join(save_dir, "mmap"), safe_serialization=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Low-bit checkpoint loading benchmark")
+    parser.add_argument("--model-path", type=str, default=None,
+                        help="Original model, a randomly initialized llama is used if not set")
+    parser.add_argument("--low-bit", type=str, default="sym_int4")
+    parser.add_argument("--save-dir", type=str, default=None,
+                        help="Where to save the checkpoints, a temporary directory by default")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        save_dir = args.save_dir or tempdir
+        ctx = multiprocessing.get_context("spawn")
+        p = ctx.Process(target=save, args=(args, save_dir))
+        p.start()
+        p.join()
+
+        # every load runs in its own process so that peak RSS is not shared
+        print(f"{'format':>8} {'load (s)':>10} {'first forward (s)':>18} "
+              f"{'load RSS (MB)':>14} {'peak RSS (MB)':>14}")
+        for fmt in ["pickle", "mmap"]:
+            queue = ctx.Queue()
+            p = ctx.Process(target=load, args=(os.path.join(save_dir, fmt), queue))
+            p.start()
+            load_time, first_token_time, load_rss, peak_rss = queue.get()
+            p.join()
+            print(f"{fmt:>8} {load_time:>10.2f} {first_token_time:>18.2f} "
+                  f"{load_rss:>14.1f} {peak_rss:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
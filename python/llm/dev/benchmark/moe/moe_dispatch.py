@@ -0,0 +1,125 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare the per-expert loop of a low-bit mixtral MoE block on CPU, which runs
+# `torch.where` and gathers / scatters once per expert, with the grouped dispatch
+# of `moe_group_forward`, which sorts the tokens by expert once per layer.
+
+import argparse
+import os
+import time
+import types
+
+import torch
+
+
+def expert_loop_forward(self, hidden_states, routing_weights, selected_experts):
+    # the loop used by `mixtral_moeblock_forward` before the grouped dispatch
+    final_hidden_states = torch.zeros_like(hidden_states)
+    expert_mask = torch.nn.functional.one_hot(selected_experts,
+                                              num_classes=self.num_experts).permute(2, 1, 0)
+    for expert_idx in range(self.num_experts):
+        idx, top_x = torch.where(expert_mask[expert_idx])
+        if top_x.shape[0] == 0:
+            continue
+        top_x_list = top_x.tolist()
+        idx_list = idx.tolist()
+        current_state = hidden_states[None, top_x_list].reshape(-1, hidden_states.size(-1))
+        current_hidden_states = self.experts[expert_idx](
+            current_state, routing_weights[top_x_list, idx_list, None])
+        final_hidden_states.index_add_(0, top_x, current_hidden_states)
+    return final_hidden_states
+
+
+def build_block(args):
+    from transformers import MixtralConfig
+    from transformers.models.mixtral.modeling_mixtral import MixtralSparseMoeBlock
+    from ipex_llm.ggml.quantize import ggml_tensor_qtype
+    from ipex_llm.transformers.convert import ggml_convert_low_bit
+    from ipex_llm.transformers.models.mixtral import mixtral_mlp_forward
+
+    torch.manual_seed(0)
+    config = MixtralConfig(hidden_size=args.hidden_size, intermediate_size=args.intermediate_size,
+                           num_local_experts=args.num_experts, num_experts_per_tok=args.top_k)
+    block = MixtralSparseMoeBlock(config).eval()
+    block = ggml_convert_low_bit(block, ggml_tensor_qtype[args.low_bit], optimize_model=False)
+    for expert in block.experts:
+        expert.forward = types.MethodType(mixtral_mlp_forward, expert)
+    return block
+
+
+def route(block, hidden_states):
+    router_logits = block.gate(hidden_states)
+    routing_weights = torch.softmax(router_logits, dim=1, dtype=torch.float)
+    routing_weights, selected_experts = torch.topk(routing_weights, block.top_k, dim=-1)
+    routing_weights /= routing_weights.sum(dim=-1, keepdim=True)
+    return routing_weights.to(hidden_states.dtype), selected_experts
+
+
+def tokens_per_second(block, dispatch, num_tokens, num_layers, warmup=2, repeat=5):
+    hidden_states = torch.randn(num_tokens, block.hidden_dim)
+    routing_weights, selected_experts = route(block, hidden_states)
+    latency = []
+    with torch.no_grad():
+        for i in range(warmup + repeat):
+            st = time.perf_counter()
+            # the same block stands for every layer of the model
+            for _ in range(num_layers):
+                dispatch(block, hidden_states, routing_weights, selected_experts)
+            if i >= warmup:
+                latency.append(time.perf_counter() - st)
+    return num_tokens / (sum(latency) / len(latency))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MoE token dispatch benchmark on CPU")
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--intermediate-size", type=int, default=3584)
+    parser.add_argument("--num-experts", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=2)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--low-bit", type=str, default="sym_int4")
+    parser.add_argument("--prefill-len", type=int, nargs="+", default=[128, 512, 2048])
+    parser.add_argument("--decode-batch", type=int, nargs="+", default=[2, 8, 32])
+    parser.add_argument("--num-workers", type=int, default=4,
+                        help="Threads running experts concurrently for `grouped+workers`")
+    args = parser.parse_args()
+
+    from ipex_llm.transformers.models.common import moe_group_forward
+
+    def grouped(block, hidden_states, routing_weights, selected_experts):
+        return moe_group_forward(block.experts, hidden_states, routing_weights,
+                                 selected_experts, expert_takes_weights=True)
+
+    block = build_block(args)
+    dispatches = [("loop", expert_loop_forward, "0"),
+                  ("grouped", grouped, "0"),
+                  ("grouped+workers", grouped, str(args.num_workers))]
+    shapes = [("prefill", num_tokens) for num_tokens in args.prefill_len] + \
+        [("decode", batch_size) for batch_size in args.decode_batch]
+
+    print(f"{'phase':>8} {'tokens':>7} " + " ".join(f"{name:>16}" for name, _, _ in dispatches)
+          + "   (tokens/s)")
+    for phase, num_tokens in shapes:
+        results = []
+        for _, dispatch, num_workers in dispatches:
+            os.environ["IPEX_LLM_MOE_NUM_WORKERS"] = num_workers
+            results.append(tokens_per_second(block, dispatch, num_tokens, args.num_layers))
+        print(f"{phase:>8} {num_tokens:>7} " + " ".join(f"{r:>16.1f}" for r in results))
+
+
+if __name__ == "__main__":
+    main()
@@ -17,13 +17,164 @@
 # https://github.com/insuhan/hyper-attn/blob/main/benchmark_patch_llm.py
 #
 
+import math
+from typing import List, Optional, Tuple
+
 import numpy as np
 import torch
-from torch.nn import CrossEntropyLoss
+from torch.nn import functional as F
 from tqdm import tqdm
 import gc
 
 from ipex_llm.transformers import AutoModelForCausalLM, AutoModel
+from ipex_llm.utils.common import invalidInputError
+
+
+# these models post-process the output of `lm_head`, their logits are computed
+# by the model forward and only the loss is chunked
+FULL_LOGITS_MODEL_TYPES = {"chatglm", "cohere", "minicpm", "minicpm3"}
+
+
+def find_lm_head(model):
+    lm_head = model.get_output_embeddings()
+    if lm_head is None:
+        # e.g. chatglm keeps its lm_head in `transformer.output_layer`
+        lm_head = getattr(getattr(model, "transformer", None), "output_layer", None)
+    return lm_head
+
+
+class PerplexityEngine:
+    """
+    Compute the negative log-likelihood of tokenized sequences.
+
+    Sequences are sorted by length and evaluated in right padded batches of at most
+    `max_batch_tokens` tokens, padding included. With causal attention no real token
+    attends to the padding after it, so no attention mask is needed. The logits are
+    computed `logits_chunk_size` positions at a time from the last hidden states, so
+    the `[seq_len, vocab_size]` logits of a sequence are never materialized.
+
+    Sequences longer than `max_length` are evaluated by a window of `max_length`
+    tokens sliding `stride` tokens at a time. Each window only scores the tokens no
+    previous window scored, with the tokens before them as context.
+    """
+    def __init__(self, model, device, max_length: Optional[int] = None,
+                 stride: Optional[int] = None, max_batch_tokens: int = 8192,
+                 logits_chunk_size: int = 512):
+        self.model = model
+        self.device = device
+        self.max_length = max_length
+        self.stride = stride or max_length
+        invalidInputError(max_length is None or 0 < self.stride <= max_length,
+                          f"stride should be in (0, {max_length}], but got {stride}.")
+        self.max_batch_tokens = max_batch_tokens
+        self.logits_chunk_size = logits_chunk_size
+
+        self.base_model, self.lm_head = None, None
+        model_type = getattr(model.config, "model_type", None)
+        if model_type not in FULL_LOGITS_MODEL_TYPES:
+            base_model = getattr(model, "base_model", model)
+            lm_head = find_lm_head(model)
+            if base_model is not model and lm_head is not None:
+                self.base_model, self.lm_head = base_model, lm_head
+        self.softcapping = getattr(model.config, "final_logit_softcapping", None)
+
+    def windows(self, seq_len: int) -> List[Tuple[int, int, int]]:
+        """Split a sequence into `(begin, end, first scored token)` windows."""
+        if self.max_length is None or seq_len <= self.max_length:
+            return [(0, seq_len, 1)]
+        windows = []
+        begin, prev_end = 0, 0
+        while True:
+            end = min(begin + self.max_length, seq_len)
+            windows.append((begin, end, max(prev_end, begin + 1)))
+            if end == seq_len:
+                return windows
+            prev_end = end
+            begin += self.stride
+
+    def _logits(self, hidden_states):
+        logits = self.lm_head(hidden_states).float()
+        if self.softcapping is not None:
+            logits = torch.tanh(logits / self.softcapping) * self.softcapping
+        return logits
+
+    def _forward(self, input_ids, first):
+        # returns the nll of predicting input_ids[:, 1:], positions before `first`
+        # of all rows are never scored and their logits are skipped
+        batch_size, seq_len = input_ids.shape
+        nll = torch.zeros(batch_size, seq_len - 1, dtype=torch.float32, device=input_ids.device)
+        if self.lm_head is None:
+            logits = self.model(input_ids).logits
+        else:
+            logits = None
+            hidden_states = self.base_model(input_ids, use_cache=False)[0]
+        for i in range(first - 1, seq_len - 1, self.logits_chunk_size):
+            j = min(i + self.logits_chunk_size, seq_len - 1)
+            if logits is None:
+                chunk_logits = self._logits(hidden_states[:, i:j])
+            else:
+                chunk_logits = logits[:, i:j].float()
+            nll[:, i:j] = F.cross_entropy(chunk_logits.flatten(0, 1),
+                                          input_ids[:, i + 1:j + 1].flatten(),
+                                          reduction="none").view(batch_size, -1)
+            del chunk_logits
+        return nll
+
+    def _batches(self, rows):
+        rows = sorted(rows, key=lambda row: row[2] - row[1])
+        batch = []
+        for row in rows:
+            # rows are sorted, the last one of a batch is the longest
+            if len(batch) > 0 and \
+                    (len(batch) + 1) * (row[2] - row[1]) > self.max_batch_tokens:
+                yield batch
+                batch = []
+            batch.append(row)
+        if len(batch) > 0:
+            yield batch
+
+    @torch.no_grad()
+    def evaluate(self, sequences: List[torch.Tensor],
+                 pad_token_id: int = 0) -> List[Tuple[float, int]]:
+        """Return the summed nll and number of scored tokens of each sequence."""
+        sequences = [seq.view(-1) for seq in sequences]
+        rows = [(idx, begin, end, first)
+                for idx, seq in enumerate(sequences)
+                for begin, end, first in self.windows(seq.size(0))]
+        nll_sums = [0.0] * len(sequences)
+        num_tokens = [0] * len(sequences)
+
+        lm_head = find_lm_head(self.model)
+        optimize_lm_head = getattr(lm_head, "optimize_lm_head", False)
+        if optimize_lm_head:
+            # the last lm_head optimization only keeps the logits of the last token
+            lm_head.optimize_lm_head = False
+        try:
+            pbar = tqdm(list(self._batches(rows)))
+            for batch in pbar:
+                seq_len = batch[-1][2] - batch[-1][1]
+                input_ids = torch.full((len(batch), seq_len), pad_token_id, dtype=torch.long)
+                for i, (idx, begin, end, _) in enumerate(batch):
+                    input_ids[i, :end - begin] = sequences[idx][begin:end]
+                first = min(first - begin for _, begin, _, first in batch)
+                nll = self._forward(input_ids.to(self.device), first).cpu()
+                for i, (idx, begin, end, first) in enumerate(batch):
+                    nll_sums[idx] += nll[i, first - begin - 1:end - begin - 1].sum().item()
+                    num_tokens[idx] += end - first
+                total = sum(nll_sums) / max(sum(num_tokens), 1)
+                pbar.set_description(f"ppl: {math.exp(total):.4f}")
+                del input_ids, nll
+        finally:
+            if optimize_lm_head:
+                lm_head.optimize_lm_head = True
+        return list(zip(nll_sums, num_tokens))
+
+    def perplexity(self, sequences: List[torch.Tensor]) -> float:
+        """Return the perplexity of all scored tokens of the sequences."""
+        results = self.evaluate(sequences)
+        return math.exp(sum(nll for nll, _ in results) /
+                        sum(num_tokens for _, num_tokens in results))
+
 
 class BigDLPPL:
     def __init__(self, model_path, device, **model_kwargs) -> None:
@@ -38,49 +189,30 @@ class BigDLPPL:
         self.model.to(device)
 
 
-    def perplexity_hf(self, encoded_texts):
+    def perplexity_hf(self, encoded_texts, max_length=None, stride=None,
+                      max_batch_tokens=8192, logits_chunk_size=512):
         self.model.eval()
-        loss_fct = CrossEntropyLoss(reduction="none")
-        ppls = []
+        engine = PerplexityEngine(self.model, self.device, max_length=max_length, stride=stride,
+                                  max_batch_tokens=max_batch_tokens,
+                                  logits_chunk_size=logits_chunk_size)
+        sequences = []
+        for encoded in encoded_texts:
+            if isinstance(encoded, dict):
+                encoded = encoded['input_ids']
+            sequences.append(encoded)
 
         try:
-            pbar = tqdm(range(len(encoded_texts)))
-            for bid in pbar:
-                encoded_batch = encoded_texts[bid:bid+1]
-                if type(encoded_batch) == dict:
-                    attn_mask = encoded_batch['attention_mask'] if 'attention_mask' in encoded_batch.keys() else None
-                    encoded_batch = encoded_batch['input_ids']
-                elif type(encoded_batch) == list:
-                    encoded_batch = encoded_batch[0]
-                
-                encoded_batch = encoded_batch.to(self.device)
-                attn_mask = torch.ones_like(encoded_batch)
-
-                out_logits = self.model(encoded_batch).logits
-
-                labels = encoded_batch
-
-                shift_logits = out_logits[..., :-1, :].contiguous()
-                shift_labels = labels[..., 1:].contiguous()
-                shift_attention_mask_batch = attn_mask[..., 1:].contiguous()
-
-                loss_ = loss_fct(shift_logits.transpose(1, 2), shift_labels).float()
-                perplexity_batch = torch.exp2(
-                    (loss_ * shift_attention_mask_batch).sum(1)
-                    / shift_attention_mask_batch.sum(1)
-                )
-                ppls += perplexity_batch.tolist()
-
-                pbar.set_description(f"[{bid:<4}/{len(encoded_texts)}] avg_ppls: {np.mean(np.array(ppls)[~np.isnan(np.array(ppls))]):.4f}")
-                
-                del out_logits, encoded_batch, attn_mask, shift_logits, shift_labels, shift_attention_mask_batch, perplexity_batch
-
-            ppl_mean = np.mean(np.array(ppls)[~np.isnan(np.array(ppls))])
+            results = engine.evaluate(sequences)
+            # keep the per-sequence average of exp2(mean nll) reported so far,
+            # so that results stay comparable with previous runs
+            ppls = np.array([2 ** (nll / num_tokens) for nll, num_tokens in results
+                             if num_tokens > 0])
+            ppl_mean = np.mean(ppls[~np.isnan(ppls)])
         finally:
             if self.device == "xpu":
                 torch.xpu.synchronize()
                 torch.xpu.empty_cache()
             del self.model
             gc.collect()
-        
-        return ppl_mean
\ No newline at end of file
+
+        return ppl_mean
@@ -32,6 +32,14 @@ import json
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument("--seq_len", type=int, default=512)
+    parser.add_argument("--max_length", type=int, default=None,
+                        help="evaluate longer sequences with a sliding window of max_length tokens")
+    parser.add_argument("--stride", type=int, default=None,
+                        help="number of tokens the sliding window moves, max_length by default")
+    parser.add_argument("--max_batch_tokens", type=int, default=8192,
+                        help="max number of tokens (padding included) of a batch")
+    parser.add_argument("--logits_chunk_size", type=int, default=512,
+                        help="number of positions whose logits are computed at once")
     parser.add_argument("--model_path", required=True, type=str)
     parser.add_argument("--datasets", required=False, type=str, default=None, nargs='*')
     parser.add_argument("--dataset_path", required=False, type=str, default=None)
@@ -97,10 +105,13 @@ def main():
         os.makedirs(log_dir, exist_ok=True)
         results = {}
         ppl_evaluator = BigDLPPL(model_path=args.model_path, device=args.device, mixed_precision=args.mixed_precision, **model_kwargs)
-        ppl = ppl_evaluator.perplexity_hf(encoded_texts)
+        ppl = ppl_evaluator.perplexity_hf(encoded_texts, max_length=args.max_length,
+                                          stride=args.stride,
+                                          max_batch_tokens=args.max_batch_tokens,
+                                          logits_chunk_size=args.logits_chunk_size)
         summary[precision] = ppl
         results['results'] = ppl
-        results['config'] = {"model": model_name, "precision": precision, "mixed_precision": args.mixed_precision, "device": args.device, "seq_len": args.seq_len, "language": args.language }
+        results['config'] = {"model": model_name, "precision": precision, "mixed_precision": args.mixed_precision, "device": args.device, "seq_len": args.seq_len, "language": args.language, "max_length": args.max_length, "stride": args.stride }
         dumped = json.dumps(results, indent=2)
         print(dumped)
 
@@ -0,0 +1,147 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the step time and peak RSS of CPU QLoRA training on a small random llama
+# with `LoraLowBitLinear`, using the tile-wise dequantization of `MatMulLowBitCPU`
+# or the previous one which dequantizes every whole weight in forward and backward.
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import torch
+
+
+class WholeWeightMatMul(torch.autograd.Function):
+    # `MatMulLowBitCPU` before the tile-wise dequantization
+
+    @staticmethod
+    def forward(ctx, A, weight):
+        from ipex_llm.transformers.low_bit_linear import ggml_int4_convert_fp32
+        x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
+                                         weight._shape[0] * weight._shape[1])
+        ctx.tensors = (A, weight)
+        return torch.matmul(A, x0_fp32.T)
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        from ipex_llm.transformers.low_bit_linear import ggml_int4_convert_fp32
+        A, weight = ctx.tensors
+        x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
+                                         weight._shape[0] * weight._shape[1])
+        return torch.matmul(grad_output, x0_fp32.to(grad_output.dtype)), None
+
+
+def reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM on Linux
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def train(args, model_path, mode, queue):
+    import ipex_llm.transformers.low_bit_linear as low_bit_linear
+    from ipex_llm.transformers import AutoModelForCausalLM
+    from ipex_llm.transformers.qlora import get_peft_model, prepare_model_for_kbit_training, \
+        LoraConfig
+
+    if mode == "whole":
+        low_bit_linear.MatMulLowBitCPU = WholeWeightMatMul
+    model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit="sym_int4",
+                                                 optimize_model=False,
+                                                 torch_dtype=torch.bfloat16,
+                                                 modules_to_not_convert=["lm_head"])
+    model = prepare_model_for_kbit_training(model, use_gradient_checkpointing=False)
+    model.enable_input_require_grads()
+    config = LoraConfig(r=8, lora_alpha=32, lora_dropout=0.05, bias="none",
+                        target_modules=["q_proj", "k_proj", "v_proj", "o_proj",
+                                        "gate_proj", "up_proj", "down_proj"],
+                        task_type="CAUSAL_LM")
+    model = get_peft_model(model, config)
+    model.train()
+    optimizer = torch.optim.AdamW([p for p in model.parameters() if p.requires_grad], lr=1e-4)
+
+    torch.manual_seed(0)
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, args.seq_len))
+    has_hwm = reset_peak_rss()
+    base_memory = 0 if has_hwm else peak_rss_mb()
+    step_time = []
+    for step in range(args.warmup + args.steps):
+        st = time.perf_counter()
+        with torch.autocast("cpu", dtype=torch.bfloat16, enabled=args.bf16):
+            loss = model(input_ids=input_ids, labels=input_ids).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad()
+        if step >= args.warmup:
+            step_time.append(time.perf_counter() - st)
+    queue.put((sum(step_time) / len(step_time), peak_rss_mb() - base_memory))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CPU QLoRA step benchmark")
+    parser.add_argument("--hidden-size", type=int, default=2048)
+    parser.add_argument("--intermediate-size", type=int, default=5632)
+    parser.add_argument("--num-layers", type=int, default=4)
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=256)
+    parser.add_argument("--steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--bf16", action="store_true",
+                        help="Train with cpu autocast, bf16 matmuls use AMX / AVX512-BF16")
+    args = parser.parse_args()
+
+    from transformers import LlamaConfig, LlamaForCausalLM
+    config = LlamaConfig(hidden_size=args.hidden_size, intermediate_size=args.intermediate_size,
+                         num_hidden_layers=args.num_layers, vocab_size=args.vocab_size,
+                         num_attention_heads=args.hidden_size // 128,
+                         num_key_value_heads=args.hidden_size // 128)
+    with tempfile.TemporaryDirectory() as model_path:
+        LlamaForCausalLM(config).save_pretrained(model_path)
+
+        # run every mode in its own process so that peak memory is not shared
+        ctx = multiprocessing.get_context("spawn")
+        print(f"{'dequantize':>10} {'step time (s)':>14} {'peak RSS during steps (MB)':>27}")
+        for mode in ["whole", "tiled"]:
+            queue = ctx.Queue()
+            p = ctx.Process(target=train, args=(args, model_path, mode, queue))
+            p.start()
+            step_time, memory = queue.get()
+            p.join()
+            print(f"{mode:>10} {step_time:>14.3f} {memory:>27.1f}")
+
+
+if __name__ == "__main__":
+    main()
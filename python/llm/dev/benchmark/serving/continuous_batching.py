@@ -0,0 +1,100 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Compare the throughput of the continuous batching scheduler with one `generate`
+# per request as the number of concurrent clients grows.
+
+import argparse
+import time
+import torch
+from ipex_llm.transformers.continuous_batching import ContinuousBatchScheduler, Sequence
+
+
+def load_model(model_path, low_bit, device):
+    if model_path is None:
+        # a tiny random llama, useful to check the scheduler overhead
+        from transformers import LlamaConfig, LlamaForCausalLM
+        config = LlamaConfig(vocab_size=32000, hidden_size=256, intermediate_size=688,
+                             num_hidden_layers=4, num_attention_heads=8,
+                             pad_token_id=0, eos_token_id=None)
+        return LlamaForCausalLM(config).eval().to(device)
+    from ipex_llm.transformers import AutoModelForCausalLM
+    model = AutoModelForCausalLM.from_pretrained(model_path, load_in_low_bit=low_bit,
+                                                 optimize_model=True, trust_remote_code=True,
+                                                 use_cache=True)
+    return model.eval().to(device)
+
+
+def make_prompts(num_clients, in_len, vocab_size):
+    torch.manual_seed(42)
+    # vary prompt lengths so that sequences are left padded inside the batch
+    return [torch.randint(3, vocab_size, (in_len - i % 8,)).tolist()
+            for i in range(num_clients)]
+
+
+@torch.no_grad()
+def run_generate(model, prompts, out_len):
+    for prompt in prompts:
+        model.generate(torch.tensor([prompt], device=model.device), do_sample=False,
+                       max_new_tokens=out_len, min_new_tokens=out_len)
+
+
+@torch.no_grad()
+def run_scheduler(model, prompts, out_len, max_num_seqs):
+    scheduler = ContinuousBatchScheduler(model, max_num_seqs=max_num_seqs)
+    for i, prompt in enumerate(prompts):
+        scheduler.add_sequence(Sequence(str(i), prompt, max_new_tokens=out_len))
+    while scheduler.has_unfinished_sequences():
+        scheduler.step()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Continuous batching throughput benchmark")
+    parser.add_argument("--model-path", type=str, default=None,
+                        help="Model to benchmark, a tiny random llama is used if not set")
+    parser.add_argument("--low-bit", type=str, default="sym_int4")
+    parser.add_argument("--device", type=str, default="cpu")
+    parser.add_argument("--in-len", type=int, default=128)
+    parser.add_argument("--out-len", type=int, default=64)
+    parser.add_argument("--max-num-seqs", type=int, default=16)
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    model = load_model(args.model_path, args.low_bit, args.device)
+    vocab_size = model.config.vocab_size
+
+    # warm up
+    run_scheduler(model, make_prompts(2, args.in_len, vocab_size), 4, args.max_num_seqs)
+
+    print(f"{'clients':>8} {'generate tok/s':>16} {'batched tok/s':>16} {'speedup':>8}")
+    for num_clients in args.clients:
+        prompts = make_prompts(num_clients, args.in_len, vocab_size)
+        num_tokens = num_clients * args.out_len
+
+        st = time.perf_counter()
+        run_generate(model, prompts, args.out_len)
+        generate_tps = num_tokens / (time.perf_counter() - st)
+
+        st = time.perf_counter()
+        run_scheduler(model, prompts, args.out_len, args.max_num_seqs)
+        batched_tps = num_tokens / (time.perf_counter() - st)
+
+        print(f"{num_clients:>8} {generate_tps:>16.2f} {batched_tps:>16.2f} "
+              f"{batched_tps / generate_tps:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Benchmark pipeline parallel serving (PPModelWorker) on CPU with the gloo backend:
+# the cost of sending the batch header to the other ranks every step, and the
+# throughput of serving a set of requests end to end.
+
+import argparse
+import asyncio
+import os
+import socket
+import tempfile
+import time
+from types import SimpleNamespace
+
+import torch
+import torch.distributed as dist
+
+
+def save_tiny_llama(path):
+    # a random llama, useful to check the scheduler overhead
+    from transformers import LlamaConfig, LlamaForCausalLM
+    torch.manual_seed(0)
+    config = LlamaConfig(vocab_size=32000, hidden_size=256, intermediate_size=688,
+                         num_hidden_layers=4, num_attention_heads=8,
+                         pad_token_id=0, eos_token_id=None)
+    LlamaForCausalLM(config).save_pretrained(path)
+
+
+def word_tokenizer(vocab_size):
+    # "w2 w17 w5" is tokenized to [2, 17, 5]
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    vocab = {"<pad>": 0, "</s>": 1}
+    vocab.update({f"w{i}": i for i in range(2, vocab_size)})
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<pad>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>",
+                                   eos_token="</s>")
+
+
+def bench_header(max_num_seqs, iters):
+    from ipex_llm.transformers.pipeline_parallel import BatchTask, batch_header_size, \
+        encode_batch_header, decode_batch_header
+    batch = BatchTask(batch_id="batch_1", request_ids=[str(i) for i in range(max_num_seqs)],
+                      max_tokens=128, batch_size=max_num_seqs, input_len=1,
+                      prompt_lengths=list(range(max_num_seqs)), stopped=False,
+                      prefilled_index=max_num_seqs, partial_prefilling=0, seq_len=512,
+                      do_sample=[True] * max_num_seqs, temperature=[0.7] * max_num_seqs,
+                      top_k=[40] * max_num_seqs, top_p=[0.9] * max_num_seqs)
+    results = {}
+    for name in ["pickled", "tensor"]:
+        dist.barrier()
+        start = time.perf_counter()
+        for _ in range(iters):
+            if name == "pickled":
+                objects = [batch if dist.get_rank() == 0 else None]
+                dist.broadcast_object_list(objects, src=0)
+            else:
+                if dist.get_rank() == 0:
+                    header = encode_batch_header(batch, max_num_seqs, "cpu")
+                else:
+                    header = torch.empty(batch_header_size(max_num_seqs), dtype=torch.int64)
+                dist.broadcast(header, src=0)
+                decode_batch_header(header, max_num_seqs)
+        dist.barrier()
+        results[name] = (time.perf_counter() - start) / iters * 1e6
+    return results
+
+
+async def serve(worker, tokenizer, prompts, out_len):
+    from ipex_llm.serving.fastapi.tgi_protocol import Parameters
+    from ipex_llm.transformers import pipeline_parallel
+    result_dict = {}
+    if worker.rank > 0:
+        # rank 0 broadcasts an empty batch header once every request is finished
+        stopped = []
+        decode = pipeline_parallel.decode_batch_header
+
+        def decode_batch_header(header, max_num_seqs):
+            batch = decode(header, max_num_seqs)
+            stopped.append(batch is None)
+            return batch
+
+        pipeline_parallel.decode_batch_header = decode_batch_header
+        while len(stopped) == 0 or not stopped[-1]:
+            await worker.process_step(tokenizer, result_dict)
+        return 0
+
+    for i, prompt in enumerate(prompts):
+        parameters = Parameters(max_new_tokens=out_len, min_new_tokens=out_len)
+        await worker.waiting_requests.put((str(i), SimpleNamespace(inputs=prompt,
+                                                                   parameters=parameters)))
+    start = time.perf_counter()
+    while len(result_dict) < len(prompts):
+        await worker.process_step(tokenizer, result_dict)
+    elapsed = time.perf_counter() - start
+    from ipex_llm.transformers.pipeline_parallel import encode_batch_header
+    dist.broadcast(encode_batch_header(None, worker.max_num_seqs, worker.device), src=0)
+    return elapsed
+
+
+def run_rank(rank, args, port):
+    from ipex_llm.transformers import init_pipeline_parallel, PPModelWorker
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port),
+                       "RANK": str(rank), "WORLD_SIZE": str(args.world_size)})
+    init_pipeline_parallel("cpu", numa_binding=not args.no_numa_binding)
+
+    header = bench_header(args.max_num_seqs, args.header_iters)
+    worker = PPModelWorker(args.model_path, rank, args.world_size, args.low_bit,
+                           args.max_num_seqs, args.max_prefilled_seqs,
+                           torch_dtype=torch.float32)
+    tokenizer = word_tokenizer(worker.model.config.vocab_size)
+    torch.manual_seed(42)
+    # vary prompt lengths so that sequences are left padded inside the batch
+    prompts = [" ".join(f"w{t}" for t in torch.randint(2, worker.model.config.vocab_size,
+                                                         (args.in_len - i % 8,)).tolist())
+               for i in range(args.requests)]
+    elapsed = asyncio.run(serve(worker, tokenizer, prompts, args.out_len))
+    if rank == 0:
+        print(f"{'header':>10} {'us/step':>10}")
+        for name, cost in header.items():
+            print(f"{name:>10} {cost:>10.1f}")
+        print(f"{'requests':>10} {'ranks':>6} {'time (s)':>10} {'tok/s':>10}")
+        print(f"{args.requests:>10} {args.world_size:>6} {elapsed:>10.2f} "
+              f"{args.requests * args.out_len / elapsed:>10.2f}")
+    dist.destroy_process_group()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Pipeline parallel serving on CPU")
+    parser.add_argument("--model-path", type=str, default=None,
+                        help="a tiny random llama is used by default")
+    parser.add_argument("--low-bit", type=str, default="sym_int4")
+    parser.add_argument("--world-size", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=8)
+    parser.add_argument("--in-len", type=int, default=32)
+    parser.add_argument("--out-len", type=int, default=32)
+    parser.add_argument("--max-num-seqs", type=int, default=4)
+    parser.add_argument("--max-prefilled-seqs", type=int, default=0)
+    parser.add_argument("--header-iters", type=int, default=1000)
+    parser.add_argument("--no-numa-binding", action="store_true")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.model_path is None:
+            args.model_path = tmp_dir
+            save_tiny_llama(tmp_dir)
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        torch.multiprocessing.spawn(run_rank, args=(args, port), nprocs=args.world_size)
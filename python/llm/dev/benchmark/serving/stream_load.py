@@ -0,0 +1,150 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Measure the cpu usage of the FastAPI server and the inter-token latency seen by
+# clients with many concurrent streams. Tokens come from a synthetic worker which
+# emits one token for every running request at a fixed interval, like a batched
+# decoding step, so the numbers only reflect the serving overhead.
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import queue
+import threading
+import time
+
+import httpx
+import numpy as np
+
+
+def serve(port, token_interval):
+    import uvicorn
+    from ipex_llm.serving.fastapi import FastApp, ModelWorker
+    from ipex_llm.serving.fastapi.api_server import app
+
+    class SyntheticWorker(ModelWorker):
+        def __init__(self):
+            self.model_name = "synthetic"
+            self.waiting_requests = asyncio.Queue()
+            self.streamer = {}
+            self.new_requests = queue.Queue()
+            self.thread = threading.Thread(target=self.decode, daemon=True)
+            self.thread.start()
+
+        async def process_step(self, tokenizer, result_dict, processor=None):
+            request_id, request = await self.waiting_requests.get()
+            self.new_requests.put((self.get_channel(request_id),
+                                   request.parameters.max_new_tokens))
+
+        def decode(self):
+            running = []
+            while True:
+                if len(running) == 0:
+                    running.append(self.new_requests.get())
+                while not self.new_requests.empty():
+                    running.append(self.new_requests.get_nowait())
+                time.sleep(token_interval)
+                for i, (channel, remain) in enumerate(running):
+                    channel.put(remain - 1, " token")
+                    running[i] = (channel, remain - 1)
+                running = [(channel, remain) for channel, remain in running if remain > 0]
+
+    @app.get("/cpu_time")
+    async def cpu_time():
+        return {"cpu_time": time.process_time()}
+
+    FastApp(SyntheticWorker(), None)
+    uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+
+
+async def get_cpu_time(client, base_url):
+    response = await client.get(f"{base_url}/cpu_time")
+    return response.json()["cpu_time"]
+
+
+async def wait_server(client, base_url, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while True:
+        try:
+            return await get_cpu_time(client, base_url)
+        except httpx.TransportError:
+            if time.perf_counter() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def stream_one(client, base_url, max_tokens):
+    payload = {"model": "synthetic", "prompt": "hello", "max_tokens": max_tokens, "stream": True}
+    arrivals = []
+    async with client.stream("POST", f"{base_url}/v1/completions", json=payload) as response:
+        async for line in response.aiter_lines():
+            if line.startswith("data: "):
+                json.loads(line[len("data: "):])
+                arrivals.append(time.perf_counter())
+    return arrivals
+
+
+async def run(args, base_url):
+    limits = httpx.Limits(max_connections=None, max_keepalive_connections=None)
+    async with httpx.AsyncClient(timeout=None, limits=limits) as client:
+        await wait_server(client, base_url)
+
+        # cpu usage of the server without any request
+        st_cpu, st = await get_cpu_time(client, base_url), time.perf_counter()
+        await asyncio.sleep(args.idle_seconds)
+        idle_cpu = (await get_cpu_time(client, base_url) - st_cpu) / \
+            (time.perf_counter() - st) * 100
+        print(f"idle server cpu: {idle_cpu:.1f}%")
+
+        print(f"{'streams':>8} {'cpu %':>8} {'tok/s':>10} "
+              f"{'p50 itl ms':>11} {'p99 itl ms':>11} {'max itl ms':>11}")
+        for num_streams in args.streams:
+            st_cpu, st = await get_cpu_time(client, base_url), time.perf_counter()
+            results = await asyncio.gather(*[stream_one(client, base_url, args.max_tokens)
+                                             for _ in range(num_streams)])
+            duration = time.perf_counter() - st
+            cpu = (await get_cpu_time(client, base_url) - st_cpu) / duration * 100
+            # the gaps between the chunks of a stream, the first one includes queuing
+            itls = np.concatenate([np.diff(arrivals[1:]) for arrivals in results]) * 1000
+            num_tokens = sum(len(arrivals) for arrivals in results)
+            print(f"{num_streams:>8} {cpu:>8.1f} {num_tokens / duration:>10.1f} "
+                  f"{np.percentile(itls, 50):>11.2f} {np.percentile(itls, 99):>11.2f} "
+                  f"{itls.max():>11.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="FastAPI streaming load benchmark")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--token-interval", type=float, default=0.02,
+                        help="Seconds between two decoding steps of the synthetic worker")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--streams", type=int, nargs="+", default=[1, 10, 100, 200])
+    parser.add_argument("--idle-seconds", type=float, default=2.0)
+    args = parser.parse_args()
+
+    server = multiprocessing.Process(target=serve, args=(args.port, args.token_interval),
+                                     daemon=True)
+    server.start()
+    try:
+        asyncio.run(run(args, f"http://127.0.0.1:{args.port}"))
+    finally:
+        server.terminate()
+        server.join()
+
+
+if __name__ == "__main__":
+    main()
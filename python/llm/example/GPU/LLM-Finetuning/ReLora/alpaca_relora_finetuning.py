@@ -114,6 +114,7 @@ def train(
     relora_steps: int = 300,         # Number of steps per ReLoRA restart
     relora_warmup_steps: int = 10,   # Number of per-restart warmup steps
     relora_cpu_offload: bool = True, # True to perform lora weight merges on cpu during restarts, for modest gpu memory savings
+    relora_num_workers: int = 4,     # Number of threads merging and requantizing lora modules during restarts
 ):
     invalidInputError(training_mode == "relora",
                       f"This example is for relora training mode, but got training_mode={training_mode}.")
@@ -146,6 +147,7 @@ def train(
             f"relora_steps: {relora_steps}\n"
             f"relora_warmup_steps: {relora_warmup_steps}\n"
             f"relora_cpu_offload: {relora_cpu_offload}\n"
+            f"relora_num_workers: {relora_num_workers}\n"
         )
     assert (
         base_model
@@ -248,6 +250,7 @@ def train(
         extra_args["relora_steps"] = relora_steps
         extra_args["relora_warmup_steps"] = relora_warmup_steps
         extra_args["relora_cpu_offload"] = relora_cpu_offload
+        extra_args["relora_num_workers"] = relora_num_workers
         extra_args["resume_from_checkpoint"] = resume_from_checkpoint
 
     trainer = ReLoRATrainer(
@@ -34,6 +34,8 @@ async def main():
                         help='The quantization type the model will convert to.')
     parser.add_argument('--port', type=int, default=8000,
                         help='The port number on which the server will run.')
+    parser.add_argument('--max-num-seqs', type=int, default=1,
+                        help='Max num of requests decoded together with continuous batching.')
     
     args = parser.parse_args()
     model_path = args.repo_id_or_model_path
@@ -41,7 +43,7 @@ async def main():
 
     processor = None
     if "whisper" not in model_path.lower():
-        local_model = ModelWorker(model_path, low_bit)
+        local_model = ModelWorker(model_path, low_bit, max_num_seqs=args.max_num_seqs)
         # Load tokenizer
         tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, padding_side='left')
         if tokenizer.pad_token is None:
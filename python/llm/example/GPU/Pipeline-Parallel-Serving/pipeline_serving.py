@@ -14,6 +14,7 @@
 # limitations under the License.
 #
 
+import torch
 import torch.distributed as dist
 from ipex_llm.transformers import init_pipeline_parallel, PPModelWorker
 from ipex_llm.serving.fastapi import FastApp
@@ -25,13 +26,7 @@ from typing import Dict
 import argparse
 logger = logging.get_logger(__name__)
 
-init_pipeline_parallel()
-my_rank = dist.get_rank()
-my_size = dist.get_world_size()
-device = f"xpu:{my_rank}"
-logger.info(f"rank: {my_rank}, size: {my_size}")
 result_dict: Dict[str, str] = {}
-local_rank = my_rank
 
 async def main():
     parser = argparse.ArgumentParser(description='Predict Tokens using fastapi by leveraging Pipeline-Parallel')
@@ -46,8 +41,16 @@ async def main():
                         help='Max num sequences in a batch.')
     parser.add_argument('--max-prefilled-seqs', type=int, default=0,
                         help='Max num sequences in a batch during prefilling.')
+    parser.add_argument('--device', type=str, default="xpu", choices=["xpu", "cpu"],
+                        help='Run every stage on an Intel GPU, or on CPU with one stage per NUMA node.')
     
     args = parser.parse_args()
+    init_pipeline_parallel(args.device)
+    my_rank = dist.get_rank()
+    my_size = dist.get_world_size()
+    logger.info(f"rank: {my_rank}, size: {my_size}")
+    local_rank = my_rank
+    torch_dtype = torch.bfloat16 if args.device == "cpu" else torch.float16
     model_path = args.repo_id_or_model_path
     low_bit = args.low_bit
     max_num_seqs = args.max_num_seqs
@@ -57,7 +60,8 @@ async def main():
     for i in range(my_size):
         if my_rank == i:
             logger.info("start model initialization")
-            local_model = PPModelWorker(model_path, my_rank, my_size, low_bit, max_num_seqs, max_prefilled_seqs)
+            local_model = PPModelWorker(model_path, my_rank, my_size, low_bit, max_num_seqs, max_prefilled_seqs,
+                                        torch_dtype=torch_dtype)
             logger.info("model initialized")
         dist.barrier()
     tokenizer = AutoTokenizer.from_pretrained(model_path, trust_remote_code=True, padding_side='left')
@@ -50,9 +50,12 @@ import os
 import sys
 import uuid
 import time
-import math
 import multiprocessing
-from typing import List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
+import pickle
+import hashlib
+import itertools
+import numpy as np
+from typing import Dict, List, Optional, Union, Generator, Sequence, Iterator, Deque, Tuple
 from collections import deque, OrderedDict
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.ggml.model.generation import GenerationMixin
@@ -60,36 +63,141 @@ from . import llama_cpp
 from .llama_types import *
 
 
-class LlamaCache:
-    """Cache for a llama.cpp model."""
+class _LlamaCacheNode:
+    def __init__(self, tokens: Tuple[int, ...], parent: Optional["_LlamaCacheNode"] = None):
+        # token ids on the edge from `parent` to this node
+        self.tokens = tokens
+        self.parent = parent
+        self.children: Dict[int, "_LlamaCacheNode"] = {}
+        # full key of the cache entry ending at this node, if any
+        self.key: Optional[Tuple[int, ...]] = None
+        # number of keys in memory (not spilled) in the subtree of this node,
+        # and the children whose subtree holds any of them
+        self.num_in_memory = 0
+        self.memory_children: Dict[int, "_LlamaCacheNode"] = {}
+
 
-    def __init__(self, capacity_bytes: int = (2 << 30)):
+class LlamaCache:
+    """
+    Cache for a llama.cpp model.
+
+    Keys are indexed by a token radix tree, so the cached key sharing the longest
+    prefix with a prompt is found in O(prompt length + key length). Least recently
+    used states are evicted once their total size exceeds `capacity_bytes`. If
+    `spill_dir` is set, evicted states are written to it instead of being dropped,
+    and the states already in it are indexed on creation so that they survive a
+    restart. The least recently spilled files are deleted once the spilled states
+    exceed `spill_capacity_bytes`. A spill directory should only be used with a
+    single model.
+    """
+
+    SPILL_SUFFIX = ".llama_state"
+
+    def __init__(self, capacity_bytes: int = (2 << 30), spill_dir: Optional[str] = None,
+                 spill_capacity_bytes: int = (16 << 30)):
         self.cache_state: OrderedDict[Tuple[int, ...], "LlamaState"] = OrderedDict()
         self.capacity_bytes = capacity_bytes
+        self._cache_size = 0
+        self._root = _LlamaCacheNode(())
+        self._nodes: Dict[Tuple[int, ...], _LlamaCacheNode] = {}
+        self.spill_dir = spill_dir
+        self.spill_capacity_bytes = spill_capacity_bytes
+        self._spill_size = 0
+        # keys of the states spilled to `spill_dir`, in the order they were spilled
+        self.spilled: OrderedDict[Tuple[int, ...], str] = OrderedDict()
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._load_spilled()
 
     @property
     def cache_size(self):
-        return sum([state.llama_state_size for state in self.cache_state.values()])
+        return self._cache_size
+
+    @property
+    def spill_size(self):
+        return self._spill_size
+
+    def _insert_key(self, key: Tuple[int, ...]):
+        node = self._root
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos], None)
+            if child is None:
+                child = _LlamaCacheNode(key[pos:], node)
+                node.children[key[pos]] = child
+                node = child
+                break
+            length = Llama.longest_token_prefix(child.tokens, key[pos:])
+            if length < len(child.tokens):
+                # split the edge, `head` keeps the shared tokens
+                head = _LlamaCacheNode(child.tokens[:length], node)
+                node.children[key[pos]] = head
+                if child.num_in_memory > 0:
+                    node.memory_children[key[pos]] = head
+                child.tokens = child.tokens[length:]
+                child.parent = head
+                head.children[child.tokens[0]] = child
+                if child.num_in_memory > 0:
+                    head.num_in_memory = child.num_in_memory
+                    head.memory_children[child.tokens[0]] = child
+                child = head
+            node = child
+            pos += length
+        node.key = key
+        self._nodes[key] = node
+
+    def _count_in_memory(self, key: Tuple[int, ...], delta: int):
+        # a key is moved in (1) or out (-1) of memory, update the counts of its ancestors
+        node = self._nodes[key]
+        while node is not self._root:
+            node.num_in_memory += delta
+            if node.num_in_memory > 0:
+                node.parent.memory_children[node.tokens[0]] = node
+            else:
+                node.parent.memory_children.pop(node.tokens[0], None)
+            node = node.parent
+        node.num_in_memory += delta
+
+    def _remove_key(self, key: Tuple[int, ...]):
+        node = self._nodes.pop(key)
+        node.key = None
+        # prune the branch which holds no other key
+        while node is not self._root and node.key is None and not node.children:
+            del node.parent.children[node.tokens[0]]
+            node = node.parent
 
     def _find_longest_prefix_key(
         self,
         key: Tuple[int, ...],
     ) -> Optional[Tuple[int, ...]]:
-        min_len = 0
-        min_key = None
-        keys = (
-            (k, Llama.longest_token_prefix(k, key)) for k in self.cache_state.keys()
-        )
-        for k, prefix_len in keys:
-            if prefix_len > min_len:
-                min_len = prefix_len
-                min_key = k
-        return min_key
+        node = self._root
+        pos = 0
+        while pos < len(key):
+            child = node.children.get(key[pos], None)
+            if child is None:
+                break
+            length = Llama.longest_token_prefix(child.tokens, key[pos:])
+            node = child
+            pos += length
+            if length < len(child.tokens):
+                break
+        if node is self._root:
+            return None
+        # every key below `node` shares the longest prefix, prefer one in memory,
+        # branches holding no key are pruned so every path down ends at a key
+        while node.key is None or (node.num_in_memory > 0 and node.key not in self.cache_state):
+            children = node.memory_children if node.num_in_memory > 0 else node.children
+            node = next(iter(children.values()))
+        return node.key
 
     def __getitem__(self, key: Sequence[int]) -> "LlamaState":
         key = tuple(key)
         _key = self._find_longest_prefix_key(key)
         invalidInputError(_key is not None, "Key not found.")
+        if _key in self.spilled:
+            value = self._load_spilled_state(_key)
+            self[_key] = value
+            return value
         value = self.cache_state[_key]
         self.cache_state.move_to_end(_key)
         return value
@@ -100,17 +208,165 @@ class LlamaCache:
     def __setitem__(self, key: Sequence[int], value: "LlamaState"):
         key = tuple(key)
         if key in self.cache_state:
-            del self.cache_state[key]
+            self._cache_size -= self.cache_state.pop(key).llama_state_size
+        else:
+            if key in self.spilled:
+                self._remove_spilled(key)
+            else:
+                self._insert_key(key)
+            self._count_in_memory(key, 1)
         self.cache_state[key] = value
-        while self.cache_size > self.capacity_bytes:
-            self.cache_state.popitem(last=False)
+        self._cache_size += value.llama_state_size
+        while self._cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            evicted_key, evicted = self.cache_state.popitem(last=False)
+            self._cache_size -= evicted.llama_state_size
+            self._count_in_memory(evicted_key, -1)
+            if self.spill_dir is not None:
+                self._spill(evicted_key, evicted)
+            else:
+                self._remove_key(evicted_key)
+
+    def _spill(self, key: Tuple[int, ...], state: "LlamaState"):
+        path = os.path.join(self.spill_dir,
+                            hashlib.sha1(repr(key).encode()).hexdigest() + self.SPILL_SUFFIX)
+        with open(path, "wb") as f:
+            # the key is pickled first so that indexing a spill file reads only the key
+            pickle.dump(key, f)
+            pickle.dump({
+                "eval_tokens": list(state.eval_tokens),
+                "eval_tokens_maxlen": state.eval_tokens.maxlen,
+                "eval_logits": state.eval_logits,
+                "llama_state": bytes(state.llama_state),
+            }, f)
+        self.spilled[key] = path
+        self._spill_size += os.path.getsize(path)
+        self._evict_spilled()
+
+    def _remove_spilled(self, key: Tuple[int, ...]):
+        path = self.spilled.pop(key)
+        self._spill_size -= os.path.getsize(path)
+        os.remove(path)
+
+    def _evict_spilled(self):
+        # delete the least recently spilled states, a state loaded back from the spill
+        # directory is spilled again as the most recent one once it is evicted
+        while self._spill_size > self.spill_capacity_bytes and len(self.spilled) > 0:
+            key = next(iter(self.spilled))
+            self._remove_spilled(key)
+            self._remove_key(key)
+
+    def _load_spilled(self):
+        paths = [os.path.join(self.spill_dir, name) for name in os.listdir(self.spill_dir)
+                 if name.endswith(self.SPILL_SUFFIX)]
+        for path in sorted(paths, key=os.path.getmtime):
+            with open(path, "rb") as f:
+                key = pickle.load(f)
+            self.spilled[key] = path
+            self._spill_size += os.path.getsize(path)
+            self._insert_key(key)
+        self._evict_spilled()
+
+    def _load_spilled_state(self, key: Tuple[int, ...]) -> "LlamaState":
+        with open(self.spilled[key], "rb") as f:
+            pickle.load(f)
+            data = pickle.load(f)
+        llama_state = data["llama_state"]
+        return LlamaState(
+            eval_tokens=deque(data["eval_tokens"], maxlen=data["eval_tokens_maxlen"]),
+            eval_logits=data["eval_logits"],
+            llama_state=(llama_cpp.c_uint8 * len(llama_state)).from_buffer_copy(llama_state),
+            llama_state_size=len(llama_state),
+        )
+
+
+class LogitsBuffer:
+    """
+    Ring buffer of the logits of the last `maxlen` evaluated tokens.
+
+    Rows are preallocated float32 NumPy arrays, the oldest rows are overwritten once
+    the buffer is full. It behaves like a `deque(maxlen=maxlen)` of logits rows,
+    indexing returns a view of the row.
+    """
+
+    def __init__(self, maxlen: int, n_vocab: int):
+        self.maxlen = maxlen
+        self.n_vocab = n_vocab
+        # allocated on demand, so a buffer of `n_ctx` rows only grows as tokens are evaluated
+        self.data = np.empty((0, n_vocab), dtype=np.single)
+        self.start = 0
+        self.length = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _reserve(self, length: int):
+        capacity = self.data.shape[0]
+        if length <= capacity or capacity == self.maxlen:
+            return
+        data = np.empty((min(self.maxlen, max(length, capacity * 2)), self.n_vocab),
+                        dtype=np.single)
+        data[:self.length] = self._rows()
+        self.data = data
+        self.start = 0
+
+    def _rows(self) -> np.ndarray:
+        # all rows in order, a copy if they wrap around the end of the buffer
+        end = self.start + self.length
+        if end <= self.data.shape[0]:
+            return self.data[self.start:end]
+        return np.concatenate([self.data[self.start:], self.data[:end - self.data.shape[0]]])
+
+    def extend(self, rows: np.ndarray):
+        rows = rows[-self.maxlen:]
+        n = rows.shape[0]
+        if n == 0:
+            return
+        self._reserve(self.length + n)
+        capacity = self.data.shape[0]
+        end = (self.start + self.length) % capacity
+        first = min(n, capacity - end)
+        self.data[end:end + first] = rows[:first]
+        self.data[:n - first] = rows[first:]
+        self.length += n
+        if self.length > capacity:
+            self.start = (self.start + self.length - capacity) % capacity
+            self.length = capacity
+
+    def pop(self) -> Optional[np.ndarray]:
+        # without `logits_all` only the last logits are kept, so the buffer may be empty
+        if self.length == 0:
+            return None
+        row = self[-1]
+        self.length -= 1
+        return row
+
+    def clear(self):
+        self.start = 0
+        self.length = 0
+
+    def copy(self) -> "LogitsBuffer":
+        buffer = LogitsBuffer(self.maxlen, self.n_vocab)
+        buffer.data = self._rows().copy()
+        buffer.length = self.length
+        return buffer
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += self.length
+        invalidInputError(0 <= index < self.length,
+                          f"LogitsBuffer index {index} out of range {self.length}.")
+        return self.data[(self.start + index) % self.data.shape[0]]
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        for i in range(self.length):
+            yield self[i]
 
 
 class LlamaState:
     def __init__(
         self,
         eval_tokens: Deque[int],
-        eval_logits: Deque[List[float]],
+        eval_logits: LogitsBuffer,
         llama_state,  # type: llama_cpp.Array[llama_cpp.c_uint8]
         llama_state_size: int,
     ):
@@ -189,8 +445,6 @@ class Llama(GenerationMixin):
         self.last_n_tokens_size = last_n_tokens_size
         self.n_batch = min(n_ctx, n_batch)
         self.eval_tokens: Deque[int] = deque(maxlen=n_ctx)
-        self.eval_logits: Deque[List[float]] = deque(maxlen=n_ctx if logits_all else 1)
-
         self.cache: Optional[LlamaCache] = None
 
         self.n_threads = n_threads
@@ -228,6 +482,7 @@ class Llama(GenerationMixin):
 
         n_vocab = self.n_vocab()
         n_ctx = self.n_ctx()
+        self.eval_logits = LogitsBuffer(maxlen=n_ctx if logits_all else 1, n_vocab=n_vocab)
         data = (llama_cpp.llama_token_data * n_vocab)(
             *[
                 llama_cpp.llama_token_data(
@@ -341,10 +596,10 @@ class Llama(GenerationMixin):
             rows = n_tokens if self.params.logits_all else 1
             n_vocab = llama_cpp.llama_n_vocab(self.ctx)
             cols = int(n_vocab)
+            # view the logits buffer of llama.cpp as an array, it is copied once into
+            # `eval_logits` since llama.cpp overwrites it on the next eval
             logits_view = llama_cpp.llama_get_logits(self.ctx)
-            logits: List[List[float]] = [
-                [logits_view[i * cols + j] for j in range(cols)] for i in range(rows)
-            ]
+            logits = np.ctypeslib.as_array(logits_view, shape=(rows, cols))
             self.eval_logits.extend(logits)
 
     def _sample(
@@ -375,7 +630,7 @@ class Llama(GenerationMixin):
             else last_n_tokens_size
         )
         logits = self.eval_logits[-1]
-        nl_logit = logits[self._token_nl]
+        nl_logit = float(logits[self._token_nl])
         candidates = self._candidates
         llama_cpp.llama_init_candidates(
             ctx=self.ctx,
@@ -566,10 +821,7 @@ class Llama(GenerationMixin):
                 tokens = tokens[longest_prefix:]
                 for _ in range(len(self.eval_tokens) - longest_prefix):
                     self.eval_tokens.pop()
-                    try:
-                        self.eval_logits.pop()
-                    except IndexError:
-                        pass
+                    self.eval_logits.pop()
 
         if reset:
             self.reset()
@@ -983,9 +1235,9 @@ class Llama(GenerationMixin):
                 for token in all_tokens
             ]
             all_logprobs = [
-                Llama.logits_to_logprobs(list(map(float, row)))
-                for row in self.eval_logits
-            ][token_offset:]
+                Llama.logits_to_logprobs(row)
+                for row in itertools.islice(self.eval_logits, token_offset, None)
+            ]
             for token, token_str, logprobs_token in zip(
                 all_tokens, all_token_strs, all_logprobs
             ):
@@ -1403,10 +1655,12 @@ class Llama(GenerationMixin):
         return llama_cpp.llama_token_nl()
 
     @staticmethod
-    def logits_to_logprobs(logits: List[float]) -> List[float]:
-        exps = [math.exp(float(x)) for x in logits]
-        sum_exps = sum(exps)
-        return [math.log(x / sum_exps) for x in exps]
+    def logits_to_logprobs(logits: Union[np.ndarray, List[float]]) -> List[float]:
+        logits = np.asarray(logits, dtype=np.single)
+        # log-softmax, shifted by the max logit so that exp never overflows
+        shifted = logits - logits.max()
+        logprobs = shifted - np.log(np.exp(shifted).sum())
+        return logprobs.tolist()
 
     @staticmethod
     def longest_token_prefix(a: Sequence[int], b: Sequence[int]):
@@ -78,6 +78,12 @@ class TransformersEmbeddings(BaseModel, Embeddings):
     """Keyword arguments to pass to the model."""
     encode_kwargs: Dict[str, Any] = Field(default_factory=dict)
     """Keyword arguments to pass when calling the `encode` method of the model."""
+    max_batch_size: int = 32
+    """Maximum number of texts computed in one forward by `embed_documents`."""
+    cache_size: int = 0
+    """Number of recently computed text embeddings reused by `embed_documents`."""
+    engine: Any = None  #: :meta private:
+    """Embedding engine which batches the texts of `embed_documents`."""
 
     @classmethod
     def from_model_id(
@@ -157,17 +163,40 @@ class TransformersEmbeddings(BaseModel, Embeddings):
         embeddings = np.mean(embeddings, axis=0)
         return embeddings
 
+    def pool(self, hidden_states, attention_mask):
+        """Mean pooling of the hidden states of non-padding tokens."""
+        mask = attention_mask.unsqueeze(-1).to(hidden_states.dtype)
+        return (hidden_states * mask).sum(dim=1) / mask.sum(dim=1)
+
+    def forward_batch(self, input_ids, attention_mask):
+        """Compute the embeddings of right padded `input_ids`, shape: [B, N]."""
+        input_ids = input_ids.to(self.model.device)
+        attention_mask = attention_mask.to(self.model.device)
+        hidden_states = self.model(input_ids, attention_mask=attention_mask,
+                                   return_dict=False)[0]  # shape: [B, T, N]
+        return self.pool(hidden_states.float(), attention_mask)
+
     def embed_documents(self, texts: List[str]) -> List[List[float]]:
         """Compute doc embeddings using a HuggingFace transformer model.
 
+        Texts are batched by length, so only texts of similar length are padded together.
+
         Args:
             texts: The list of texts to embed.
 
         Returns:
             List of embeddings, one for each text.
         """
+        from ipex_llm.transformers.embedding_engine import EmbeddingEngine
+
+        if self.engine is None:
+            self.engine = EmbeddingEngine(self.forward_batch,
+                                          pad_token_id=self.tokenizer.pad_token_id,
+                                          max_batch_size=self.max_batch_size,
+                                          cache_size=self.cache_size)
         texts = list(map(lambda x: x.replace("\n", " "), texts))
-        embeddings = [self.embed(text, **self.encode_kwargs).tolist() for text in texts]
+        batch_input_ids = [self.tokenizer.encode(text, **self.encode_kwargs) for text in texts]
+        embeddings = [embedding.tolist() for embedding in self.engine.embed(batch_input_ids)]
         return embeddings
 
     def embed_query(self, text: str) -> List[float]:
@@ -193,3 +222,7 @@ class TransformersBgeEmbeddings(TransformersEmbeddings):
         embeddings = self.model(input_ids, return_dict=False)[0].cpu()
         embeddings = torch.nn.functional.normalize(embeddings[:, 0], p=2, dim=1)
         return embeddings[0]
+
+    def pool(self, hidden_states, attention_mask):
+        """Normalized embedding of the CLS token."""
+        return torch.nn.functional.normalize(hidden_states[:, 0], p=2, dim=1)
@@ -27,6 +27,7 @@ import uuid
 from typing import List, Optional, Union, Dict
 from fastapi.middleware.cors import CORSMiddleware
 from .tgi_protocol import Parameters
+from .token_channel import TokenChannel
 from typing_extensions import Literal
 from fastapi import File, UploadFile, Form
 from .openai_protocol import (
@@ -111,17 +112,21 @@ class FastApp():
         self.app = app
 
 
-def get_queue_next_token(delta_text_queue):
+def add_request_channel(request_id):
+    # the channel is registered before the request is queued, so that the response
+    # can wait on it right away instead of polling for the worker to create it
+    channel = TokenChannel()
+    local_model.streamer[request_id] = channel
+    return channel
+
+
+async def get_queue_next_token(delta_text_queue):
     timeout = int(os.getenv("IPEX_LLM_FASTAPI_TIMEOUT", 60))
-    delta_text = delta_text_queue.text_queue.get(timeout=timeout)
+    remain, delta_text = await delta_text_queue.get(timeout=timeout)
     if "whisper" in local_model.model_name.lower():
         if delta_text is not None and "<|" in delta_text and "|>" in delta_text:
             import re
             delta_text = re.sub(r'<\|.*?\|>', '', delta_text)
-    if delta_text is None:
-        remain = 0
-    else:
-        remain = 1
     return delta_text, remain
 
 
@@ -137,16 +142,7 @@ async def chat_stream_generator(local_model, delta_text_queue, request_id):
     model_name = local_model.model_name
     index = 0
     while True:
-        await asyncio.sleep(0)
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
-            else:
-                await asyncio.sleep(0)
-                continue
+        delta_text, remain = await get_queue_next_token(delta_text_queue)
         if remain == 0 and delta_text is not None or remain != 0:
             if should_return_end_token(delta_text):
                 choice_data = ChatCompletionResponseStreamChoice(
@@ -181,16 +177,7 @@ async def completion_stream_generator(local_model, delta_text_queue, request_id)
     model_name = local_model.model_name
     index = 0
     while True:
-        await asyncio.sleep(0)
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
-            else:
-                await asyncio.sleep(0)
-                continue
+        delta_text, remain = await get_queue_next_token(delta_text_queue)
         if remain == 0 and delta_text is not None or remain != 0:
             if should_return_end_token(delta_text):
                 choice_data = CompletionResponseStreamChoice(
@@ -223,22 +210,11 @@ async def completion_stream_generator(local_model, delta_text_queue, request_id)
 
 async def generator(local_model, delta_text_queue, request_id):
     while True:
-        if not hasattr(delta_text_queue, 'empty'):
-            delta_text, remain = get_queue_next_token(delta_text_queue)
-            if delta_text is None:
-                break
-            else:
-                yield delta_text
-        else:
-            if not delta_text_queue.empty():
-                with local_model.dict_lock:
-                    remain, delta_text = await delta_text_queue.get()
-                yield delta_text
-                if remain == 0:
-                    break
-            else:
-                await asyncio.sleep(0)
-                continue
+        delta_text, remain = await get_queue_next_token(delta_text_queue)
+        if delta_text is not None:
+            yield delta_text
+        if remain == 0:
+            break
     local_model.streamer.pop(request_id, None)
 
 
@@ -248,15 +224,12 @@ async def generate(inputs_request: InputsRequest):
         result = await generate_stream_api(inputs_request)
         return result
     request_id = str(uuid.uuid4())
+    cur_streamer = add_request_channel(request_id)
     await local_model.waiting_requests.put((request_id, inputs_request))
-    while True:
-        await asyncio.sleep(0)
-        cur_streamer = local_model.streamer.get(request_id, None)
-        if cur_streamer is not None:
-            output_str = []
-            async for item in generator(local_model, cur_streamer, request_id):
-                output_str.append(item)
-            return request_id, "".join(output_str)
+    output_str = []
+    async for item in generator(local_model, cur_streamer, request_id):
+        output_str.append(item)
+    return request_id, "".join(output_str)
 
 
 @app.post("/generate_stream")
@@ -267,20 +240,17 @@ async def generate_stream_api(inputs_request: InputsRequest):
 
 async def generate_stream(inputs_request: InputsRequest):
     request_id = str(uuid.uuid4()) + "stream"
+    if inputs_request.req_type not in ['completion', 'chat']:
+        invalidInputError(False, "Invalid Request Type.")
+    cur_streamer = add_request_channel(request_id)
     await local_model.waiting_requests.put((request_id, inputs_request))
-    while True:
-        await asyncio.sleep(0.1)
-        cur_streamer = local_model.streamer.get(request_id, None)
-        if cur_streamer is not None:
-            if inputs_request.req_type == 'completion':
-                cur_generator = completion_stream_generator(local_model, cur_streamer, request_id)
-            elif inputs_request.req_type == 'chat':
-                cur_generator = chat_stream_generator(local_model, cur_streamer, request_id)
-            else:
-                invalidInputError(False, "Invalid Request Type.")
-            return request_id, StreamingResponse(
-                content=cur_generator, media_type="text/event-stream"
-            )
+    if inputs_request.req_type == 'completion':
+        cur_generator = completion_stream_generator(local_model, cur_streamer, request_id)
+    else:
+        cur_generator = chat_stream_generator(local_model, cur_streamer, request_id)
+    return request_id, StreamingResponse(
+        content=cur_generator, media_type="text/event-stream"
+    )
 
 
 def get_prompt(messages) -> str:
@@ -432,6 +402,7 @@ async def startup_event():
 
 
 async def process_requests(local_model, result_dict):
+    # `process_step` waits for new requests or for the model, so this loop
+    # only wakes up when there is work to do
     while True:
-        await asyncio.sleep(0)
         await local_model.process_step(tokenizer, result_dict, processor)
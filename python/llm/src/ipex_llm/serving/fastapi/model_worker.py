@@ -19,15 +19,18 @@ from transformers.utils import logging
 import os
 import time
 import asyncio
+import threading
 from PIL import Image
 import requests
-from transformers import TextIteratorStreamer
+from .token_channel import TokenChannel, ChannelStreamer
 logger = logging.get_logger(__name__)
 
 
 class ModelWorker:
-    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16):
+    def __init__(self, checkpoint, low_bit, model_type="normal", torch_dtype=torch.float16,
+                 max_num_seqs=1, device="xpu"):
         self.dtype = torch_dtype
+        self.device = device
         start = time.perf_counter()
         if model_type == "audio":
             self.model = self.load_model(checkpoint, low_bit, "audio")
@@ -45,6 +48,16 @@ class ModelWorker:
         self.streamer = {}
         self.model_name = checkpoint
 
+        # continuous batching is used when more than one sequence may run at the same time
+        self.max_num_seqs = max_num_seqs
+        self.scheduler = None
+        if max_num_seqs > 1 and model_type != "audio":
+            from ipex_llm.transformers.continuous_batching import ContinuousBatchScheduler
+            self.scheduler = ContinuousBatchScheduler(self.model, max_num_seqs)
+        self.dict_lock = threading.Lock()
+        # created with the tokenizer at the first decoding step
+        self.detokenizer = None
+
     def load_model(self, model_path, low_bit='sym_int4', model_type="normal"):
         if model_type == "audio":
             from ipex_llm.transformers import AutoModelForSpeechSeq2Seq
@@ -77,7 +90,7 @@ class ModelWorker:
                                                   trust_remote_code=True,
                                                   modules_to_not_convert=modules,
                                                   use_cache=True,)
-        model = model.eval().to("xpu")
+        model = model.eval().to(self.device)
         return model
 
     def get_local_image_path(self, image_path):
@@ -94,9 +107,14 @@ class ModelWorker:
                     file.write(response.content)
         return local_path
 
+    def get_channel(self, request_id):
+        # requests queued by `api_server` come with their channel
+        if request_id not in self.streamer:
+            self.streamer[request_id] = TokenChannel()
+        return self.streamer[request_id]
+
     async def add_asr_request(self, processor):
-        if self.waiting_requests.empty():
-            return
+        # wait for the next request
         tmp_result = await self.waiting_requests.get()
         request_id, request = tmp_result
         transcription_request = request.transcription_request
@@ -111,12 +129,11 @@ class ModelWorker:
             sampling_rate=sampling_rate,
             return_tensors="pt",
             return_attention_mask=True,
-        ).input_features.to('xpu')
+        ).input_features.to(self.device)
         return input_features, forced_decoder_ids, request_id
 
     async def add_request(self, tokenizer):
-        if self.waiting_requests.empty():
-            return
+        # wait for the next request
         tmp_result = await self.waiting_requests.get()
         request_id, prompt_request = tmp_result
         plain_texts = prompt_request.inputs
@@ -138,7 +155,7 @@ class ModelWorker:
             if prompt_request.image_list is None:
                 inputs = self.model.build_inputs(tokenizer, plain_texts, [], meta_instruction)
                 im_mask = torch.zeros(inputs['input_ids'].shape[:2]).bool()
-                input_ids = inputs["input_ids"].to('xpu')
+                input_ids = inputs["input_ids"].to(self.device)
             else:
                 # only process the first image now
                 local_path = self.get_local_image_path(prompt_request.image_list[0])
@@ -146,7 +163,7 @@ class ModelWorker:
                 plain_texts = "<ImageHere>" + plain_texts
                 inputs, im_mask = self.model.interleav_wrap_chat(tokenizer, plain_texts,
                                                                  image, [], meta_instruction)
-                inputs_embeds = inputs["inputs_embeds"].to('xpu').to(self.dtype)
+                inputs_embeds = inputs["inputs_embeds"].to(self.device).to(self.dtype)
         elif "glm-4v" in self.model_name.lower() and prompt_request.image_list is not None:
             # only process the first image now
             local_path = self.get_local_image_path(prompt_request.image_list[0])
@@ -158,53 +175,126 @@ class ModelWorker:
                                                    tokenize=True,
                                                    return_tensors="pt",
                                                    return_dict=True)
-            inputs = inputs.to('xpu')
+            inputs = inputs.to(self.device)
         else:
             inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
-            input_ids = inputs.input_ids.to('xpu')
+            input_ids = inputs.input_ids.to(self.device)
         parameters = prompt_request.parameters
         return input_ids, parameters, request_id, inputs_embeds, inputs
 
+    def add_sequence(self, tokenizer, request_id, prompt_request):
+        from ipex_llm.transformers.continuous_batching import Sequence
+        input_ids = tokenizer(prompt_request.inputs).input_ids
+        parameters = prompt_request.parameters
+        eos_token_id = tokenizer.eos_token_id
+        if "codegeex" in self.model_name.lower():
+            eos_token_id = [tokenizer.eos_token_id,
+                            tokenizer.convert_tokens_to_ids("<|user|>"),
+                            tokenizer.convert_tokens_to_ids("<|observation|>")]
+        seq = Sequence(request_id, input_ids,
+                       max_new_tokens=parameters.max_new_tokens,
+                       eos_token_id=eos_token_id,
+                       do_sample=parameters.do_sample,
+                       temperature=parameters.temperature,
+                       top_k=parameters.top_k,
+                       top_p=parameters.top_p,
+                       min_new_tokens=parameters.min_new_tokens)
+        self.get_channel(request_id)
+        self.scheduler.add_sequence(seq)
+
+    def get_printable_texts(self, tokenizer, outputs):
+        if self.detokenizer is None:
+            from ipex_llm.transformers.streamer import IncrementalDetokenizer
+            self.detokenizer = IncrementalDetokenizer(tokenizer, skip_special_tokens=True)
+        request_ids = [seq.request_id for seq, _ in outputs]
+        printable_texts = self.detokenizer.step(request_ids,
+                                                [[token_id] for _, token_id in outputs])
+        finished = [i for i, (seq, _) in enumerate(outputs) if seq.finished]
+        remaining_texts = self.detokenizer.finish([request_ids[i] for i in finished])
+        for i, text in zip(finished, remaining_texts):
+            printable_texts[i] += text
+        return printable_texts
+
+    async def process_batch_step(self, tokenizer, result_dict):
+        if not self.scheduler.has_unfinished_sequences():
+            # nothing to decode, wait for a request instead of polling the queue
+            request_id, prompt_request = await self.waiting_requests.get()
+            self.add_sequence(tokenizer, request_id, prompt_request)
+        while not self.waiting_requests.empty():
+            request_id, prompt_request = self.waiting_requests.get_nowait()
+            self.add_sequence(tokenizer, request_id, prompt_request)
+
+        # run the model in an executor thread to keep the event loop serving requests
+        loop = asyncio.get_running_loop()
+        outputs = await loop.run_in_executor(None, self.scheduler.step)
+
+        printable_texts = self.get_printable_texts(tokenizer, outputs)
+        for (seq, token_id), printable_text in zip(outputs, printable_texts):
+            remain = 0 if seq.finished else seq.max_new_tokens - len(seq.output_ids)
+            self.get_channel(seq.request_id).put(remain, printable_text)
+            if seq.finished:
+                with self.dict_lock:
+                    result_dict[seq.request_id] = tokenizer.decode(seq.output_ids,
+                                                                   skip_special_tokens=True)
+                if len(seq.output_ids) > 1:
+                    first_token = seq.first_token_time - seq.arrival_time
+                    next_token = (time.perf_counter() - seq.first_token_time) / \
+                        (len(seq.output_ids) - 1)
+                    logger.info(f"First token latency: {first_token}, "
+                                f"next token latency: {next_token}")
+
     @torch.no_grad()
     async def process_step(self, tokenizer, result_dict, processor=None):
-        if not self.waiting_requests.empty():
-            if processor is not None and "whisper" in self.model_name.lower():
-                input_features, decoder_ids, request_id = await self.add_asr_request(processor)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
-
-                def model_generate():
-                    self.model.generate(input_features,
-                                        streamer=self.streamer[request_id],
-                                        forced_decoder_ids=decoder_ids)
-            else:
-                input_ids, parameters, request_id, inputs_embeds, inputs = \
-                    await self.add_request(tokenizer)
-                self.streamer[request_id] = TextIteratorStreamer(tokenizer, skip_prompt=True)
-
-                def model_generate():
-                    generate_kwargs = {k: v for k, v in parameters.dict().items() if v is not None}
-                    if "codegeex" in self.model_name.lower():
-                        eos_token_id = [tokenizer.eos_token_id,
-                                        tokenizer.convert_tokens_to_ids("<|user|>"),
-                                        tokenizer.convert_tokens_to_ids("<|observation|>")]
-                        generate_kwargs["eos_token_id"] = eos_token_id
-                    elif "internlm-xcomposer2-vl-7b" in self.model_name.lower():
-                        eos_token_id = [
-                            tokenizer.eos_token_id,
-                            tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
-                        ]
-                        generate_kwargs["eos_token_id"] = eos_token_id
-                    if input_ids is not None:
-                        self.model.generate(input_ids,
-                                            streamer=self.streamer[request_id], **generate_kwargs)
-                    elif inputs_embeds is not None:
-                        self.model.generate(inputs_embeds=inputs_embeds,
-                                            streamer=self.streamer[request_id], **generate_kwargs)
-                    else:
-                        self.model.generate(**inputs,
-                                            streamer=self.streamer[request_id], **generate_kwargs)
+        if self.scheduler is not None:
+            await self.process_batch_step(tokenizer, result_dict)
+            return
+        if processor is not None and "whisper" in self.model_name.lower():
+            input_features, decoder_ids, request_id = await self.add_asr_request(processor)
+            streamer = ChannelStreamer(tokenizer, self.get_channel(request_id), skip_prompt=True)
+
+            def model_generate():
+                self.model.generate(input_features,
+                                    streamer=streamer,
+                                    forced_decoder_ids=decoder_ids)
+        else:
+            input_ids, parameters, request_id, inputs_embeds, inputs = \
+                await self.add_request(tokenizer)
+            streamer = ChannelStreamer(tokenizer, self.get_channel(request_id), skip_prompt=True)
+
+            def model_generate():
+                generate_kwargs = {k: v for k, v in parameters.dict().items() if v is not None}
+                if "codegeex" in self.model_name.lower():
+                    eos_token_id = [tokenizer.eos_token_id,
+                                    tokenizer.convert_tokens_to_ids("<|user|>"),
+                                    tokenizer.convert_tokens_to_ids("<|observation|>")]
+                    generate_kwargs["eos_token_id"] = eos_token_id
+                elif "internlm-xcomposer2-vl-7b" in self.model_name.lower():
+                    eos_token_id = [
+                        tokenizer.eos_token_id,
+                        tokenizer.convert_tokens_to_ids(['[UNUSED_TOKEN_145]'])[0]
+                    ]
+                    generate_kwargs["eos_token_id"] = eos_token_id
+                if input_ids is not None:
+                    self.model.generate(input_ids,
+                                        streamer=streamer, **generate_kwargs)
+                elif inputs_embeds is not None:
+                    self.model.generate(inputs_embeds=inputs_embeds,
+                                        streamer=streamer, **generate_kwargs)
+                else:
+                    self.model.generate(**inputs,
+                                        streamer=streamer, **generate_kwargs)
+        if self.device == "xpu":
             torch.xpu.empty_cache()
             torch.xpu.synchronize()
-            from threading import Thread
-            t1 = Thread(target=model_generate)
-            t1.start()
+
+        def run():
+            try:
+                model_generate()
+            except Exception as e:
+                logger.error(f"Failed to generate for request {request_id}: {e}")
+                # end the response instead of leaving it waiting until the timeout
+                streamer.channel.close()
+
+        from threading import Thread
+        t1 = Thread(target=run)
+        t1.start()
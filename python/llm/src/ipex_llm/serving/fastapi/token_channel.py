@@ -0,0 +1,85 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import asyncio
+import threading
+from collections import deque
+from typing import Optional, Tuple
+
+from transformers import TextStreamer
+
+
+class TokenChannel:
+    """
+    Deliver the `(remain, delta_text)` items of one request to its response coroutine.
+
+    `put` can be called from any thread, e.g. a `generate` thread. The waiting
+    coroutine is woken by `loop.call_soon_threadsafe`, and items put before the
+    wake up runs are delivered by the same wake up, so the event loop never polls
+    and a fast producer does not flood it with callbacks. `remain == 0` marks the
+    last item of a request.
+    """
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop]=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self.items = deque()
+        self.lock = threading.Lock()
+        self.wakeup_pending = False
+        # only accessed in the event loop thread
+        self.waiter = None
+
+    def put(self, remain: int, delta_text: Optional[str]):
+        with self.lock:
+            self.items.append((remain, delta_text))
+            if self.wakeup_pending:
+                return
+            self.wakeup_pending = True
+        self.loop.call_soon_threadsafe(self._wakeup)
+
+    def close(self):
+        """End the request, `get` returns `(0, None)` after the items put before."""
+        self.put(0, None)
+
+    def _wakeup(self):
+        with self.lock:
+            self.wakeup_pending = False
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self, timeout: Optional[float]=None) -> Tuple[int, Optional[str]]:
+        """Wait for the next item, raises `asyncio.TimeoutError` after `timeout` seconds."""
+        while True:
+            with self.lock:
+                if len(self.items) > 0:
+                    return self.items.popleft()
+            self.waiter = self.loop.create_future()
+            try:
+                await asyncio.wait_for(self.waiter, timeout)
+            finally:
+                self.waiter = None
+
+
+class ChannelStreamer(TextStreamer):
+    """A `generate` streamer which puts the decoded text into a `TokenChannel`."""
+    def __init__(self, tokenizer, channel: TokenChannel, skip_prompt: bool = True,
+                 **decode_kwargs):
+        super().__init__(tokenizer, skip_prompt, **decode_kwargs)
+        self.channel = channel
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        if len(text) > 0:
+            self.channel.put(1, text)
+        if stream_end:
+            self.channel.close()
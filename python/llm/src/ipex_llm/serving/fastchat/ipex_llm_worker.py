@@ -22,10 +22,10 @@ Relies on load_model method
 import os
 import torch
 import torch.nn.functional as F
-import gc
 import argparse
 import asyncio
 import atexit
+import base64
 import json
 from typing import List
 import uuid
@@ -49,6 +49,7 @@ from fastchat.serve.base_model_worker import (
 from fastchat.utils import get_context_length, is_partial_stop
 
 from ipex_llm.transformers.loader import load_model
+from ipex_llm.transformers.embedding_engine import EmbeddingEngine
 from transformers import TextIteratorStreamer
 
 app = FastAPI()
@@ -73,6 +74,8 @@ class BigDLLLMWorker(BaseModelWorker):
         load_low_bit_model: bool = False,
         stream_interval: int = 4,
         benchmark: str = "true",
+        embed_max_batch_size: int = 32,
+        embed_max_wait_ms: float = 2.0,
     ):
         super().__init__(
             controller_addr,
@@ -112,20 +115,37 @@ class BigDLLLMWorker(BaseModelWorker):
         self.stream_interval = stream_interval
         self.context_len = get_context_length(self.model.config)
         self.embed_in_truncate = embed_in_truncate
+        # Based on conditions of different model_type
+        self.model_type_dict = {
+            "is_llama": "llama" in str(type(self.model)),
+            "is_t5": "t5" in str(type(self.model)),
+            "is_chatglm": "chatglm" in str(type(self.model)),
+            "is_bert": "bert" in str(type(self.model)),
+            "is_robert": "robert" in str(type(self.model)),
+        }
+        # chunks of all inputs of concurrent embedding requests are computed in batches
+        self.embedding_engine = EmbeddingEngine(
+            self.__forward_embed_chunks,
+            pad_token_id=self.tokenizer.pad_token_id,
+            max_batch_size=embed_max_batch_size,
+            max_wait_ms=embed_max_wait_ms,
+        )
         if not no_register:
             self.init_heart_beat()
 
     def __process_embed_chunk(self, input_ids, attention_mask, **model_type_dict):
         if model_type_dict.get("is_bert"):
-            model_output = self.model(input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask)
             if model_type_dict.get("is_robert"):
                 data = model_output.last_hidden_state
             else:
                 data = model_output[0]
         elif model_type_dict.get("is_t5"):
-            model_output = self.model(input_ids, decoder_input_ids=input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask,
+                                      decoder_input_ids=input_ids)
             data = model_output.encoder_last_hidden_state
         else:
+            # inputs are right padded, causal attention never attends the padding
             model_output = self.model(input_ids, output_hidden_states=True)
             if model_type_dict.get("is_chatglm"):
                 data = model_output.hidden_states[-1].transpose(0, 1)
@@ -142,7 +162,18 @@ class BigDLLLMWorker(BaseModelWorker):
 
         return sum_embeddings, token_num
 
-    @torch.inference_mode()
+    def __forward_embed_chunks(self, input_ids, attention_mask):
+        sum_embeddings, _ = self.__process_embed_chunk(
+            input_ids.to(self.device), attention_mask.to(self.device), **self.model_type_dict
+        )
+        return sum_embeddings
+
+    def __encode_base64(self, embeddings: torch.Tensor) -> List[str]:
+        embeddings = embeddings.cpu()
+        return [
+            base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
+        ]
+
     def get_embeddings(self, params):
         self.call_ct += 1
 
@@ -150,107 +181,52 @@ class BigDLLLMWorker(BaseModelWorker):
             # Get tokenizer
             tokenizer = self.tokenizer
             ret = {"embedding": [], "token_num": 0}
-
-            # Based on conditions of different model_type
-            model_type_dict = {
-                "is_llama": "llama" in str(type(self.model)),
-                "is_t5": "t5" in str(type(self.model)),
-                "is_chatglm": "chatglm" in str(type(self.model)),
-                "is_bert": "bert" in str(type(self.model)),
-                "is_robert": "robert" in str(type(self.model)),
-            }
+            use_cls_pooling = getattr(self.model, "use_cls_pooling", False)
 
             if self.embed_in_truncate:
                 encoding = tokenizer.batch_encode_plus(
                     params["input"],
-                    padding=True,
                     truncation="longest_first",
-                    return_tensors="pt",
                     max_length=self.context_len,
                 )
             else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
-                )
-            input_ids = encoding["input_ids"].to(self.device)
-            # Check if we need attention_mask or not.
-            attention_mask = input_ids != tokenizer.pad_token_id
+                encoding = tokenizer.batch_encode_plus(params["input"])
+
+            # split every input into chunks of at most `context_len` tokens, inputs are
+            # not padded here, the engine pads chunks of similar length together
+            chunks = []
+            for row, ids in enumerate(encoding["input_ids"]):
+                if self.embed_in_truncate:
+                    chunks.append((row, ids))
+                    continue
+                for i in range(0, len(ids), self.context_len):
+                    chunk_ids = ids[i:i + self.context_len]
+                    if use_cls_pooling:
+                        # add cls token to get cls embedding
+                        chunk_ids = [tokenizer.cls_token_id] + chunk_ids
+                    chunks.append((row, chunk_ids))
+            futures = [self.embedding_engine.submit(chunk_ids) for _, chunk_ids in chunks]
+
+            num_rows = len(encoding["input_ids"])
+            sum_embeddings = [0] * num_rows
+            token_nums = [0] * num_rows
+            for (row, chunk_ids), future in zip(chunks, futures):
+                chunk_embeddings = future.result()
+                if use_cls_pooling:
+                    chunk_embeddings = chunk_embeddings * len(chunk_ids)
+                sum_embeddings[row] = sum_embeddings[row] + chunk_embeddings
+                token_nums[row] += len(chunk_ids)
+
+            embedding = torch.stack([e / n for e, n in zip(sum_embeddings, token_nums)])
+            normalized_embeddings = F.normalize(embedding, p=2, dim=1)
+            ret["token_num"] = sum(token_nums)
 
             base64_encode = params.get("encoding_format", None)
-
-            if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
-                    input_ids, attention_mask, **model_type_dict
-                )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
-                ):
-                    embedding = embedding / token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
-            else:
-                all_embeddings = []
-                all_token_num = 0
-                for i in range(0, input_ids.size(1), self.context_len):
-                    chunk_input_ids = input_ids[:, i:i + self.context_len]
-                    chunk_attention_mask = attention_mask[:, i:i + self.context_len]
-
-                    # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        cls_tokens = (
-                            torch.zeros(
-                                (chunk_input_ids.size(0), 1),
-                                dtype=chunk_input_ids.dtype,
-                                device=chunk_input_ids.device,
-                            )
-                            + tokenizer.cls_token_id
-                        )
-                        chunk_input_ids = torch.cat(
-                            [cls_tokens, chunk_input_ids], dim=-1
-                        )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
-                        )
-                        chunk_attention_mask = torch.cat(
-                            [mask, chunk_attention_mask], dim=-1
-                        )
-
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
-                        chunk_input_ids, chunk_attention_mask, **model_type_dict
-                    )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
-                    else:
-                        all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
-
-                all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-
-                ret["token_num"] = all_token_num
-
             if base64_encode == "base64":
                 out_embeddings = self.__encode_base64(normalized_embeddings)
             else:
                 out_embeddings = normalized_embeddings.tolist()
             ret["embedding"] = out_embeddings
-
-            gc.collect()
-            torch.cuda.empty_cache()
-            if self.device == "xpu":
-                torch.xpu.empty_cache()
-            if self.device == "npu":
-                torch.npu.empty_cache()
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -448,7 +424,8 @@ async def api_get_status(request: Request):
 async def api_get_embeddings(request: Request):
     params = await request.json()
     await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
+    # run in a thread so that concurrent requests are batched by the embedding engine
+    embedding = await asyncio.to_thread(worker.get_embeddings, params)
     release_worker_semaphore()
     return JSONResponse(content=embedding)
 
@@ -518,6 +495,18 @@ if __name__ == "__main__":
         help="Load models that have been converted/saved using ipex-llm's save_low_bit interface",
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--embed-max-batch-size",
+        type=int,
+        default=32,
+        help="Max number of input chunks computed in one embedding forward",
+    )
+    parser.add_argument(
+        "--embed-max-wait-ms",
+        type=float,
+        default=2.0,
+        help="Max time to wait for more embedding requests before a forward",
+    )
 
     args = parser.parse_args()
     worker = BigDLLLMWorker(
@@ -537,5 +526,7 @@ if __name__ == "__main__":
         args.load_low_bit_model,
         args.stream_interval,
         args.benchmark,
+        args.embed_max_batch_size,
+        args.embed_max_wait_ms,
     )
     uvicorn.run(app, host=args.host, port=args.port, log_level="info")
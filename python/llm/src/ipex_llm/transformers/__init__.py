@@ -21,5 +21,23 @@ from .model import AutoModelForCausalLM, AutoModel, AutoModelForSeq2SeqLM, \
         AutoModelForSequenceClassification, AutoModelForMaskedLM, \
         AutoModelForNextSentencePrediction, AutoModelForMultipleChoice, \
         AutoModelForTokenClassification
+# the native ggml classes (`LlamaForCausalLM`, ...) are cheap to import, their ggml
+# backends are only imported by `from_pretrained`
 from .modelling_bigdl import *
-from .pipeline_parallel import init_pipeline_parallel, PPModelWorker
+
+# these modules are only imported when they are used, importing them patches
+# `GenerationMixin.generate` and pulls in `torch.distributed`
+_LAZY_ATTRS = {
+    "init_pipeline_parallel": ".pipeline_parallel",
+    "PPModelWorker": ".pipeline_parallel",
+    "PrefixCache": ".prefix_cache",
+    "enable_expert_offload": ".moe_offload",
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_ATTRS:
+        import importlib
+        module = importlib.import_module(_LAZY_ATTRS[name], __name__)
+        return getattr(module, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
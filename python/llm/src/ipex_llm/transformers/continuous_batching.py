@@ -0,0 +1,262 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import torch
+import logging
+from collections import deque
+from typing import List, Optional, Tuple, Union
+from ipex_llm.utils.common import invalidInputError
+from ipex_llm.transformers.kv import DynamicBatchCache
+
+logger = logging.getLogger(__name__)
+
+
+def sample_tokens(logits: torch.Tensor,
+                  do_sample: torch.Tensor,
+                  temperature: torch.Tensor,
+                  top_k: torch.Tensor,
+                  top_p: torch.Tensor) -> torch.Tensor:
+    """
+    Pick the next token of every row with its own sampling parameters.
+
+    :param logits: [batch_size, vocab_size] logits of the last position.
+    :param do_sample: [batch_size] bool, rows with `False` are decoded greedily.
+    :param temperature: [batch_size] float.
+    :param top_k: [batch_size] int, `0` disables top-k filtering.
+    :param top_p: [batch_size] float, `1.0` disables top-p filtering.
+    :return: [batch_size] int64 tensor of next tokens.
+    """
+    logits = logits.float()
+    next_tokens = torch.argmax(logits, dim=-1)
+    if not bool(do_sample.any()):
+        return next_tokens
+
+    vocab_size = logits.size(-1)
+    logits = logits / temperature.clamp(min=1e-5).unsqueeze(1)
+    sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+    ranks = torch.arange(vocab_size, device=logits.device).expand_as(sorted_logits)
+    top_k = torch.where(top_k > 0, top_k.clamp(max=vocab_size), vocab_size)
+    remove_mask = ranks >= top_k.unsqueeze(1)
+    sorted_logits = sorted_logits.masked_fill(remove_mask, -float("inf"))
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    # keep the smallest set of tokens whose cumulative probability exceeds top_p,
+    # the most probable token is always kept
+    cumulative_probs = sorted_probs.cumsum(dim=-1) - sorted_probs
+    remove_mask = cumulative_probs > top_p.unsqueeze(1)
+    sorted_probs = sorted_probs.masked_fill(remove_mask, 0.0)
+    sampled = torch.multinomial(sorted_probs, num_samples=1)
+    sampled = sorted_indices.gather(1, sampled).squeeze(1)
+    return torch.where(do_sample, sampled, next_tokens)
+
+
+class Sequence:
+    """State of a single request in a continuous batch."""
+    def __init__(self, request_id: str, input_ids: List[int],
+                 max_new_tokens: int = 32,
+                 eos_token_id: Optional[Union[int, List[int]]]=None,
+                 do_sample: bool = False,
+                 temperature: Optional[float] = None,
+                 top_k: Optional[int] = None,
+                 top_p: Optional[float] = None,
+                 min_new_tokens: Optional[int] = None):
+        invalidInputError(len(input_ids) > 0, "Prompt of a request should not be empty.")
+        self.request_id = request_id
+        self.input_ids = list(input_ids)
+        self.output_ids = []
+        self.max_new_tokens = max_new_tokens
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        self.eos_token_id = set(eos_token_id) if eos_token_id is not None else set()
+        self.do_sample = bool(do_sample)
+        self.temperature = temperature if temperature is not None else 1.0
+        self.top_k = top_k if top_k is not None else 0
+        self.top_p = top_p if top_p is not None else 1.0
+        self.min_new_tokens = min_new_tokens if min_new_tokens is not None else 0
+        self.finish_reason = None
+        self.arrival_time = time.perf_counter()
+        self.first_token_time = None
+
+    @property
+    def finished(self) -> bool:
+        return self.finish_reason is not None
+
+    def append_token(self, token_id: int):
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.output_ids.append(token_id)
+        if len(self.output_ids) >= self.min_new_tokens and token_id in self.eos_token_id:
+            self.finish_reason = "stop"
+        elif len(self.output_ids) >= self.max_new_tokens:
+            self.finish_reason = "length"
+
+
+class ContinuousBatchScheduler:
+    """
+    Iteration-level scheduler: every `step` runs one decoding forward for all
+    running sequences, admits waiting sequences into the running batch and
+    retires finished ones, so requests never wait for the whole batch.
+
+    The running batch shares one `DynamicBatchCache` whose rows are left padded,
+    the padded positions are masked out by `attention_mask`.
+    """
+    def __init__(self, model, max_num_seqs: int = 8, max_prefilled_seqs: int = 0,
+                 pad_token_id: int = 0):
+        self.model = model
+        self.max_num_seqs = max_num_seqs
+        # 0 means admitting as many sequences as there are free slots
+        self.max_prefilled_seqs = max_prefilled_seqs
+        self.pad_token_id = pad_token_id
+        self.waiting = deque()
+        self.running = []
+        self.past_key_values = None
+        self.attention_mask = None
+        self.position_ids = None
+        self.next_input_ids = None
+        self.num_generated_tokens = 0
+
+    @property
+    def device(self):
+        return self.model.device
+
+    def add_sequence(self, seq: Sequence):
+        # deque.append is thread safe, so requests can be added from the event loop
+        # while `step` runs in an executor thread
+        self.waiting.append(seq)
+
+    def has_unfinished_sequences(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def _sampling_params(self, seqs: List[Sequence]):
+        device = self.device
+        do_sample = torch.tensor([s.do_sample for s in seqs], dtype=torch.bool, device=device)
+        temperature = torch.tensor([s.temperature for s in seqs], dtype=torch.float32,
+                                   device=device)
+        top_k = torch.tensor([s.top_k for s in seqs], dtype=torch.int64, device=device)
+        top_p = torch.tensor([s.top_p for s in seqs], dtype=torch.float32, device=device)
+        return do_sample, temperature, top_k, top_p
+
+    def _sample(self, logits: torch.Tensor, seqs: List[Sequence]) -> List[int]:
+        next_tokens = sample_tokens(logits, *self._sampling_params(seqs))
+        next_tokens = next_tokens.tolist()
+        for seq, token in zip(seqs, next_tokens):
+            seq.append_token(token)
+        self.num_generated_tokens += len(seqs)
+        return next_tokens
+
+    def _forward(self, input_ids, attention_mask, position_ids, past_key_values):
+        outputs = self.model(input_ids=input_ids,
+                             attention_mask=attention_mask,
+                             position_ids=position_ids,
+                             past_key_values=past_key_values,
+                             use_cache=True)
+        invalidInputError(isinstance(outputs.past_key_values, DynamicBatchCache),
+                          f"{self.model.config.model_type} does not support "
+                          "continuous batching yet.")
+        return outputs.logits[:, -1, :], outputs.past_key_values
+
+    def _decode(self) -> List[Tuple[Sequence, int]]:
+        attention_mask = torch.cat([self.attention_mask,
+                                    self.attention_mask.new_ones((len(self.running), 1))],
+                                   dim=-1)
+        logits, self.past_key_values = self._forward(self.next_input_ids, attention_mask,
+                                                     self.position_ids, self.past_key_values)
+        self.attention_mask = attention_mask
+        self.position_ids = self.position_ids + 1
+        next_tokens = self._sample(logits, self.running)
+        self.next_input_ids = torch.tensor(next_tokens, device=self.device).unsqueeze(1)
+        return list(zip(self.running, next_tokens))
+
+    def _prefill(self, seqs: List[Sequence]) -> List[Tuple[Sequence, int]]:
+        device = self.device
+        max_len = max(len(s.input_ids) for s in seqs)
+        input_ids = torch.full((len(seqs), max_len), self.pad_token_id,
+                               dtype=torch.int64, device=device)
+        attention_mask = torch.zeros((len(seqs), max_len), dtype=torch.int64, device=device)
+        for i, seq in enumerate(seqs):
+            input_ids[i, max_len - len(seq.input_ids):] = torch.tensor(seq.input_ids)
+            attention_mask[i, max_len - len(seq.input_ids):] = 1
+        position_ids = (attention_mask.cumsum(-1) - 1).clamp(min=0)
+        logits, past_key_values = self._forward(input_ids, attention_mask, position_ids,
+                                                DynamicBatchCache())
+        next_tokens = self._sample(logits, seqs)
+
+        # merge the new sequences into the running batch
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+            self.position_ids = position_ids[:, -1:] + 1
+            self.next_input_ids = torch.tensor(next_tokens, device=device).unsqueeze(1)
+        else:
+            length = max(self.attention_mask.size(1), max_len)
+            self.past_key_values.extend(past_key_values)
+            self.attention_mask = torch.cat([
+                torch.nn.functional.pad(self.attention_mask,
+                                        (length - self.attention_mask.size(1), 0)),
+                torch.nn.functional.pad(attention_mask, (length - max_len, 0)),
+            ], dim=0)
+            self.position_ids = torch.cat([self.position_ids, position_ids[:, -1:] + 1], dim=0)
+            self.next_input_ids = torch.cat([
+                self.next_input_ids,
+                torch.tensor(next_tokens, device=device).unsqueeze(1)
+            ], dim=0)
+        self.running.extend(seqs)
+        return list(zip(seqs, next_tokens))
+
+    def _retire(self):
+        keep = [i for i, seq in enumerate(self.running) if not seq.finished]
+        if len(keep) == len(self.running):
+            return
+        if len(keep) == 0:
+            self.running = []
+            self.past_key_values = None
+            self.attention_mask = None
+            self.position_ids = None
+            self.next_input_ids = None
+            return
+        self.running = [self.running[i] for i in keep]
+        indices = torch.tensor(keep, dtype=torch.int64, device=self.device)
+        attention_mask = self.attention_mask[indices]
+        # drop the leading columns which are padding for all remaining rows
+        start = int((attention_mask != 0).any(dim=0).int().argmax())
+        self.past_key_values.select(indices, start)
+        self.attention_mask = attention_mask[:, start:]
+        self.position_ids = self.position_ids[indices]
+        self.next_input_ids = self.next_input_ids[indices]
+
+    @torch.no_grad()
+    def step(self) -> List[Tuple[Sequence, int]]:
+        """
+        Run one scheduling iteration.
+
+        :return: list of `(sequence, new_token_id)` produced in this iteration,
+                 check `sequence.finished` to know whether it is the last token.
+        """
+        outputs = []
+        if len(self.running) > 0:
+            outputs.extend(self._decode())
+            self._retire()
+
+        num_free_slots = self.max_num_seqs - len(self.running)
+        if self.max_prefilled_seqs > 0:
+            num_free_slots = min(num_free_slots, self.max_prefilled_seqs)
+        admitted = []
+        while len(self.waiting) > 0 and len(admitted) < num_free_slots:
+            admitted.append(self.waiting.popleft())
+        if len(admitted) > 0:
+            outputs.extend(self._prefill(admitted))
+            self._retire()
+        return outputs
@@ -477,6 +477,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                  mixed_precision=False,
                                  act_order=False,
                                  enable_scale_search=False,
+                                 quantize_pool=None,
                                  ):
     from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params, \
         FP16Linear, BF16Linear
@@ -664,7 +665,12 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                                              imatrix=cur_imatrix,
                                              in_features=in_features,
                                              enable_xetla=enable_xetla,
-                                             enable_scale_search=enable_scale_search).to(device)
+                                             enable_scale_search=enable_scale_search)
+                    if quantize_pool is None:
+                        paramsLowBit = paramsLowBit.to(device)
+                    else:
+                        # quantized in place by a worker thread, the caller waits for the pool
+                        quantize_pool.submit(paramsLowBit, device)
                     new_linear._parameters['weight'] = paramsLowBit
                     if module.bias is not None:
                         new_linear._parameters['bias'] = nn.Parameter(module.bias.data)\
@@ -766,6 +772,7 @@ def _replace_with_low_bit_linear(model, qtype, modules_to_not_convert=None,
                 mixed_precision=mixed_precision,
                 act_order=act_order,
                 enable_scale_search=enable_scale_search,
+                quantize_pool=quantize_pool,
             )
             has_been_replaced = _flag or has_been_replaced
     return model, has_been_replaced
@@ -915,6 +922,160 @@ def replace_with_low_bit_linear_for_module(model, qtype, module_name=None,
     return model
 
 
+def replace_with_quantized_linear_for_module(model, qtype, module_name, data, weight_shape):
+    """
+    Replace the linear layer of weight `module_name` with a LowBitLinear whose
+    weight is `data`, which is already quantized in the block layout of `qtype`.
+    """
+    from ipex_llm.transformers.low_bit_linear import LowBitLinear, FP4Params
+
+    invalidInputError(module_name.endswith(".weight"),
+                      f"Please provide the name of a linear weight, got {module_name}")
+    parent_name, _, name = module_name[:-len(".weight")].rpartition(".")
+    parent_module = model.get_submodule(parent_name)
+    module = parent_module._modules[name]
+    out_features, in_features = weight_shape
+    with init_empty_weights():
+        new_linear = LowBitLinear(
+            in_features,
+            out_features,
+            qtype,
+            module.bias is not None,
+        )
+    new_linear._parameters['weight'] = FP4Params(data=data.reshape(-1),
+                                                 requires_grad=False,
+                                                 quantized=True,
+                                                 _shape=(out_features, in_features),
+                                                 qtype=qtype,
+                                                 in_features=in_features)
+    if module.bias is not None:
+        new_linear._parameters['bias'] = module.bias
+    if not module.training:
+        new_linear.eval()
+    new_linear.requires_grad_(False)
+    parent_module._modules[name] = new_linear
+    return model
+
+
+# Per-module hooks applied by `model.apply` before linears are converted,
+# model_type -> [(module, hook)], where `module` is under `ipex_llm.transformers.models`
+# and imported only when a model of this type is converted.
+_PRE_OPTIMIZE_HOOKS = {
+    # for yuan 2.0
+    "yuan": [("yuan", "merge_qk")],
+    "starcoder2": [("starcoder2", "merge_qkv")],
+    "phi": [("phi", "merge_qkv")],
+    "phi3": [("phi3", "pre_compute_inv_freq"), ("phi3", "split_mlp")],
+    "phi3_v": [("phi3", "pre_compute_inv_freq"), ("phi3", "split_mlp")],
+    "qwen2_moe": [("qwen2_moe", "merge_qkv")],
+    "qwen2_vl": [("qwen2_vl", "merge_qkv")],
+    # for stablelm-zephyr-3b and stablelm-2-zephyr-1_6b
+    "stablelm": [("stablelm", "merge_qkv")],
+    "internlm": [("internlm", "merge_qkv")],
+    # for internlm-xcomposer2-vl
+    "internlmxcomposer2": [("internlm", "pre_process_attn_and_mlp")],
+    "gemma": [("gemma", "merge_qkv"), ("gemma", "pre_compute_inv_freq")],
+    "gemma2": [("gemma2", "merge_qkv")],
+    "llama": [("llama", "merge_qkv")],
+    "mllama": [("mllama", "merge_qkv")],
+    "minicpm": [("minicpm", "merge_qkv"), ("minicpm", "apply_residual_scale")],
+    "minicpm3": [("minicpm3", "pre_compute_inv_freq"), ("minicpm3", "padding_v_head_dim")],
+    "glm": [("glm", "merge_qkv"), ("glm", "split_mlp")],
+}
+
+# Forwards replaced after linears are converted, model_type -> [(class, module, forward)],
+# `class` is looked up in the modeling module of the model, `module` is under
+# `ipex_llm.transformers.models` and imported only when a model of this type is converted.
+# Model types whose replacements depend on the model size or transformers version
+# are handled in `_optimize_post`.
+_POST_OPTIMIZE_FORWARDS = {
+    # dolly-v1-6b
+    "gptj": [("GPTJAttention", "gptj", "gptj_attention_forward"),
+             ("GPTJModel", "gptj", "gptj_model_forward"),
+             ("GPTJBlock", "gptj", "gptj_block_forward")],
+    "bloom": [("BloomAttention", "bloom", "bloom_attention_forward")],
+    "internlm": [("InternLMAttention", "internlm", "internlm_attention_forward"),
+                 ("InternLMRMSNorm", "llama", "llama_rms_norm_forward")],
+    "internlm2": [("InternLM2Attention", "internlm", "internlm2_attention_forward"),
+                  ("InternLM2RMSNorm", "llama", "llama_rms_norm_forward")],
+    # for Qwen1.5-MOE-A2.7B
+    "qwen2_moe": [("Qwen2MoeModel", "qwen2_moe", "qwen2moe_model_forward"),
+                  ("Qwen2MoeForCausalLM", "qwen2_moe", "qwen2_moe_causal_lm_forward"),
+                  ("Qwen2MoeRMSNorm", "llama", "llama_rms_norm_forward"),
+                  ("Qwen2MoeSparseMoeBlock", "qwen2_moe", "qwen2moe_moeblock_forward"),
+                  ("Qwen2MoeMLP", "qwen2", "qwen2_mlp_forward"),
+                  ("Qwen2MoeAttention", "qwen2", "qwen2_attention_forward"),
+                  ("Qwen2MoeSdpaAttention", "qwen2", "qwen2_attention_forward")],
+    "aquila": [("AquilaAttention", "aquila", "aquila_attention_forward"),
+               ("AquilaRMSNorm", "llama", "llama_rms_norm_forward")],
+    "gemma": [("GemmaModel", "gemma", "gemma_model_forward"),
+              ("GemmaAttention", "gemma", "gemma_attention_forward"),
+              ("GemmaRMSNorm", "gemma", "gemma_rms_norm_forward"),
+              ("GemmaMLP", "common", "mlp_gelu_forward")],
+    "Yi": [("YiRMSNorm", "llama", "llama_rms_norm_forward")],
+    # rwkv v4
+    "rwkv": [("RwkvSelfAttention", "rwkv4", "rwkv_attention_forward"),
+             ("RwkvFeedForward", "rwkv4", "rwkv_ffn_forward")],
+    "deci": [("LlamaRMSNorm", "llama", "llama_rms_norm_forward"),
+             ("LlamaMLP", "llama", "llama_mlp_forward"),
+             ("DeciLMAttention", "decilm", "decilm_attention_forward_4_35_2")],
+    "starcoder2": [("Starcoder2Attention", "starcoder2", "attention_forward"),
+                   ("Starcoder2Model", "starcoder2", "model_forward")],
+    # for phi-2
+    "phi": [("PhiAttention", "phi", "attention_forward"),
+            ("PhiModel", "phi", "model_forward")],
+    # YuanMLP keeps its forward, `yuan_mlp_forward` breaks quantize_kv on mtl
+    "yuan": [("YuanAttention", "yuan", "yuan_attention_forward")],
+    # for stablelm-zephyr-3b and stablelm-2-zephyr-1_6b
+    "stablelm": [("StableLmAttention", "stablelm", "stablelm_attention_forward"),
+                 ("StableLmMLP", "llama", "llama_mlp_forward"),
+                 ("StableLmModel", "stablelm", "stablelm_model_forward")],
+}
+
+
+# `_POST_OPTIMIZE_FORWARDS` entries which also match model types containing them
+_POST_OPTIMIZE_SUBSTRING_TYPES = ["gptj", "bloom"]
+
+
+def _import_models_module(name):
+    # short names refer to modules under `ipex_llm.transformers.models`
+    if "." not in name:
+        name = f"ipex_llm.transformers.models.{name}"
+    return importlib.import_module(name)
+
+
+def register_pre_optimize_hook(model_type, module, hook):
+    """
+    Apply `hook` of `module` to all submodules of `model_type` models by `model.apply`
+    before their linears are converted to low-bit.
+
+    :param module: full module name, or a module name under `ipex_llm.transformers.models`.
+    :param hook: name of a function which takes an `nn.Module`.
+    """
+    _PRE_OPTIMIZE_HOOKS.setdefault(model_type, []).append((module, hook))
+
+
+def register_forward(model_type, class_name, module, forward):
+    """
+    Replace the `forward` of `class_name` in the modeling module of `model_type` models
+    with `forward` of `module` after their linears are converted to low-bit.
+
+    :param module: full module name, or a module name under `ipex_llm.transformers.models`.
+    """
+    _POST_OPTIMIZE_FORWARDS.setdefault(model_type, []).append((class_name, module, forward))
+
+
+def _post_optimize_forwards_type(model_type):
+    # gptj and bloom forwards also apply to model types containing their name,
+    # e.g. model types of remote code variants
+    if model_type in _POST_OPTIMIZE_FORWARDS:
+        return model_type
+    for name in _POST_OPTIMIZE_SUBSTRING_TYPES:
+        if name in model_type:
+            return name
+    return None
+
+
 def _optimize_pre(model, qtype=None):
     try:
         from sentence_transformers.SentenceTransformer import SentenceTransformer
@@ -933,6 +1094,8 @@ def _optimize_pre(model, qtype=None):
                     "supported for further optimizations")
         return model
 
+    for hook in _pre_optimize_hooks(model, qtype):
+        model.apply(hook)
     # for rwkv models (verified RWKV/rwkv-4-world-7b)
     if model.config.model_type == "rwkv":
         model.rwkv._rescale_layers()
@@ -958,88 +1121,11 @@ def _optimize_pre(model, qtype=None):
         if model.config.hidden_size in [4096, 2048]:
             from ipex_llm.transformers.models.baichuan import pre_compute_inv_freq
             model.apply(pre_compute_inv_freq)
-    # for yuan 2.0
-    elif model.config.model_type == "yuan":
-        from ipex_llm.transformers.models.yuan import merge_qk
-        model.apply(merge_qk)
-    # for bge-large
-    elif model.config.model_type == 'bert' and (
-        not model.config.is_decoder and
-        model.config.position_embedding_type == "absolute"
-    ):
-        from ipex_llm.transformers.models.bert import merge_qkv
-        model.apply(merge_qkv)
-    # for starcoder2
-    elif model.config.model_type == "starcoder2":
-        from ipex_llm.transformers.models.starcoder2 import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type == "phi":
-        from ipex_llm.transformers.models.phi import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type in ["phi3", "phi3_v"]:
-        from ipex_llm.transformers.models.phi3 import pre_compute_inv_freq
-        model.apply(pre_compute_inv_freq)
-        from ipex_llm.transformers.models.phi3 import split_mlp
-        model.apply(split_mlp)
-    # for qwen2
-    elif model.config.model_type == "qwen2":
-        # Skip merge_qkv and padding_mlp if quant_method is 'gptq'
-        should_apply_merge_qkv = (
-            not hasattr(model.config, "quantization_config") or
-            not hasattr(model.config.quantization_config, "quant_method") or
-            model.config.quantization_config.quant_method != "gptq"
-        )
-        if should_apply_merge_qkv:
-            from ipex_llm.transformers.models.qwen2 import merge_qkv
-            model.apply(merge_qkv)
-            if qtype != ggml_tensor_qtype["fp6"]:
-                from ipex_llm.transformers.models.qwen2 import padding_mlp
-                model.apply(padding_mlp)
-    elif model.config.model_type == "qwen2_moe":
-        from ipex_llm.transformers.models.qwen2_moe import merge_qkv
-        model.apply(merge_qkv)
     elif model.config.model_type == "qwen2_audio":
         from ipex_llm.transformers.models.qwen2 import merge_qkv
         model.language_model.apply(merge_qkv)
-    elif model.config.model_type == "qwen2_vl":
-        from ipex_llm.transformers.models.qwen2_vl import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type == "stablelm":
-        # For stablelm-zephyr-3b and stablelm-2-zephyr-1_6b
-        from ipex_llm.transformers.models.stablelm import merge_qkv
-        model.apply(merge_qkv)
-    # for internlm
-    elif model.config.model_type == "internlm":
-        from ipex_llm.transformers.models.internlm import merge_qkv
-        model.apply(merge_qkv)
-    # for internlm-xcomposer2-vl
-    elif model.config.model_type == "internlmxcomposer2":
-        from ipex_llm.transformers.models.internlm import pre_process_attn_and_mlp
-        model.apply(pre_process_attn_and_mlp)
     elif model.config.model_type == "internvl_chat":
         _optimize_pre(model.language_model, qtype=qtype)
-    elif model.config.model_type == "gemma":
-        from ipex_llm.transformers.models.gemma import merge_qkv, pre_compute_inv_freq
-        model.apply(merge_qkv)
-        model.apply(pre_compute_inv_freq)
-    elif model.config.model_type == "gemma2":
-        from ipex_llm.transformers.models.gemma2 import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type == "llama":
-        from ipex_llm.transformers.models.llama import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type == "mllama":
-        from ipex_llm.transformers.models.mllama import merge_qkv
-        model.apply(merge_qkv)
-    elif model.config.model_type == "minicpm":
-        from ipex_llm.transformers.models.minicpm import merge_qkv, apply_residual_scale
-        model.apply(merge_qkv)
-        model.apply(apply_residual_scale)
-    elif model.config.model_type == "minicpm3":
-        from ipex_llm.transformers.models.minicpm3 import pre_compute_inv_freq
-        model.apply(pre_compute_inv_freq)
-        from ipex_llm.transformers.models.minicpm3 import padding_v_head_dim
-        model.apply(padding_v_head_dim)
     elif model.config.model_type == "minicpmv":
         from ipex_llm.transformers.models.minicpmv import merge_qkv
         model.vpm.apply(merge_qkv)
@@ -1061,27 +1147,55 @@ def _optimize_pre(model, qtype=None):
         model.llm.config.model_type = "llama"
         _optimize_pre(model.llm, qtype=qtype)
         model.llm.config.model_type = "megrezo"
-    elif model.config.model_type == "chatglm":
-        if hasattr(model.config, 'padded_vocab_size') and model.config.padded_vocab_size == 65024:
+
+    return model
+
+
+def _pre_optimize_hooks(model, qtype=None):
+    """
+    Per-module hooks of `_optimize_pre`, which are applied by `model.apply`. They only
+    depend on the model config, so that a model converted layer by layer decides them once.
+    """
+    config = model.config
+    if config.model_type in _PRE_OPTIMIZE_HOOKS:
+        return [getattr(_import_models_module(module_name), hook)
+                for module_name, hook in _PRE_OPTIMIZE_HOOKS[config.model_type]]
+    # for bge-large
+    elif config.model_type == 'bert' and (
+        not config.is_decoder and
+        config.position_embedding_type == "absolute"
+    ):
+        from ipex_llm.transformers.models.bert import merge_qkv
+        return [merge_qkv]
+    # for qwen2
+    elif config.model_type == "qwen2":
+        # Skip merge_qkv and padding_mlp if quant_method is 'gptq'
+        should_apply_merge_qkv = (
+            not hasattr(config, "quantization_config") or
+            not hasattr(config.quantization_config, "quant_method") or
+            config.quantization_config.quant_method != "gptq"
+        )
+        if should_apply_merge_qkv:
+            from ipex_llm.transformers.models.qwen2 import merge_qkv
+            if qtype != ggml_tensor_qtype["fp6"]:
+                from ipex_llm.transformers.models.qwen2 import padding_mlp
+                return [merge_qkv, padding_mlp]
+            return [merge_qkv]
+    elif config.model_type == "chatglm":
+        if hasattr(config, 'padded_vocab_size') and config.padded_vocab_size == 65024:
             # chatglm2 and chatglm3
             from ipex_llm.transformers.models.chatglm2 import split_mlp
-            model.apply(split_mlp)
-        elif isinstance(model.config.eos_token_id, list):
+            return [split_mlp]
+        elif isinstance(config.eos_token_id, list):
             from ipex_llm.transformers.models.chatglm2 import split_mlp
             # glm4 family
             if hasattr(model.transformer, "vision"):
-                if model.config.num_layers != 40:
+                if config.num_layers != 40:
                     from ipex_llm.transformers.models.chatglm4v import merge_qkv
-                    model.apply(merge_qkv)
-                    model.apply(split_mlp)
-            elif model.config.num_layers in [40, 28]:
-                model.apply(split_mlp)
-    elif model.config.model_type == "glm":
-        from ipex_llm.transformers.models.glm import merge_qkv, split_mlp
-        model.apply(merge_qkv)
-        model.apply(split_mlp)
-
-    return model
+                    return [merge_qkv, split_mlp]
+            elif config.num_layers in [40, 28]:
+                return [split_mlp]
+    return []
 
 
 def ggml_convert_low_bit(model, qtype, optimize_model=True,
@@ -1305,10 +1419,15 @@ def _optimize_post(model, lightweight_bmm=False):
     from ipex_llm.transformers.models.common import layer_norm_forward
     convert_forward(model, nn.LayerNorm, layer_norm_forward)
 
-    from ipex_llm.transformers.models.llama import llama_rms_norm_forward
-    from ipex_llm.transformers.models.llama import llama_mlp_forward
-
-    if model.config.model_type == "llama" and model.config.rope_scaling is not None:
+    post_forwards_type = _post_optimize_forwards_type(model.config.model_type)
+    if post_forwards_type is not None:
+        modeling_module_name = model.__class__.__module__
+        module = importlib.import_module(modeling_module_name)
+        for class_name, module_name, forward in _POST_OPTIMIZE_FORWARDS[post_forwards_type]:
+            convert_forward(model,
+                            getattr(module, class_name),
+                            getattr(_import_models_module(module_name), forward))
+    elif model.config.model_type == "llama" and model.config.rope_scaling is not None:
         # llama 3.2 & llama 3.1
         modeling_module_name = model.__class__.__module__
         module = importlib.import_module(modeling_module_name)
@@ -1530,29 +1649,6 @@ def _optimize_post(model, lightweight_bmm=False):
                             module.MultiheadAttention,
                             mpt_multihead_attention_forward
                             )
-    elif "gptj" in model.config.model_type:
-        # dolly-v1-6b
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.gptj import gptj_attention_forward, gptj_model_forward,\
-            gptj_block_forward
-        convert_forward(model,
-                        module.GPTJAttention,
-                        gptj_attention_forward)
-        convert_forward(model,
-                        module.GPTJModel,
-                        gptj_model_forward)
-        convert_forward(model,
-                        module.GPTJBlock,
-                        gptj_block_forward)
-    elif "bloom" in model.config.model_type:
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.bloom import bloom_attention_forward
-        convert_forward(model,
-                        module.BloomAttention,
-                        bloom_attention_forward
-                        )
     elif "falcon" in model.config.model_type or "RefinedWeb" in model.config.model_type:
         if model.config.architectures is not None:
             modeling_module_name = model.__class__.__module__
@@ -1601,6 +1697,7 @@ def _optimize_post(model, lightweight_bmm=False):
             # baichuan-7B and baichuan2-7B
             from ipex_llm.transformers.models.baichuan import baichuan_attention_forward_7b
             from ipex_llm.transformers.models.baichuan import baichuan_model_7b_forward
+            from ipex_llm.transformers.models.llama import llama_rms_norm_forward
             for i in range(len(model.model.layers)):
                 setattr(model.model.layers[i].self_attn, "layer_idx", i)
             convert_forward(model, module.Attention, baichuan_attention_forward_7b)
@@ -1644,18 +1741,6 @@ def _optimize_post(model, lightweight_bmm=False):
                         transformers.models.gpt_neox.modeling_gpt_neox.GPTNeoXAttention,
                         gptneox_attention_forward
                         )
-    elif model.config.model_type == "internlm":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.internlm import internlm_attention_forward
-        convert_forward(model, module.InternLMAttention, internlm_attention_forward)
-        convert_forward(model, module.InternLMRMSNorm, llama_rms_norm_forward)
-    elif model.config.model_type == "internlm2":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.internlm import internlm2_attention_forward
-        convert_forward(model, module.InternLM2Attention, internlm2_attention_forward)
-        convert_forward(model, module.InternLM2RMSNorm, llama_rms_norm_forward)
     elif model.config.model_type == "internlmxcomposer2":
         modeling_module_name = model.model.__class__.__module__
         module = importlib.import_module(modeling_module_name)
@@ -1665,6 +1750,7 @@ def _optimize_post(model, lightweight_bmm=False):
             internlm_xcomposser2_model_forward_wrapper,
             internlm_xcomposser2_chat
         )
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
         convert_forward(model, module.InternLM2Attention, internlm_xcomposser2_attention_forward)
         convert_forward(model, module.InternLM2MLP, internlm_xcomposser2_mlp_forward)
         convert_forward(model, module.InternLM2RMSNorm, llama_rms_norm_forward)
@@ -1741,6 +1827,7 @@ def _optimize_post(model, lightweight_bmm=False):
         from ipex_llm.transformers.models.qwen2 import qwen2_attention_forward
         from ipex_llm.transformers.models.qwen2 import qwen2_causal_lm_forward
         from ipex_llm.transformers.models.qwen2 import qwen2_mlp_forward
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
         convert_forward(model,
                         module.Qwen2ForCausalLM,
                         qwen2_causal_lm_forward)
@@ -1762,36 +1849,6 @@ def _optimize_post(model, lightweight_bmm=False):
         else:
             from ipex_llm.transformers.models.qwen2 import qwen2_model_forward
             convert_forward(model, module.Qwen2Model, qwen2_model_forward)
-    elif model.config.model_type == "qwen2_moe":
-        # for Qwen1.5-MOE-A2.7B
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.qwen2_moe import qwen2moe_moeblock_forward
-        from ipex_llm.transformers.models.qwen2_moe import qwen2moe_model_forward
-        from ipex_llm.transformers.models.qwen2_moe import qwen2_moe_causal_lm_forward
-        from ipex_llm.transformers.models.qwen2 import qwen2_attention_forward
-        from ipex_llm.transformers.models.qwen2 import qwen2_mlp_forward
-        convert_forward(model,
-                        module.Qwen2MoeModel,
-                        qwen2moe_model_forward)
-        convert_forward(model,
-                        module.Qwen2MoeForCausalLM,
-                        qwen2_moe_causal_lm_forward)
-        convert_forward(model,
-                        module.Qwen2MoeRMSNorm,
-                        llama_rms_norm_forward)
-        convert_forward(model,
-                        module.Qwen2MoeSparseMoeBlock,
-                        qwen2moe_moeblock_forward)
-        convert_forward(model,
-                        module.Qwen2MoeMLP,
-                        qwen2_mlp_forward)
-        convert_forward(model,
-                        module.Qwen2MoeAttention,
-                        qwen2_attention_forward)
-        convert_forward(model,
-                        module.Qwen2MoeSdpaAttention,
-                        qwen2_attention_forward)
     elif model.config.model_type == "qwen2_audio":
         _optimize_post(model.language_model, lightweight_bmm=lightweight_bmm)
     elif model.config.model_type == "qwen2_vl":
@@ -1828,6 +1885,8 @@ def _optimize_post(model, lightweight_bmm=False):
                             cohere_model_forward)
 
         from ipex_llm.transformers.models.cohere import cohere_attention_forward
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
+        from ipex_llm.transformers.models.llama import llama_mlp_forward
         convert_forward(model,
                         module.CohereAttention,
                         cohere_attention_forward)
@@ -1837,17 +1896,6 @@ def _optimize_post(model, lightweight_bmm=False):
         convert_forward(model,
                         module.CohereMLP,
                         llama_mlp_forward)
-    elif model.config.model_type == "aquila":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.aquila import aquila_attention_forward
-        convert_forward(model,
-                        module.AquilaAttention,
-                        aquila_attention_forward
-                        )
-        convert_forward(model,
-                        module.AquilaRMSNorm,
-                        llama_rms_norm_forward)
     elif model.config.model_type == "mixtral":
         # For mistralai/Mixtral-8x7B-v0.1
         invalidInputError(version.parse(trans_version) >= version.parse("4.36.0"),
@@ -1857,6 +1905,7 @@ def _optimize_post(model, lightweight_bmm=False):
         module = importlib.import_module(modeling_module_name)
         from ipex_llm.transformers.models.mixtral import mixtral_moeblock_forward, \
             mixtral_attention_forward, mixtral_mlp_forward, mixtral_model_forward
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
         convert_forward(model,
                         module.MixtralAttention,
                         mixtral_attention_forward)
@@ -1887,6 +1936,8 @@ def _optimize_post(model, lightweight_bmm=False):
                         module.MLP,
                         phixtral_mlp_forward)
     elif model.config.model_type == "mistral":
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
+        from ipex_llm.transformers.models.llama import llama_mlp_forward
         if model.config.architectures is not None and \
                 model.config.architectures[0] == "MixtralForCausalLM":
             # For DiscoResearch/mixtral-7b-8expert
@@ -1938,17 +1989,6 @@ def _optimize_post(model, lightweight_bmm=False):
                 convert_forward(model,
                                 module.MistralMLP,
                                 llama_mlp_forward)
-    elif model.config.model_type == "gemma":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.gemma import gemma_model_forward
-        from ipex_llm.transformers.models.gemma import gemma_attention_forward
-        from ipex_llm.transformers.models.gemma import gemma_rms_norm_forward
-        from ipex_llm.transformers.models.common import mlp_gelu_forward
-        convert_forward(model, module.GemmaModel, gemma_model_forward)
-        convert_forward(model, module.GemmaAttention, gemma_attention_forward)
-        convert_forward(model, module.GemmaRMSNorm, gemma_rms_norm_forward)
-        convert_forward(model, module.GemmaMLP, mlp_gelu_forward)
     elif model.config.model_type == "gemma2":
         modeling_module_name = model.__class__.__module__
         module = importlib.import_module(modeling_module_name)
@@ -1964,12 +2004,6 @@ def _optimize_post(model, lightweight_bmm=False):
         convert_forward(model, Gemma2SdpaAttention, gemma2_attention_forward)
         convert_forward(model, Gemma2Model, gemma2_model_forward)
         convert_forward(model, Gemma2MLP, mlp_gelu_forward)
-    elif model.config.model_type == "Yi":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        convert_forward(model,
-                        module.YiRMSNorm,
-                        llama_rms_norm_forward)
     elif model.config.model_type == "whisper" and lightweight_bmm:
         if platform.system().lower() == 'windows':
             from ipex_llm.transformers.bmm import SafeBMM
@@ -1984,18 +2018,6 @@ def _optimize_post(model, lightweight_bmm=False):
             convert_forward(model,
                             module.WhisperAttention,
                             safe_bmm_fwd)
-    elif model.config.model_type == "rwkv":
-        # rwkv v4
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.rwkv4 import rwkv_attention_forward
-        from ipex_llm.transformers.models.rwkv4 import rwkv_ffn_forward
-        convert_forward(model,
-                        module.RwkvSelfAttention,
-                        rwkv_attention_forward)
-        convert_forward(model,
-                        module.RwkvFeedForward,
-                        rwkv_ffn_forward)
     elif model.config.model_type == "rwkv5":
         # rwkv v5
         modeling_module_name = model.__class__.__module__
@@ -2014,19 +2036,6 @@ def _optimize_post(model, lightweight_bmm=False):
         convert_forward(model,
                         module.Rwkv5Model,
                         rwkv_model_forward)
-    elif model.config.model_type == "deci":
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.decilm import decilm_attention_forward_4_35_2
-        convert_forward(model,
-                        module.LlamaRMSNorm,
-                        llama_rms_norm_forward)
-        convert_forward(model,
-                        module.LlamaMLP,
-                        llama_mlp_forward)
-        convert_forward(model,
-                        module.DeciLMAttention,
-                        decilm_attention_forward_4_35_2, )
     elif model.config.model_type == "gpt_bigcode":
         # starcoder
         modeling_module_name = model.__class__.__module__
@@ -2054,22 +2063,6 @@ def _optimize_post(model, lightweight_bmm=False):
                          sdpa_attn)
         except AttributeError:
             pass
-    elif model.config.model_type == "starcoder2":
-        # starcoder2
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.starcoder2 import attention_forward
-        from ipex_llm.transformers.models.starcoder2 import model_forward
-        convert_forward(model, module.Starcoder2Attention, attention_forward)
-        convert_forward(model, module.Starcoder2Model, model_forward)
-    elif model.config.model_type == "phi":
-        # for phi-2
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.phi import attention_forward
-        from ipex_llm.transformers.models.phi import model_forward
-        convert_forward(model, module.PhiAttention, attention_forward)
-        convert_forward(model, module.PhiModel, model_forward)
     elif model.config.model_type in ["phi3", "phi3_v"]:
         # for phi-3
         modeling_module_name = model.__class__.__module__
@@ -2088,20 +2081,6 @@ def _optimize_post(model, lightweight_bmm=False):
             from ipex_llm.transformers.models.phi3 import phi3v_model_forward_wrapper
             model_forward = phi3v_model_forward_wrapper(module.Phi3VModel.forward)
             convert_forward(model, module.Phi3VModel, model_forward)
-    elif model.config.model_type == 'yuan':
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.yuan import yuan_attention_forward
-        # from ipex_llm.transformers.models.yuan import yuan_mlp_forward
-        convert_forward(model,
-                        module.YuanAttention,
-                        yuan_attention_forward
-                        )
-        # disable able mlp_forward for quantize_kv on mtl.
-        # convert_forward(model,
-        #                 module.YuanMLP,
-        #                 yuan_mlp_forward
-        #                 )
     elif model.config.model_type == 'bert' and (
         not model.config.is_decoder and
         model.config.position_embedding_type == "absolute"
@@ -2116,29 +2095,14 @@ def _optimize_post(model, lightweight_bmm=False):
         convert_forward(model,
                         module.BertEncoder,
                         encoder_forward)
-    elif model.config.model_type == 'stablelm':
-        # For stablelm-zephyr-3b and stablelm-2-zephyr-1_6b
-        modeling_module_name = model.__class__.__module__
-        module = importlib.import_module(modeling_module_name)
-        from ipex_llm.transformers.models.stablelm import stablelm_attention_forward
-        from ipex_llm.transformers.models.stablelm import stablelm_model_forward
-        convert_forward(model,
-                        module.StableLmAttention,
-                        stablelm_attention_forward
-                        )
-        convert_forward(model,
-                        module.StableLmMLP,
-                        llama_mlp_forward)
-        convert_forward(model,
-                        module.StableLmModel,
-                        stablelm_model_forward
-                        )
     elif model.config.model_type == "minicpm":
         modeling_module_name = model.__class__.__module__
         module = importlib.import_module(modeling_module_name)
         from ipex_llm.transformers.models.minicpm import minicpm_attention_forward
         from ipex_llm.transformers.models.minicpm import minicpm_model_forward_wrapper
         from ipex_llm.transformers.models.minicpm import minicpm_decoder_layer_forward
+        from ipex_llm.transformers.models.llama import llama_rms_norm_forward
+        from ipex_llm.transformers.models.llama import llama_mlp_forward
         convert_forward(model, module.MiniCPMAttention, minicpm_attention_forward)
         convert_forward(model, module.MiniCPMMLP, llama_mlp_forward)
         convert_forward(model, module.MiniCPMRMSNorm, llama_rms_norm_forward)
@@ -0,0 +1,178 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import time
+import queue
+import hashlib
+import logging
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, List, Optional
+
+import torch
+from ipex_llm.utils.common import invalidInputError
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingEngine:
+    """
+    Compute embeddings of concurrent requests in padded batches.
+
+    Requests submitted from any thread are collected by a background thread for at
+    most `max_wait_ms` after the first one arrives, sorted by length and grouped into
+    buckets of `bucket_size` tokens, so every forward only pads a bucket's sequences
+    to the longest one of the bucket. Each bucket runs one forward of at most
+    `max_batch_size` sequences and every request gets its own row back.
+
+    `forward_fn(input_ids, attention_mask)` takes right padded `[batch_size, seq_len]`
+    cpu tensors and returns pooled `[batch_size, hidden_size]` embeddings, e.g.
+
+        engine = EmbeddingEngine(forward_fn, pad_token_id=tokenizer.pad_token_id)
+        embeddings = engine.embed([tokenizer.encode(text) for text in texts])
+
+    When `cache_size > 0`, the embeddings of the most recently used `cache_size` token
+    sequences are kept and identical sequences are not computed again.
+    """
+    def __init__(self, forward_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                 pad_token_id: Optional[int] = None,
+                 max_batch_size: int = 32,
+                 max_wait_ms: float = 2.0,
+                 bucket_size: int = 64,
+                 cache_size: int = 0):
+        invalidInputError(max_batch_size > 0 and bucket_size > 0,
+                          "max_batch_size and bucket_size should be positive.")
+        self.forward_fn = forward_fn
+        self.pad_token_id = pad_token_id if pad_token_id is not None else 0
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.bucket_size = bucket_size
+        # requests collected in one round, the surplus of a bulk submit is sorted
+        # and bucketed together instead of being cut at the first `max_batch_size`
+        self.max_num_requests = max_batch_size * 8
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.requests = queue.Queue()
+        self.thread = None
+        self.num_requests = 0
+        self.num_cache_hits = 0
+        self.num_batches = 0
+        self.num_padded_tokens = 0
+        self.num_tokens = 0
+
+    def get_stats(self) -> dict:
+        return {
+            "num_requests": self.num_requests,
+            "num_cache_hits": self.num_cache_hits,
+            "num_batches": self.num_batches,
+            "num_tokens": self.num_tokens,
+            "num_padded_tokens": self.num_padded_tokens,
+        }
+
+    @staticmethod
+    def _hash(input_ids: List[int]) -> bytes:
+        return hashlib.sha1(array("q", input_ids).tobytes()).digest()
+
+    def submit(self, input_ids: List[int]) -> Future:
+        """Submit the token ids of one sequence, the future resolves to its embedding."""
+        invalidInputError(len(input_ids) > 0, "Input of an embedding request should not be empty.")
+        future = Future()
+        key = None
+        with self.lock:
+            self.num_requests += 1
+            if self.cache_size > 0:
+                key = self._hash(input_ids)
+                embedding = self.cache.get(key, None)
+                if embedding is not None:
+                    self.cache.move_to_end(key)
+                    self.num_cache_hits += 1
+                    future.set_result(embedding)
+                    return future
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, daemon=True,
+                                               name="ipex_llm_embedding_engine")
+                self.thread.start()
+        self.requests.put((list(input_ids), key, future))
+        return future
+
+    def embed(self, batch_input_ids: List[List[int]]) -> List[torch.Tensor]:
+        """Compute the embeddings of a list of token id sequences, blocks until done."""
+        futures = [self.submit(input_ids) for input_ids in batch_input_ids]
+        return [future.result() for future in futures]
+
+    def _collect(self):
+        requests = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(requests) < self.max_num_requests:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout > 0:
+                    requests.append(self.requests.get(timeout=timeout))
+                else:
+                    requests.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return requests
+
+    def _buckets(self, requests):
+        requests = sorted(requests, key=lambda r: len(r[0]))
+        batch = []
+        for request in requests:
+            if len(batch) > 0 and (len(batch) >= self.max_batch_size or
+                                   (len(request[0]) - 1) // self.bucket_size !=
+                                   (len(batch[0][0]) - 1) // self.bucket_size):
+                yield batch
+                batch = []
+            batch.append(request)
+        if len(batch) > 0:
+            yield batch
+
+    @torch.inference_mode()
+    def _run(self, batch):
+        seq_len = len(batch[-1][0])
+        input_ids = torch.full((len(batch), seq_len), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), seq_len), dtype=torch.long)
+        for i, (ids, _, _) in enumerate(batch):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[i, :len(ids)] = 1
+        embeddings = self.forward_fn(input_ids, attention_mask).float().cpu()
+
+        self.num_batches += 1
+        self.num_tokens += sum(len(ids) for ids, _, _ in batch)
+        self.num_padded_tokens += input_ids.numel()
+        with self.lock:
+            for (_, key, _), embedding in zip(batch, embeddings):
+                if key is not None:
+                    self.cache[key] = embedding
+                    self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        for (_, _, future), embedding in zip(batch, embeddings):
+            future.set_result(embedding)
+
+    def _loop(self):
+        while True:
+            for batch in self._buckets(self._collect()):
+                try:
+                    self._run(batch)
+                except Exception as e:
+                    logger.error(f"Failed to compute embeddings of a batch: {e}")
+                    for _, _, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
@@ -27,6 +27,20 @@ qtype_map = {
     9: "asym_int5",     # q5_1
 }
 
+# k-quant GGUF file types, which are dequantized while loading, the names are the
+# GGUF file types and not ipex-llm qtypes
+kquant_file_types = {
+    10: "q2_k",
+    11: "q3_k_s",
+    12: "q3_k_m",
+    13: "q3_k_l",
+    14: "q4_k_s",
+    15: "q4_k_m",
+    16: "q5_k_s",
+    17: "q5_k_m",
+    18: "q6_k",
+}
+
 
 def load_gguf_model(fpath: str, dtype: torch.dtype = torch.float, low_bit: str = "sym_int4"):
     from .gguf import GGUFFileLoader
@@ -39,7 +53,8 @@ def load_gguf_model(fpath: str, dtype: torch.dtype = torch.float, low_bit: str =
     print("model_family:" + model_family)
     qtype = loader.config["general.file_type"]
 
-    invalidInputError(qtype in qtype_map, f"Unsupported gguf quantize type: {qtype}")
+    invalidInputError(qtype in qtype_map or qtype in kquant_file_types,
+                      f"Unsupported gguf quantize type: {qtype}")
 
     with torch.no_grad():
         if model_family == "llama":
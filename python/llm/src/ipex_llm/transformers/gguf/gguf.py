@@ -18,16 +18,29 @@
 # and https://github.com/ggerganov/llama.cpp/blob/master/ggml-quants.c
 # and https://github.com/ggerganov/llama.cpp/blob/master/llama.cpp
 
+import os
 import struct
 import functools
 import torch
 import numpy
 
 from io import BufferedReader
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
 from ipex_llm.utils.common import invalidInputError
 
 
+# gguf qtypes quantized like an ipex-llm low-bit qtype, such tensors can be used as
+# low-bit weights without dequantization if the ipex-llm build uses the same block
+# shape, see `GGUFTensorLoader.is_passthrough`
+GGUF_PASSTHROUGH_QTYPES = {
+    2: ggml_tensor_qtype["sym_int4"],   # q4_0
+    8: ggml_tensor_qtype["sym_int8"],   # q8_0
+}
+
+
 class GGUFReader:
     def __init__(self, f: BufferedReader):
         self.f = f
@@ -162,8 +175,35 @@ class GGUFTensorInfos:
         self.base_offset = base_offset
 
 
+class GGUFBlockTensor:
+    """
+    A quantized gguf tensor kept as raw blocks.
+
+    `data` is a [rows, row_size_in_bytes] uint8 tensor, every row holds the blocks of
+    one output channel, so rows can be reordered without dequantization.
+    `qtype` is the ipex-llm qtype with the same block layout.
+    """
+    def __init__(self, data: torch.Tensor, qtype: int, dims, convert_func):
+        self.data = data
+        self.qtype = qtype
+        self.shape = torch.Size(dims)
+        self.convert_func = convert_func
+
+    def permute_rows(self, n_head: int):
+        # same as reshape(n_head, rows // n_head // 2, 2, ...).swapaxes(1, 2) on float weight
+        rows = self.data.size(0)
+        data = (self.data.reshape(n_head, rows // n_head // 2, 2, -1)
+                         .swapaxes(1, 2)
+                         .reshape(rows, -1))
+        return GGUFBlockTensor(data, self.qtype, self.shape, self.convert_func)
+
+    def dequantize(self):
+        data = self.data.reshape(-1)
+        return self.convert_func(data, data.numel(), len(self.shape), list(self.shape))
+
+
 class GGUFTensorLoader:
-    def __init__(self, fpath: str, tensor_infos: GGUFTensorInfos):
+    def __init__(self, fpath: str, tensor_infos: GGUFTensorInfos, num_threads: int = None):
         self.block_ne = {
             0: 1,       # f32
             1: 1,       # f16
@@ -193,10 +233,10 @@ class GGUFTensorLoader:
             7: 24,      # q5_1
             8: 34,      # q8_0
             9: 40,      # q8_1
-            10: 0,      # q2_k
-            11: 0,      # q3_k
-            12: 0,      # q4_k
-            13: 0,      # q5_k
+            10: 84,     # q2_k
+            11: 110,    # q3_k
+            12: 144,    # q4_k
+            13: 176,    # q5_k
             14: 210,    # q6_k
             15: 0,      # q8_k
             16: 1,      # i8
@@ -213,10 +253,10 @@ class GGUFTensorLoader:
             7: self.convert_q5_1_tensor,        # q5_1
             8: self.convert_q8_0_tensor,        # q8_0
             9: self.convert_unknown_tensor,     # q8_1
-            10: self.convert_unknown_tensor,    # q2_k
-            11: self.convert_unknown_tensor,    # q3_k
-            12: self.convert_unknown_tensor,    # q4_k
-            13: self.convert_unknown_tensor,    # q5_k
+            10: self.convert_q2_k_tensor,       # q2_k
+            11: self.convert_q3_k_tensor,       # q3_k
+            12: self.convert_q4_k_tensor,       # q4_k
+            13: self.convert_q5_k_tensor,       # q5_k
             14: self.convert_q6_k_tensor,       # q6_k
             15: self.convert_unknown_tensor,    # q8_k
             16: self.convert_unknown_tensor,    # i8
@@ -227,42 +267,97 @@ class GGUFTensorLoader:
         self.fpath = fpath
         self.infos = tensor_infos.infos
         self.base_offset = tensor_infos.base_offset
+        self.buffer = None
+        if num_threads is None:
+            num_threads = int(os.environ.get("IPEX_LLM_GGUF_LOAD_THREADS",
+                                             min(8, os.cpu_count() or 1)))
+        self.num_threads = num_threads
+
+    def is_passthrough(self, qtype: int, passthrough_qtype: int) -> bool:
+        """
+        Whether gguf blocks of `qtype` can be used as low-bit weights of `passthrough_qtype`.
+        ipex-llm may build a qtype with larger blocks than gguf, e.g. 64 values per
+        sym_int4 (q4_0) block instead of 32, such gguf tensors are dequantized.
+        """
+        if GGUF_PASSTHROUGH_QTYPES.get(qtype, None) != passthrough_qtype:
+            return False
+        import ipex_llm.ggml.model.llama.llama_cpp as ggml
+        return ggml.ggml_qk_size(passthrough_qtype) == self.block_ne[qtype] \
+            and ggml.ggml_type_size(passthrough_qtype) == self.block_size[qtype]
+
+    def _permute_rows(self, name, dims, tensor, row_permutes):
+        # llama.cpp interleaves the rotary halves of q/k heads, undo it for transformers
+        for suffix, n_head in row_permutes.items():
+            if name.endswith(suffix):
+                if isinstance(tensor, GGUFBlockTensor):
+                    return tensor.permute_rows(n_head)
+                return (tensor.reshape(n_head, dims[0] // n_head // 2, 2, *dims[1:])
+                              .swapaxes(1, 2)
+                              .reshape(dims))
+        return tensor
+
+    def _load_tensor(self, info, passthrough_qtype: int = None, row_permutes: dict = None):
+        name, ndims, dims, qtype, offset = info
+        total_ne = functools.reduce(lambda x, y: x * y, dims)
+        invalidInputError(total_ne % self.block_ne[qtype] == 0,
+                          f"wrong elements num: {dims}")
+
+        size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
+        invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
+
+        offset += self.base_offset
+        # zero-copy view of the tensor's bytes in the mapped file
+        tensor = torch.from_numpy(self.buffer[offset:offset + size])
+        if passthrough_qtype is not None and ndims == 2 \
+                and self.is_passthrough(qtype, passthrough_qtype):
+            tensor = GGUFBlockTensor(tensor.reshape(dims[0], -1), passthrough_qtype,
+                                     dims, self.convert_funcs[qtype])
+        else:
+            tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
+        if row_permutes:
+            tensor = self._permute_rows(name, dims, tensor, row_permutes)
+        return name, tensor
+
+    def _load_tensors(self, passthrough_qtype: int = None, row_permutes: dict = None):
+        if self.buffer is None:
+            # copy-on-write mapping, so tensor views are writable but never change the file
+            self.buffer = numpy.memmap(self.fpath, dtype=numpy.uint8, mode="c")
+        infos = tqdm(self.infos, desc="Loading gguf tensors")
+        if self.num_threads <= 1:
+            for info in infos:
+                yield self._load_tensor(info, passthrough_qtype, row_permutes)
+            return
+
+        # dequantization and row permutation run in the thread pool (torch ops release
+        # the GIL), at most `num_threads` tensors are in flight and they are yielded in
+        # file order
+        with ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            futures = deque()
+            for info in infos:
+                futures.append(pool.submit(self._load_tensor, info, passthrough_qtype,
+                                           row_permutes))
+                if len(futures) >= self.num_threads:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
 
     def __iter__(self):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8).copy()
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                yield name, tensor
-
-    def load_while_process(self, process):
-        with open(self.fpath, 'rb') as f:
-            for name, ndims, dims, qtype, offset in tqdm(self.infos, desc="Loading gguf tensors"):
-                total_ne = functools.reduce(lambda x, y: x * y, dims)
-                invalidInputError(total_ne % self.block_ne[qtype] == 0,
-                                  f"wrong elements num: {dims}")
-
-                size = total_ne // self.block_ne[qtype] * self.block_size[qtype]
-                invalidInputError(size != 0, f"unsupported quantize type: {qtype}")
-
-                offset += self.base_offset
-                f.seek(offset)
-                data = f.read(size)
-                arr = numpy.frombuffer(data, dtype=numpy.uint8)
-                tensor = torch.from_numpy(arr)
-                tensor = self.convert_funcs[qtype](tensor, size, ndims, dims)
-                process(name, tensor)
+        return self._load_tensors()
+
+    def load_while_process(self, process, passthrough_qtype: int = None,
+                           row_permutes: dict = None):
+        """
+        Call `process(name, tensor)` for every tensor in file order.
+
+        :param passthrough_qtype: ipex-llm qtype of the low-bit weights. 2D gguf tensors
+            with the same block layout are passed as `GGUFBlockTensor` instead of being
+            dequantized, `process` should call `dequantize()` if it cannot use them as is.
+        :param row_permutes: maps a tensor name suffix (e.g. "attn_q.weight") to the number
+            of heads, rows of such tensors are permuted from llama.cpp's to transformers'
+            rotary layout before `process` is called.
+        """
+        for name, tensor in self._load_tensors(passthrough_qtype, row_permutes):
+            process(name, tensor)
 
     def convert_f32_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         return tensor.view(torch.float)
@@ -341,6 +436,101 @@ class GGUFTensorLoader:
         result = (data * scales).reshape(dims)
         return result
 
+    def convert_q2_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q2_K in llama.cpp ggml-quants.c
+
+        block_size = self.block_size[10]
+        tensor = tensor.reshape((-1, block_size))
+
+        scales, qs, d, dmin = (tensor[:, :16], tensor[:, 16:80],
+                               tensor[:, 80:82], tensor[:, 82:84])
+        d = d.view(torch.half).float()
+        dmin = dmin.view(torch.half).float()
+        # 2 chunks of 32 bytes, every byte holds 4 values at bit 0, 2, 4, 6
+        shift = torch.arange(0, 8, 2).reshape((1, 1, 4, 1))
+        data = (qs.reshape((-1, 2, 1, 32)) >> shift) & 0B11
+        # every 16 values share a 4-bit scale and a 4-bit min
+        data = data.reshape((-1, 16, 16))
+        dl = (d * (scales & 0xF)).unsqueeze(-1)
+        ml = (dmin * (scales >> 4)).unsqueeze(-1)
+        result = (dl * data - ml).reshape(dims)
+        return result
+
+    def convert_q3_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q3_K in llama.cpp ggml-quants.c
+
+        block_size = self.block_size[11]
+        tensor = tensor.reshape((-1, block_size))
+
+        hmask, qs, scales, d = (tensor[:, :32], tensor[:, 32:96],
+                                tensor[:, 96:108], tensor[:, 108:])
+        d = d.view(torch.half).float()
+        # unpack 16 6-bit scales
+        tmp = scales[:, 8:]
+        scales = torch.cat([(scales[:, :4] & 0xF) | ((tmp & 0B11) << 4),
+                            (scales[:, 4:8] & 0xF) | (((tmp >> 2) & 0B11) << 4),
+                            (scales[:, :4] >> 4) | (((tmp >> 4) & 0B11) << 4),
+                            (scales[:, 4:8] >> 4) | (((tmp >> 6) & 0B11) << 4)],
+                           dim=-1).view(torch.int8) - 32
+        # low 2 bits are packed like q2_k, the high bit of the i-th 32 values is
+        # the i-th bit of hmask, values without the high bit are minus 4
+        shift = torch.arange(0, 8, 2).reshape((1, 1, 4, 1))
+        ldata = (qs.reshape((-1, 2, 1, 32)) >> shift) & 0B11
+        shift = torch.arange(0, 8, 1).reshape((1, 8, 1))
+        hdata = (hmask.reshape((-1, 1, 32)) >> shift) & 1
+        data = ldata.reshape((-1, 8, 32)) + hdata * 4 - 4
+        data = data.reshape((-1, 16, 16))
+        result = (d * scales).unsqueeze(-1) * data
+        result = result.reshape(dims)
+        return result
+
+    def _unpack_k4_scales(self, scales: torch.Tensor):
+        # see get_scale_min_k4 in ggml-quants.c, 8 6-bit scales and 8 6-bit mins
+        sc = torch.cat([scales[:, :4] & 63,
+                        (scales[:, 8:] & 0xF) | ((scales[:, :4] >> 6) << 4)], dim=-1)
+        mn = torch.cat([scales[:, 4:8] & 63,
+                        (scales[:, 8:] >> 4) | ((scales[:, 4:8] >> 6) << 4)], dim=-1)
+        return sc, mn
+
+    def convert_q4_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q4_K in llama.cpp ggml-quants.c
+
+        block_size = self.block_size[12]
+        tensor = tensor.reshape((-1, block_size))
+
+        d, dmin, scales, qs = (tensor[:, :2], tensor[:, 2:4],
+                               tensor[:, 4:16], tensor[:, 16:])
+        d = d.view(torch.half).float()
+        dmin = dmin.view(torch.half).float()
+        sc, mn = self._unpack_k4_scales(scales)
+        # 4 chunks of 32 bytes, low nibbles are the first 32 values of a chunk
+        qs = qs.reshape((-1, 4, 1, 32))
+        data = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape((-1, 8, 32))
+        result = (d * sc).unsqueeze(-1) * data - (dmin * mn).unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
+    def convert_q5_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
+        # see dequantize_row_q5_K in llama.cpp ggml-quants.c
+
+        block_size = self.block_size[13]
+        tensor = tensor.reshape((-1, block_size))
+
+        d, dmin, scales, qh, qs = (tensor[:, :2], tensor[:, 2:4], tensor[:, 4:16],
+                                   tensor[:, 16:48], tensor[:, 48:])
+        d = d.view(torch.half).float()
+        dmin = dmin.view(torch.half).float()
+        sc, mn = self._unpack_k4_scales(scales)
+        qs = qs.reshape((-1, 4, 1, 32))
+        ldata = torch.cat([qs & 0xF, qs >> 4], dim=2).reshape((-1, 8, 32))
+        # the high bit of the i-th 32 values is the i-th bit of qh
+        shift = torch.arange(0, 8, 1).reshape((1, 8, 1))
+        hdata = ((qh.reshape((-1, 1, 32)) >> shift) & 1) << 4
+        data = ldata | hdata
+        result = (d * sc).unsqueeze(-1) * data - (dmin * mn).unsqueeze(-1)
+        result = result.reshape(dims)
+        return result
+
     def convert_q6_k_tensor(self, tensor: torch.Tensor, size: int, ndims: int, dims: int):
         # see https://github.com/ggerganov/llama.cpp/blob
         # /8e672efe632bb6a7333964a255c4b96f018b9a65/ggml-quants.c#L2263
@@ -371,12 +561,12 @@ class GGUFTensorLoader:
 
 
 class GGUFFileLoader:
-    def __init__(self, fpath: str):
+    def __init__(self, fpath: str, num_threads: int = None):
         with open(fpath, 'rb') as f:
             header = GGUFHeader(f)
             config = GGUFConfig(f, header)
             tensor_infos = GGUFTensorInfos(f, header, config)
-            tensor_loader = GGUFTensorLoader(fpath, tensor_infos)
+            tensor_loader = GGUFTensorLoader(fpath, tensor_infos, num_threads)
 
         self.header = header
         self.config = config.config
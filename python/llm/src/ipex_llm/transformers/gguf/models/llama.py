@@ -21,9 +21,10 @@ from accelerate.utils import set_module_tensor_to_device
 from tempfile import NamedTemporaryFile
 from transformers import LlamaConfig, LlamaForCausalLM, LlamaTokenizer
 
-from ..gguf import GGUFFileLoader
+from ..gguf import GGUFFileLoader, GGUFBlockTensor
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
-from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module
+from ipex_llm.transformers.convert import replace_with_low_bit_linear_for_module, \
+    replace_with_quantized_linear_for_module
 
 
 def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
@@ -57,30 +58,21 @@ def load_gguf_llama(loader: GGUFFileLoader, dtype: torch.dtype = torch.float,
     def process_llama(name, tensor):
         nonlocal model
         module_name = get_llama_module_name(name)
-        if 'q_proj' in module_name:
-            # gguf weight needs to reshape for q_proj
-            head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head, head // n_head // 2, 2, *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
-        elif 'k_proj' in module_name:
-            # gguf weight needs to reshape for k_proj
-            head, hd_size = tensor.shape[0], tensor.shape[1:]
-            set_module_tensor_to_device(model, module_name, "cpu",
-                                        tensor.reshape(n_head_kv,
-                                                       head // n_head_kv // 2,
-                                                       2,
-                                                       *hd_size)
-                                              .swapaxes(1, 2)
-                                              .reshape(tensor.shape),
-                                        dtype=dtype)
-        else:
-            set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
+        if isinstance(tensor, GGUFBlockTensor):
+            if isinstance(model.get_submodule(module_name.rpartition(".")[0]), torch.nn.Linear):
+                # gguf blocks are used as low-bit weight directly
+                model = replace_with_quantized_linear_for_module(model, tensor.qtype,
+                                                                 module_name, tensor.data,
+                                                                 tensor.shape)
+                return
+            tensor = tensor.dequantize()
+        set_module_tensor_to_device(model, module_name, "cpu", tensor, dtype=dtype)
         model = replace_with_low_bit_linear_for_module(model, qtype=qtype, module_name=module_name)
     tensor_loader = loader.tensor_loader
-    tensor_loader.load_while_process(process_llama)
+    # gguf q_proj and k_proj weights are permuted for transformers by the loader threads
+    row_permutes = {"attn_q.weight": n_head, "attn_k.weight": n_head_kv}
+    tensor_loader.load_while_process(process_llama, passthrough_qtype=qtype,
+                                     row_permutes=row_permutes)
 
     # see https://github.com/google/sentencepiece/blob/master/src/sentencepiece_model.proto
     from transformers.convert_slow_tokenizer import import_protobuf
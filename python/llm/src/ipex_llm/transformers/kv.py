@@ -15,6 +15,7 @@
 #
 
 
+import bisect
 import torch
 import torch.nn.functional as F
 import torch.nn as nn
@@ -151,6 +152,600 @@ class DynamicNormalCache(DynamicCache):
         return past_key_values
 
 
+class DynamicBatchCache(DynamicNormalCache):
+    """
+    KV cache shared by all running sequences of a continuous batch.
+    Rows are left padded to the same length, the padded positions must be
+    masked out by the attention mask kept by the caller.
+    """
+
+    def _set_seen_tokens(self, seq_len: int):
+        if hasattr(self, "_seen_tokens"):
+            # 4.39 uses `_seen_tokens`
+            self._seen_tokens = seq_len
+        else:
+            # 4.37 uses `seen_tokens`
+            self.seen_tokens = seq_len
+
+    def _reserve(self, k_cache: torch.Tensor, v_cache: torch.Tensor,
+                 bsz: int, length: int):
+        new_k_cache, new_v_cache = init_kv_cache(
+            bsz, k_cache.size(1), k_cache.size(3),
+            length, length + self.KV_ALLOC_BLOCK_LENGTH,
+            k_cache.dtype, k_cache.device
+        )
+        return new_k_cache, new_v_cache
+
+    def select(self, indices: torch.Tensor, start: int = 0) -> None:
+        """
+        Keep only the rows in `indices` and drop the first `start` positions,
+        which must be padding for all kept rows.
+        """
+        for layer_idx in range(len(self.key_cache)):
+            k_cache = self.key_cache[layer_idx][indices, :, start:, :]
+            v_cache = self.value_cache[layer_idx][indices, :, start:, :]
+            new_k_cache, new_v_cache = self._reserve(k_cache, v_cache,
+                                                     k_cache.size(0), k_cache.size(2))
+            new_k_cache[...] = k_cache
+            new_v_cache[...] = v_cache
+            self.key_cache[layer_idx] = new_k_cache
+            self.value_cache[layer_idx] = new_v_cache
+        self._set_seen_tokens(self.get_seq_length())
+
+    def extend(self, other: DynamicNormalCache) -> None:
+        """
+        Append the rows of `other` after the rows of this cache, the shorter one
+        is left padded with zeros so that all rows end at the same position.
+        """
+        if len(self.key_cache) == 0:
+            self.key_cache = list(other.key_cache)
+            self.value_cache = list(other.value_cache)
+            self._set_seen_tokens(other.get_seq_length())
+            return
+
+        invalidInputError(len(self.key_cache) == len(other.key_cache),
+                          "Cannot extend kv cache with different number of layers.")
+        length = max(self.get_seq_length(), other.get_seq_length())
+        for layer_idx in range(len(self.key_cache)):
+            k_1, v_1 = self.key_cache[layer_idx], self.value_cache[layer_idx]
+            k_2, v_2 = other.key_cache[layer_idx], other.value_cache[layer_idx]
+            bsz_1, bsz_2 = k_1.size(0), k_2.size(0)
+            new_k_cache, new_v_cache = self._reserve(k_1, v_1, bsz_1 + bsz_2, length)
+            new_k_cache[:bsz_1, :, :length - k_1.size(2), :] = 0
+            new_v_cache[:bsz_1, :, :length - v_1.size(2), :] = 0
+            new_k_cache[:bsz_1, :, length - k_1.size(2):, :] = k_1
+            new_v_cache[:bsz_1, :, length - v_1.size(2):, :] = v_1
+            new_k_cache[bsz_1:, :, :length - k_2.size(2), :] = 0
+            new_v_cache[bsz_1:, :, :length - v_2.size(2), :] = 0
+            new_k_cache[bsz_1:, :, length - k_2.size(2):, :] = k_2
+            new_v_cache[bsz_1:, :, length - v_2.size(2):, :] = v_2
+            self.key_cache[layer_idx] = new_k_cache
+            self.value_cache[layer_idx] = new_v_cache
+        self._set_seen_tokens(length)
+
+
+class KVBlockPool:
+    """
+    Pool of fixed-size kv cache blocks shared by all paged caches on a device.
+    Every layer owns the same list of storage chunks and a block id addresses
+    the same block in all layers, so one block table serves all layers.
+    The pool grows by adding chunks, blocks already handed out never move.
+    """
+    def __init__(self, num_heads: int, head_dim: int, block_size: int, num_blocks: int,
+                 dtype: torch.dtype, device: torch.device):
+        self.num_heads = num_heads
+        self.head_dim = head_dim
+        self.block_size = block_size
+        self.num_blocks = num_blocks
+        self.dtype = dtype
+        self.device = device
+        # block id of the first block and number of blocks of every chunk
+        self.chunk_starts = [0]
+        self.chunk_sizes = [num_blocks]
+        # [chunk_size, num_heads, block_size, head_dim] chunks per layer, the tokens
+        # of one head are contiguous in a block
+        self.key_chunks = []
+        self.value_chunks = []
+        # used as a stack, recently freed blocks are reused first
+        self.free_blocks = list(range(num_blocks - 1, -1, -1))
+
+    def _new_storage(self, num_blocks: int):
+        return torch.empty(num_blocks, self.num_heads, self.block_size, self.head_dim,
+                           dtype=self.dtype, device=self.device)
+
+    def get_layer(self, layer_idx: int) -> Tuple[List[torch.Tensor], List[torch.Tensor]]:
+        while len(self.key_chunks) <= layer_idx:
+            self.key_chunks.append([self._new_storage(n) for n in self.chunk_sizes])
+            self.value_chunks.append([self._new_storage(n) for n in self.chunk_sizes])
+        return self.key_chunks[layer_idx], self.value_chunks[layer_idx]
+
+    def locate(self, block: int) -> Tuple[int, int]:
+        """Chunk index of `block` and its offset in that chunk."""
+        chunk_idx = bisect.bisect_right(self.chunk_starts, block) - 1
+        return chunk_idx, block - self.chunk_starts[chunk_idx]
+
+    def _grow(self, num_blocks: int):
+        # only happens when the pool is exhausted, a chunk as large as the pool
+        # is added so that the number of chunks stays logarithmic
+        chunk_size = max(self.num_blocks, num_blocks)
+        for layer_idx in range(len(self.key_chunks)):
+            self.key_chunks[layer_idx].append(self._new_storage(chunk_size))
+            self.value_chunks[layer_idx].append(self._new_storage(chunk_size))
+        self.chunk_starts.append(self.num_blocks)
+        self.chunk_sizes.append(chunk_size)
+        new_num_blocks = self.num_blocks + chunk_size
+        self.free_blocks = list(range(new_num_blocks - 1, self.num_blocks - 1, -1)) + \
+            self.free_blocks
+        self.num_blocks = new_num_blocks
+
+    def allocate(self, num_blocks: int) -> List[int]:
+        if len(self.free_blocks) < num_blocks:
+            self._grow(num_blocks - len(self.free_blocks))
+        blocks = self.free_blocks[-num_blocks:][::-1]
+        del self.free_blocks[-num_blocks:]
+        return blocks
+
+    def free(self, blocks: List[int]):
+        self.free_blocks.extend(blocks)
+
+    @property
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    def memory_usage(self) -> int:
+        """Bytes held by the pool for all layers."""
+        block_bytes = self.block_size * self.num_heads * self.head_dim * \
+            torch.tensor([], dtype=self.dtype).element_size()
+        return 2 * len(self.key_chunks) * self.num_blocks * block_bytes
+
+
+_kv_block_pools = {}
+
+
+def get_kv_block_pool(num_heads: int, head_dim: int, block_size: int, num_blocks: int,
+                      dtype: torch.dtype, device: torch.device) -> KVBlockPool:
+    key = (str(device), dtype, num_heads, head_dim, block_size)
+    if key not in _kv_block_pools:
+        _kv_block_pools[key] = KVBlockPool(num_heads, head_dim, block_size, num_blocks,
+                                           dtype, device)
+    return _kv_block_pools[key]
+
+
+class DynamicPagedCache(DynamicNormalCache):
+    """
+    KV cache made of fixed-size blocks taken from the per-device `KVBlockPool`,
+    every sequence in the batch has its own block table. Growing a sequence only
+    takes blocks from the free list, nothing is reallocated or copied, and blocks
+    go back to the pool when the cache is released.
+
+    `key_cache` and `value_cache` only hold `meta` tensors recording the shape of
+    every layer. Optimized attention forwards call `write` and then `attention`,
+    which reads the blocks in place. `update` gathers the blocks into contiguous
+    key/value states and is only kept for forwards unaware of paged caches.
+    Pass an instance as `past_key_values` to opt in.
+    """
+    BLOCK_SIZE = 64
+    INIT_NUM_BLOCKS = 256
+
+    def __init__(self, num_hidden_layers: Optional[int]=None,
+                 block_size: Optional[int]=None) -> None:
+        super().__init__(num_hidden_layers)
+        self.block_size = block_size if block_size is not None else self.BLOCK_SIZE
+        self.pool = None
+        self.block_tables = []
+        self.block_table = None
+        # per sequence, runs of blocks stored next to each other in one chunk as
+        # [chunk index, offset in chunk, number of blocks, index in block table]
+        self.block_runs = []
+
+    def _allocate(self, length: int, device: torch.device):
+        num_blocks = (length + self.block_size - 1) // self.block_size
+        if len(self.block_tables[0]) < num_blocks:
+            for table, runs in zip(self.block_tables, self.block_runs):
+                for block in self.pool.allocate(num_blocks - len(table)):
+                    chunk_idx, offset = self.pool.locate(block)
+                    if runs and runs[-1][0] == chunk_idx and \
+                            runs[-1][1] + runs[-1][2] == offset:
+                        runs[-1][2] += 1
+                    else:
+                        runs.append([chunk_idx, offset, 1, len(table)])
+                    table.append(block)
+            self.block_table = torch.tensor(self.block_tables, dtype=torch.int64,
+                                            device=device)
+        return num_blocks
+
+    def write(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int):
+        """Write new key/value states of `layer_idx` into their blocks."""
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+        device = key_states.device
+
+        if layer_idx == 0:
+            if hasattr(self, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                self._seen_tokens += seq_len
+            else:
+                # 4.37 uses `seen_tokens`
+                self.seen_tokens += seq_len
+
+        if self.pool is None:
+            self.pool = get_kv_block_pool(num_heads, head_dim, self.block_size,
+                                          self.INIT_NUM_BLOCKS, key_states.dtype, device)
+            self.block_tables = [[] for _ in range(batch_size)]
+            self.block_runs = [[] for _ in range(batch_size)]
+
+        start = self.get_seq_length(layer_idx)
+        end = start + seq_len
+        self._allocate(end, device)
+        k_chunks, v_chunks = self.pool.get_layer(layer_idx)
+
+        positions = torch.arange(start, end, device=device)
+        blocks = self.block_table[:, positions // self.block_size]
+        heads = torch.arange(num_heads, device=device)
+        for chunk_idx, (k_chunk, v_chunk) in enumerate(zip(k_chunks, v_chunks)):
+            # [batch_size, num_heads, seq_len] slots of the new tokens in this chunk
+            local_blocks = blocks - self.pool.chunk_starts[chunk_idx]
+            slots = (local_blocks[:, None, :] * num_heads + heads[None, :, None]) * \
+                self.block_size + positions % self.block_size
+            if len(k_chunks) == 1:
+                slots, k_new, v_new = slots.view(-1), key_states, value_states
+            else:
+                in_chunk = (local_blocks >= 0) & (local_blocks < k_chunk.size(0))
+                if not in_chunk.any():
+                    continue
+                in_chunk = in_chunk[:, None, :].expand_as(slots)
+                slots, k_new, v_new = slots[in_chunk], key_states[in_chunk], \
+                    value_states[in_chunk]
+            k_chunk.view(-1, head_dim).index_copy_(0, slots, k_new.reshape(-1, head_dim))
+            v_chunk.view(-1, head_dim).index_copy_(0, slots, v_new.reshape(-1, head_dim))
+
+        placeholder = torch.empty((batch_size, num_heads, end, head_dim),
+                                  dtype=key_states.dtype, device="meta")
+        if len(self.key_cache) <= layer_idx:
+            self.key_cache.append(placeholder)
+            self.value_cache.append(placeholder)
+        else:
+            self.key_cache[layer_idx] = placeholder
+            self.value_cache[layer_idx] = placeholder
+
+    def _runs(self, layer_idx: int, batch_idx: int, length: int):
+        # views of the blocks of one sequence, [num_blocks, num_heads, num_tokens, head_dim]
+        # each, a partially filled last block comes alone
+        k_chunks, v_chunks = self.pool.get_layer(layer_idx)
+        for chunk_idx, offset, num_blocks, table_idx in self.block_runs[batch_idx]:
+            run_start = table_idx * self.block_size
+            if run_start >= length:
+                break
+            num_full = min(num_blocks, (length - run_start) // self.block_size)
+            if num_full > 0:
+                yield run_start, k_chunks[chunk_idx][offset:offset + num_full], \
+                    v_chunks[chunk_idx][offset:offset + num_full]
+            tail = min(length - run_start - num_full * self.block_size, self.block_size)
+            if num_full < num_blocks and tail > 0:
+                last = offset + num_full
+                yield run_start + num_full * self.block_size, \
+                    k_chunks[chunk_idx][last:last + 1, :, :tail], \
+                    v_chunks[chunk_idx][last:last + 1, :, :tail]
+
+    def attention(
+        self,
+        query_states: torch.Tensor,
+        layer_idx: int,
+        attention_mask: Optional[torch.Tensor]=None,
+        scale: Optional[float]=None,
+    ) -> torch.Tensor:
+        """
+        Scaled dot product attention of `query_states` (`[batch_size, num_heads, q_len,
+        head_dim]`) over the cached keys/values of `layer_idx`, reading the blocks in
+        place. The last `q_len` cached tokens are the queries' own tokens, without
+        `attention_mask` a causal mask is applied. Softmax is merged across block runs
+        like flash attention, so no contiguous copy of the cache is made.
+        """
+        batch_size, num_heads, q_len, head_dim = query_states.shape
+        length = self.get_seq_length(layer_idx)
+        num_kv_heads = self.pool.num_heads
+        n_rep = num_heads // num_kv_heads
+        if scale is None:
+            scale = 1 / math.sqrt(head_dim)
+
+        if attention_mask is None and q_len > 1:
+            key_pos = torch.arange(length, device=query_states.device)
+            query_pos = key_pos[length - q_len:]
+            causal = torch.zeros(q_len, length, dtype=torch.float32,
+                                 device=query_states.device)
+            causal.masked_fill_(key_pos[None, :] > query_pos[:, None], float("-inf"))
+            causal = causal.repeat(n_rep, 1)
+        else:
+            causal = None
+
+        outputs = []
+        for batch_idx in range(batch_size):
+            # group query heads sharing one kv head, [num_kv_heads, n_rep * q_len, head_dim]
+            query = query_states[batch_idx].reshape(num_kv_heads, n_rep * q_len, head_dim)
+            query = query.to(self.pool.dtype)
+            if attention_mask is not None:
+                mask = attention_mask[batch_idx, 0, :, :length].float().repeat(n_rep, 1)
+            else:
+                mask = causal
+            row_max = torch.full((num_kv_heads, n_rep * q_len, 1), float("-inf"),
+                                 device=query.device)
+            row_sum = torch.zeros_like(row_max)
+            output = torch.zeros(num_kv_heads, n_rep * q_len, head_dim, device=query.device)
+            for run_start, k, v in self._runs(layer_idx, batch_idx, length):
+                num_blocks, num_tokens = k.size(0), k.size(2)
+                # [num_blocks, num_kv_heads, n_rep * q_len, num_tokens] -> one row per query
+                scores = torch.matmul(query, k.transpose(-1, -2)).float() * scale
+                scores = scores.permute(1, 2, 0, 3).flatten(2)
+                if mask is not None:
+                    scores = scores + mask[:, run_start:run_start + scores.size(-1)]
+                new_max = torch.maximum(row_max, scores.amax(-1, keepdim=True))
+                # rows masked so far keep a max of -inf, use 0 to avoid nan
+                safe_max = torch.where(torch.isinf(new_max), torch.zeros_like(new_max),
+                                       new_max)
+                probs = torch.exp(scores - safe_max)
+                alpha = torch.exp(row_max - safe_max)
+                row_sum = row_sum * alpha + probs.sum(-1, keepdim=True)
+                probs = probs.view(num_kv_heads, -1, num_blocks, num_tokens).permute(2, 0, 1, 3)
+                output = output * alpha + torch.matmul(probs.to(v.dtype), v).float().sum(0)
+                row_max = new_max
+            output = output / row_sum.clamp_min(torch.finfo(output.dtype).tiny)
+            outputs.append(output.reshape(num_heads, q_len, head_dim))
+        return torch.stack(outputs).to(query_states.dtype)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # fix converting empty DynamicCache in transformers >= 4.45
+        if key_states == []:
+            return key_states, value_states
+
+        self.write(key_states, value_states, layer_idx)
+        length = self.get_seq_length(layer_idx)
+        keys, values = [], []
+        for batch_idx in range(len(self.block_tables)):
+            runs = list(self._runs(layer_idx, batch_idx, length))
+            keys.append(torch.cat([k.transpose(0, 1).flatten(1, 2) for _, k, _ in runs], dim=1))
+            values.append(torch.cat([v.transpose(0, 1).flatten(1, 2) for _, _, v in runs],
+                                    dim=1))
+        return torch.stack(keys), torch.stack(values)
+
+    def free(self):
+        """Return all blocks to the pool."""
+        if self.pool is not None:
+            for table in self.block_tables:
+                self.pool.free(table)
+            self.block_tables = []
+            self.block_runs = []
+            self.block_table = None
+            self.pool = None
+        self.key_cache = []
+        self.value_cache = []
+
+    def __del__(self):
+        self.free()
+
+
+def rotate_by(key_states: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor,
+              out: Optional[torch.Tensor]=None) -> torch.Tensor:
+    """
+    Apply the rotary position embedding given by `cos` and `sin` (`[seq_len, head_dim // 2]`)
+    to `key_states` (`[batch_size, num_heads, seq_len, head_dim]`), writing into `out` if given.
+    """
+    if out is None:
+        out = torch.empty_like(key_states)
+    half = key_states.size(-1) // 2
+    x1, x2 = key_states[..., :half], key_states[..., half:]
+    o1, o2 = out[..., :half], out[..., half:]
+    torch.mul(x1, cos, out=o1)
+    o1.addcmul_(x2, sin, value=-1)
+    torch.mul(x2, cos, out=o2)
+    o2.addcmul_(x1, sin)
+    return out
+
+
+class DynamicSinkCache(DynamicCache):
+    """
+    StreamingLLM kv cache (https://arxiv.org/abs/2309.17453), which keeps the first
+    `num_sink_tokens` tokens (attention sinks) and the most recent tokens, at most
+    `window_length` tokens in total, so memory and per-token latency stay constant
+    however long the conversation is.
+
+    Every layer keeps one `[batch_size, num_heads, window_length, head_dim]` buffer,
+    its first `num_sink_tokens` slots hold the sink tokens and the others are a ring
+    buffer of recent tokens: once the window is full, a new token overwrites the
+    oldest recent token, nothing is reallocated or concatenated.
+
+    Positions are re-indexed inside the window as StreamingLLM does: new tokens take
+    the positions right after the kept tokens (see `get_cache_position`), and a cached
+    key is rotated from the position it was written at to its current position when
+    it is returned, which needs the `inv_freq` of the rotary embedding in
+    `cache_kwargs`. Keys are cached at the position they were written at rather than
+    rotated in place every step, so rounding errors do not accumulate.
+
+    Rows must not be padded, the attention mask is ignored by model forwards.
+    """
+    def __init__(self, window_length: int = 1024, num_sink_tokens: int = 4,
+                 num_hidden_layers: Optional[int] = None) -> None:
+        # ignore num_hidden_layers to fix transformers >= 4.45
+        super().__init__()
+        invalidInputError(0 <= num_sink_tokens < window_length,
+                          "num_sink_tokens should be less than window_length, "
+                          f"but got {num_sink_tokens} and {window_length}.")
+        self.window_length = window_length
+        self.num_sink_tokens = num_sink_tokens
+        self.num_recent_tokens = window_length - num_sink_tokens
+        # per layer: number of kept tokens, ring index of the oldest recent token,
+        # and the position every slot was rotated to when it was written
+        self.lengths = []
+        self.heads = []
+        self.slot_positions = []
+        # keys rotated to their current positions, only used once tokens are evicted
+        self.rotated_key_cache = []
+        # rotation of the current decoding step, computed by layer 0 and shared by
+        # the other layers, which always keep the same slots
+        self.cos = None
+        self.sin = None
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        """Returns the number of kept tokens."""
+        if len(self.lengths) <= layer_idx:
+            return 0
+        return self.lengths[layer_idx]
+
+    def get_max_length(self) -> Optional[int]:
+        return self.window_length
+
+    def get_max_cache_shape(self) -> Optional[int]:
+        return self.window_length
+
+    def get_usable_length(self, new_seq_length: int, layer_idx: Optional[int] = 0) -> int:
+        """Returns the number of kept tokens which new tokens attend to."""
+        length = self.get_seq_length(layer_idx)
+        if length + new_seq_length <= self.window_length:
+            return length
+        if new_seq_length <= self.num_recent_tokens:
+            # the oldest recent tokens are evicted to make room for new tokens
+            return self.window_length - new_seq_length
+        # a chunk longer than the window attends to all kept tokens, and only its
+        # last tokens are kept afterwards
+        return length
+
+    def get_cache_position(self, new_seq_length: int,
+                           device: Optional[torch.device]=None) -> torch.Tensor:
+        """Returns the positions of new tokens inside the window."""
+        start = self.get_usable_length(new_seq_length)
+        return torch.arange(start, start + new_seq_length, device=device)
+
+    def _current_positions(self, layer_idx: int) -> torch.Tensor:
+        head = self.heads[layer_idx]
+        ring = (torch.arange(self.num_recent_tokens) - head) % self.num_recent_tokens
+        return torch.cat([torch.arange(self.num_sink_tokens), ring + self.num_sink_tokens])
+
+    def _order(self, layer_idx: int) -> torch.Tensor:
+        head = self.heads[layer_idx]
+        ring = (torch.arange(self.num_recent_tokens) + head) % self.num_recent_tokens
+        return torch.cat([torch.arange(self.num_sink_tokens), ring + self.num_sink_tokens])
+
+    @staticmethod
+    def _rotation(delta: torch.Tensor, inv_freq: Optional[torch.Tensor],
+                  dtype: torch.dtype, device: torch.device):
+        invalidInputError(inv_freq is not None,
+                          "DynamicSinkCache needs `inv_freq` of the rotary embedding in "
+                          "`cache_kwargs` to re-index positions.")
+        freqs = delta.to(device, torch.float32)[:, None] * inv_freq.to(device, torch.float32)
+        return freqs.cos().to(dtype), freqs.sin().to(dtype)
+
+    def _write(self, layer_idx: int, key_states: torch.Tensor, value_states: torch.Tensor,
+               slot: int, start: int):
+        # write new tokens from `slot` on, wrapping around the ring of recent tokens
+        k_cache, v_cache = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        positions = self.slot_positions[layer_idx]
+        seq_len = key_states.size(2)
+        first = min(seq_len, self.window_length - slot)
+        k_cache[:, :, slot:slot + first] = key_states[:, :, :first]
+        v_cache[:, :, slot:slot + first] = value_states[:, :, :first]
+        positions[slot:slot + first] = torch.arange(start, start + first)
+        if first < seq_len:
+            rest = seq_len - first
+            sink = self.num_sink_tokens
+            k_cache[:, :, sink:sink + rest] = key_states[:, :, first:]
+            v_cache[:, :, sink:sink + rest] = value_states[:, :, first:]
+            positions[sink:sink + rest] = torch.arange(start + first, start + seq_len)
+
+    def _ordered(self, layer_idx: int, inv_freq: Optional[torch.Tensor]):
+        """Kept tokens of a layer in order, with keys rotated to their current positions."""
+        k_cache, v_cache = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        length = self.lengths[layer_idx]
+        delta = self._current_positions(layer_idx) - self.slot_positions[layer_idx]
+        if length < self.window_length or not delta.any():
+            return k_cache[:, :, :length], v_cache[:, :, :length]
+        order = self._order(layer_idx)
+        cos, sin = self._rotation(delta[order], inv_freq, k_cache.dtype, k_cache.device)
+        order = order.to(k_cache.device)
+        keys = rotate_by(k_cache.index_select(2, order), cos, sin)
+        return keys, v_cache.index_select(2, order)
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]]=None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        # fix converting empty DynamicCache in transformers >= 4.45
+        if key_states == []:
+            return key_states, value_states
+
+        batch_size, num_heads, seq_len, head_dim = key_states.shape
+        inv_freq = cache_kwargs.get("inv_freq", None) if cache_kwargs is not None else None
+
+        if layer_idx == 0:
+            if hasattr(self, "_seen_tokens"):
+                # 4.39 uses `_seen_tokens`
+                self._seen_tokens += seq_len
+            else:
+                # 4.37 uses `seen_tokens`
+                self.seen_tokens += seq_len
+
+        if len(self.key_cache) <= layer_idx:
+            shape = (batch_size, num_heads, self.window_length, head_dim)
+            self.key_cache.append(key_states.new_empty(shape))
+            self.value_cache.append(value_states.new_empty(shape))
+            self.lengths.append(0)
+            self.heads.append(0)
+            self.slot_positions.append(torch.arange(self.window_length))
+            self.rotated_key_cache.append(None)
+
+        k_cache, v_cache = self.key_cache[layer_idx], self.value_cache[layer_idx]
+        length = self.lengths[layer_idx]
+        start = self.get_usable_length(seq_len, layer_idx)
+        sink = self.num_sink_tokens
+        num_recent = self.num_recent_tokens
+
+        if length + seq_len <= self.window_length:
+            # nothing is evicted yet, slots are in order and keys are at their positions
+            self._write(layer_idx, key_states, value_states, length, start)
+            self.lengths[layer_idx] = length + seq_len
+            return k_cache[:, :, :length + seq_len], v_cache[:, :, :length + seq_len]
+
+        if seq_len > num_recent:
+            # attend to all kept tokens and the whole chunk, then keep the sink tokens
+            # and the last `num_recent` tokens of the chunk
+            keys, values = self._ordered(layer_idx, inv_freq)
+            keys = torch.cat([keys, key_states], dim=2)
+            values = torch.cat([values, value_states], dim=2)
+            if length < sink:
+                self._write(layer_idx, key_states[:, :, :sink - length],
+                            value_states[:, :, :sink - length], length, start)
+            self.heads[layer_idx] = 0
+            self.lengths[layer_idx] = self.window_length
+            self._write(layer_idx, key_states[:, :, -num_recent:],
+                        value_states[:, :, -num_recent:], sink, start + seq_len - num_recent)
+            return keys, values
+
+        # overwrite the oldest recent tokens
+        head = self.heads[layer_idx]
+        slot = sink + (head + length - sink) % num_recent
+        self._write(layer_idx, key_states, value_states, slot, start)
+        self.heads[layer_idx] = (head + length - sink + seq_len - num_recent) % num_recent
+        self.lengths[layer_idx] = self.window_length
+
+        if seq_len > 1:
+            # new tokens attend to kept tokens causally, which needs them in order
+            return self._ordered(layer_idx, inv_freq)
+
+        if layer_idx == 0 or self.cos is None:
+            delta = self._current_positions(layer_idx) - self.slot_positions[layer_idx]
+            self.cos, self.sin = self._rotation(delta, inv_freq, k_cache.dtype, k_cache.device)
+        if self.rotated_key_cache[layer_idx] is None:
+            self.rotated_key_cache[layer_idx] = torch.empty_like(k_cache)
+        keys = rotate_by(k_cache, self.cos, self.sin, out=self.rotated_key_cache[layer_idx])
+        return keys, v_cache
+
+
 # Copied from transformers.models.llama.modeling_llama.repeat_kv
 def repeat_kv(hidden_states: torch.Tensor, n_rep: int) -> torch.Tensor:
     """
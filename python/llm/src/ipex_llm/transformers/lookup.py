@@ -90,9 +90,10 @@ def generate(
             logger.warning("Prompt lookup is currently not supported on CPU with IPEX, "
                            "fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
-        elif input_tensor_shape is not None and input_tensor_shape[0] > 1:
-            logger.warning("Prompt lookup is currently not supported with batch inference, "
-                           "fallback to original generate.")
+        elif input_tensor_shape is not None and input_tensor_shape[0] > 1 \
+                and (is_inputs_embeds or streamer is not None):
+            logger.warning("Prompt lookup with batch inference is currently not supported "
+                           "with inputs_embeds or streamer, fallback to original generate.")
             kwargs.pop("max_matching_ngram_size", None)
         elif kwargs.get("num_beams", None) not in [None, 1]:
             logger.warning("Prompt lookup is currently not supported with num_beams != 1, "
@@ -105,7 +106,7 @@ def generate(
             spec_params = []
             for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                         'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                        'th_batch_num']:
+                        'th_batch_num', 'draft_policy']:
                 value = kwargs.pop(var, None)
                 if value is not None:
                     spec_params.append(var)
@@ -136,8 +137,82 @@ def generate(
 GenerationMixin.generate = generate
 
 
-def tensor2key(key_tensor: torch.LongTensor):
-    return tuple(key_tensor.tolist())
+# odd multiplier of the rolling n-gram hash, products wrap around in int64
+NGRAM_HASH_BASE = 1000003
+
+
+class NgramIndex():
+    """
+    Hashed n-gram index of a batch of ragged token sequences.
+
+    `hashes[n - 1, b, i]` is a rolling hash of the n-gram `tokens[b, i:i + n]`, so
+    finding the earliest occurrence of the trailing n-gram of every row is a single
+    vectorized comparison instead of a lookup of Python tuples. A hash collision only
+    yields a bad candidate, which is rejected by verification.
+    """
+
+    def __init__(self, max_ngram_size: int, batch_size: int, capacity: int = 1024):
+        self.max_ngram_size = max_ngram_size
+        self.tokens = torch.zeros(batch_size, capacity, dtype=torch.long)
+        self.hashes = torch.zeros(max_ngram_size, batch_size, capacity, dtype=torch.long)
+        self.lengths = [0] * batch_size
+
+    def _reserve(self, length: int):
+        capacity = self.tokens.size(1)
+        if length <= capacity:
+            return
+        while capacity < length:
+            capacity *= 2
+        tokens = self.tokens.new_zeros(self.tokens.size(0), capacity)
+        tokens[:, :self.tokens.size(1)] = self.tokens
+        hashes = self.hashes.new_zeros(self.hashes.size(0), self.hashes.size(1), capacity)
+        hashes[:, :, :self.hashes.size(2)] = self.hashes
+        self.tokens, self.hashes = tokens, hashes
+
+    def extend(self, row: int, new_tokens: torch.LongTensor):
+        """Append `new_tokens` to the sequence of `row`."""
+        begin = self.lengths[row]
+        end = begin + new_tokens.numel()
+        self._reserve(end)
+        self.tokens[row, begin:end] = new_tokens.to("cpu", torch.long).view(-1)
+        # recompute the hashes of all n-grams which end in the new tokens
+        start = max(0, begin - self.max_ngram_size + 1)
+        window = self.tokens[row, start:end]
+        hashes = torch.zeros_like(window)
+        for ngram_size in range(1, min(self.max_ngram_size, window.numel()) + 1):
+            hashes = hashes[:window.numel() - ngram_size + 1] * NGRAM_HASH_BASE \
+                + window[ngram_size - 1:]
+            self.hashes[ngram_size - 1, row, start:start + hashes.numel()] = hashes
+        self.lengths[row] = end
+
+    def match(self, num_output_tokens: int) -> List[torch.LongTensor]:
+        """
+        Find the earliest occurrence of the longest trailing n-gram of every row.
+
+        :return: the (possibly empty) continuation of at most `num_output_tokens`
+                 tokens after the occurrence, one for each row.
+        """
+        batch_size = len(self.lengths)
+        max_length = max(self.lengths)
+        rows = torch.arange(batch_size)
+        lengths = torch.tensor(self.lengths, dtype=torch.long)
+        positions = torch.arange(max_length)
+        found = torch.zeros(batch_size, dtype=torch.bool)
+        starts = torch.zeros(batch_size, dtype=torch.long)
+        for ngram_size in range(self.max_ngram_size, 0, -1):
+            hashes = self.hashes[ngram_size - 1, :, :max_length]
+            query = hashes[rows, (lengths - ngram_size).clamp(min=0)]
+            # an occurrence must be followed by at least one token
+            matches = (hashes == query[:, None]) & \
+                (positions[None, :] < (lengths - ngram_size)[:, None])
+            matched = matches.any(dim=1) & ~found
+            # argmax returns the first maximal element, i.e. the earliest occurrence
+            first = matches.to(torch.uint8).argmax(dim=1)
+            starts = torch.where(matched, first + ngram_size, starts)
+            found |= matched
+        ends = torch.minimum(starts + num_output_tokens, lengths)
+        return [self.tokens[row, starts[row]:ends[row]] if found[row]
+                else self.tokens.new_empty(0) for row in range(batch_size)]
 
 
 # This class is copied from https://github.com/huggingface/transformers/blob/main/src
@@ -174,33 +249,39 @@ class PromptLookupCandidateGenerator():
             self.max_candidates = 9
             self.min_candidates = 0
 
-        self.lookup_table = {}
+        self.ngram_index = None
         invalidInputError(self.max_matching_ngram_size > 0 and self.num_output_tokens > 0,
                           "Invalid max_matching_ngram_size or num_output_tokens")
 
     def init_look_up_table(self,
-                           input_ids: torch.LongTensor):
-        for ngram_size in range(min(self.max_matching_ngram_size, input_ids.shape[1]), 0, -1):
-            # Create sliding windows of size ngram_size
-            windows = input_ids.cpu().unfold(dimension=1, size=ngram_size, step=1)
-            for idx in range(windows.size(1)):
-                window = tensor2key(windows[0, idx])
-                if window not in self.lookup_table:
-                    self.lookup_table[window] = idx
+                           input_ids: torch.LongTensor,
+                           attention_mask: Optional[torch.Tensor] = None):
+        # each row has its own look up table, padding tokens are not indexed
+        self.ngram_index = NgramIndex(self.max_matching_ngram_size, input_ids.size(0),
+                                      capacity=max(1024, 2 * input_ids.size(1)))
+        input_ids = input_ids.cpu()
+        for row in range(input_ids.size(0)):
+            row_input_ids = input_ids[row]
+            if attention_mask is not None:
+                row_input_ids = row_input_ids[attention_mask[row].cpu().bool()]
+            self.ngram_index.extend(row, row_input_ids)
 
     def update_look_up_table(self,
                              new_input_ids: torch.LongTensor):
         # Maintain a look up table
-        window = tensor2key(new_input_ids[0, -self.max_matching_ngram_size:])
-        for ngram_size in range(self.max_matching_ngram_size):
-            if window[ngram_size:] not in self.lookup_table:
-                self.lookup_table[window[ngram_size:]] = \
-                    new_input_ids.size(1)-self.max_matching_ngram_size+ngram_size
+        length = self.ngram_index.lengths[0]
+        self.ngram_index.extend(0, new_input_ids[0, length:])
 
-    def get_n_gram_idx(self,
-                       ngram_tensor: torch.LongTensor):
-        key = tensor2key(ngram_tensor)
-        return self.lookup_table[key]
+    def extend_look_up_table(self, row: int, new_tokens: torch.LongTensor):
+        self.ngram_index.extend(row, new_tokens)
+
+    def get_batch_candidates(self) -> List[torch.LongTensor]:
+        """
+        Fetches the candidates of every row, rows without a match get no candidates.
+        """
+        if self.num_output_tokens == 0:
+            return [self.ngram_index.tokens.new_empty(0)] * len(self.ngram_index.lengths)
+        return self.ngram_index.match(self.num_output_tokens)
 
     def get_candidates(self,
                        input_ids: torch.LongTensor)-> Tuple[torch.LongTensor,
@@ -219,32 +300,16 @@ class PromptLookupCandidateGenerator():
         """
         if self.num_output_tokens == 0:
             return input_ids, None
-        input_length = input_ids.size(1)
-
-        chosen_ids = None
-        for ngram_size in range(min(self.max_matching_ngram_size, input_length - 1), 0, -1):
-            # Convert ngram to a tensor for comparison
-            ngram_tensor = input_ids[0, -ngram_size:]
-
-            # # Get the indices of matches
-            idx = self.get_n_gram_idx(ngram_tensor)
 
-            # Iterate through match indices to find a valid continuation
-            start_idx = idx + ngram_size
-            end_idx = start_idx + self.num_output_tokens
-            end_idx = min(end_idx, input_length)
+        chosen_ids = self.ngram_index.match(self.num_output_tokens)[0]
 
-            if start_idx < end_idx:
-                chosen_ids = input_ids[0, start_idx:end_idx]
-                break
-
-        if chosen_ids is None or len(chosen_ids) == 0:
+        if len(chosen_ids) == 0:
             # In case we didn't find a match return the input sequence unchanged,
             # reverts back to autoregressive decoding
             return input_ids, None
 
         # Now need extend input_ids with chosen_ids
-        chosen_ids = chosen_ids.unsqueeze(0)
+        chosen_ids = chosen_ids.to(input_ids.device).unsqueeze(0)
         candidate_input_ids = torch.cat((input_ids, chosen_ids), dim=1)
         # assisted_generation expects logits as well, but we don't have those here,
         # so returning None
@@ -292,9 +357,6 @@ def lookup_generate(self,
             model_kwargs = _prepare_generate_args(self, inputs, generation_config,
                                                   streamer, **sampling_kwargs)
 
-    invalidInputError(input_ids.shape[0] == 1,
-                      "Prompt lookup is currently not supported with batch inference.")
-
     device_name = get_xpu_device_type(input_ids)
 
     candidates_generator = PromptLookupCandidateGenerator(
@@ -302,6 +364,20 @@ def lookup_generate(self,
         max_matching_ngram_size=max_matching_ngram_size,
         device=device_name)
 
+    if input_ids.shape[0] > 1:
+        invalidInputError(streamer is None,
+                          "Streamer is not supported with batched prompt lookup.")
+        # chatglm derives position ids from input ids instead of the attention mask,
+        # which is wrong for left padded rows with masked out rejected candidates
+        invalidInputError(self.config.model_type not in ["chatglm"],
+                          "Batched prompt lookup is not supported for chatglm, "
+                          "please use a batch size of 1.")
+        if attention_mask is None:
+            attention_mask = model_kwargs.pop("attention_mask", None)
+        return _lookup_generate_batch(self, input_ids, attention_mask, max_new_tokens,
+                                      candidates_generator, generation_config,
+                                      logits_processor, model_kwargs, device_name)
+
     step = 0
     step_verify = 0
 
@@ -455,3 +531,197 @@ def lookup_generate(self,
         streamer.end()
 
     return input_ids[:, : input_len + step]
+
+
+def _sample_or_greedy(logits, generation_config):
+    if generation_config.do_sample:
+        output_ids, _ = deepmind_sample(logits,
+                                        top_k=generation_config.top_k,
+                                        top_p=generation_config.top_p,
+                                        temperature=generation_config.temperature)
+        return output_ids.view(logits.shape[:2])
+    else:
+        return greedy(logits)
+
+
+def _verify_attention_mask(self, attention_mask, query_length):
+    # transformers 4.37 unmasks the left padding of a 2D mask for sdpa assuming that the
+    # queries cover the whole padding, which fails when a few tokens are verified after a
+    # left padded prompt, a 4D mask is used as it is
+    from packaging import version
+    if version.parse(transformers.__version__) >= version.parse("4.38.0") or \
+            getattr(self.config, "_attn_implementation", None) != "sdpa":
+        return attention_mask
+    kv_length = attention_mask.size(1)
+    causal_mask = torch.ones(query_length, kv_length, dtype=torch.bool,
+                             device=attention_mask.device).tril(kv_length - query_length)
+    return (attention_mask.bool()[:, None, None, :] & causal_mask).to(attention_mask.dtype)
+
+
+def _lookup_generate_batch(self, input_ids, attention_mask, max_new_tokens,
+                           candidates_generator, generation_config, logits_processor,
+                           model_kwargs, device_name):
+    """
+    Prompt lookup generation of a left padded batch.
+
+    Every row looks up candidates in its own sequence, the ragged candidates are right
+    padded into one verify forward and every row accepts its own matched prefix. The KV
+    cache is cropped to the longest accepted prefix of the batch, the rejected positions
+    of the other rows stay in the cache but are masked out by the attention mask, and
+    position ids are derived from the attention mask.
+    """
+    batch_size, input_len = input_ids.shape
+    device = input_ids.device
+    if attention_mask is None:
+        attention_mask = torch.ones_like(input_ids)
+    pad_token_id = generation_config.pad_token_id
+    if isinstance(pad_token_id, list):
+        pad_token_id = pad_token_id[0]
+    pad_token_id = 0 if pad_token_id is None else pad_token_id
+
+    eos_token_id_set = set()
+    if generation_config.eos_token_id is not None:
+        if isinstance(generation_config.eos_token_id, list):
+            eos_token_id_set = set(generation_config.eos_token_id)
+        else:
+            eos_token_id_set = set([generation_config.eos_token_id])
+
+    clear_benchmarks(self)
+    self.accept_rate = []
+    generated = [[] for _ in range(batch_size)]
+    finished = [False] * batch_size
+
+    def accept(row, tokens):
+        # append accepted tokens of a row, stop on eos and `max_new_tokens`
+        tokens = tokens[:max_new_tokens - len(generated[row])]
+        for idx, token in enumerate(tokens):
+            if token in eos_token_id_set:
+                tokens = tokens[:idx + 1]
+                finished[row] = True
+                break
+        generated[row].extend(tokens)
+        if len(generated[row]) >= max_new_tokens:
+            finished[row] = True
+        return tokens
+
+    def history():
+        # left padded token history of every row for logits processors
+        rows = [torch.cat((input_ids[row].cpu(), torch.tensor(generated[row], dtype=torch.long)))
+                for row in range(batch_size)]
+        max_len = max(len(r) for r in rows)
+        padded = torch.full((batch_size, max_len), pad_token_id, dtype=torch.long)
+        for row, r in enumerate(rows):
+            padded[row, max_len - len(r):] = r
+        return padded.to(device)
+
+    # first token use full model
+    tic = time.time()
+    model_kwargs["attention_mask"] = attention_mask
+    model_inputs = self.prepare_inputs_for_generation(input_ids, **model_kwargs)
+    output = self(**model_inputs, return_dict=True)
+    logits = output['logits'][:, -1:]
+    logits[:, -1, :] = logits_processor(input_ids, logits[:, -1, :])
+    output_ids = _sample_or_greedy(logits, generation_config)
+    past_key_values = output['past_key_values']
+    last_ids = output_ids[:, -1].tolist()
+    for row in range(batch_size):
+        accept(row, last_ids[row:row + 1])
+    candidates_generator.init_look_up_table(
+        torch.cat((input_ids, output_ids), dim=-1),
+        torch.cat((attention_mask, torch.ones_like(output_ids, dtype=attention_mask.dtype)),
+                  dim=-1))
+    if self.device.type == 'xpu':
+        torch.xpu.synchronize()
+    self.first_token_time = time.time() - tic
+    e2e_tic = time.time()
+
+    while not all(finished):
+        toc = time.time()
+        candidates = candidates_generator.get_batch_candidates()
+        candidate_lengths = [0 if finished[row] else len(candidates[row])
+                             for row in range(batch_size)]
+        candidate_length = max(candidate_lengths)
+        verify_input_ids = torch.full((batch_size, candidate_length + 1), pad_token_id,
+                                      dtype=torch.long)
+        verify_input_ids[:, 0] = torch.tensor(last_ids, dtype=torch.long)
+        for row in range(batch_size):
+            if candidate_lengths[row] > 0:
+                verify_input_ids[row, 1:candidate_lengths[row] + 1] = candidates[row]
+        verify_input_ids = verify_input_ids.to(device)
+        self.draft_num.append(candidate_length)
+        tic = time.time()
+        self.draft_time.append(tic - toc)
+
+        past_len = attention_mask.size(1)
+        cur_attention_mask = torch.cat((attention_mask,
+                                        attention_mask.new_ones(batch_size,
+                                                                candidate_length + 1)), dim=1)
+        position_ids = (cur_attention_mask.long().cumsum(-1) - 1)[:, past_len:]
+        output = _non_cpu_ipex_verify(self, verify_input_ids, past_key_values,
+                                      _verify_attention_mask(self, cur_attention_mask,
+                                                             candidate_length + 1),
+                                      return_dict=True, use_cache=True,
+                                      position_ids=position_ids)
+        logits = output['logits']
+        past_key_values = output['past_key_values']
+
+        if len(logits_processor) > 0:
+            seq = history()
+            for i in range(candidate_length + 1):
+                logits[:, i, :] = logits_processor(
+                    torch.cat((seq, verify_input_ids[:, 1:i + 1]), dim=1), logits[:, i, :])
+
+        output_ids = _sample_or_greedy(logits, generation_config)
+
+        if self.device.type == 'xpu':
+            torch.xpu.synchronize()
+        toc = time.time()
+        self.verify_time.append(toc - tic)
+
+        # Compare drafts with target verified outputs, each row accepts its own
+        # matched prefix and one token generated by the base model
+        n_matches = ((output_ids[:, :-1] != verify_input_ids[:, 1:])
+                     .cumsum(-1) == 0).sum(-1).cpu()
+        n_matches = torch.minimum(n_matches, torch.tensor(candidate_lengths))
+        max_matches = n_matches.max().item()
+        mot = time.time()
+        self.match_time.append(mot - toc)
+
+        self.accept_num.append(max_matches + 1)
+        self.n_matched += sum(n for n, f in zip(n_matches.tolist(), finished) if not f)
+        self.n_drafted += sum(candidate_lengths)
+
+        # Clean up target model KV cache to the longest accepted prefix
+        if candidate_length > max_matches:
+            past_key_values = _crop_past_key_values(self, past_key_values,
+                                                    candidate_length - max_matches)
+        attention_mask = cur_attention_mask[:, :past_len + 1 + max_matches].clone()
+        rejected = torch.arange(max_matches)[None, :] >= n_matches[:, None]
+        attention_mask[:, past_len + 1:][rejected.to(attention_mask.device)] = 0
+
+        accept_rate = self.n_matched / self.n_drafted if self.n_drafted > 0 else 1
+        self.accept_rate.append(accept_rate)
+        if device_name not in ["mtl", "lnl"]:
+            candidates_generator.update_candidate_strategy(candidate_length, max_matches,
+                                                           accept_rate)
+
+        output_ids = output_ids.cpu()
+        for row in range(batch_size):
+            if finished[row]:
+                continue
+            tokens = accept(row, output_ids[row, :n_matches[row] + 1].tolist())
+            last_ids[row] = tokens[-1]
+            candidates_generator.extend_look_up_table(row, torch.tensor(tokens))
+
+        self.post_time.append(time.time() - mot)
+
+    e2e_toc = time.time()
+    self.n_token_generated = max(len(tokens) for tokens in generated)
+    self.e2e_time_without_first = e2e_toc - e2e_tic
+
+    # finished rows are padded with `pad_token_id`, the same as `generate`
+    output_ids = torch.full((batch_size, self.n_token_generated), pad_token_id,
+                            dtype=torch.long)
+    for row, tokens in enumerate(generated):
+        output_ids[row, :len(tokens)] = torch.tensor(tokens, dtype=torch.long)
+    return torch.cat((input_ids, output_ids.to(device)), dim=-1)
@@ -0,0 +1,178 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# A low-bit checkpoint is a safetensors file whose quantized tensors are stored as
+# raw uint8 bytes, the qtype, weight_shape and weight_length needed to rebuild
+# `FP4Params` are kept in the `low_bit` entry of the safetensors metadata.
+# Loading memory maps the file and makes every weight a view into the mapping,
+# so no tensor is unpickled or copied.
+
+import os
+import json
+import struct
+import numpy as np
+import torch
+from functools import reduce
+from operator import mul
+from typing import Optional
+
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger
+
+
+LOW_BIT_WEIGHTS_NAME = "low_bit_model.safetensors"
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def save_low_bit_checkpoint(model: torch.nn.Module, save_directory: str):
+    from safetensors.torch import save_file
+    from .low_bit_linear import FP4Params
+
+    os.makedirs(save_directory, exist_ok=True)
+    tensors = {}
+    low_bit = {}
+    aliases = {}
+    saved = {}
+    for name, tensor in model.state_dict(keep_vars=True).items():
+        # tied weights are stored once
+        key = (tensor.data_ptr(), tensor.dtype, tuple(tensor.shape))
+        if tensor.numel() > 0 and key in saved:
+            aliases[name] = saved[key]
+            continue
+        saved[key] = name
+        if isinstance(tensor, FP4Params):
+            weight_shape = list(tensor._shape)
+            low_bit[name] = {
+                "qtype": tensor.qtype,
+                "weight_shape": weight_shape,
+                "weight_length": reduce(mul, weight_shape, 1),
+            }
+        tensors[name] = tensor.data.contiguous()
+
+    metadata = {
+        "format": "pt",
+        "low_bit": json.dumps(low_bit),
+        "aliases": json.dumps(aliases),
+    }
+    save_file(tensors, os.path.join(save_directory, LOW_BIT_WEIGHTS_NAME), metadata=metadata)
+
+
+def _read_header(checkpoint_file: str):
+    with open(checkpoint_file, "rb") as f:
+        header_length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(header_length))
+    return header, 8 + header_length
+
+
+def get_low_bit_checkpoint_dtype(checkpoint_file: str):
+    """Return the dtype of the first floating point tensor which is not quantized."""
+    header, _ = _read_header(checkpoint_file)
+    low_bit = json.loads(header.pop("__metadata__", {}).get("low_bit", "{}"))
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        if name not in low_bit and dtype.is_floating_point:
+            return dtype
+    return torch.float32
+
+
+def load_low_bit_checkpoint(model: torch.nn.Module, checkpoint_file: str,
+                            dtype: Optional[torch.dtype] = None):
+    """
+    Load a checkpoint saved by `save_low_bit_checkpoint` into `model`, whose linear
+    layers are already replaced by low-bit linear layers (possibly on meta device).
+
+    :param dtype: the dtype of floating point parameters which are not quantized,
+                  parameters are copied only if they are stored in another dtype.
+    """
+    from .low_bit_linear import FP4Params
+
+    header, data_offset = _read_header(checkpoint_file)
+    metadata = header.pop("__metadata__", {})
+    low_bit = json.loads(metadata.get("low_bit", "{}"))
+    aliases = json.loads(metadata.get("aliases", "{}"))
+
+    # copy-on-write mapping, pages are read from disk only when they are touched
+    buffer = np.memmap(checkpoint_file, dtype=np.uint8, mode="c")
+    unexpected_keys = []
+    for name, info in header.items():
+        begin, end = info["data_offsets"]
+        begin += data_offset
+        end += data_offset
+        tensor_dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        tensor = torch.from_numpy(buffer[begin:end])
+        if begin % torch.empty(0, dtype=tensor_dtype).element_size() != 0:
+            # a misaligned view cannot be reinterpreted, fallback to a copy
+            tensor = tensor.clone()
+        tensor = tensor.view(tensor_dtype).view(info["shape"])
+
+        module_name, _, tensor_name = name.rpartition(".")
+        try:
+            module = model.get_submodule(module_name)
+        except AttributeError:
+            unexpected_keys.append(name)
+            continue
+
+        if name in low_bit:
+            old_param = module._parameters.get(tensor_name, None)
+            module._parameters[tensor_name] = FP4Params(
+                data=tensor,
+                requires_grad=False,
+                quantized=True,
+                _shape=tuple(low_bit[name]["weight_shape"]),
+                convert_shape_only=False,
+                qtype=low_bit[name]["qtype"],
+                in_features=getattr(old_param, "in_features", None),
+                enable_xetla=getattr(old_param, "enable_xetla", False),
+                enable_scale_search=getattr(old_param, "enable_scale_search", False),
+            )
+        elif tensor_name in module._parameters:
+            if dtype is not None and tensor.is_floating_point() and tensor.dtype != dtype:
+                tensor = tensor.to(dtype)
+            module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=False)
+        elif tensor_name in module._buffers:
+            module._buffers[tensor_name] = tensor
+        else:
+            unexpected_keys.append(name)
+
+    for name, target in aliases.items():
+        module_name, _, tensor_name = name.rpartition(".")
+        target_module_name, _, target_tensor_name = target.rpartition(".")
+        module = model.get_submodule(module_name)
+        target_module = model.get_submodule(target_module_name)
+        if target_tensor_name in target_module._parameters:
+            module._parameters[tensor_name] = target_module._parameters[target_tensor_name]
+        else:
+            module._buffers[tensor_name] = target_module._buffers[target_tensor_name]
+
+    if len(unexpected_keys) > 0:
+        logger.warning(f"Some weights of {checkpoint_file} were not used: {unexpected_keys}")
+    missing_keys = [name for name, param in model.named_parameters()
+                    if param.device.type == "meta"]
+    invalidInputError(len(missing_keys) == 0,
+                      f"Some weights are missing in {checkpoint_file}: {missing_keys}")
+    return model
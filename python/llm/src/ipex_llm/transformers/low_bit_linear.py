@@ -62,6 +62,8 @@ import ctypes
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
 
 TORCH_LINEAR_THRESHOLD = int(os.getenv("BIGDL_LLM_LINEAR_THRESHOLD", "512"))
+# elements of a weight tile dequantized at once when training on CPU
+LOW_BIT_TILE_NUMEL = int(os.getenv("IPEX_LLM_LOW_BIT_TILE_NUMEL", str(1 << 20)))
 SYM_INT4 = ggml_tensor_qtype["sym_int4"]
 ASYM_INT4 = ggml_tensor_qtype["asym_int4"]
 SYM_INT8 = ggml_tensor_qtype["sym_int8"]
@@ -362,6 +364,54 @@ def ggml_convert_fp32(tensor: torch.Tensor, weight_shape: tuple, k: int, qtype:
     return dst_tensor
 
 
+_dequantize_scratch = {}
+
+
+def get_dequantize_scratch(numel: int, dtype: torch.dtype):
+    # one buffer per dtype is shared by all layers and grows to the largest tile
+    scratch = _dequantize_scratch.get(dtype, None)
+    if scratch is None or scratch.numel() < numel:
+        scratch = torch.empty(numel, dtype=dtype)
+        _dequantize_scratch[dtype] = scratch
+    return scratch[:numel]
+
+
+def ggml_dequantize_rows(tensor: torch.Tensor, qtype: int, in_features: int,
+                         row_start: int, row_end: int, dst_tensor: torch.Tensor):
+    # rows of a CPU low-bit weight are whole blocks, so a range of rows is contiguous
+    row_bytes = in_features // ggml.ggml_qk_size(qtype) * ggml.ggml_type_size(qtype)
+    src_ptr = ctypes.c_void_p(tensor.data.data_ptr() + row_start * row_bytes)
+    dst_ptr = ctypes.c_void_p(dst_tensor.data.data_ptr())
+    k = (row_end - row_start) * in_features
+    if qtype == SYM_INT4:
+        ggml.ggml_dequantize_q4_0(src_ptr, dst_ptr, k)
+    else:
+        ggml.ggml_dequantize(src_ptr, dst_ptr, k, qtype)
+    return dst_tensor.view(row_end - row_start, in_features)
+
+
+def iter_dequantized_tiles(weight: torch.Tensor, dtype: torch.dtype):
+    """
+    Dequantize a CPU low-bit weight tile by tile, each tile holds a range of output
+    features and is only valid until the next one is produced.
+    """
+    out_features, in_features = weight._shape
+    invalidInputError(weight.data.dtype == torch.uint8,
+                      "Input tensor must be uint8")
+    tile_rows = max(1, min(out_features, LOW_BIT_TILE_NUMEL // in_features))
+    fp32_scratch = get_dequantize_scratch(tile_rows * in_features, torch.float)
+    if dtype != torch.float:
+        scratch = get_dequantize_scratch(tile_rows * in_features, dtype)
+    for row_start in range(0, out_features, tile_rows):
+        row_end = min(row_start + tile_rows, out_features)
+        numel = (row_end - row_start) * in_features
+        tile = ggml_dequantize_rows(weight.data, weight.qtype, in_features,
+                                    row_start, row_end, fp32_scratch[:numel])
+        if dtype != torch.float:
+            tile = scratch[:numel].view_as(tile).copy_(tile)
+        yield row_start, row_end, tile
+
+
 def reshape_lm_head_input(x):
     if x.dim() > 3:
         x = x.reshape([-1, x.shape[-2], x.shape[-1]])
@@ -661,13 +711,19 @@ class MatMulLowBit(torch.autograd.Function):
 
 
 class MatMulLowBitCPU(torch.autograd.Function):
+    # Only a tile of the weight is dequantized at a time instead of the whole weight,
+    # bf16 inputs (e.g. with cpu autocast) are multiplied by bf16 tiles, which runs
+    # on AMX / AVX512-BF16 when the cpu supports them.
 
     @staticmethod
     def forward(ctx, A, weight):
         ctx.is_empty = False
-        x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
-                                         weight._shape[0] * weight._shape[1])
-        result = torch.matmul(A, x0_fp32.T)
+        dtype = torch.bfloat16 if A.dtype == torch.bfloat16 else torch.float
+        A_2d = A.reshape(-1, A.shape[-1]).to(dtype)
+        result = torch.empty(A_2d.shape[0], weight._shape[0], dtype=dtype)
+        for row_start, row_end, tile in iter_dequantized_tiles(weight, dtype):
+            torch.mm(A_2d, tile.t(), out=result[:, row_start:row_end])
+        result = result.view(*A.shape[:-1], weight._shape[0])
         if any(ctx.needs_input_grad[:2]):
             ctx.tensors = (A, weight)
         else:
@@ -683,10 +739,17 @@ class MatMulLowBitCPU(torch.autograd.Function):
         A, weight = ctx.tensors
         grad_A, grad_weight = None, None
         if req_gradA:
-            x0_fp32 = ggml_int4_convert_fp32(weight.data, weight._shape,
-                                             weight._shape[0] * weight._shape[1])
-            grad_A = torch.matmul(grad_output, x0_fp32.to(grad_output.dtype))
-        return grad_A, grad_weight, None
+            dtype = torch.bfloat16 if grad_output.dtype == torch.bfloat16 else torch.float
+            grad_2d = grad_output.reshape(-1, grad_output.shape[-1]).to(dtype)
+            # accumulate the tiles in fp32
+            grad_A = torch.zeros(grad_2d.shape[0], weight._shape[1], dtype=torch.float)
+            for row_start, row_end, tile in iter_dequantized_tiles(weight, dtype):
+                if dtype == torch.float:
+                    grad_A.addmm_(grad_2d[:, row_start:row_end], tile)
+                else:
+                    grad_A += torch.mm(grad_2d[:, row_start:row_end], tile)
+            grad_A = grad_A.to(A.dtype).view(*A.shape)
+        return grad_A, grad_weight
 
 
 class LowBitLinear(nn.Linear):
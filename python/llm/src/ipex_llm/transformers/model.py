@@ -51,6 +51,8 @@ from ipex_llm.transformers.gguf.api import load_gguf_model
 
 from .utils import logger, load_state_dict
 from .utils import extract_local_archive_file, get_local_shard_files, load_imatrix_data
+from .low_bit_checkpoint import LOW_BIT_WEIGHTS_NAME, save_low_bit_checkpoint, \
+    load_low_bit_checkpoint, get_low_bit_checkpoint_dtype
 from .patches import patch_flash_attn_import, patch_sdpa_available
 
 patched_training_mode = None
@@ -67,6 +69,8 @@ def save_low_bit(self, *args, **kwargs):
     origin_device = self.device
     self.to('cpu')
 
+    # the low-bit safetensors checkpoint is memory mapped by `load_low_bit`
+    safe_serialization = kwargs.pop('safe_serialization', False)
     kwargs['safe_serialization'] = False
 
     architectures = getattr(self.config, "architectures", None)
@@ -76,10 +80,12 @@ def save_low_bit(self, *args, **kwargs):
     if disk_embedding:
         from ipex_llm.transformers.embedding import DiskEmbedding
         self.apply(DiskEmbedding.restore_normal_embedding)
-        self.save_pretrained(*args, **kwargs)
-        self.apply(DiskEmbedding.replace_normal_embedding)
+    if safe_serialization:
+        save_low_bit_checkpoint(self, args[0])
     else:
         self.save_pretrained(*args, **kwargs)
+    if disk_embedding:
+        self.apply(DiskEmbedding.replace_normal_embedding)
 
     if architectures:
         self.config.update({"architectures": architectures})
@@ -163,6 +169,17 @@ class _BaseAutoModelClass:
         :param pipeline_parallel_stages: int value, the number of GPUs allocated for
             pipeline parallel. Default to be ``1``. Please set pipeline_parallel_stages > 1
             to run pipeline parallel inference on multiple GPUs.
+        :param streaming_convert: boolean value, Whether to load checkpoint shards tensor by
+            tensor and quantize every decoder layer once its weights are loaded, so the full
+            precision model is never held in memory. Linears are quantized by
+            ``IPEX_LLM_QUANTIZE_THREADS`` threads. Unsupported models fallback to the
+            default loading. Default to be ``False``.
+        :param expert_offload_path: str value, the path of the expert store of a MoE model
+            (mixtral, qwen2_moe). The low-bit experts are written to it, or checked against
+            the store already there, and released from the model. With ``streaming_convert``
+            this happens layer by layer, so all experts are never in memory at once. Call
+            ``enable_expert_offload`` with the same path on the loaded model to run it.
+            Default to be ``None``.
         :return: a model instance
         """
         pretrained_model_name_or_path = kwargs.get("pretrained_model_name_or_path", None) \
@@ -449,9 +466,17 @@ class _BaseAutoModelClass:
         if embedding_qtype is not None:
             embedding_qtype = ggml_tensor_qtype[embedding_qtype]
         enable_xetla = kwargs.pop("enable_xetla", False)
+        streaming_convert = kwargs.pop("streaming_convert", False)
+        expert_offload_path = kwargs.pop("expert_offload_path", None)
+        expert_writer = None
+        if expert_offload_path is not None:
+            from .moe_offload import ExpertStoreWriter
+            expert_writer = ExpertStoreWriter(expert_offload_path)
         _args = copy.deepcopy(args)
         _kwargs = copy.deepcopy(kwargs)
         awq_config = None
+        # whether the model is loaded and converted by streaming conversion
+        converted = False
 
         if quant_config and quant_config.quant_method == "awq":
             # The latest transformers only support cuda version
@@ -496,30 +521,53 @@ class _BaseAutoModelClass:
                 offload_dir=None
             )
         else:
-            if quant_config is not None:
-                kwargs["quantization_config"] = quant_config
-            _load_pre()
-            try:
-                # To handle the input CUDA setting (such as 'device_map={"":0}'), ignore it
-                kwargs.pop('device_map', None)
-                model = cls.HF_Model.from_pretrained(*args, **kwargs)
-            except NotImplementedError:
-                logger.info("Failed to load models with `low_cpu_mem_usage` specified, "
-                            "will fall to traditional load method with higher memory consumption.")
-                _kwargs["low_cpu_mem_usage"] = False
-                model = cls.HF_Model.from_pretrained(*_args, **_kwargs)
-                model.config.update({"bigdl_lcmu_enabled": False})
-
-        model = model.to("cpu")
-        model = ggml_convert_low_bit(model, qtype, optimize_model,
-                                     modules_to_not_convert=modules_to_not_convert,
-                                     cpu_embedding=cpu_embedding,
-                                     lightweight_bmm=lightweight_bmm,
-                                     torch_dtype=kwargs.get("torch_dtype", 'auto'),
-                                     imatrix_data=imatrix_data,
-                                     embedding_qtype=embedding_qtype,
-                                     enable_xetla=enable_xetla,
-                                     mixed_precision=mixed_precision)
+            model = None
+            if streaming_convert and quant_config is None and len(args) == 1:
+                from .streaming_convert import load_convert_streaming
+                model = load_convert_streaming(cls.HF_Model, qtype, optimize_model, args[0],
+                                               modules_to_not_convert=modules_to_not_convert,
+                                               cpu_embedding=cpu_embedding,
+                                               lightweight_bmm=lightweight_bmm,
+                                               imatrix_data=imatrix_data,
+                                               embedding_qtype=embedding_qtype,
+                                               enable_xetla=enable_xetla,
+                                               mixed_precision=mixed_precision,
+                                               layer_hook=expert_writer.add
+                                               if expert_writer is not None else None,
+                                               **kwargs)
+            # `None` means the model is not supported, fallback to the default path
+            converted = model is not None
+            if not converted:
+                if quant_config is not None:
+                    kwargs["quantization_config"] = quant_config
+                _load_pre()
+                try:
+                    # To handle the input CUDA setting (such as 'device_map={"":0}'), ignore it
+                    kwargs.pop('device_map', None)
+                    model = cls.HF_Model.from_pretrained(*args, **kwargs)
+                except NotImplementedError:
+                    logger.info("Failed to load models with `low_cpu_mem_usage` specified, "
+                                "will fall to traditional load method with higher memory "
+                                "consumption.")
+                    _kwargs["low_cpu_mem_usage"] = False
+                    model = cls.HF_Model.from_pretrained(*_args, **_kwargs)
+                    model.config.update({"bigdl_lcmu_enabled": False})
+
+        if not converted:
+            model = model.to("cpu")
+            model = ggml_convert_low_bit(model, qtype, optimize_model,
+                                         modules_to_not_convert=modules_to_not_convert,
+                                         cpu_embedding=cpu_embedding,
+                                         lightweight_bmm=lightweight_bmm,
+                                         torch_dtype=kwargs.get("torch_dtype", 'auto'),
+                                         imatrix_data=imatrix_data,
+                                         embedding_qtype=embedding_qtype,
+                                         enable_xetla=enable_xetla,
+                                         mixed_precision=mixed_precision)
+            if expert_writer is not None:
+                expert_writer.add(model)
+        if expert_writer is not None:
+            expert_writer.close()
 
         if disk_embedding:
             from ipex_llm.transformers.embedding import DiskEmbedding
@@ -652,10 +700,17 @@ class _BaseAutoModelClass:
         elif type(config) in cls.HF_Model._model_mapping.keys():
             model_class = _get_model_class(config, cls.HF_Model._model_mapping)
 
-        resolved_archive_file, is_sharded = extract_local_archive_file(
-            pretrained_model_name_or_path,
-            subfolder,
-            variant)
+        # checkpoint saved by `save_low_bit(..., safe_serialization=True)` is memory mapped
+        low_bit_checkpoint_file = os.path.join(pretrained_model_name_or_path, subfolder,
+                                               LOW_BIT_WEIGHTS_NAME)
+        use_low_bit_checkpoint = os.path.isfile(low_bit_checkpoint_file)
+        if use_low_bit_checkpoint:
+            is_sharded = False
+        else:
+            resolved_archive_file, is_sharded = extract_local_archive_file(
+                pretrained_model_name_or_path,
+                subfolder,
+                variant)
 
         if is_sharded:
             resolved_archive_file, sharded_metadata = \
@@ -677,6 +732,8 @@ class _BaseAutoModelClass:
                     if hasattr(config, "torch_dtype") and config.torch_dtype is not None:
                         torch_dtype = config.torch_dtype
 
+                    elif use_low_bit_checkpoint:
+                        torch_dtype = get_low_bit_checkpoint_dtype(low_bit_checkpoint_file)
                     else:
                         if is_sharded and "dtype" in sharded_metadata:
                             torch_dtype = sharded_metadata["dtype"]
@@ -720,7 +777,7 @@ class _BaseAutoModelClass:
 
         if is_sharded:
             loaded_state_dict_keys = sharded_metadata["all_checkpoint_keys"]
-        else:
+        elif not use_low_bit_checkpoint:
             import os
             import json
             with open(os.path.join(pretrained_model_name_or_path,
@@ -732,27 +789,30 @@ class _BaseAutoModelClass:
         if dtype_orig is not None:
             torch.set_default_dtype(dtype_orig)
 
-        (
-            model,
-            missing_keys,
-            unexpected_keys,
-            mismatched_keys,
-            offload_index,
-            error_msgs,
-        ) = model_class._load_pretrained_model(
-            model,
-            None,
-            loaded_state_dict_keys,  # XXX: rename?
-            resolved_archive_file,
-            pretrained_model_name_or_path,
-            sharded_metadata=sharded_metadata,
-            _fast_init=False,  # always false to avoid pre-init behaviors
-            low_cpu_mem_usage=bigdl_lcmu_enabled,
-            offload_folder=offload_folder,
-            offload_state_dict=offload_state_dict,
-            dtype=torch_dtype,
-            keep_in_fp32_modules=[],
-        )
+        if use_low_bit_checkpoint:
+            model = load_low_bit_checkpoint(model, low_bit_checkpoint_file, torch_dtype)
+        else:
+            (
+                model,
+                missing_keys,
+                unexpected_keys,
+                mismatched_keys,
+                offload_index,
+                error_msgs,
+            ) = model_class._load_pretrained_model(
+                model,
+                None,
+                loaded_state_dict_keys,  # XXX: rename?
+                resolved_archive_file,
+                pretrained_model_name_or_path,
+                sharded_metadata=sharded_metadata,
+                _fast_init=False,  # always false to avoid pre-init behaviors
+                low_cpu_mem_usage=bigdl_lcmu_enabled,
+                offload_folder=offload_folder,
+                offload_state_dict=offload_state_dict,
+                dtype=torch_dtype,
+                keep_in_fp32_modules=[],
+            )
 
         # make sure token embedding weights are still tied if needed
         model.tie_weights()
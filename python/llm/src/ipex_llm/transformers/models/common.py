@@ -14,6 +14,7 @@
 # limitations under the License.
 
 
+import os
 import math
 import torch
 from typing import List
@@ -286,3 +287,62 @@ def scaled_dot_product_attention(query: torch.Tensor, key: torch.Tensor,
         )
         attn_output = attn_output.to(dtype)    # workaround ipex 2.1's bug
         return attn_output
+
+
+_moe_executor = None
+
+
+def _get_moe_executor():
+    # experts run one after another unless IPEX_LLM_MOE_NUM_WORKERS is set, the
+    # kernels of a single expert are already multi-threaded
+    global _moe_executor
+    num_workers = int(os.environ.get("IPEX_LLM_MOE_NUM_WORKERS", "0"))
+    if num_workers <= 1:
+        return None
+    if _moe_executor is None or _moe_executor._max_workers != num_workers:
+        from concurrent.futures import ThreadPoolExecutor
+        _moe_executor = ThreadPoolExecutor(max_workers=num_workers,
+                                           thread_name_prefix="ipex_llm_moe")
+    return _moe_executor
+
+
+def moe_group_forward(experts: torch.nn.ModuleList, hidden_states: torch.Tensor,
+                      routing_weights: torch.Tensor, selected_experts: torch.Tensor,
+                      expert_takes_weights: bool = False):
+    # sort the (token, expert) pairs by expert once, so that every expert runs on a
+    # contiguous segment, and scatter all outputs back with a single `index_add_`
+    top_k = selected_experts.size(-1)
+    flat_experts = selected_experts.view(-1)
+    order = torch.argsort(flat_experts, stable=True)
+    counts = torch.bincount(flat_experts, minlength=len(experts)).tolist()
+    token_ids = order // top_k
+    sorted_states = hidden_states.index_select(0, token_ids)
+    sorted_weights = routing_weights.reshape(-1).index_select(0, order).unsqueeze(-1)
+    sorted_outputs = torch.empty_like(sorted_states)
+
+    segments = []
+    start = 0
+    for expert_idx, count in enumerate(counts):
+        if count > 0:
+            segments.append((expert_idx, start, start + count))
+            start += count
+
+    def run_expert(segment):
+        expert_idx, start, end = segment
+        current_state = sorted_states[start:end]
+        if expert_takes_weights:
+            current_hidden_states = experts[expert_idx](current_state, sorted_weights[start:end])
+        else:
+            current_hidden_states = experts[expert_idx](current_state) * sorted_weights[start:end]
+        sorted_outputs[start:end] = current_hidden_states
+
+    executor = _get_moe_executor()
+    if executor is not None and len(segments) > 1:
+        list(executor.map(run_expert, segments))
+    else:
+        for segment in segments:
+            run_expert(segment)
+
+    final_hidden_states = torch.zeros_like(hidden_states)
+    final_hidden_states.index_add_(0, token_ids, sorted_outputs)
+    return final_hidden_states
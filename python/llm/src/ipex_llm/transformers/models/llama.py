@@ -118,10 +118,15 @@ def llama_model_forward_4_36(
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
     from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, \
-        DynamicCompressFp8Cache
+        DynamicCompressFp8Cache, DynamicSinkCache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        attention_mask = None
+        position_ids = past_key_values.get_cache_position(input.shape[1],
+                                                          input.device).unsqueeze(0)
+    elif use_cache:
         use_quantize = use_quantize_kv_cache(
             self.layers[0].mlp.up_proj, input,
             self.config.num_attention_heads//self.config.num_key_value_heads)
@@ -166,10 +171,15 @@ def llama_model_forward_4_38(
     cache_position: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
     from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, \
-        DynamicCompressFp8Cache
+        DynamicCompressFp8Cache, DynamicSinkCache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        attention_mask = None
+        cache_position = past_key_values.get_cache_position(input.shape[1], input.device)
+        position_ids = cache_position.unsqueeze(0)
+    elif use_cache:
         use_quantize = use_quantize_kv_cache(
             self.layers[0].mlp.up_proj, input,
             self.config.num_attention_heads//self.config.num_key_value_heads)
@@ -215,10 +225,15 @@ def llama_model_forward_4_41(
     cache_position: Optional[torch.LongTensor] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
     from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, \
-        DynamicCompressFp8Cache
+        DynamicCompressFp8Cache, DynamicSinkCache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
     input = input_ids if input_ids is not None else inputs_embeds
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        attention_mask = None
+        cache_position = past_key_values.get_cache_position(input.shape[1], input.device)
+        position_ids = cache_position.unsqueeze(0)
+    elif use_cache:
         use_quantize = use_quantize_kv_cache(
             self.layers[0].mlp.up_proj, input,
             self.config.num_attention_heads//self.config.num_key_value_heads)
@@ -1088,8 +1103,10 @@ def llama_attention_forward_4_41(
     cache_position: Optional[torch.LongTensor] = None,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[List[torch.FloatTensor]]]:
+    from ipex_llm.transformers.kv import DynamicSinkCache
     if use_quantize_kv_cache(get_q_proj_or_qkv_proj(self), hidden_states,
-                             self.num_key_value_groups):
+                             self.num_key_value_groups) and \
+            not isinstance(past_key_value, DynamicSinkCache):
         forward_function = llama_attention_forward_4_41_quantized
     else:
         forward_function = llama_attention_forward_4_41_original
@@ -1369,7 +1386,8 @@ def llama_attention_forward_4_41_original(
     cache_position: Optional[torch.LongTensor] = None,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[List[torch.FloatTensor]]]:
-    from ipex_llm.transformers.kv import DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicCompressCache, DynamicPagedCache, \
+        DynamicSinkCache
     if "padding_mask" in kwargs:
         warnings.warn(
             "Passing `padding_mask` is deprecated and will be removed in v4.37. "
@@ -1383,6 +1401,8 @@ def llama_attention_forward_4_41_original(
 
     # [CompressKV]
     use_compresskv = isinstance(past_key_value, DynamicCompressCache)
+    use_pagedkv = isinstance(past_key_value, DynamicPagedCache)
+    use_sinkkv = isinstance(past_key_value, DynamicSinkCache)
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx, seq_len=q_len)
@@ -1538,6 +1558,12 @@ def llama_attention_forward_4_41_original(
                     key_states, value_states, self.layer_idx,
                     query_states, attention_mask, self.num_key_value_groups,
                     self.config, enough_kv_room, KV_CACHE_ALLOC_BLOCK_LENGTH)
+            elif use_pagedkv:
+                past_key_value.write(key_states, value_states, self.layer_idx)
+            elif use_sinkkv:
+                key_states, value_states = past_key_value.update(
+                    key_states, value_states, self.layer_idx,
+                    {"inv_freq": self.rotary_emb.inv_freq})
             else:
                 # update the number of seen tokens
                 if self.layer_idx == 0:
@@ -1581,7 +1607,12 @@ def llama_attention_forward_4_41_original(
     else:
         new_attention_mask = attention_mask
 
-    if not self.training and not hidden_states.requires_grad and \
+    if use_pagedkv:
+        # attend to the cached blocks in place
+        attn_output = past_key_value.attention(query_states, self.layer_idx,
+                                               new_attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, new_attention_mask):
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -1677,8 +1708,10 @@ def llama_attention_forward_4_38(
     cache_position: Optional[torch.LongTensor] = None,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[List[torch.FloatTensor]]]:
+    from ipex_llm.transformers.kv import DynamicSinkCache
     if use_quantize_kv_cache(get_q_proj_or_qkv_proj(self), hidden_states,
-                             self.num_key_value_groups):
+                             self.num_key_value_groups) and \
+            not isinstance(past_key_value, DynamicSinkCache):
         forward_function = llama_attention_forward_4_38_quantized
     else:
         forward_function = llama_attention_forward_4_38_original
@@ -1960,7 +1993,8 @@ def llama_attention_forward_4_38_original(
     cache_position: Optional[torch.LongTensor] = None,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[List[torch.FloatTensor]]]:
-    from ipex_llm.transformers.kv import DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicCompressCache, DynamicPagedCache, \
+        DynamicSinkCache
     if "padding_mask" in kwargs:
         warnings.warn(
             "Passing `padding_mask` is deprecated and will be removed in v4.37. "
@@ -1974,6 +2008,8 @@ def llama_attention_forward_4_38_original(
 
     # [CompressKV]
     use_compresskv = isinstance(past_key_value, DynamicCompressCache)
+    use_pagedkv = isinstance(past_key_value, DynamicPagedCache)
+    use_sinkkv = isinstance(past_key_value, DynamicSinkCache)
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
     enough_kv_room = is_enough_kv_cache_room_4_36(past_key_value, self.layer_idx, seq_len=q_len)
@@ -2128,6 +2164,12 @@ def llama_attention_forward_4_38_original(
                     key_states, value_states, self.layer_idx,
                     query_states, attention_mask, self.num_key_value_groups,
                     self.config, enough_kv_room, KV_CACHE_ALLOC_BLOCK_LENGTH)
+            elif use_pagedkv:
+                past_key_value.write(key_states, value_states, self.layer_idx)
+            elif use_sinkkv:
+                key_states, value_states = past_key_value.update(
+                    key_states, value_states, self.layer_idx,
+                    {"inv_freq": self.rotary_emb.inv_freq})
             else:
                 # update the number of seen tokens
                 if self.layer_idx == 0:
@@ -2171,7 +2213,12 @@ def llama_attention_forward_4_38_original(
     else:
         new_attention_mask = attention_mask
 
-    if not self.training and not hidden_states.requires_grad and \
+    if use_pagedkv:
+        # attend to the cached blocks in place
+        attn_output = past_key_value.attention(query_states, self.layer_idx,
+                                               new_attention_mask)
+        attn_weights = None
+    elif not self.training and not hidden_states.requires_grad and \
             use_flash_attention(query_states, key_states, new_attention_mask):
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
@@ -2614,11 +2661,13 @@ def llama_model_forward_4_41_internal(
         all_hidden_states += (hidden_states,)
 
     next_cache = None
-    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, \
+        DynamicSinkCache, DynamicPagedCache
     if use_cache:
         next_cache = (
             next_decoder_cache.to_legacy_cache()
-            if not isinstance(next_decoder_cache, (DynamicFp8Cache, DynamicCompressCache))
+            if not isinstance(next_decoder_cache, (DynamicFp8Cache, DynamicCompressCache,
+                                                   DynamicSinkCache, DynamicPagedCache))
             else next_decoder_cache
         )
 
@@ -2744,11 +2793,13 @@ def llama_model_forward_4_38_internal(
         all_hidden_states += (hidden_states,)
 
     next_cache = None
-    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, \
+        DynamicSinkCache, DynamicPagedCache
     if use_cache:
         next_cache = (
             next_decoder_cache.to_legacy_cache()
-            if not isinstance(next_decoder_cache, (DynamicFp8Cache, DynamicCompressCache))
+            if not isinstance(next_decoder_cache, (DynamicFp8Cache, DynamicCompressCache,
+                                                   DynamicSinkCache, DynamicPagedCache))
             else next_decoder_cache
         )
     if not return_dict:
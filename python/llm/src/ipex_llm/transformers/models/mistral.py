@@ -202,9 +202,15 @@ def mistral_model_forward_4_36(
     output_hidden_states: Optional[bool] = None,
     return_dict: Optional[bool] = None,
 ) -> Union[Tuple, BaseModelOutputWithPast]:
-    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicCompressCache, DynamicSinkCache
     use_cache = use_cache if use_cache is not None else self.config.use_cache
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        input = input_ids if input_ids is not None else inputs_embeds
+        attention_mask = None
+        position_ids = past_key_values.get_cache_position(input.shape[1],
+                                                          input.device).unsqueeze(0)
+    elif use_cache:
         if use_quantize_kv_cache(self.layers[0].mlp.up_proj, input_ids,
                                  self.config.num_attention_heads//self.config.num_key_value_heads):
             if not isinstance(past_key_values, DynamicFp8Cache):
@@ -666,7 +672,9 @@ def mistral_attention_forward_4_36(
     use_cache: bool=False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states, self.num_key_value_groups):
+    from ipex_llm.transformers.kv import DynamicSinkCache
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.num_key_value_groups) and \
+            not isinstance(past_key_value, DynamicSinkCache):
         forward_function = mistral_attention_forward_4_36_quantized
     else:
         forward_function = mistral_attention_forward_4_36_original
@@ -904,7 +912,8 @@ def mistral_attention_forward_4_36_original(
     use_cache: bool=False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    from ipex_llm.transformers.kv import DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicCompressCache, DynamicPagedCache, \
+        DynamicSinkCache
 
     bsz, q_len, hidden_size = hidden_states.size()
     device = hidden_states.device
@@ -913,6 +922,8 @@ def mistral_attention_forward_4_36_original(
 
     # [CompressKV]
     use_compresskv = isinstance(past_key_value, DynamicCompressCache)
+    use_pagedkv = isinstance(past_key_value, DynamicPagedCache)
+    use_sinkkv = isinstance(past_key_value, DynamicSinkCache)
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
 
@@ -1011,6 +1022,12 @@ def mistral_attention_forward_4_36_original(
                     key_states, value_states, self.layer_idx,
                     query_states, attention_mask, self.num_key_value_groups,
                     self.config, enough_kv_room, KV_CACHE_ALLOC_BLOCK_LENGTH)
+            elif use_pagedkv:
+                past_key_value.write(key_states, value_states, self.layer_idx)
+            elif use_sinkkv:
+                key_states, value_states = past_key_value.update(
+                    key_states, value_states, self.layer_idx,
+                    {"inv_freq": self.rotary_emb.inv_freq})
             else:
                 # update the number of seen tokens
                 if self.layer_idx == 0:
@@ -1047,7 +1064,7 @@ def mistral_attention_forward_4_36_original(
                     past_key_value.key_cache[self.layer_idx] = key_states
                     past_key_value.value_cache[self.layer_idx] = value_states
 
-    if not self.training and not hidden_states.requires_grad:
+    if not self.training and not hidden_states.requires_grad and not use_pagedkv:
         fsdp_flag = use_flash_attention(query_states, key_states)
     else:
         fsdp_flag = False
@@ -1056,7 +1073,14 @@ def mistral_attention_forward_4_36_original(
     else:
         attention_dtype = original_dtype
 
-    if fsdp_flag:
+    if use_pagedkv:
+        # attend to the cached blocks in place
+        attn_output = past_key_value.attention(query_states, self.layer_idx,
+                                               attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
@@ -1137,7 +1161,9 @@ def mistral_attention_forward_4_39(
     use_cache: bool=False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    if use_quantize_kv_cache(self.q_proj, hidden_states, self.num_key_value_groups):
+    from ipex_llm.transformers.kv import DynamicSinkCache
+    if use_quantize_kv_cache(self.q_proj, hidden_states, self.num_key_value_groups) and \
+            not isinstance(past_key_value, DynamicSinkCache):
         forward_function = mistral_attention_forward_4_36_quantized
     else:
         forward_function = mistral_attention_forward_4_39_original
@@ -1163,7 +1189,8 @@ def mistral_attention_forward_4_39_original(
     use_cache: bool=False,
     **kwargs
 ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Cache]]:
-    from ipex_llm.transformers.kv import DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicCompressCache, DynamicPagedCache, \
+        DynamicSinkCache
     bsz, q_len, hidden_size = hidden_states.size()
     device = hidden_states.device
     # for flash attention
@@ -1171,6 +1198,8 @@ def mistral_attention_forward_4_39_original(
 
     # [CompressKV]
     use_compresskv = isinstance(past_key_value, DynamicCompressCache)
+    use_pagedkv = isinstance(past_key_value, DynamicPagedCache)
+    use_sinkkv = isinstance(past_key_value, DynamicSinkCache)
 
     use_fuse_rope = should_use_fuse_rope(self, hidden_states, position_ids)
 
@@ -1267,6 +1296,12 @@ def mistral_attention_forward_4_39_original(
                     key_states, value_states, self.layer_idx,
                     query_states, attention_mask, self.num_key_value_groups,
                     self.config, enough_kv_room, KV_CACHE_ALLOC_BLOCK_LENGTH)
+            elif use_pagedkv:
+                past_key_value.write(key_states, value_states, self.layer_idx)
+            elif use_sinkkv:
+                key_states, value_states = past_key_value.update(
+                    key_states, value_states, self.layer_idx,
+                    {"inv_freq": self.rotary_emb.inv_freq})
             else:
                 # update the number of seen tokens
                 if self.layer_idx == 0:
@@ -1304,7 +1339,7 @@ def mistral_attention_forward_4_39_original(
                     past_key_value.key_cache[self.layer_idx] = key_states
                     past_key_value.value_cache[self.layer_idx] = value_states
 
-    if not self.training and not hidden_states.requires_grad:
+    if not self.training and not hidden_states.requires_grad and not use_pagedkv:
         fsdp_flag = use_flash_attention(query_states, key_states)
     else:
         fsdp_flag = False
@@ -1313,7 +1348,14 @@ def mistral_attention_forward_4_39_original(
     else:
         attention_dtype = original_dtype
 
-    if fsdp_flag:
+    if use_pagedkv:
+        # attend to the cached blocks in place
+        attn_output = past_key_value.attention(query_states, self.layer_idx,
+                                               attention_mask)
+        attn_weights = None
+        attn_output = attn_output.transpose(1, 2).contiguous()
+        attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
+    elif fsdp_flag:
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups).to(device,
                                                                          dtype=attention_dtype)
@@ -53,6 +53,7 @@ from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.models.utils import init_kv_cache, extend_kv_cache, append_kv_cache
 from ipex_llm.transformers.models.utils import apply_rotary_pos_emb, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.mistral import should_use_fuse_rope
+from ipex_llm.transformers.models.common import moe_group_forward
 from ipex_llm.transformers.models.utils import use_decoding_fast_path
 from ipex_llm.transformers.models.utils import use_flash_attention, use_sdp
 from ipex_llm.transformers.models.utils import mlp_fusion_check, SILU
@@ -91,7 +92,12 @@ def mixtral_moeblock_forward(self,
     # we cast back to the input dtype
     routing_weights = routing_weights.to(hidden_states.dtype)
 
-    if bs == 1:
+    if getattr(self, "expert_cache", None) is not None:
+        # experts are offloaded by `enable_expert_offload`
+        final_hidden_states = self.expert_cache.moe_forward(self, hidden_states, routing_weights,
+                                                            selected_experts,
+                                                            expert_takes_weights=True)
+    elif bs == 1:
         selected_experts = selected_experts[0].cpu().tolist()
         for idx in range(self.top_k):
             exp_id = selected_experts[idx]
@@ -119,38 +125,8 @@ def mixtral_moeblock_forward(self,
                                                  routing_weights[top_x_list, idx_list, None])
             final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
     else:
-        final_hidden_states = torch.zeros(
-            (batch_size * sequence_length, hidden_dim),
-            dtype=hidden_states.dtype,
-            device=hidden_states.device
-        )
-        # One hot encode the selected experts to create an expert mask
-        # this will be used to easily index which expert is going to be sollicitated
-        expert_mask = torch.nn.functional.one_hot(selected_experts,
-                                                  num_classes=self.num_experts).permute(2, 1, 0)
-
-        # Loop over all available experts in the model and perform the computation on each expert
-        for expert_idx in range(self.num_experts):
-            expert_layer = self.experts[expert_idx]
-            idx, top_x = torch.where(expert_mask[expert_idx])
-
-            if top_x.shape[0] == 0:
-                continue
-
-            # in torch it is faster to index using lists than torch tensors
-            top_x_list = top_x.tolist()
-            idx_list = idx.tolist()
-
-            # Index the correct hidden states and compute the expert hidden state for
-            # the current expert. We need to make sure to multiply the output hidden
-            # states by `routing_weights` on the corresponding tokens (top-1 and top-2)
-            current_state = hidden_states[None, top_x_list].reshape(-1, hidden_dim)
-            current_hidden_states = expert_layer(current_state,
-                                                 routing_weights[top_x_list, idx_list, None])
-
-            # However `index_add_` only support torch tensors for indexing so we'll use
-            # the `top_x` tensor here.
-            final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
+        final_hidden_states = moe_group_forward(self.experts, hidden_states, routing_weights,
+                                                selected_experts, expert_takes_weights=True)
 
     final_hidden_states = final_hidden_states.reshape(batch_size, sequence_length, hidden_dim)
     return final_hidden_states, router_logits
@@ -53,7 +53,7 @@ from ipex_llm.transformers.models.utils import use_quantize_kv_cache, \
     should_use_compresskv, is_enough_kv_cache_room_4_36
 from ipex_llm.transformers.models.utils import use_flash_attention
 from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache, \
-    DynamicCompressCache, DynamicCompressFp8Cache
+    DynamicCompressCache, DynamicCompressFp8Cache, DynamicSinkCache
 from ipex_llm.utils.common import invalidInputError
 
 from transformers.models.qwen2.modeling_qwen2 import Qwen2Attention, Qwen2MLP
@@ -124,7 +124,11 @@ def qwen2_model_forward(
     use_compress_kv = should_use_compresskv(inputs, inputs.shape[1]) or \
         isinstance(past_key_values, DynamicCompressCache)
 
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        attention_mask = None
+        position_ids = None
+    elif use_cache:
         if use_compress_kv and not isinstance(past_key_values, DynamicCompressCache):
             if use_quantize_kv:
                 past_key_values = DynamicCompressFp8Cache.from_legacy_cache(past_key_values)
@@ -136,6 +140,7 @@ def qwen2_model_forward(
         if not use_quantize_kv and not use_compress_kv and not isinstance(past_key_values,
                                                                           DynamicNormalCache):
             past_key_values = DynamicNormalCache.from_legacy_cache(past_key_values)
+    if use_cache:
         past_key_values_length = past_key_values.get_usable_length(seq_length)
     # ipex-llm changes end
 
@@ -316,7 +321,13 @@ def qwen2_model_forward_4_42(
     use_compress_kv = should_use_compresskv(inputs_embeds, inputs_embeds.shape[1]) or \
         isinstance(past_key_values, DynamicCompressCache)
 
-    if use_cache:
+    if isinstance(past_key_values, DynamicSinkCache):
+        # positions are re-indexed inside the window kept by the cache
+        attention_mask = None
+        cache_position = past_key_values.get_cache_position(inputs_embeds.shape[1],
+                                                            inputs_embeds.device)
+        position_ids = cache_position.unsqueeze(0)
+    elif use_cache:
         if use_compress_kv and not isinstance(past_key_values, DynamicCompressCache):
             if use_quantize_kv:
                 past_key_values = DynamicCompressFp8Cache.from_legacy_cache(past_key_values)
@@ -531,8 +542,9 @@ def qwen2_attention_forward(
     device = hidden_states.device
 
     # [CompressKV]
-    from ipex_llm.transformers.kv import DynamicCompressCache
+    from ipex_llm.transformers.kv import DynamicCompressCache, DynamicPagedCache
     use_compresskv = isinstance(past_key_value, DynamicCompressCache)
+    use_pagedkv = isinstance(past_key_value, DynamicPagedCache)
 
     if hasattr(self, 'qkv_proj') and self.qkv_proj is not None:
         qkv = self.qkv_proj(hidden_states)
@@ -578,12 +590,21 @@ def qwen2_attention_forward(
                 key_states, value_states, self.layer_idx,
                 query_states, attention_mask, self.num_key_value_groups,
                 self.config, enough_kv_room, 256)
+        elif isinstance(past_key_value, DynamicSinkCache):
+            key_states, value_states = past_key_value.update(
+                key_states, value_states, self.layer_idx,
+                {"inv_freq": self.rotary_emb.inv_freq})
+        elif use_pagedkv:
+            past_key_value.write(key_states, value_states, self.layer_idx)
         else:
             key_states, value_states = past_key_value.update(key_states, value_states,
                                                              self.layer_idx, None)
 
     attn_weights = None
-    if use_flash_attention(query_states, key_states, attention_mask):
+    if use_pagedkv:
+        # attend to the cached blocks in place
+        attn_output = past_key_value.attention(query_states, self.layer_idx, attention_mask)
+    elif use_flash_attention(query_states, key_states, attention_mask):
         # repeat k/v heads if n_kv_heads < n_heads
         key_states = repeat_kv(key_states, self.num_key_value_groups)
         value_states = repeat_kv(value_states, self.num_key_value_groups)
@@ -43,7 +43,7 @@ import torch.utils.checkpoint
 from torch.nn import CrossEntropyLoss
 from typing import Optional, Tuple, Union, List
 from ipex_llm.utils.common import invalidInputError
-from ipex_llm.transformers.models.common import merge_qkv_base
+from ipex_llm.transformers.models.common import merge_qkv_base, moe_group_forward
 from ipex_llm.transformers.models.utils import use_quantize_kv_cache
 from ipex_llm.transformers.kv import DynamicFp8Cache, DynamicNormalCache
 
@@ -385,7 +385,11 @@ def qwen2moe_moeblock_forward(self, hidden_states: torch.Tensor):
     # we cast back to the input dtype
     routing_weights = routing_weights.to(hidden_states.dtype)
 
-    if bs == 1:
+    if getattr(self, "expert_cache", None) is not None:
+        # experts are offloaded by `enable_expert_offload`
+        final_hidden_states = self.expert_cache.moe_forward(self, hidden_states, routing_weights,
+                                                            selected_experts)
+    elif bs == 1:
         selected_experts = selected_experts[0].cpu().tolist()
         for idx in range(self.top_k):
             exp_id = selected_experts[idx]
@@ -413,34 +417,8 @@ def qwen2moe_moeblock_forward(self, hidden_states: torch.Tensor):
                 routing_weights[top_x_list, idx_list, None]
             final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
     else:
-        final_hidden_states = torch.zeros(
-            (batch_size * sequence_length, hidden_dim),
-            dtype=hidden_states.dtype,
-            device=hidden_states.device
-        )
-
-        # One hot encode the selected experts to create an expert mask
-        # this will be used to easily index which expert is going to be sollicitated
-        expert_mask = torch.nn.functional.one_hot(selected_experts,
-                                                  num_classes=self.num_experts).permute(2, 1, 0)
-
-        # Loop over all available experts in the model and perform the computation on each expert
-        for expert_idx in range(self.num_experts):
-            expert_layer = self.experts[expert_idx]
-            idx, top_x = torch.where(expert_mask[expert_idx])
-
-            if top_x.shape[0] == 0:
-                continue
-
-            # Index the correct hidden states and compute the expert hidden state for
-            # the current expert. We need to make sure to multiply the output hidden
-            # states by `routing_weights` on the corresponding tokens (top-1 and top-2)
-            current_state = hidden_states[None, top_x].reshape(-1, hidden_dim)
-            current_hidden_states = expert_layer(current_state) * routing_weights[top_x, idx, None]
-
-            # However `index_add_` only support torch tensors for indexing so we'll use
-            # the `top_x` tensor here.
-            final_hidden_states.index_add_(0, top_x, current_hidden_states.to(hidden_states.dtype))
+        final_hidden_states = moe_group_forward(self.experts, hidden_states, routing_weights,
+                                                selected_experts)
     shared_expert_output = self.shared_expert(hidden_states)
     shared_expert_output = F.sigmoid(self.shared_expert_gate(hidden_states)) * shared_expert_output
 
@@ -0,0 +1,435 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Expert offloading for MoE models: the (low-bit) weights of all experts are written
+# to one file which is memory-mapped, and only a bounded set of experts is copied to
+# the device. The router of the next MoE layer is applied to the hidden states of the
+# current one to guess which experts it will use, and those are loaded in background
+# threads while the current layer runs.
+
+import os
+import json
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+import torch
+import torch.nn as nn
+
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger
+
+
+_ALIGNMENT = 64
+
+
+def named_moe_blocks(model: nn.Module, prefix: str = "") -> List[Tuple[str, nn.Module]]:
+    """Return the names and sparse MoE blocks of a model, e.g. mixtral and qwen2_moe."""
+    return [(name, module) for name, module in model.named_modules(prefix=prefix)
+            if isinstance(getattr(module, "experts", None), nn.ModuleList)
+            and isinstance(getattr(module, "gate", None), nn.Module)]
+
+
+def find_moe_blocks(model: nn.Module) -> List[nn.Module]:
+    """Return the sparse MoE blocks of a model, e.g. mixtral and qwen2_moe."""
+    return [module for _, module in named_moe_blocks(model)]
+
+
+def _expert_name(block_name: str, expert_idx: int) -> str:
+    return f"{block_name}.experts.{expert_idx}" if block_name else f"experts.{expert_idx}"
+
+
+class ExpertStore:
+    """
+    Expert weights in one memory-mapped file, indexed by parameter name, e.g.
+    `model.layers.0.block_sparse_moe.experts.3.w1.weight`.
+
+    The raw data of every parameter is stored, so low-bit `FP4Params` are loaded
+    back without quantizing again, e.g. `ExpertStore.save(path, named_moe_blocks(model))`
+    once and `ExpertStore(path)` afterwards.
+    """
+    DATA_FILE = "experts.bin"
+    INDEX_FILE = "experts.json"
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, self.INDEX_FILE), "r") as f:
+            index = json.load(f)
+        self.path = path
+        # number of experts of every MoE block
+        self.blocks = index.get("blocks", {})
+        self.tensors = index["tensors"]
+        # number of parameters of every expert
+        self.num_params = {_expert_name(name, expert_idx): 0
+                           for name, num_experts in self.blocks.items()
+                           for expert_idx in range(num_experts)}
+        for key in self.tensors:
+            expert_name = key
+            while "." in expert_name and expert_name not in self.num_params:
+                expert_name = expert_name.rsplit(".", 1)[0]
+            if expert_name in self.num_params:
+                self.num_params[expert_name] += 1
+        self.data = torch.from_file(os.path.join(path, self.DATA_FILE), shared=True,
+                                    size=index["num_bytes"], dtype=torch.uint8)
+
+    @classmethod
+    def exists(cls, path: str) -> bool:
+        # the index is written last, a store without it was not completely written
+        return os.path.exists(os.path.join(path, cls.INDEX_FILE))
+
+    @staticmethod
+    def save(path: str, named_blocks: List[Tuple[str, nn.Module]]):
+        writer = ExpertStoreWriter(path)
+        for name, block in named_blocks:
+            writer.add_block(name, block, release=False)
+        writer.close()
+
+    def _check(self, condition: bool, reason: str):
+        invalidInputError(condition,
+                          f"The expert store in {self.path} does not match the model: "
+                          f"{reason}. Remove it to write a new one.")
+
+    def validate_block(self, name: str, block: nn.Module):
+        """Check that the store holds the experts of `block` with the same dtypes and shapes."""
+        self._check(name in self.blocks, f"MoE block {name} is not in the store")
+        self._check(self.blocks[name] == len(block.experts),
+                    f"{name} has {len(block.experts)} experts, "
+                    f"but the store has {self.blocks[name]}")
+        for expert_idx, expert in enumerate(block.experts):
+            expert_name = _expert_name(name, expert_idx)
+            params = list(expert.named_parameters())
+            self._check(self.num_params.get(expert_name, 0) == len(params),
+                        f"{expert_name} has {len(params)} parameters, "
+                        f"but the store has {self.num_params.get(expert_name, 0)}")
+            for param_name, param in params:
+                key = f"{expert_name}.{param_name}"
+                self._check(key in self.tensors, f"{key} is not in the store")
+                _, dtype, shape = self.tensors[key]
+                self._check(dtype == _dtype_name(param.dtype),
+                            f"{key} is {_dtype_name(param.dtype)}, but {dtype} in the store")
+                # released experts hold no data, there is no shape to compare
+                self._check(param.numel() == 0 or list(param.shape) == shape,
+                            f"{key} has shape {list(param.shape)}, but {shape} in the store")
+
+    def validate(self, named_blocks: List[Tuple[str, nn.Module]]):
+        """Check that the store holds exactly the experts of `named_blocks`."""
+        names = [name for name, _ in named_blocks]
+        self._check(sorted(names) == sorted(self.blocks),
+                    f"the model has MoE blocks {names}, but the store has "
+                    f"{list(self.blocks)}")
+        for name, block in named_blocks:
+            self.validate_block(name, block)
+
+    def load(self, expert: nn.Module, expert_name: str, device):
+        for name, param in expert.named_parameters():
+            offset, dtype, shape = self.tensors[f"{expert_name}.{name}"]
+            dtype = getattr(torch, dtype)
+            num_bytes = torch.Size(shape).numel() * torch.empty(0, dtype=dtype).element_size()
+            data = self.data[offset:offset + num_bytes].view(dtype).view(shape)
+            # copy out of the mapped file, which may be dropped from memory at any time
+            param.data = data.to(device, copy=True)
+
+    @staticmethod
+    def release(expert: nn.Module):
+        for param in expert.parameters():
+            param.data = torch.empty(0, dtype=param.dtype, device=param.device)
+
+
+def _dtype_name(dtype: torch.dtype) -> str:
+    return str(dtype).split(".")[-1]
+
+
+class ExpertStoreWriter:
+    """
+    Write the experts of MoE blocks to a store at `path` one block at a time, e.g.
+    while a model is loaded and converted layer by layer, so that the experts of
+    all layers are never in memory at once. If `path` already holds a store, the
+    blocks are validated against it instead. `close` writes the index.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.store = ExpertStore(path) if ExpertStore.exists(path) else None
+        self.blocks = {}
+        if self.store is None:
+            os.makedirs(path, exist_ok=True)
+            self.file = open(os.path.join(path, ExpertStore.DATA_FILE), "wb")
+            self.tensors = {}
+            self.offset = 0
+
+    def add_block(self, name: str, block: nn.Module, release: bool = True):
+        """Write (or validate) the experts of `block`, then release them if `release`."""
+        if self.store is not None:
+            self.store.validate_block(name, block)
+        else:
+            for expert_idx, expert in enumerate(block.experts):
+                for param_name, param in expert.named_parameters():
+                    data = param.data.detach().cpu().contiguous()
+                    raw = data.reshape(-1).view(torch.uint8)
+                    # keep every tensor aligned so it can be viewed as its dtype
+                    padding = -self.offset % _ALIGNMENT
+                    self.file.write(b"\0" * padding)
+                    self.offset += padding
+                    self.file.write(memoryview(raw.numpy()))
+                    self.tensors[f"{_expert_name(name, expert_idx)}.{param_name}"] = \
+                        [self.offset, _dtype_name(data.dtype), list(data.shape)]
+                    self.offset += raw.numel()
+        self.blocks[name] = len(block.experts)
+        if release:
+            for expert in block.experts:
+                ExpertStore.release(expert)
+
+    def add(self, module: nn.Module, prefix: str = "", release: bool = True):
+        """Write (or validate) the experts of all MoE blocks in `module` named `prefix`."""
+        for name, block in named_moe_blocks(module, prefix):
+            self.add_block(name, block, release)
+
+    def close(self):
+        if self.store is not None:
+            self.store._check(sorted(self.blocks) == sorted(self.store.blocks),
+                              f"the model has MoE blocks {list(self.blocks)}, "
+                              f"but the store has {list(self.store.blocks)}")
+            return
+        self.file.close()
+        with open(os.path.join(self.path, ExpertStore.INDEX_FILE), "w") as f:
+            json.dump({"num_bytes": self.offset, "blocks": self.blocks,
+                       "tensors": self.tensors}, f)
+
+
+class ExpertCache:
+    """
+    Keep at most `capacity` experts of all MoE layers resident on `device`.
+
+    Experts are evicted by least recent use (`policy="lru"`) or least frequent use
+    (`policy="lfu"`). An expert is pinned while it runs and is never evicted then,
+    if every resident expert is pinned the cache temporarily holds one more.
+
+    `get_stats()` reports:
+        num_hits: experts which were resident when they were needed
+        num_prefetch_stalls: experts which were still being prefetched
+        num_misses: experts which were neither resident nor prefetched
+        num_prefetches, num_evictions: experts loaded in background / evicted
+        stall_time: seconds spent waiting for experts to be loaded
+        hit_rate: num_hits over the number of experts needed
+    """
+    def __init__(self, store: ExpertStore, named_blocks: List[Tuple[str, nn.Module]],
+                 capacity: int, device, policy: str = "lru", prefetch: bool = True,
+                 num_workers: int = 1):
+        invalidInputError(policy in ["lru", "lfu"],
+                          f"policy should be 'lru' or 'lfu', but got {policy}.")
+        invalidInputError(capacity > 0, "capacity should be positive.")
+        self.store = store
+        self.block_names = [name for name, _ in named_blocks]
+        self.experts = [block.experts for _, block in named_blocks]
+        self.gates = [block.gate for _, block in named_blocks]
+        self.capacity = capacity
+        self.device = device
+        self.policy = policy
+        self.prefetch_enabled = prefetch
+        # at most half of the cache is used to guess the experts of the next layer
+        self.max_prefetch = max(1, capacity // 2)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers,
+                                           thread_name_prefix="ipex_llm_expert_loader")
+        # (layer, expert) in the order of their last use
+        self.resident: OrderedDict = OrderedDict()
+        self.frequency: Dict[Tuple[int, int], int] = {}
+        self.loading = {}
+        # experts which were needed before they were loaded, they count as misses
+        self.on_demand = set()
+        self.pinned = set()
+        self.num_hits = 0
+        self.num_prefetch_stalls = 0
+        self.num_misses = 0
+        self.num_prefetches = 0
+        self.num_evictions = 0
+        self.stall_time = 0.0
+
+    def get_stats(self) -> dict:
+        num_needed = self.num_hits + self.num_prefetch_stalls + self.num_misses
+        return {
+            "num_hits": self.num_hits,
+            "num_prefetch_stalls": self.num_prefetch_stalls,
+            "num_misses": self.num_misses,
+            "num_prefetches": self.num_prefetches,
+            "num_evictions": self.num_evictions,
+            "num_resident": len(self.resident),
+            "stall_time": self.stall_time,
+            "hit_rate": self.num_hits / num_needed if num_needed > 0 else 0.0,
+        }
+
+    def _victim(self):
+        candidates = [key for key in self.resident
+                      if key not in self.pinned and
+                      (key not in self.loading or self.loading[key].done())]
+        if len(candidates) == 0:
+            return None
+        if self.policy == "lfu":
+            # `min` keeps the least recently used one among the least frequent ones
+            return min(candidates, key=lambda key: self.frequency.get(key, 0))
+        return candidates[0]
+
+    def _reserve(self) -> bool:
+        while len(self.resident) >= self.capacity:
+            key = self._victim()
+            if key is None:
+                return False
+            future = self.loading.pop(key, None)
+            if future is not None:
+                future.result()
+            self.on_demand.discard(key)
+            self.resident.pop(key)
+            self.store.release(self.experts[key[0]][key[1]])
+            self.num_evictions += 1
+        return True
+
+    def _load(self, key):
+        self.store.load(self.experts[key[0]][key[1]],
+                        _expert_name(self.block_names[key[0]], key[1]), self.device)
+
+    def prefetch(self, layer_idx: int, expert_ids: List[int], on_demand: bool = False):
+        """Load experts of a layer in background, if there is room for them."""
+        for expert_idx in expert_ids:
+            key = (layer_idx, expert_idx)
+            if key in self.resident:
+                continue
+            if not self._reserve():
+                return
+            self.resident[key] = None
+            self.loading[key] = self.executor.submit(self._load, key)
+            if on_demand:
+                self.on_demand.add(key)
+            else:
+                self.num_prefetches += 1
+
+    def prefetch_next(self, layer_idx: int, hidden_states: torch.Tensor, top_k: int):
+        """Guess the experts of the next layer by applying its router to `hidden_states`."""
+        if not self.prefetch_enabled or layer_idx + 1 >= len(self.gates):
+            return
+        with torch.no_grad():
+            router_logits = self.gates[layer_idx + 1](hidden_states)
+            selected = torch.topk(router_logits, top_k, dim=-1).indices.view(-1)
+            counts = torch.bincount(selected, minlength=router_logits.size(-1))
+            num_experts = min(self.max_prefetch, int((counts > 0).sum()))
+            expert_ids = torch.topk(counts, num_experts).indices.tolist()
+        self.prefetch(layer_idx + 1, expert_ids)
+
+    def acquire(self, layer_idx: int, expert_idx: int) -> nn.Module:
+        """Make an expert resident and pin it until `release`."""
+        key = (layer_idx, expert_idx)
+        future = self.loading.pop(key, None)
+        if key in self.on_demand:
+            self.on_demand.discard(key)
+            self.num_misses += 1
+            st = time.perf_counter()
+            future.result()
+            self.stall_time += time.perf_counter() - st
+        elif future is not None:
+            if future.done():
+                self.num_hits += 1
+                future.result()
+            else:
+                self.num_prefetch_stalls += 1
+                st = time.perf_counter()
+                future.result()
+                self.stall_time += time.perf_counter() - st
+        elif key in self.resident:
+            self.num_hits += 1
+        else:
+            self.num_misses += 1
+            st = time.perf_counter()
+            self._reserve()
+            self._load(key)
+            self.stall_time += time.perf_counter() - st
+            self.resident[key] = None
+        self.resident.move_to_end(key)
+        self.frequency[key] = self.frequency.get(key, 0) + 1
+        self.pinned.add(key)
+        return self.experts[layer_idx][expert_idx]
+
+    def release(self, layer_idx: int, expert_idx: int):
+        self.pinned.discard((layer_idx, expert_idx))
+
+    def moe_forward(self, block: nn.Module, hidden_states: torch.Tensor,
+                    routing_weights: torch.Tensor, selected_experts: torch.Tensor,
+                    expert_takes_weights: bool = False) -> torch.Tensor:
+        """
+        Run the selected experts of a MoE block and sum their weighted outputs.
+
+        :param expert_takes_weights: whether experts are called as `expert(x, weights)`
+                                     (e.g. ipex-llm mixtral) or as `expert(x) * weights`.
+        """
+        layer_idx = block.expert_layer_idx
+        expert_ids = torch.unique(selected_experts).tolist()
+        keys = [(layer_idx, expert_idx) for expert_idx in expert_ids]
+        # the experts of this layer are not evicted to make room for the others
+        self.pinned.update(key for key in keys if key in self.resident)
+        self.prefetch(layer_idx, expert_ids, on_demand=True)
+        self.pinned.update(key for key in keys if key in self.resident)
+        self.prefetch_next(layer_idx, hidden_states, selected_experts.size(-1))
+        # run the resident experts first, so that loading overlaps with them
+        expert_ids.sort(key=lambda expert_idx: (layer_idx, expert_idx) in self.loading)
+
+        final_hidden_states = torch.zeros_like(hidden_states)
+        try:
+            for expert_idx in expert_ids:
+                top_x, idx = torch.where(selected_experts == expert_idx)
+                expert = self.acquire(layer_idx, expert_idx)
+                current_state = hidden_states[top_x]
+                weights = routing_weights[top_x, idx, None]
+                if expert_takes_weights:
+                    current_hidden_states = expert(current_state, weights)
+                else:
+                    current_hidden_states = expert(current_state) * weights
+                self.release(layer_idx, expert_idx)
+                final_hidden_states.index_add_(0, top_x,
+                                               current_hidden_states.to(hidden_states.dtype))
+        finally:
+            self.pinned.difference_update(keys)
+        return final_hidden_states
+
+
+def enable_expert_offload(model: nn.Module, path: str, capacity: int,
+                          policy: str = "lru", prefetch: bool = True,
+                          num_workers: int = 1) -> ExpertCache:
+    """
+    Offload the experts of an optimized MoE model (mixtral, qwen2_moe) to `path`.
+
+    Expert weights are written to `path` unless it already holds a store, which is
+    then checked against the model. All experts are released and at most `capacity`
+    of them are loaded back when used. Call it after the model is converted to
+    low-bit and moved to its device.
+
+    To never hold all experts in memory, pass `expert_offload_path=path` with
+    `streaming_convert=True` to `from_pretrained`, which writes the store layer by
+    layer while loading, and call this function on the loaded model afterwards.
+
+    :return: the `ExpertCache` of the model, which reports hit rates and stall time.
+    """
+    named_blocks = named_moe_blocks(model)
+    invalidInputError(len(named_blocks) > 0, "No MoE block is found in the model.")
+    device = next(named_blocks[0][1].experts.parameters()).device
+    if not ExpertStore.exists(path):
+        logger.info(f"Writing the experts of {len(named_blocks)} MoE layers to {path}")
+        ExpertStore.save(path, named_blocks)
+    store = ExpertStore(path)
+    store.validate(named_blocks)
+    cache = ExpertCache(store, named_blocks, capacity, device, policy=policy,
+                        prefetch=prefetch, num_workers=num_workers)
+    for layer_idx, (_, block) in enumerate(named_blocks):
+        for expert in block.experts:
+            store.release(expert)
+        block.expert_cache = cache
+        block.expert_layer_idx = layer_idx
+    return cache
@@ -35,9 +35,10 @@ from ipex_llm.ggml.quantize import ggml_tensor_qtype
 import logging
 logger = logging.getLogger(__name__)
 import asyncio
-import uuid
 import threading
 import pickle
+from collections import deque
+from transformers.cache_utils import DynamicCache
 try:
     from pydantic import BaseModel
 except ImportError:
@@ -105,11 +106,96 @@ class Dummy_GLMBlock(nn.Module):
         return hidden_states, kv_cache
 
 
-def init_pipeline_parallel():
-    import oneccl_bindings_for_pytorch
+# device type of pipeline parallel stages, set by `init_pipeline_parallel`
+_pp_device_type = "xpu"
+
+
+def init_pipeline_parallel(device: str = "xpu", backend: Optional[str] = None,
+                           numa_binding: bool = True):
+    """
+    Initialize the process group for pipeline parallel.
+
+    :param device: ``"xpu"`` runs stage ``rank`` on ``xpu:{rank}``, ``"cpu"`` runs every
+           stage on CPU, e.g. one stage per NUMA node of a multi-socket Xeon.
+    :param backend: collectives backend, defaults to ``"ccl"`` for xpu and ``"gloo"`` for cpu.
+    :param numa_binding: on cpu, pin each rank to the cores of one NUMA node.
+    """
+    global _pp_device_type
+    invalidInputError(device in ["xpu", "cpu"],
+                      f"Pipeline parallel only supports xpu or cpu, but got {device}.")
+    _pp_device_type = device
+    if backend is None:
+        backend = "ccl" if device == "xpu" else "gloo"
+    if backend == "ccl":
+        import oneccl_bindings_for_pytorch
     os.environ["MASTER_ADDR"] = os.environ.get("MASTER_ADDR", "127.0.0.1")
     os.environ["MASTER_PORT"] = os.environ.get("MASTER_PORT", "29500")
-    dist.init_process_group('ccl')
+    dist.init_process_group(backend)
+    if device == "cpu" and numa_binding:
+        bind_numa_node(dist.get_rank(), dist.get_world_size())
+
+
+def get_pp_device(rank: Optional[int] = None) -> torch.device:
+    if _pp_device_type == "cpu":
+        return torch.device("cpu")
+    rank = dist.get_rank() if rank is None else rank
+    return torch.device(f"{_pp_device_type}:{rank}")
+
+
+def _synchronize(device: torch.device):
+    if device.type == "xpu":
+        torch.xpu.synchronize(device)
+
+
+def _empty_cache(device: torch.device):
+    if device.type == "xpu":
+        torch.xpu.empty_cache()
+
+
+def _parse_cpulist(cpulist: str) -> List[int]:
+    # e.g. "0-27,56-83"
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if len(part) == 0:
+            continue
+        if "-" in part:
+            begin, end = part.split("-")
+            cpus.extend(range(int(begin), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def bind_numa_node(rank: int, world_size: int, node_dir: str = "/sys/devices/system/node"):
+    """
+    Pin the current process to the cores of NUMA node ``rank % num_nodes``, ranks sharing
+    a node split its cores. Memory is then allocated on that node by first touch.
+
+    :return: the bound cpus, ``None`` if NUMA information is not available.
+    """
+    if not os.path.isdir(node_dir) or not hasattr(os, "sched_setaffinity"):
+        return None
+    nodes = sorted(int(name[4:]) for name in os.listdir(node_dir)
+                   if name.startswith("node") and name[4:].isdigit())
+    if len(nodes) == 0:
+        return None
+    node_idx = rank % len(nodes)
+    with open(os.path.join(node_dir, f"node{nodes[node_idx]}", "cpulist")) as f:
+        cpus = _parse_cpulist(f.read())
+    # respect the affinity set by the launcher, e.g. taskset or numactl
+    allowed = os.sched_getaffinity(0)
+    cpus = [cpu for cpu in cpus if cpu in allowed]
+    num_local_ranks = (world_size - node_idx + len(nodes) - 1) // len(nodes)
+    chunk = len(cpus) // num_local_ranks
+    local_idx = rank // len(nodes)
+    cpus = cpus[local_idx * chunk:(local_idx + 1) * chunk]
+    if len(cpus) == 0:
+        return None
+    os.sched_setaffinity(0, cpus)
+    if "OMP_NUM_THREADS" not in os.environ:
+        torch.set_num_threads(len(cpus))
+    logger.info(f"Rank {rank} is bound to NUMA node {nodes[node_idx]}, cpus {cpus}")
+    return cpus
 
 
 def low_mem_convert(model):
@@ -230,7 +316,7 @@ def pipeline_parallel(model, pipeline_parallel_stages, torch_dtype=torch.float32
     model.num_layers = num_layers
     if torch_dtype == torch.float16:
         model = model.half()
-    model = model.to(f'xpu:{local_rank}')
+    model = model.to(get_pp_device(local_rank))
     return model
 
 
@@ -368,7 +454,7 @@ def pipeline_parallel_generate(self,
                 _images_feature = 1597 + _input_ids.shape[0] * 2 + _input_ids.shape[1]
                 _inputs_shape = (_input_ids.shape[0], _images_feature, self.config.hidden_size,)
             inputs_embeds = torch.empty(_inputs_shape,
-                                        device=f'xpu:{local_rank}', dtype=self.dtype)
+                                        device=self.device, dtype=self.dtype)
             dist.recv(inputs_embeds, src=pre_rank)
             outputs = self(input_ids=None, inputs_embeds=inputs_embeds,
                            past_key_values=_past_key_values, use_cache=True, **model_kwargs)
@@ -379,7 +465,7 @@ def pipeline_parallel_generate(self,
             dist.broadcast(next_ids, src=local_rank)
         else:
             dist.send(outputs[0].to(self.dtype), dst=next_rank)
-            next_ids = torch.empty((bs, 1), device=f'xpu:{local_rank}', dtype=torch.int64)
+            next_ids = torch.empty((bs, 1), device=self.device, dtype=torch.int64)
             dist.broadcast(next_ids, src=self.pipeline_parallel_stages - 1)
 
         _input_ids = next_ids
@@ -466,9 +552,19 @@ class BatchTask(BaseModel):
     prefilled_index: int
     partial_prefilling: int
 
+    # padded length of the sequences, i.e. the width of the attention mask
+    seq_len: int = 0
+    # per-sequence sampling parameters used by the tail rank
+    do_sample: List[bool] = []
+    temperature: List[float] = []
+    top_k: List[int] = []
+    top_p: List[float] = []
+    # rows left after some sequences finished, every rank keeps only these rows of its kv cache
+    keep_indices: Optional[List[int]] = None
 
-def make_attention_mask(prompt_lengths, device):
-    max_length = max(prompt_lengths)
+
+def make_attention_mask(prompt_lengths, device, max_length=None):
+    max_length = max(prompt_lengths) if max_length is None else max_length
     batch_size = len(prompt_lengths)
 
     range_tensor = torch.arange(max_length, device=device).expand(batch_size, max_length)
@@ -479,6 +575,62 @@ def make_attention_mask(prompt_lengths, device):
     return attention_mask
 
 
+# scalar fields of BatchTask sent to the other ranks, `request_ids` are only used by rank 0
+_BATCH_HEADER_FIELDS = ["batch_size", "input_len", "seq_len", "max_tokens", "stopped",
+                        "prefilled_index", "partial_prefilling"]
+# per-sequence fields, each one is padded to `max_num_seqs` entries
+_BATCH_HEADER_LISTS = [("prompt_lengths", torch.int64), ("do_sample", torch.int64),
+                       ("top_k", torch.int64), ("temperature", torch.float64),
+                       ("top_p", torch.float64), ("keep_indices", torch.int64)]
+
+
+def batch_header_size(max_num_seqs):
+    # has_batch, batch index, scalar fields, number of keep_indices, per-sequence fields
+    return 3 + len(_BATCH_HEADER_FIELDS) + len(_BATCH_HEADER_LISTS) * max_num_seqs
+
+
+def encode_batch_header(cur_batch, max_num_seqs, device):
+    """
+    Encode `cur_batch` as a fixed size int64 tensor, so that it is sent to the other ranks
+    by a single `dist.broadcast` instead of pickling the whole `BatchTask` every step.
+    Float fields are stored as the bits of float64.
+    """
+    header = torch.zeros(batch_header_size(max_num_seqs), dtype=torch.int64)
+    if cur_batch is not None:
+        keep_indices = cur_batch.keep_indices
+        scalars = [1, int(cur_batch.batch_id.rsplit("_", 1)[-1])]
+        scalars += [int(getattr(cur_batch, name)) for name in _BATCH_HEADER_FIELDS]
+        scalars.append(-1 if keep_indices is None else len(keep_indices))
+        header[:len(scalars)] = torch.tensor(scalars, dtype=torch.int64)
+        offset = len(scalars)
+        for name, dtype in _BATCH_HEADER_LISTS:
+            values = getattr(cur_batch, name) or []
+            if len(values) > 0:
+                header[offset:offset + len(values)] = \
+                    torch.tensor(values, dtype=dtype).view(torch.int64)
+            offset += max_num_seqs
+    return header.to(device)
+
+
+def decode_batch_header(header, max_num_seqs):
+    header = header.cpu()
+    num_scalars = 3 + len(_BATCH_HEADER_FIELDS)
+    scalars = header[:num_scalars].tolist()
+    if scalars[0] == 0:
+        return None
+    fields = dict(zip(_BATCH_HEADER_FIELDS, scalars[2:-1]))
+    fields["stopped"] = bool(fields["stopped"])
+    num_keep = scalars[-1]
+    lists = header[num_scalars:].view(len(_BATCH_HEADER_LISTS), max_num_seqs)
+    for i, (name, dtype) in enumerate(_BATCH_HEADER_LISTS):
+        length = num_keep if name == "keep_indices" else fields["batch_size"]
+        fields[name] = lists[i, :max(length, 0)].view(dtype).tolist()
+    fields["do_sample"] = [bool(x) for x in fields["do_sample"]]
+    if num_keep < 0:
+        fields["keep_indices"] = None
+    return BatchTask(batch_id=f"batch_{scalars[1]}", request_ids=[], **fields)
+
+
 class PPModelWorker:
     """Implementation for pipeline parallel multi-stage serving."""
     def __init__(self, checkpoint, rank, world_size, low_bit, max_num_seqs, max_prefilled_seqs,
@@ -500,18 +652,22 @@ class PPModelWorker:
         self.on_going_batches = [None] * self.world_size
         self.input_ids_dict = {}
         self.past_key_values_dict = {}
-        self.tokens = {}
-        self.token_times = {}
+        # state of the requests admitted by rank 0
+        self.sequences = {}
+        # tokens of the running rows of a batch, held back while new rows are prefilled
+        self.pending_ids = {}
+        # admitted requests whose prompts are too long to join a running batch
+        self.pending_requests = deque()
         self.waiting_requests = asyncio.Queue()
         self.send_buff = None
         self.dict_lock = threading.Lock()
         self.streamer = {}
-        self.token_cache = {}
-        self.print_len = {}
-        self.is_finish = {}
+        # created with the tokenizer at the first decoding step
+        self.detokenizer = None
         self.model_name = checkpoint
+        self.num_batches = 0
 
-        self.device = f"xpu:{self.rank}"
+        self.device = get_pp_device(self.rank)
         # self.layer_start = 0
         # self.layer_end = 0
 
@@ -556,7 +712,10 @@ class PPModelWorker:
         return cur_batch
 
     def cat_kv_cache(self, model_type, kv_cache_1, kv_cache_2):
-        if model_type in ["baichuan", "chatglm", "mixtral"]:
+        if isinstance(kv_cache_1, DynamicCache) and isinstance(kv_cache_2, tuple):
+            # rows joining a running batch
+            kv_cache_2 = DynamicCache.from_legacy_cache(kv_cache_2)
+        if isinstance(kv_cache_1, tuple):
             result = []
             for sub_tuple1, sub_tuple2 in zip(kv_cache_1, kv_cache_2):
                 if sub_tuple1 is None:
@@ -590,6 +749,53 @@ class PPModelWorker:
 
             return kv_cache_1
 
+    def select_kv_cache(self, model_type, kv_cache, indices):
+        if isinstance(kv_cache, tuple):
+            dim = 1 if model_type == "chatglm" and self.model.config.num_layers != 40 else 0
+            # placeholders of other stages are shared by several layers, select them once
+            selected = {}
+
+            def select(t):
+                if t is None:
+                    return None
+                if id(t) not in selected:
+                    selected[id(t)] = t.index_select(dim, indices)
+                return selected[id(t)]
+
+            return tuple(None if sub_tuple is None else tuple(select(t) for t in sub_tuple)
+                         for sub_tuple in kv_cache)
+        else:
+            num_cache = min(len(kv_cache.key_cache), self.model.num_layers)
+            for layer_idx in range(num_cache):
+                if kv_cache.key_cache[layer_idx].numel() == 0:
+                    continue
+                kv_cache.key_cache[layer_idx] = \
+                    kv_cache.key_cache[layer_idx].index_select(0, indices)
+                kv_cache.value_cache[layer_idx] = \
+                    kv_cache.value_cache[layer_idx].index_select(0, indices)
+
+            return kv_cache
+
+    def select_rows(self, cur_id, keep_indices):
+        kv_cache = self.past_key_values_dict.get(cur_id, None)
+        if kv_cache is not None:
+            indices = torch.tensor(keep_indices, dtype=torch.int64, device=self.device)
+            self.past_key_values_dict[cur_id] = self.select_kv_cache(
+                self.model.config.model_type, kv_cache, indices)
+
+    def sample(self, logits, cur_batch, start=0, end=None):
+        from ipex_llm.transformers.continuous_batching import sample_tokens
+        end = cur_batch.batch_size if end is None else end
+        device = logits.device
+        next_ids = sample_tokens(
+            logits[:, -1, :],
+            torch.tensor(cur_batch.do_sample[start:end], dtype=torch.bool, device=device),
+            torch.tensor(cur_batch.temperature[start:end], dtype=torch.float32, device=device),
+            torch.tensor(cur_batch.top_k[start:end], dtype=torch.int64, device=device),
+            torch.tensor(cur_batch.top_p[start:end], dtype=torch.float32, device=device),
+        )
+        return next_ids.unsqueeze(1)
+
     def update_kv_cache(self, kv_cache, prefill=False):
         layer_start = self.model.layer_start
         layer_end = self.model.layer_end
@@ -613,8 +819,11 @@ class PPModelWorker:
                 (value_placeholder, value_placeholder) for _ in range(layer_start)
             ) + (kv_cache)[layer_start:]
             kv_cache = past_key_values_placeholder
-        else:
-            pass
+        elif isinstance(kv_cache, tuple) and \
+                self.model.config.model_type not in ["baichuan", "chatglm", "mixtral"]:
+            # a legacy cache only holds the layers of this stage, keep it as a
+            # DynamicCache so that `join_requests` can extend it
+            kv_cache = DynamicCache.from_legacy_cache(kv_cache)
 
         return kv_cache
 
@@ -626,7 +835,8 @@ class PPModelWorker:
         # logger.info(f"{self.rank} {cur_batch} {input.shape}")
         cur_id = cur_batch.batch_id
         _past_key_values = self.past_key_values_dict.get(cur_id, None)
-        attention_mask = make_attention_mask(cur_batch.prompt_lengths, input.device)
+        attention_mask = make_attention_mask(cur_batch.prompt_lengths, input.device,
+                                             cur_batch.seq_len)
 
         if self.rank == 0:
             input_ids = input
@@ -650,7 +860,7 @@ class PPModelWorker:
                 tmp_past_key_values = _past_key_values
                 _past_key_values = None
 
-        torch.xpu.empty_cache()
+        _empty_cache(self.device)
         output = self.model(input_ids=input_ids,
                             inputs_embeds=inputs_embeds,
                             past_key_values=_past_key_values,
@@ -674,8 +884,8 @@ class PPModelWorker:
 
             if self.pp_config.is_tail:
                 _pre_output = self.partial_output_dict.get(cur_id, None)
-                tmp_output = output.logits
-                tmp_output = torch.argmax(tmp_output[:, -1:, :], dim=-1)
+                tmp_output = self.sample(output.logits, cur_batch,
+                                         cur_input_start, cur_input_end)
                 if _pre_output is None:
                     _pre_output = tmp_output
                 else:
@@ -685,7 +895,7 @@ class PPModelWorker:
             _prefill = self.past_key_values_dict.get(cur_id, None) is None
             _past_key_values = self.update_kv_cache(output.past_key_values, prefill=_prefill)
             self.past_key_values_dict[cur_id] = _past_key_values
-        torch.xpu.synchronize()
+        _synchronize(self.device)
         if not self.pp_config.is_tail:
             _output = output[0]
             if _output.dtype != self.dtype:
@@ -696,51 +906,208 @@ class PPModelWorker:
                 _output = self.partial_output_dict.pop(cur_id, None)
                 cur_batch.partial_prefilling = 0
             else:
-                _output = torch.argmax(output.logits[:, -1:, :], dim=-1)
+                _output = self.sample(output.logits, cur_batch)
         return _output, cur_batch
 
     def is_initialized(self):
         return True
 
+    def add_sequence(self, tokenizer, request_id, prompt_request):
+        from ipex_llm.transformers.continuous_batching import Sequence
+        input_ids = tokenizer(prompt_request.inputs).input_ids
+        parameters = prompt_request.parameters
+        eos_token_id = self.model.generation_config.eos_token_id
+        if eos_token_id is None:
+            eos_token_id = []
+        elif isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        if tokenizer.eos_token_id is not None:
+            eos_token_id = list(eos_token_id) + [tokenizer.eos_token_id]
+        seq = Sequence(request_id, input_ids,
+                       max_new_tokens=parameters.max_new_tokens,
+                       eos_token_id=eos_token_id,
+                       do_sample=parameters.do_sample,
+                       temperature=parameters.temperature,
+                       top_k=parameters.top_k,
+                       top_p=parameters.top_p,
+                       min_new_tokens=parameters.min_new_tokens)
+        self.sequences[request_id] = seq
+        if request_id not in self.streamer:
+            # requests queued by `api_server` come with their channel
+            from ipex_llm.serving.fastapi.token_channel import TokenChannel
+            self.streamer[request_id] = TokenChannel()
+        return seq
+
+    def make_input_ids(self, seqs, seq_len, tokenizer):
+        pad_token_id = tokenizer.pad_token_id
+        if pad_token_id is None:
+            pad_token_id = tokenizer.eos_token_id
+        input_ids = torch.full((len(seqs), seq_len), pad_token_id, dtype=torch.int64)
+        for i, seq in enumerate(seqs):
+            input_ids[i, seq_len - len(seq.input_ids):] = torch.tensor(seq.input_ids)
+        return input_ids.to(self.device)
+
+    def extend_batch(self, cur_batch, seqs):
+        cur_batch.request_ids = cur_batch.request_ids + [seq.request_id for seq in seqs]
+        cur_batch.batch_size = len(cur_batch.request_ids)
+        cur_batch.max_tokens = max([cur_batch.max_tokens] + [seq.max_new_tokens for seq in seqs])
+        cur_batch.prompt_lengths = cur_batch.prompt_lengths + [len(seq.input_ids) for seq in seqs]
+        cur_batch.do_sample = cur_batch.do_sample + [seq.do_sample for seq in seqs]
+        cur_batch.temperature = cur_batch.temperature + [seq.temperature for seq in seqs]
+        cur_batch.top_k = cur_batch.top_k + [seq.top_k for seq in seqs]
+        cur_batch.top_p = cur_batch.top_p + [seq.top_p for seq in seqs]
+
+    def has_waiting_requests(self):
+        return len(self.pending_requests) > 0 or not self.waiting_requests.empty()
+
     async def add_request(self, tokenizer):
-        request_ids, prompt_requests = [], []
-        for _ in range(self.max_num_seqs):
-            if self.waiting_requests.empty():
-                break
-
-            tmp_result = await self.waiting_requests.get()
-            request_id, prompt_request = tmp_result
-            request_ids.append(request_id)
-            prompt_requests.append(prompt_request)
-
-        plain_texts = [req.inputs for req in prompt_requests]
-        inputs = tokenizer(plain_texts, return_tensors="pt", padding=True)
-        input_ids = inputs.input_ids.to(f'xpu:{self.rank}')
-        attention_mask = inputs.attention_mask.to(f'xpu:{self.rank}')
+        seqs = []
+        while len(seqs) < self.max_num_seqs and len(self.pending_requests) > 0:
+            seqs.append(self.pending_requests.popleft())
+        while len(seqs) < self.max_num_seqs and not self.waiting_requests.empty():
+            request_id, prompt_request = await self.waiting_requests.get()
+            seqs.append(self.add_sequence(tokenizer, request_id, prompt_request))
+
+        seq_len = max(len(seq.input_ids) for seq in seqs)
+        # batch ids are numbered so that they fit in the tensor encoded batch header
+        self.num_batches += 1
         new_batch = BatchTask(
-            batch_id="batch_" + str(uuid.uuid4()),
-            request_ids=request_ids,
-            max_tokens=max([req.parameters.max_new_tokens for req in prompt_requests]),
-            batch_size=input_ids.size(0),
-            input_len=input_ids.size(1),
-            prompt_lengths=[sum(attention_mask[i, :]) for i in range(input_ids.size(0))],
+            batch_id="batch_" + str(self.num_batches),
+            request_ids=[],
+            max_tokens=0,
+            batch_size=0,
+            input_len=seq_len,
+            prompt_lengths=[],
             stopped=False,
             prefilled_index=0,
             partial_prefilling=0,
+            seq_len=seq_len,
         )
-
-        self.input_ids_dict[new_batch.batch_id] = input_ids
-        self.token_times[new_batch.batch_id] = [time.perf_counter()]
+        self.extend_batch(new_batch, seqs)
+        self.input_ids_dict[new_batch.batch_id] = self.make_input_ids(seqs, seq_len, tokenizer)
 
         return new_batch
 
+    async def join_requests(self, cur_batch, tokenizer):
+        """
+        Admit waiting requests into the free rows of a decoding batch. The new rows are
+        prefilled as a partial prefilling of the batch and their kv cache is concatenated
+        to the running rows by every rank.
+
+        :return: input ids of the new rows, `None` if no request joins the batch.
+        """
+        cur_id = cur_batch.batch_id
+        num_free_rows = self.max_num_seqs - cur_batch.batch_size
+        # tuple based kv caches keep placeholders of other stages and are not extended,
+        # requests waiting for a new batch go first so that batches do not run forever
+        if num_free_rows <= 0 or len(self.pending_requests) > 0 \
+                or not isinstance(self.past_key_values_dict.get(cur_id, None), DynamicCache):
+            return None
+
+        seqs = []
+        while len(seqs) < num_free_rows and not self.waiting_requests.empty():
+            request_id, prompt_request = await self.waiting_requests.get()
+            seq = self.add_sequence(tokenizer, request_id, prompt_request)
+            if len(seq.input_ids) > cur_batch.seq_len:
+                # new rows are left padded to the length of the batch
+                self.pending_requests.append(seq)
+            else:
+                seqs.append(seq)
+        if len(seqs) == 0:
+            return None
+
+        # rows of the running sequences are not used by the partial prefilling
+        input_ids = torch.cat([
+            torch.zeros((cur_batch.batch_size, cur_batch.seq_len), dtype=torch.int64,
+                        device=self.device),
+            self.make_input_ids(seqs, cur_batch.seq_len, tokenizer),
+        ], dim=0)
+        cur_batch.prefilled_index = cur_batch.batch_size
+        cur_batch.partial_prefilling = len(seqs)
+        cur_batch.input_len = cur_batch.seq_len
+        self.extend_batch(cur_batch, seqs)
+        self.input_ids_dict[cur_id] = input_ids
+        return input_ids
+
+    def update_sequences(self, cur_batch, tokenizer, next_ids, result_dict, num_appended=0):
+        """
+        Append the next token of every row to its sequence, the first `num_appended` rows
+        already got theirs, e.g. the running rows held back while new rows were prefilled.
+        """
+        outputs = []
+        for i, (request_id, token_id) in enumerate(zip(cur_batch.request_ids,
+                                                       next_ids.view(-1).tolist())):
+            if i < num_appended:
+                continue
+            seq = self.sequences[request_id]
+            seq.append_token(token_id)
+            outputs.append((seq, token_id))
+            if seq.finished:
+                self.sequences.pop(request_id, None)
+                output_ids = seq.output_ids[:-1] if seq.finish_reason == "stop" \
+                    else seq.output_ids
+                with self.dict_lock:
+                    result_dict[request_id] = tokenizer.decode(output_ids,
+                                                               skip_special_tokens=False)
+                if len(seq.output_ids) > 1:
+                    first_token = seq.first_token_time - seq.arrival_time
+                    next_token = (time.perf_counter() - seq.first_token_time) / \
+                        (len(seq.output_ids) - 1)
+                    logger.info(f"First token latency: {first_token}, "
+                                f"next token latency: {next_token}")
+        return outputs
+
+    async def decode_step(self, cur_batch, tokenizer, next_ids, result_dict, num_appended=0):
+        cur_id = cur_batch.batch_id
+        outputs = self.update_sequences(cur_batch, tokenizer, next_ids, result_dict,
+                                        num_appended)
+
+        pre_task = self.stream_tasks.get(cur_id)
+        if pre_task is not None:
+            await pre_task
+            del self.stream_tasks[cur_id]
+        cur_task = asyncio.create_task(self.stream_output(outputs, tokenizer))
+        self.stream_tasks[cur_id] = cur_task
+
+        # finished sequences are removed by `update_sequences`
+        keep = [i for i, request_id in enumerate(cur_batch.request_ids)
+                if request_id in self.sequences]
+        if len(keep) == 0:
+            # Finish a batch
+            await self.wait_stream_output(cur_id)
+            self.clear_batch(cur_id)
+            cur_batch.stopped = True
+            return next_ids
+
+        if len(keep) < cur_batch.batch_size:
+            # retire finished rows so that they no longer cost compute
+            cur_batch.keep_indices = keep
+            self.select_rows(cur_id, keep)
+            next_ids = next_ids[torch.tensor(keep, device=next_ids.device)]
+            cur_batch.request_ids = [cur_batch.request_ids[i] for i in keep]
+            cur_batch.prompt_lengths = [cur_batch.prompt_lengths[i] for i in keep]
+            cur_batch.do_sample = [cur_batch.do_sample[i] for i in keep]
+            cur_batch.temperature = [cur_batch.temperature[i] for i in keep]
+            cur_batch.top_k = [cur_batch.top_k[i] for i in keep]
+            cur_batch.top_p = [cur_batch.top_p[i] for i in keep]
+            cur_batch.batch_size = len(keep)
+            cur_batch.prefilled_index = len(keep)
+
+        input_ids = await self.join_requests(cur_batch, tokenizer)
+        if input_ids is not None:
+            # the running rows resume once the new rows are prefilled
+            self.pending_ids[cur_id] = next_ids
+            return input_ids
+
+        cur_batch.input_len = 1
+        cur_batch.seq_len += 1
+        cur_batch.prompt_lengths = [x + 1 for x in cur_batch.prompt_lengths]
+        return next_ids
+
     def clear_batch(self, cur_id):
         self.input_ids_dict.pop(cur_id, None)
-        self.tokens.pop(cur_id, None)
-        self.token_times.pop(cur_id, None)
         self.past_key_values_dict.pop(cur_id, None)
-
-        self.is_finish.pop(cur_id, None)
+        self.pending_ids.pop(cur_id, None)
         self.partial_output_dict.pop(cur_id, None)
 
     async def wait_stream_output(self, cur_id):
@@ -748,72 +1115,41 @@ class PPModelWorker:
         if cur_task is not None:
             await cur_task
 
-    def get_printable_text(self, cur_text, request_id):
-        if cur_text.endswith("\n"):
-            printable_text = cur_text[self.print_len[request_id]:]
-            self.token_cache[request_id] = []
-            self.print_len[request_id] = 0
-        elif len(cur_text) > 0 and _is_chinese_char(ord(cur_text[-1])):
-            printable_text = cur_text[self.print_len[request_id]:]
-            self.print_len[request_id] += len(printable_text)
-            self.token_cache[request_id] = []
-            self.print_len[request_id] = 0
-        else:
-            r_index = cur_text.rfind(" ") + 1
-            if r_index > self.print_len[request_id]:
-                printable_text = cur_text[self.print_len[request_id]: r_index]
-                self.token_cache[request_id] = self.token_cache[request_id][-1:]
-                self.print_len[request_id] = 0
-            else:
-                printable_text = cur_text[self.print_len[request_id]: r_index]
-        return printable_text
-
-    async def stream_output(self, cur_batch, tokenizer, next_ids):
-        cur_id = cur_batch.batch_id
-        cur_cached_ids = []
-        _stream_tasks = []
-        for index, request_id in enumerate(cur_batch.request_ids):
-            if not self.is_finish.get(request_id, False):
-                if self.token_cache.get(request_id, None) is None:
-                    self.token_cache[request_id] = []
-                    self.print_len[request_id] = 0
-                self.token_cache[request_id].extend(next_ids[index].tolist())
-                cur_cached_ids.append(self.token_cache[request_id])
-
-        for index, request_id in enumerate(cur_batch.request_ids):
-            if not self.is_finish.get(request_id, False):
-                remain = cur_batch.max_tokens - len(self.tokens[cur_id])
-
-                if self.streamer.get(request_id, None) is None:
-                    self.streamer[request_id] = asyncio.Queue()
-
-                # Currently ignore eos for benchmark
-                # if next_ids[index].int() == tokenizer.eos_token_id:
-                #     remain = 0
-                #     self.is_finish[request_id] = True
-
-                cur_text = tokenizer.decode(self.token_cache[request_id])
-                printable_text = self.get_printable_text(cur_text, request_id)
-
-                if remain > 0:
-                    _stream_tasks.append(self.streamer[request_id].put((remain, printable_text)))
-                else:
-                    printable_text = printable_text + cur_text[self.print_len[request_id]:]
-                    self.token_cache.pop(request_id, None)
-                    self.print_len.pop(request_id, None)
-                    _stream_tasks.append(self.streamer[request_id].put((remain, printable_text)))
-        await asyncio.gather(*_stream_tasks)
+    async def stream_output(self, outputs, tokenizer):
+        if self.detokenizer is None:
+            from ipex_llm.transformers.streamer import IncrementalDetokenizer
+            self.detokenizer = IncrementalDetokenizer(tokenizer)
+        request_ids = [seq.request_id for seq, _ in outputs]
+        # the eos token of a stopped sequence is not streamed
+        printable_texts = self.detokenizer.step(
+            request_ids,
+            [[] if seq.finish_reason == "stop" else [token_id] for seq, token_id in outputs])
+        finished = [i for i, (seq, _) in enumerate(outputs) if seq.finished]
+        remaining_texts = self.detokenizer.finish([request_ids[i] for i in finished])
+        for i, text in zip(finished, remaining_texts):
+            printable_texts[i] += text
+        for (seq, _), printable_text in zip(outputs, printable_texts):
+            remain = 0 if seq.finished else seq.max_new_tokens - len(seq.output_ids)
+            self.streamer[seq.request_id].put(remain, printable_text)
 
     async def process_step(self, tokenizer, result_dict, processor=None):
+        if self.rank == 0 and not self.has_waiting_requests() and \
+                all(batch is None for batch in self.on_going_batches):
+            # the pipeline is drained, wait for a request instead of spinning
+            request_id, prompt_request = await self.waiting_requests.get()
+            self.pending_requests.append(self.add_sequence(tokenizer, request_id, prompt_request))
+        else:
+            # let the server handle requests between two steps
+            await asyncio.sleep(0)
         cur_batch = None
-        torch.xpu.synchronize(self.device)
+        _synchronize(self.device)
         if self.rank == 0:
             if self.on_going_batches[0] is not None:
                 cur_batch = self.on_going_batches[0]
                 cur_input = None
 
             if cur_batch is None:
-                if not self.waiting_requests.empty():
+                if self.has_waiting_requests():
                     # wait more requests to be put in self.waiting_requests
                     await asyncio.sleep(0.01)
                     cur_batch = await self.add_request(tokenizer)
@@ -824,101 +1160,85 @@ class PPModelWorker:
 
             if (cur_batch is not None) and (not cur_batch.stopped) and (cur_input is None):
                 cur_id = cur_batch.batch_id
+                cur_batch.keep_indices = None
                 if cur_batch.prefilled_index >= cur_batch.batch_size:
                     cur_batch.partial_prefilling = 0
                 if cur_batch.partial_prefilling > 0:
-                    next_ids = torch.empty((cur_batch.partial_prefilling, 1,),
-                                           device=f'xpu:{self.rank}', dtype=torch.int64)
+                    num_rows = cur_batch.partial_prefilling
                 else:
-                    next_ids = torch.empty((cur_batch.batch_size, 1,),
-                                           device=f'xpu:{self.rank}', dtype=torch.int64)
+                    # after requests joined the batch, only the new rows come from the tail
+                    pending_ids = self.pending_ids.pop(cur_id, None)
+                    num_rows = cur_batch.batch_size
+                    if pending_ids is not None:
+                        num_rows -= pending_ids.size(0)
+                next_ids = torch.empty((num_rows, 1,),
+                                       device=self.device, dtype=torch.int64)
 
                 # logger.info(f"recv {self.rank} {next_ids.shape}")
                 dist.recv(next_ids, src=self.pre_rank)
-                torch.xpu.synchronize(self.device)
+                _synchronize(self.device)
 
                 if cur_batch.partial_prefilling > 0:
                     cur_input = self.input_ids_dict[cur_batch.batch_id]
                 else:
-                    if self.tokens.get(cur_id, None) is None:
-                        self.tokens[cur_id] = []
                     if len(next_ids.shape) == 1:
                         next_ids = next_ids.unsqueeze(0)
-                    self.tokens[cur_id].append(next_ids)
-                    self.token_times[cur_id].append(time.perf_counter())
-                    cur_input = next_ids
-                    cur_batch.input_len = 1
-                    cur_batch.prompt_lengths = [x + 1 for x in cur_batch.prompt_lengths]
-
-                    pre_task = self.stream_tasks.get(cur_id)
-                    if pre_task is not None:
-                        await pre_task
-                        del self.stream_tasks[cur_id]
-                    cur_task = asyncio.create_task(
-                        self.stream_output(cur_batch, tokenizer, next_ids)
-                    )
-                    self.stream_tasks[cur_id] = cur_task
-
-                    if len(self.tokens[cur_id]) >= cur_batch.max_tokens:
-                        # Finish a batch
-                        outputs = torch.cat(self.tokens[cur_id], dim=1)
-                        outputs = outputs.cpu()
-                        output_strs = tokenizer.batch_decode(outputs, skip_special_tokens=False)
-                        for request_id, output_str in zip(cur_batch.request_ids, output_strs):
-                            with self.dict_lock:
-                                result_dict[request_id] = output_str
-
-                        cur_times = self.token_times[cur_id]
-                        first_token = cur_times[1] - cur_times[0]
-                        next_token = (cur_times[-1] - cur_times[1]) / (len(self.tokens[cur_id]) - 1)
-                        logger.info(f"First token latency: {first_token}, "
-                                    f"next token latency: {next_token}")
-                        await self.wait_stream_output(cur_id)
-                        self.clear_batch(cur_id)
-                        cur_batch.stopped = True
+                    num_appended = 0
+                    if pending_ids is not None:
+                        # the tokens of the running rows are already appended and streamed
+                        num_appended = pending_ids.size(0)
+                        next_ids = torch.cat([pending_ids, next_ids], dim=0)
+                    cur_input = await self.decode_step(cur_batch, tokenizer, next_ids,
+                                                       result_dict, num_appended)
             else:
                 if (cur_batch is not None) and cur_batch.stopped:
                     cur_batch = None
 
             if cur_batch is not None:
                 cur_batch = self.prepare_batch(cur_batch)
-                dist.broadcast_object_list([cur_batch], src=0)
+                header = encode_batch_header(cur_batch, self.max_num_seqs, self.device)
+                dist.broadcast(header, src=0)
             else:
                 await asyncio.sleep(0)
 
         else:
-            batch_list = [None]
-            dist.broadcast_object_list(batch_list, src=0)
-            cur_batch = batch_list[0]
+            header = torch.empty(batch_header_size(self.max_num_seqs),
+                                 dtype=torch.int64, device=self.device)
+            dist.broadcast(header, src=0)
+            cur_batch = decode_batch_header(header, self.max_num_seqs)
             cur_input = None
 
             if cur_batch is not None:
                 if cur_batch.stopped:
                     self.clear_batch(cur_batch.batch_id)
                 else:
+                    if cur_batch.keep_indices is not None:
+                        self.select_rows(cur_batch.batch_id, cur_batch.keep_indices)
                     cur_batch = self.prepare_batch(cur_batch)
                     cur_len = cur_batch.input_len
                     if cur_batch.partial_prefilling:
                         cur_input = torch.empty(
                             (cur_batch.partial_prefilling, cur_len, self.hidden_size,),
-                            device=f'xpu:{self.rank}',
+                            device=self.device,
                             dtype=self.dtype,
                         )
                     else:
                         cur_input = torch.empty(
                             (cur_batch.batch_size, cur_len, self.hidden_size,),
-                            device=f'xpu:{self.rank}',
+                            device=self.device,
                             dtype=self.dtype,
                         )
                     # logger.info(f"recv {self.rank} {cur_input.shape}")
                     dist.recv(cur_input, src=self.pre_rank)
-                    torch.xpu.synchronize(self.device)
+                    _synchronize(self.device)
 
         output, cur_batch = self.model_step(cur_input, cur_batch)
 
-        torch.xpu.synchronize(self.device)
+        _synchronize(self.device)
         if self.send_buff is not None:
+            # a finished gloo send must not be waited again, it would block forever
             self.send_buff.wait()
+            self.send_buff = None
         if output is not None:
             self.send_buff = dist.isend(output, dst=self.next_rank)
 
@@ -927,31 +1247,6 @@ class PPModelWorker:
             self.on_going_batches[self.world_size - 1] = cur_batch
 
 
-def _is_chinese_char(cp):
-    """Checks whether CP is the codepoint of a CJK character."""
-    # This defines a "chinese character" as anything in the CJK Unicode block:
-    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
-    #
-    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
-    # despite its name. The modern Korean Hangul alphabet is a different block,
-    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
-    # space-separated words, so they are not treated specially and handled
-    # like the all of the other languages.
-    if (
-        (cp >= 0x4E00 and cp <= 0x9FFF)
-        or (cp >= 0x3400 and cp <= 0x4DBF)  #
-        or (cp >= 0x20000 and cp <= 0x2A6DF)  #
-        or (cp >= 0x2A700 and cp <= 0x2B73F)  #
-        or (cp >= 0x2B740 and cp <= 0x2B81F)  #
-        or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
-        or (cp >= 0xF900 and cp <= 0xFAFF)
-        or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
-    ):  #
-        return True
-
-    return False
-
-
 def llama_causallm_forward_4_37_lowmem(
     self,
     input_ids: torch.LongTensor = None,
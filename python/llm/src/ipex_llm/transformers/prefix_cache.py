@@ -0,0 +1,325 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import torch
+import logging
+from collections import OrderedDict
+from typing import Callable, List, Optional, Tuple
+from transformers import GenerationConfig, LogitsProcessorList, StoppingCriteriaList
+from transformers.cache_utils import DynamicCache
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicFp8Cache
+from ipex_llm.transformers.models.utils import init_kv_cache, append_kv_cache
+
+# patch GenerationMixin.generate
+from transformers import GenerationMixin
+original_generate = GenerationMixin.generate
+logger = logging.getLogger("ipex_llm.prefix_cache")
+
+# cache classes whose `key_cache`/`value_cache` hold the whole sequence as
+# [bsz, num_heads, seq_len, head_dim] tensors, so they can be sliced and restored
+SUPPORTED_CACHE_CLASSES = (DynamicCache, DynamicNormalCache, DynamicFp8Cache)
+
+
+class _RadixNode:
+    def __init__(self, tokens: Tuple[int, ...], key_states: List[torch.Tensor],
+                 value_states: List[torch.Tensor], parent: Optional["_RadixNode"] = None):
+        # token ids on the edge from `parent` to this node and their per-layer K/V
+        self.tokens = tokens
+        self.key_states = key_states
+        self.value_states = value_states
+        self.parent = parent
+        self.children = {}
+        self.last_access = 0
+
+    @property
+    def nbytes(self) -> int:
+        return sum(k.numel() * k.element_size() + v.numel() * v.element_size()
+                   for k, v in zip(self.key_states, self.value_states))
+
+    def split(self, offset: int) -> "_RadixNode":
+        # turn `parent -> self` into `parent -> head -> self`, `head` keeps the
+        # first `offset` tokens, copies are made so that evicting one part frees its memory
+        head = _RadixNode(self.tokens[:offset],
+                          [k[:, :, :offset].clone() for k in self.key_states],
+                          [v[:, :, :offset].clone() for v in self.value_states],
+                          self.parent)
+        head.last_access = self.last_access
+        self.parent.children[self.tokens[0]] = head
+        self.tokens = self.tokens[offset:]
+        self.key_states = [k[:, :, offset:].clone() for k in self.key_states]
+        self.value_states = [v[:, :, offset:].clone() for v in self.value_states]
+        self.parent = head
+        head.children[self.tokens[0]] = self
+        return head
+
+
+def _common_prefix_length(a, b) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PrefixCache:
+    """
+    Reuse the KV cache of a prompt prefix across `generate` calls.
+
+    Prefilled prompts are stored in a radix tree keyed by token ids, each node
+    holds the per-layer K/V of the tokens on its edge, so shared prefixes such as
+    a system prompt are stored once. When a new prompt shares a prefix with any
+    stored prompt, the KV cache is seeded with the stored K/V and only the
+    remaining tokens are prefilled. Least recently used leaves are evicted once
+    the stored K/V exceed `max_bytes`.
+
+    A `PrefixCache` should only be used with a single model, e.g.
+
+        prefix_cache = PrefixCache(max_bytes=2 * 1024 ** 3)
+        output = model.generate(input_ids, max_new_tokens=32, prefix_cache=prefix_cache)
+
+    Only batch size 1 greedy/sampling generation is supported.
+    """
+    def __init__(self, max_bytes: int = 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.root = _RadixNode((), [], [])
+        self.cache_cls = None
+        self.nbytes = 0
+        self._tick = 0
+        # stored nodes in least recently used order, a node is always behind its
+        # descendants, so the first node is the least recently used leaf
+        self._lru = OrderedDict()
+        self.num_requests = 0
+        self.num_hits = 0
+        self.num_prompt_tokens = 0
+        self.num_saved_tokens = 0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.num_hits / self.num_requests if self.num_requests > 0 else 0.0
+
+    def get_stats(self) -> dict:
+        return {
+            "num_requests": self.num_requests,
+            "num_hits": self.num_hits,
+            "hit_rate": self.hit_rate,
+            "num_prompt_tokens": self.num_prompt_tokens,
+            "num_saved_prefill_tokens": self.num_saved_tokens,
+            "nbytes": self.nbytes,
+        }
+
+    def reset_stats(self):
+        self.num_requests = 0
+        self.num_hits = 0
+        self.num_prompt_tokens = 0
+        self.num_saved_tokens = 0
+
+    def clear(self):
+        self.root = _RadixNode((), [], [])
+        self.cache_cls = None
+        self.nbytes = 0
+        self._lru = OrderedDict()
+
+    def _touch(self, path: List[_RadixNode]):
+        # touch the deepest node first, so that ancestors stay behind their descendants
+        for node in reversed(path):
+            node.last_access = self._tick
+            self._lru[node] = None
+            self._lru.move_to_end(node)
+
+    def match(self, tokens: List[int]) -> Tuple[int, List[List[Tuple[torch.Tensor, torch.Tensor]]]]:
+        """
+        Find the longest stored prefix of `tokens`.
+
+        :return: matched length and the K/V segments along the matched path,
+                 `segments[i]` is a list of per-layer `(key, value)`.
+        """
+        self._tick += 1
+        node = self.root
+        pos = 0
+        path = []
+        segments = []
+        while pos < len(tokens):
+            child = node.children.get(tokens[pos], None)
+            if child is None:
+                break
+            length = _common_prefix_length(child.tokens, tokens[pos:])
+            path.append(child)
+            segments.append([(k[:, :, :length], v[:, :, :length])
+                             for k, v in zip(child.key_states, child.value_states)])
+            pos += length
+            if length < len(child.tokens):
+                break
+            node = child
+        self._touch(path)
+        return pos, segments
+
+    def insert(self, tokens: List[int], past_key_values):
+        """
+        Store the K/V of `tokens`, `past_key_values` should hold exactly these tokens.
+        """
+        if not isinstance(past_key_values, SUPPORTED_CACHE_CLASSES) \
+                or len(past_key_values.key_cache) == 0 \
+                or past_key_values.key_cache[0].size(2) != len(tokens):
+            logger.debug(f"Skip storing prefix of unsupported cache {type(past_key_values)}.")
+            return
+        if self.cache_cls is not type(past_key_values):
+            # K/V of different cache classes (e.g. fp8 and fp16) cannot be mixed
+            self.clear()
+            self.cache_cls = type(past_key_values)
+
+        self._tick += 1
+        node = self.root
+        pos = 0
+        path = []
+        while pos < len(tokens):
+            child = node.children.get(tokens[pos], None)
+            if child is None:
+                break
+            length = _common_prefix_length(child.tokens, tokens[pos:])
+            if length < len(child.tokens):
+                child = child.split(length)
+            path.append(child)
+            pos += length
+            node = child
+        if pos == len(tokens):
+            self._touch(path)
+            return
+
+        leaf = _RadixNode(tuple(tokens[pos:]),
+                          [k[:, :, pos:].clone() for k in past_key_values.key_cache],
+                          [v[:, :, pos:].clone() for v in past_key_values.value_cache],
+                          node)
+        node.children[leaf.tokens[0]] = leaf
+        path.append(leaf)
+        self._touch(path)
+        self.nbytes += leaf.nbytes
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self._lru:
+            # nodes on the path just inserted are the most recently used,
+            # they are evicted last and only if they alone exceed the budget
+            leaf, _ = self._lru.popitem(last=False)
+            del leaf.parent.children[leaf.tokens[0]]
+            self.nbytes -= leaf.nbytes
+
+    def lookup(self, tokens: List[int]):
+        """
+        Build a new KV cache seeded with the longest stored prefix of `tokens`.
+
+        :return: matched length and the seeded cache, `None` if nothing matches.
+        """
+        length, segments = self.match(tokens)
+        if length == 0:
+            return 0, None
+        past_key_values = self.cache_cls()
+        for layer_idx in range(len(segments[0])):
+            k, _ = segments[0][layer_idx]
+            k_cache, v_cache = init_kv_cache(
+                k.size(0), k.size(1), k.size(3),
+                0, length + DynamicNormalCache.KV_ALLOC_BLOCK_LENGTH,
+                k.dtype, k.device
+            )
+            for segment in segments:
+                k_cache, v_cache = append_kv_cache(k_cache, v_cache, *segment[layer_idx])
+            past_key_values.key_cache.append(k_cache)
+            past_key_values.value_cache.append(v_cache)
+        if hasattr(past_key_values, "_seen_tokens"):
+            # 4.39 uses `_seen_tokens`
+            past_key_values._seen_tokens = length
+        else:
+            # 4.37 uses `seen_tokens`
+            past_key_values.seen_tokens = length
+        return length, past_key_values
+
+    @torch.no_grad()
+    def prefill(self, model, input_ids: torch.Tensor,
+                attention_mask: Optional[torch.Tensor] = None):
+        """
+        Prefill all prompt tokens except the last one, reusing the stored prefix.
+        The last token is left to `generate` so that it produces the first logits.
+
+        :return: KV cache of `input_ids[:, :-1]`, `None` if the prompt has only one token.
+        """
+        tokens = input_ids[0].tolist()
+        self.num_requests += 1
+        self.num_prompt_tokens += len(tokens)
+        prefix = tokens[:-1]
+        if len(prefix) == 0:
+            return None
+
+        length, past_key_values = self.lookup(prefix)
+        if length > 0:
+            self.num_hits += 1
+            self.num_saved_tokens += length
+        else:
+            past_key_values = DynamicCache()
+        if length < len(prefix):
+            mask = attention_mask[:, :len(prefix)] if attention_mask is not None else None
+            outputs = model(input_ids=input_ids[:, length:len(prefix)],
+                            attention_mask=mask,
+                            past_key_values=past_key_values,
+                            use_cache=True)
+            past_key_values = outputs.past_key_values
+            self.insert(prefix, past_key_values)
+        return past_key_values
+
+
+@torch.no_grad()
+def generate(
+    self,
+    inputs: Optional[torch.Tensor] = None,
+    generation_config: Optional[GenerationConfig] = None,
+    logits_processor: Optional[LogitsProcessorList] = None,
+    stopping_criteria: Optional[StoppingCriteriaList] = None,
+    prefix_allowed_tokens_fn: Optional[Callable[[int, torch.Tensor], List[int]]]=None,
+    synced_gpus: Optional[bool] = None,
+    assistant_model: Optional["PreTrainedModel"] = None,
+    streamer: Optional["BaseStreamer"] = None,
+    **kwargs,
+):
+    prefix_cache = kwargs.pop("prefix_cache", None)
+    if prefix_cache is not None:
+        input_ids = inputs if inputs is not None else kwargs.get("input_ids", None)
+        if input_ids is None or input_ids.dim() != 2 or input_ids.size(0) != 1 \
+                or input_ids.is_floating_point():
+            logger.warning("Prefix cache only supports batch size 1 `input_ids`, "
+                           "fallback to original generate.")
+        elif kwargs.get("past_key_values", None) is not None:
+            logger.warning("Prefix cache is ignored since `past_key_values` is provided.")
+        elif kwargs.get("num_beams", None) not in [None, 1]:
+            logger.warning("Prefix cache is currently not supported with num_beams != 1, "
+                           "fallback to original generate.")
+        elif hasattr(self, "draft_model") or kwargs.get("lookahead", None):
+            logger.warning("Prefix cache is currently not supported with speculative "
+                           "or lookup decoding, fallback to original generate.")
+        else:
+            past_key_values = prefix_cache.prefill(self, input_ids,
+                                                   kwargs.get("attention_mask", None))
+            if past_key_values is not None:
+                kwargs["past_key_values"] = past_key_values
+    return original_generate(self,
+                             inputs=inputs,
+                             generation_config=generation_config,
+                             logits_processor=logits_processor,
+                             stopping_criteria=stopping_criteria,
+                             prefix_allowed_tokens_fn=prefix_allowed_tokens_fn,
+                             synced_gpus=synced_gpus,
+                             assistant_model=assistant_model,
+                             streamer=streamer,
+                             **kwargs)
+
+GenerationMixin.generate = generate
@@ -48,12 +48,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
+import json
+import math
 import torch
 import logging
+from collections import OrderedDict
 from torch.nn import Linear, Embedding, Module
 from ipex_llm.transformers.low_bit_linear import LowBitLinear, BF16Linear, get_qk_size
 from peft.tuners.lora import LoraLayer
-from typing import Any, Optional, Union
+from typing import Any, List, Optional, Union
 from ipex_llm.utils.common import invalidInputError
 from ipex_llm.transformers.utils import get_autocast_dtype
 from ipex_llm.ggml.quantize import ggml_tensor_qtype
@@ -389,3 +393,204 @@ def cast_lora_weight(model, dtype=torch.bfloat16):
             if hasattr(module, 'weight'):
                 if module.weight.dtype == torch.float32:
                     module = module.to(dtype)
+
+
+class MultiLoraLinear(Module):
+    # A (low-bit) linear with the stacked LoRA weights of several adapters, every
+    # row of a batch selects its adapter by the index set in `MultiLoraRegistry`.
+    def __init__(self, base_layer, registry, num_slots: int, max_rank: int,
+                 qa_lora: bool = False):
+        super().__init__()
+        self.base_layer = base_layer
+        self.registry = registry
+        in_features = base_layer.in_features
+        if qa_lora:
+            qk_size = get_qk_size(base_layer.qtype)
+            in_features = in_features // qk_size
+            self.qa_pool = torch.nn.AvgPool1d(qk_size)
+        else:
+            self.qa_pool = torch.nn.Identity()
+        # the scaling of an adapter is folded into its B, unused ranks are zero and
+        # the last slot stays all zero for rows without adapter
+        dtype, device = registry.dtype, registry.device
+        self.register_buffer("lora_A", torch.zeros(num_slots + 1, max_rank, in_features,
+                                                   dtype=dtype, device=device),
+                             persistent=False)
+        self.register_buffer("lora_B", torch.zeros(num_slots + 1, base_layer.out_features,
+                                                   max_rank, dtype=dtype, device=device),
+                             persistent=False)
+
+    def load_slot(self, slot: int, lora_A: Optional[torch.Tensor],
+                  lora_B: Optional[torch.Tensor], scaling: float):
+        self.lora_A[slot].zero_()
+        self.lora_B[slot].zero_()
+        if lora_A is not None:
+            rank = lora_A.size(0)
+            invalidInputError(rank <= self.lora_A.size(1),
+                              f"LoRA rank {rank} is larger than max_rank {self.lora_A.size(1)}.")
+            self.lora_A[slot, :rank] = lora_A
+            self.lora_B[slot, :, :rank] = lora_B * scaling
+
+    def forward(self, x: torch.Tensor):
+        result = self.base_layer(x)
+        indices = self.registry.indices
+        if indices is None:
+            return result
+        if indices.size(0) != x.size(0):
+            # e.g. beam search expands every row to `num_beams` rows
+            invalidInputError(x.size(0) % indices.size(0) == 0,
+                              f"Batch size {x.size(0)} does not match the {indices.size(0)} "
+                              "adapters given to `set_adapters`.")
+            indices = indices.repeat_interleave(x.size(0) // indices.size(0))
+        lora_x = self.qa_pool(x.to(self.lora_A.dtype))
+        lora_x = lora_x.reshape(x.size(0), -1, lora_x.size(-1))
+        # gather the adapter of every row and apply all of them with batched matmuls
+        lora_A = self.lora_A[indices]
+        lora_B = self.lora_B[indices]
+        delta = torch.bmm(torch.bmm(lora_x, lora_A.transpose(1, 2)), lora_B.transpose(1, 2))
+        return result + delta.view(*result.shape).to(result.dtype)
+
+
+class MultiLoraRegistry:
+    """
+    Serve many LoRA adapters fine-tuned with `ipex_llm.transformers.qlora` on one base model.
+
+    Adapters are registered by name and path (a directory written by `save_pretrained`
+    of a peft model), at most `capacity` of them are kept loaded and the least recently
+    used one is replaced when another is needed. Every row of a batch uses the adapter
+    given to `set_adapters`, e.g.
+
+        registry = enable_multi_lora(model, ["q_proj", "v_proj"], max_rank=16, capacity=8)
+        registry.register("tenant_a", "./adapters/tenant_a")
+        registry.set_adapters(["tenant_a", "tenant_b", None])
+        output = model.generate(input_ids, max_new_tokens=32)
+    """
+    def __init__(self, capacity: int, qa_lora: bool = False, dtype=torch.float32,
+                 device="cpu"):
+        invalidInputError(capacity > 0, "capacity should be positive.")
+        self.capacity = capacity
+        self.qa_lora = qa_lora
+        self.dtype = dtype
+        self.device = device
+        self.layers = {}
+        self.paths = {}
+        # name -> slot in the order of their last use
+        self.slots = OrderedDict()
+        self.free_slots = list(range(capacity))
+        self.indices = None
+        self.num_hits = 0
+        self.num_loads = 0
+        self.num_evictions = 0
+
+    def register(self, name: str, path: str):
+        if self.paths.get(name, None) != path:
+            # the adapter is read again from the new path when it is used
+            self.unload(name)
+        self.paths[name] = path
+
+    def get_stats(self) -> dict:
+        return {
+            "num_hits": self.num_hits,
+            "num_loads": self.num_loads,
+            "num_evictions": self.num_evictions,
+            "num_loaded": len(self.slots),
+        }
+
+    def _read_adapter(self, path: str):
+        with open(os.path.join(path, "adapter_config.json"), "r") as f:
+            config = json.load(f)
+        qa_lora = config.get("training_mode", "qlora") == "qalora"
+        invalidInputError(self.qa_lora == qa_lora,
+                          "All adapters should be trained with the same training_mode.")
+        weights_file = os.path.join(path, "adapter_model.safetensors")
+        if os.path.exists(weights_file):
+            from safetensors.torch import load_file
+            state_dict = load_file(weights_file)
+        else:
+            state_dict = torch.load(os.path.join(path, "adapter_model.bin"), map_location="cpu")
+        rank, lora_alpha = config["r"], config["lora_alpha"]
+        if config.get("use_rslora", False):
+            scaling = lora_alpha / math.sqrt(rank)
+        else:
+            scaling = lora_alpha / rank
+        weights = {}
+        for key, value in state_dict.items():
+            # e.g. base_model.model.model.layers.0.self_attn.q_proj.lora_A.weight
+            for kind in ["lora_A", "lora_B"]:
+                suffix = f".{kind}.weight"
+                if key.endswith(suffix):
+                    layer_name = key[:-len(suffix)]
+                    if layer_name.startswith("base_model.model."):
+                        layer_name = layer_name[len("base_model.model."):]
+                    invalidInputError(layer_name in self.layers,
+                                      f"{layer_name} is not a target module of multi-LoRA.")
+                    max_rank = self.layers[layer_name].lora_A.size(1)
+                    invalidInputError(value.size(1 if kind == "lora_B" else 0) <= max_rank,
+                                      f"LoRA rank {rank} is larger than max_rank {max_rank}.")
+                    weights.setdefault(layer_name, {})[kind] = value
+        return weights, scaling
+
+    def load(self, name: str, pinned=()) -> int:
+        """Return the slot of an adapter, loading it from disk if it is not loaded."""
+        if name in self.slots:
+            self.num_hits += 1
+            self.slots.move_to_end(name)
+            return self.slots[name]
+        invalidInputError(name in self.paths, f"Adapter {name} is not registered.")
+        if not self.free_slots:
+            victim = next((key for key in self.slots if key not in pinned), None)
+            invalidInputError(victim is not None,
+                              f"A batch can use at most {self.capacity} adapters.")
+        # read (and check) the adapter before evicting anything, so that a bad adapter
+        # leaves the loaded ones untouched
+        weights, scaling = self._read_adapter(self.paths[name])
+        if self.free_slots:
+            slot = self.free_slots.pop(0)
+        else:
+            slot = self.slots.pop(victim)
+            self.num_evictions += 1
+        for layer_name, layer in self.layers.items():
+            layer_weights = weights.get(layer_name, {})
+            layer.load_slot(slot, layer_weights.get("lora_A", None),
+                            layer_weights.get("lora_B", None), scaling)
+        self.slots[name] = slot
+        self.num_loads += 1
+        return slot
+
+    def unload(self, name: str):
+        """Release the slot of a loaded adapter, e.g. after it is unregistered."""
+        if name in self.slots:
+            self.free_slots.append(self.slots.pop(name))
+            self.free_slots.sort()
+
+    def set_adapters(self, names: Optional[List[Optional[str]]]):
+        """Select the adapter of every row of the next batches, `None` means no adapter."""
+        if names is None:
+            self.indices = None
+            return
+        pinned = set(name for name in names if name is not None)
+        indices = [self.capacity if name is None else self.load(name, pinned)
+                   for name in names]
+        self.indices = torch.tensor(indices, dtype=torch.long, device=self.device)
+
+
+def enable_multi_lora(model, target_modules: List[str], max_rank: int, capacity: int,
+                      qa_lora: bool = False, dtype=torch.float32) -> MultiLoraRegistry:
+    """
+    Replace the target linears of a (low-bit) base model with `MultiLoraLinear`.
+
+    The base model should be loaded with `optimize_model=False`, so that its linears
+    keep the names used by the adapters.
+    """
+    device = next(model.parameters()).device
+    registry = MultiLoraRegistry(capacity, qa_lora=qa_lora, dtype=dtype, device=device)
+    for name, module in list(model.named_modules()):
+        if name.split(".")[-1] in target_modules and \
+                isinstance(module, (LowBitLinear, BF16Linear, Linear)):
+            layer = MultiLoraLinear(module, registry, capacity, max_rank, qa_lora=qa_lora)
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, layer)
+            registry.layers[name] = layer
+    invalidInputError(len(registry.layers) > 0,
+                      f"No module of {target_modules} is found in the model.")
+    return registry
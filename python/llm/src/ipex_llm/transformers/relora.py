@@ -38,6 +38,8 @@ import json
 import logging
 import os.path
 import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Dict, List, Sequence
 import peft
@@ -68,7 +70,7 @@ class ReLoRATrainer(Trainer):
 
     def __init__(self, *args, base_model="meta-llama/Llama-2-7b-hf",
                  relora_steps=150, relora_warmup_steps=10,
-                 relora_cpu_offload=False,
+                 relora_cpu_offload=False, relora_num_workers=4,
                  resume_from_checkpoint=False, **kwargs):
         self.lr_scheduler = None
         self.relora_steps = relora_steps
@@ -79,6 +81,7 @@ class ReLoRATrainer(Trainer):
             callbacks.append(
                 ReLoRACallback(relora_steps=relora_steps,
                                relora_cpu_offload=relora_cpu_offload,
+                               relora_num_workers=relora_num_workers,
                                base_model=base_model,
                                resume_from_checkpoint=resume_from_checkpoint))
         kwargs["callbacks"] = callbacks
@@ -149,10 +152,11 @@ def reset_optimizer(optimizer: torch.optim.Optimizer):
 class ReLoRACallback(TrainerCallback):
     """Callback to merge LoRA weights into the base model and save full-weight checkpoints"""
 
-    def __init__(self, relora_steps=150, relora_cpu_offload=False,
+    def __init__(self, relora_steps=150, relora_cpu_offload=False, relora_num_workers=4,
                  base_model="meta-llama/Llama-2-7b-hf", resume_from_checkpoint=None):
         self.relora_steps = relora_steps
         self.cpu_offload = relora_cpu_offload
+        self.num_workers = relora_num_workers
         self.last_full_model = base_model
         self.resume_from_checkpoint = resume_from_checkpoint
 
@@ -163,6 +167,7 @@ class ReLoRACallback(TrainerCallback):
                           "for ReLORA base_model must be a local path")
 
         self.num_lora_restarts = 0
+        self.last_reset_time = None
         self.need_full_save = False
 
     def on_train_begin(
@@ -200,6 +205,7 @@ class ReLoRACallback(TrainerCallback):
                 "relora",
             )
 
+            st = time.perf_counter()
             with torch.no_grad():
                 merge_and_save(
                     model,
@@ -208,8 +214,12 @@ class ReLoRACallback(TrainerCallback):
                     reinit=True,
                     actually_save=is_main_process(),
                     cpu_offload=self.cpu_offload,
+                    num_workers=self.num_workers,
                 )
                 reset_optimizer(optimizer)
+            self.last_reset_time = time.perf_counter() - st
+            LOG.info(f"ReLoRA reset {self.num_lora_restarts + 1} took "
+                     f"{self.last_reset_time:.1f}s")
 
             self.last_full_model = checkpoint_folder
             self.num_lora_restarts += 1
@@ -259,6 +269,8 @@ class ReLoRACallback(TrainerCallback):
         **_kwargs,
     ):
         logs["num_lora_restarts"] = self.num_lora_restarts
+        if self.last_reset_time is not None:
+            logs["relora_reset_time"] = self.last_reset_time
         return control
 
     def on_train_end(
@@ -278,6 +290,7 @@ class ReLoRACallback(TrainerCallback):
                 reinit=False,
                 actually_save=is_main_process(),
                 cpu_offload=self.cpu_offload,
+                num_workers=self.num_workers,
             )
         # no need to save if unquantized, as finetune.py will call merge_and_unload()
         return control
@@ -333,15 +346,20 @@ def sharded_paths(path: str, module_names: List[str]) -> Dict[str, str]:
 
 def lora_delta_weight(layer: peft.tuners.lora.LoraLayer, device) -> torch.Tensor:
     if isinstance(layer, LoraLowBitLinear):
-        adapter = layer.active_adapter
-        return (
-            peft.utils.transpose(
-                layer.lora_B[adapter].weight.detach().to(device)
-                @ layer.lora_A[adapter].weight.detach().to(device),
-                getattr(layer, "fan_in_fan_out", False),
+        # `active_adapter` is a list of names since peft 0.6
+        delta = 0
+        for adapter in layer.active_adapters:
+            if adapter not in layer.lora_A.keys():
+                continue
+            delta = delta + (
+                peft.utils.transpose(
+                    layer.lora_B[adapter].weight.detach().to(device)
+                    @ layer.lora_A[adapter].weight.detach().to(device),
+                    getattr(layer, "fan_in_fan_out", False),
+                )
+                * layer.scaling[adapter]
             )
-            * layer.scaling[adapter]
-        )
+        return delta
 
     return layer.get_delta_weight().to(device)
 
@@ -373,11 +391,66 @@ def update_weights(
             target.reset_lora_parameters(adapter_name)
 
     if isinstance(target, LoraLowBitLinear):
-        # LOG.info(f"new fp4params {device}, {target.weight.data}, {target.weight.data.device}")
-        new_low_bit_params = FP4Params(new_weight.cpu(),
-                                       qtype=target.qtype).to("cpu")
+        # the low-bit weight belongs to the wrapped linear, not to the lora layer
+        base_layer = target.get_base_layer()
+        if isinstance(new_weight, FP4Params):
+            # already quantized by `merge_and_save`
+            new_low_bit_params = new_weight
+        else:
+            new_low_bit_params = FP4Params(new_weight.cpu(),
+                                           qtype=base_layer.qtype).to("cpu")
         new_low_bit_params = new_low_bit_params.to(device=device)
-        target._parameters['weight'] = new_low_bit_params
+        base_layer._parameters['weight'] = new_low_bit_params
+
+
+class ShardReader:
+    """Read the tensors of a checkpoint shard from its memory-mapped file on demand."""
+
+    def __init__(self, path: str):
+        self.tensors = None
+        if path.endswith(".safetensors"):
+            from safetensors import safe_open
+            self.handle = safe_open(path, framework="pt", device="cpu")
+        else:
+            try:
+                tensors = torch.load(path, map_location="cpu", mmap=True)
+            except (TypeError, RuntimeError):
+                # torch without mmap support, or a checkpoint of the legacy format
+                tensors = torch.load(path, map_location="cpu")
+            if "state_dict" in tensors:
+                tensors = tensors["state_dict"]
+            self.tensors = tensors
+
+    def keys(self) -> List[str]:
+        if self.tensors is None:
+            return list(self.handle.keys())
+        return list(self.tensors.keys())
+
+    def get_tensor(self, key: str) -> torch.Tensor:
+        if self.tensors is None:
+            return self.handle.get_tensor(key)
+        return self.tensors[key]
+
+
+def merge_module(reader: ShardReader, key: str, target: peft.tuners.lora.LoraLayer,
+                 cpu_offload: bool, actually_save: bool):
+    math_dev = "cpu" if cpu_offload else target.weight.data.device
+    new_weight = reader.get_tensor(key).to(math_dev, torch.float) + \
+        lora_delta_weight(target, math_dev).float()
+    out_tensor = new_weight.half().cpu() if actually_save else None
+    if isinstance(target, LoraLowBitLinear):
+        # quantize here, so that it runs in parallel with the other modules
+        new_weight = FP4Params(new_weight.cpu(),
+                               qtype=target.get_base_layer().qtype).quantize("cpu")
+    return new_weight, out_tensor
+
+
+def save_shard(reader: ShardReader, out_tensors: Dict[str, torch.Tensor], shard_fn: str):
+    for name in reader.keys():
+        if name not in out_tensors:
+            out_tensors[name] = reader.get_tensor(name).half()
+    LOG.info(f"saving tensors to {shard_fn}")
+    st.save_file(out_tensors, shard_fn, metadata={"format": "pt"})
 
 
 def merge_and_save(
@@ -387,7 +460,16 @@ def merge_and_save(
     reinit: bool = False,
     cpu_offload: bool = False,
     actually_save: bool = True,
+    num_workers: int = 4,
 ):
+    """
+    Merge the LoRA weights into the base weights read from `model_src`, requantize the
+    low-bit base layers and save the merged weights to `model_dst`.
+
+    Modules of a shard are merged and quantized by `num_workers` threads, and a merged
+    shard is written in background while the next one is merged.
+    """
+    st_time = time.perf_counter()
     modules = find_lora_modules(model)
 
     os.makedirs(model_dst, exist_ok=True)
@@ -395,61 +477,63 @@ def merge_and_save(
     out_shard_paths = {}
 
     unique_shards = list(set(shard_paths.values()))
-    for shard_path in unique_shards:
-        out_tensors = {}
-        if shard_path.endswith(".safetensors"):
-            in_tensors = st.load_file(str(Path(model_src) / shard_path))
-        else:
-            in_tensors = torch.load(Path(model_src) / shard_path)
-            if "state_dict" in in_tensors:
-                in_tensors = in_tensors["state_dict"]
-
-        LOG.info(f"load from {model_src}, {shard_path}")
-
-        for module_name, target in modules.items():
-            key = module_name + ".weight"
-            if key not in shard_paths or shard_paths[key] != shard_path:
-                continue
-
-            orig_weight = in_tensors[key].float()
-            old_dev = target.weight.data.device
-            math_dev = "cpu" if cpu_offload else old_dev
-
-            delta_weight = lora_delta_weight(target, math_dev).float()
-            new_weight = orig_weight.to(math_dev) + delta_weight
-            del delta_weight
+    pending_write = None
+    with ThreadPoolExecutor(max_workers=max(1, num_workers),
+                            thread_name_prefix="relora_merge") as executor, \
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="relora_save") as writer:
+        for shard_path in unique_shards:
+            reader = ShardReader(str(Path(model_src) / shard_path))
+            LOG.info(f"load from {model_src}, {shard_path}")
+
+            futures = {}
+            for module_name, target in modules.items():
+                key = module_name + ".weight"
+                if key not in shard_paths or shard_paths[key] != shard_path:
+                    continue
+                future = executor.submit(merge_module, reader, key, target,
+                                         cpu_offload, actually_save)
+                futures[future] = (key, target)
+
+            out_tensors = {}
+            for future in as_completed(futures):
+                key, target = futures[future]
+                new_weight, out_tensor = future.result()
+                if actually_save:
+                    out_tensors[key] = out_tensor
+                update_weights(target, new_weight, reinit=reinit,
+                               device=target.weight.data.device)
+            del futures
 
             if actually_save:
-                out_tensors[key] = new_weight.half().cpu()
-
-            update_weights(target, new_weight, reinit=reinit, device=old_dev)
-
-        if actually_save:
-            out_shard_name = shard_path
-            if out_shard_name.startswith("pytorch_model"):
-                out_shard_name = (
-                    out_shard_name.replace("pytorch_model", "model").rstrip(".bin")
-                    + ".safetensors"
-                )
-
-            for module_name in in_tensors:
-                if module_name not in out_tensors:
-                    out_tensors[module_name] = in_tensors[module_name].half()
-                out_shard_paths[module_name] = out_shard_name
-
-            shard_fn = str(Path(model_dst) / out_shard_name)
-            LOG.info(f"saving tensors to {shard_fn}")
-            st.save_file(out_tensors, shard_fn, metadata={"format": "pt"})
-
-        del in_tensors
-        del out_tensors
-        torch.xpu.empty_cache()
+                out_shard_name = shard_path
+                if out_shard_name.startswith("pytorch_model"):
+                    out_shard_name = out_shard_name.replace("pytorch_model", "model")
+                    if out_shard_name.endswith(".bin"):
+                        # not `rstrip`, which also strips e.g. the "n" of a shard name
+                        out_shard_name = out_shard_name[:-len(".bin")]
+                    out_shard_name += ".safetensors"
+                for module_name in reader.keys():
+                    out_shard_paths[module_name] = out_shard_name
+
+                # at most one shard is being written while the next one is merged
+                if pending_write is not None:
+                    pending_write.result()
+                shard_fn = str(Path(model_dst) / out_shard_name)
+                pending_write = writer.submit(save_shard, reader, out_tensors, shard_fn)
+
+            del reader
+            del out_tensors
+            torch.xpu.empty_cache()
+
+        if pending_write is not None:
+            pending_write.result()
 
     if actually_save and len(unique_shards) > 1:
         with open(
             str(Path(model_dst, "model.safetensors.index.json")), "w", encoding="utf-8"
         ) as file:
             json.dump({"metadata": {}, "weight_map": out_shard_paths}, file)
+    LOG.info(f"merged {len(modules)} LoRA modules in {time.perf_counter() - st_time:.1f}s")
 
 
 def load_weight_checkpoint(model: peft.LoraModel, checkpoint_path: str):
@@ -40,6 +40,7 @@ import torch
 import time
 import os
 import copy
+import random
 import logging
 import inspect
 import transformers
@@ -91,7 +92,7 @@ def generate(
             )
             for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                         'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                        'th_batch_num']:
+                        'th_batch_num', 'draft_policy']:
                 kwargs.pop(var, None)
             return original_generate(self,
                                      inputs=inputs,
@@ -109,7 +110,7 @@ def generate(
         for var in ['max_new_tokens', 'max_step_draft', 'th_stop_draft', 'do_sample',
                     'top_k', 'top_p', 'temperature', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'repetition_penalty',
-                    'attention_mask', 'min_step_draft', 'eos_token_id']:
+                    'attention_mask', 'min_step_draft', 'eos_token_id', 'draft_policy']:
             value = kwargs.pop(var, None)
             if value is not None:
                 new_speculative_kwargs[var] = value
@@ -122,7 +123,7 @@ def generate(
         # related to speculative decoding should be removed
         for var in ['max_step_draft', 'th_stop_draft', 'hf_adjust',
                     'auto_th_stop_draft', 'auto_parameters', 'min_step_draft',
-                    'th_batch_num']:
+                    'th_batch_num', 'draft_policy']:
             kwargs.pop(var, None)
         return original_generate(self,
                                  inputs=inputs,
@@ -188,6 +189,156 @@ def clear_benchmarks(self):
     self.n_matched = 0
 
 
+class SpeculativeStats:
+    """
+    Per-request statistics of speculative decoding, `speculative_generate` stores
+    the statistics of the last request in `model.speculative_stats`.
+    """
+    def __init__(self):
+        self.first_token_time = 0.0
+        # one entry per verify step
+        self.draft_lengths = []
+        self.accepted_lengths = []
+        self.draft_times = []
+        self.verify_times = []
+
+    def record(self, drafted_n_tokens: int, n_matched: int,
+               draft_time: float, verify_time: float):
+        self.draft_lengths.append(drafted_n_tokens)
+        self.accepted_lengths.append(n_matched)
+        self.draft_times.append(draft_time)
+        self.verify_times.append(verify_time)
+
+    @property
+    def acceptance_rate(self) -> float:
+        num_drafted = sum(self.draft_lengths)
+        return sum(self.accepted_lengths) / num_drafted if num_drafted > 0 else 0.0
+
+    def acceptance_histogram(self) -> List[int]:
+        """`histogram[i]` is the number of verify steps which accept `i` draft tokens."""
+        histogram = [0] * (max(self.draft_lengths, default=0) + 1)
+        for n_matched in self.accepted_lengths:
+            histogram[n_matched] += 1
+        return histogram
+
+    def get_stats(self) -> dict:
+        num_steps = len(self.draft_lengths)
+        draft_time = sum(self.draft_times)
+        verify_time = sum(self.verify_times)
+        # the target model generates one more token in each verify step
+        num_tokens = sum(self.accepted_lengths) + num_steps
+        return {
+            "num_verify_steps": num_steps,
+            "num_drafted": sum(self.draft_lengths),
+            "num_accepted": sum(self.accepted_lengths),
+            "acceptance_rate": self.acceptance_rate,
+            "acceptance_histogram": self.acceptance_histogram(),
+            "mean_draft_length": sum(self.draft_lengths) / num_steps if num_steps else 0.0,
+            "mean_tokens_per_step": num_tokens / num_steps if num_steps else 0.0,
+            "first_token_time": self.first_token_time,
+            "draft_time": draft_time,
+            "verify_time": verify_time,
+            "draft_time_ratio": draft_time / (draft_time + verify_time)
+            if draft_time + verify_time > 0 else 0.0,
+            "tokens_per_second": num_tokens / (draft_time + verify_time)
+            if draft_time + verify_time > 0 else 0.0,
+        }
+
+
+class DraftLengthPolicy:
+    """
+    Decide how many tokens the draft model generates in each speculative step.
+
+    The default policy always drafts `max_step_draft` tokens, subclasses override
+    `next_draft_length` and learn from the outcome of every step in `update`.
+    A policy passed to `generate(..., draft_policy=policy)` replaces the
+    `th_stop_draft` early stop and `hf_adjust`, and keeps its state across requests.
+    """
+    def __init__(self, min_step_draft: int = 1, max_step_draft: int = 8):
+        invalidInputError(1 <= min_step_draft <= max_step_draft,
+                          "Expect 1 <= min_step_draft <= max_step_draft, but got "
+                          f"{min_step_draft} and {max_step_draft}.")
+        self.min_step_draft = min_step_draft
+        self.max_step_draft = max_step_draft
+
+    def next_draft_length(self) -> int:
+        return self.max_step_draft
+
+    def update(self, drafted_n_tokens: int, n_matched: int,
+               draft_time: float, verify_time: float):
+        pass
+
+
+class AdaptiveDraftPolicy(DraftLengthPolicy):
+    """
+    Choose the draft length which maximizes the expected accepted tokens per second.
+
+    Draft tokens are modeled as accepted independently with probability `alpha`, so a
+    draft of `k` tokens yields `(1 - alpha ** (k + 1)) / (1 - alpha)` tokens including
+    the one generated by the target model, and costs `k * draft_token_time +
+    verify_time(k)`. `alpha`, the draft time per token and a linear model of the verify
+    time are exponential moving averages with weight `decay` of the past steps.
+    With probability `explore` a neighbouring length is tried, so that the verify time
+    model sees more than one length.
+    """
+    def __init__(self, min_step_draft: int = 1, max_step_draft: int = 16,
+                 init_step_draft: int = 4, decay: float = 0.9, explore: float = 0.05):
+        super().__init__(min_step_draft, max_step_draft)
+        self.init_step_draft = min(max(init_step_draft, min_step_draft), max_step_draft)
+        self.decay = decay
+        self.explore = explore
+        self.num_updates = 0
+        self.accepted = 0.0
+        self.rejected = 0.0
+        self.draft_token_time = 0.0
+        # moving averages of k, t, k * k and k * t of verify steps
+        self.verify_moments = [0.0, 0.0, 0.0, 0.0]
+
+    @property
+    def alpha(self) -> float:
+        if self.accepted + self.rejected == 0:
+            return 0.5
+        return min(max(self.accepted / (self.accepted + self.rejected), 0.01), 0.99)
+
+    def verify_time(self, k: int) -> float:
+        mean_k, mean_t, mean_kk, mean_kt = self.verify_moments
+        var_k = mean_kk - mean_k * mean_k
+        slope = max((mean_kt - mean_k * mean_t) / var_k, 0.0) if var_k > 1e-6 else 0.0
+        return max(mean_t + slope * (k - mean_k), 1e-6)
+
+    def expected_tokens(self, k: int) -> float:
+        alpha = self.alpha
+        return (1 - alpha ** (k + 1)) / (1 - alpha)
+
+    def next_draft_length(self) -> int:
+        if self.num_updates == 0:
+            return self.init_step_draft
+        best_k = max(range(self.min_step_draft, self.max_step_draft + 1),
+                     key=lambda k: self.expected_tokens(k) /
+                     (k * self.draft_token_time + self.verify_time(k)))
+        if random.random() < self.explore:
+            best_k += random.choice([-1, 1])
+        return min(max(best_k, self.min_step_draft), self.max_step_draft)
+
+    def update(self, drafted_n_tokens: int, n_matched: int,
+               draft_time: float, verify_time: float):
+        # the bias correction makes early averages independent of the zero initialization
+        weight = (1 - self.decay) / (1 - self.decay ** (self.num_updates + 1))
+        self.num_updates += 1
+
+        def average(old, new):
+            return old + weight * (new - old)
+
+        # accepted drafts are successes, the first rejected draft is the only failure
+        self.accepted = average(self.accepted, n_matched)
+        self.rejected = average(self.rejected, 1.0 if n_matched < drafted_n_tokens else 0.0)
+        self.draft_token_time = average(self.draft_token_time,
+                                        draft_time / max(drafted_n_tokens, 1))
+        k = drafted_n_tokens
+        self.verify_moments = [average(old, new) for old, new in
+                               zip(self.verify_moments, [k, verify_time, k * k, k * verify_time])]
+
+
 def _prepare_past_key_values_storage_cpu(self, past_key_values,
                                          max_new_tokens, _enable_ipex=False):
     past_key_values_storage = []
@@ -774,7 +925,7 @@ def _prepare_generate_args_4_45(self, inputs, generation_config, streamer=None,
 
 
 def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_mask=None,
-                         return_dict=True, use_cache=True):
+                         return_dict=True, use_cache=True, position_ids=None):
     forward_args = {
         "input_ids": verify_input_ids,
         "past_key_values": past_key_values,
@@ -784,7 +935,10 @@ def _non_cpu_ipex_verify(self, verify_input_ids, past_key_values, cur_attention_
     if cur_attention_mask is not None:
         forward_args["attention_mask"] = cur_attention_mask
 
-    if self.config.model_type == "chatglm":
+    if position_ids is not None:
+        # e.g. batched verify, whose rows have different numbers of padding tokens
+        forward_args["position_ids"] = position_ids
+    elif self.config.model_type == "chatglm":
         if isinstance(self.config.eos_token_id, list) and not hasattr(self.transformer, "vision") \
                 and self.config.num_layers in [28, 40]:
             # glm4 models
@@ -821,12 +975,17 @@ def speculative_generate(self,
                          generation_config: Optional[GenerationConfig] = None,
                          attention_mask=None,
                          streamer: Optional["BaseStreamer"] = None,
+                         draft_policy: Optional[DraftLengthPolicy] = None,
                          **sampling_kwargs):
     invalidInputError(draft_model is not None,
                       "Draft model should be provided.")
     # min_step_draft >= 1. Since the max_step_draft may adjust,
     # min_step_draft can > max_step_draft
     min_step_draft = min_step_draft if min_step_draft >= 1 else 1
+    if draft_policy is not None:
+        # buffers below are allocated for the longest draft
+        max_step_draft = draft_policy.max_step_draft
+        hf_adjust = False
 
     input_ids, generation_config, logits_processor, stopping_criteria, \
         model_kwargs = _prepare_generate_args(self, inputs, generation_config, streamer,
@@ -865,6 +1024,8 @@ def speculative_generate(self,
     e2e_tic = 0.0
 
     self.clear_benchmarks()
+    stats = SpeculativeStats()
+    self.speculative_stats = stats
 
     if self.device.type == 'xpu':
         torch.xpu.empty_cache()
@@ -916,6 +1077,7 @@ def speculative_generate(self,
                 torch.xpu.synchronize()
             toc = time.time()
             self.first_token_time = toc - tic
+            stats.first_token_time = self.first_token_time
             e2e_tic = time.time()
         else:
             draft_current_input_ids = current_input_ids
@@ -949,7 +1111,11 @@ def speculative_generate(self,
                 random_probs = torch.rand(max_step_draft, device=self.device, dtype=self.dtype)
             # Draft model auto-regressively generate k tokens
             # Early stop when prob less then th_stop_draft
-            for step_draft in range(max_step_draft):
+            if draft_policy is not None:
+                step_draft_limit = draft_policy.next_draft_length()
+            else:
+                step_draft_limit = max_step_draft
+            for step_draft in range(step_draft_limit):
                 if attention_mask is None:
                     draft_attention_mask = None
                 else:
@@ -1057,11 +1223,13 @@ def speculative_generate(self,
                 draft_past_key_values = draft_output['past_key_values']
                 # check if draft prob is less then th_stop_draft
                 # Draft number + step >= max output token number
-                th_random = 1 if random_probs is None else random_probs[step_draft]
-                if (draft_output_probs.item() < th_stop_draft and th_random > 0.3 and
-                        step_draft + 1 >= min_step_draft) or \
-                        step + step_draft + 2 >= max_new_tokens:
+                if step + step_draft + 2 >= max_new_tokens:
                     break
+                if draft_policy is None:
+                    th_random = 1 if random_probs is None else random_probs[step_draft]
+                    if draft_output_probs.item() < th_stop_draft and th_random > 0.3 and \
+                            step_draft + 1 >= min_step_draft:
+                        break
             if self.device.type == 'xpu':
                 torch.xpu.synchronize()
             toc = time.time()
@@ -1233,6 +1401,11 @@ def speculative_generate(self,
             self.n_matched += max_matched - 1
             self.n_drafted += drafted_n_tokens
             step_verify += 1
+            stats.record(drafted_n_tokens, max_matched - 1,
+                         self.draft_time[-1], self.verify_time[-1])
+            if draft_policy is not None:
+                draft_policy.update(drafted_n_tokens, max_matched - 1,
+                                    self.draft_time[-1], self.verify_time[-1])
 
             if auto_th_stop_draft and step_verify % auto_parameters[0] == 0:
                 tmp_matchness = auto_parameters[1]*(tmp_matchness) + \
@@ -17,12 +17,114 @@
 # https://github.com/huggingface/transformers/blob/main/src/transformers/generation/streamers.py
 #
 
-from typing import Optional, List
+from typing import Dict, Hashable, Optional, List, Tuple
 
 import torch
 from transformers import TextIteratorStreamer
 
 
+def _is_chinese_char(cp):
+    """Checks whether CP is the codepoint of a CJK character."""
+    # This defines a "chinese character" as anything in the CJK Unicode block:
+    #   https://en.wikipedia.org/wiki/CJK_Unified_Ideographs_(Unicode_block)
+    #
+    # Note that the CJK Unicode block is NOT all Japanese and Korean characters,
+    # despite its name. The modern Korean Hangul alphabet is a different block,
+    # as is Japanese Hiragana and Katakana. Those alphabets are used to write
+    # space-separated words, so they are not treated specially and handled
+    # like the all of the other languages.
+    if (
+        (cp >= 0x4E00 and cp <= 0x9FFF)
+        or (cp >= 0x3400 and cp <= 0x4DBF)  #
+        or (cp >= 0x20000 and cp <= 0x2A6DF)  #
+        or (cp >= 0x2A700 and cp <= 0x2B73F)  #
+        or (cp >= 0x2B740 and cp <= 0x2B81F)  #
+        or (cp >= 0x2B820 and cp <= 0x2CEAF)  #
+        or (cp >= 0xF900 and cp <= 0xFAFF)
+        or (cp >= 0x2F800 and cp <= 0x2FA1F)  #
+    ):  #
+        return True
+
+    return False
+
+
+class _DetokenizerState:
+    __slots__ = ["token_ids", "read_offset", "pending"]
+
+    def __init__(self):
+        # the text of token_ids[:read_offset] has been decoded, they are only kept
+        # as the prefix of the tokens after them
+        self.token_ids = []
+        self.read_offset = 0
+        # decoded text which is not printable yet
+        self.pending = ""
+
+
+class IncrementalDetokenizer:
+    """
+    Decode the generated tokens of many sequences incrementally.
+
+    Each step only decodes the tokens since the last complete character of a
+    sequence instead of all of its tokens. The tokens decoded by the previous step
+    are decoded with them as prefix, so that tokenizers which strip the leading
+    space of a text give the right spaces. Tokens which end in the middle of a
+    UTF-8 character (decoded as U+FFFD) wait for the next tokens. The steps of all
+    sequences run in one `batch_decode`.
+
+    Decoded text is printable when it ends with a new line or a CJK character,
+    otherwise up to its last space, so that words are not cut.
+
+    Sequences are identified by hashable keys, e.g. request ids or row indices.
+    """
+    def __init__(self, tokenizer, **decode_kwargs):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = decode_kwargs
+        self.states: Dict[Hashable, _DetokenizerState] = {}
+
+    def _decode(self, states: List[_DetokenizerState]) -> List[Tuple[str, str]]:
+        # returns the text of the prefix and of all tokens of each state
+        windows = []
+        for state in states:
+            windows.append(state.token_ids[:state.read_offset])
+            windows.append(state.token_ids)
+        texts = self.tokenizer.batch_decode(windows, **self.decode_kwargs) \
+            if len(windows) > 0 else []
+        return list(zip(texts[0::2], texts[1::2]))
+
+    def step(self, keys: List[Hashable], token_ids: List[List[int]]) -> List[str]:
+        """Append `token_ids[i]` to sequence `keys[i]`, return the printable text of each."""
+        states = []
+        for key, ids in zip(keys, token_ids):
+            state = self.states.get(key, None)
+            if state is None:
+                state = self.states[key] = _DetokenizerState()
+            state.token_ids.extend(ids)
+            states.append(state)
+
+        printable_texts = []
+        for state, (prefix_text, text) in zip(states, self._decode(states)):
+            if len(text) > len(prefix_text) and not text.endswith("\ufffd"):
+                text = state.pending + text[len(prefix_text):]
+                state.token_ids = state.token_ids[state.read_offset:]
+                state.read_offset = len(state.token_ids)
+            else:
+                text = state.pending
+            if text.endswith("\n") or (len(text) > 0 and _is_chinese_char(ord(text[-1]))):
+                printable_text = text
+            else:
+                printable_text = text[:text.rfind(" ") + 1]
+            state.pending = text[len(printable_text):]
+            printable_texts.append(printable_text)
+        return printable_texts
+
+    def finish(self, keys: List[Hashable]) -> List[str]:
+        """Return the remaining text of each sequence, and forget the sequences."""
+        states = [self.states.pop(key, None) or _DetokenizerState() for key in keys]
+        # incomplete characters are flushed as they are
+        return [state.pending + text[len(prefix_text):]
+                for state, (prefix_text, text) in zip(states, self._decode(states))]
+
+
 class BatchTextIteratorStreamer(TextIteratorStreamer):
     """
     A specialized version of TextIteratorStreamer that handles text streams in batches, providing
@@ -57,8 +159,7 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
     ):
         super().__init__(tokenizer, skip_prompt, timeout, **decode_kwargs)
         self.batch_size = batch_size
-        self.token_cache = [[] for _ in range(batch_size)]
-        self.print_len = [0 for _ in range(batch_size)]
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
         self.generate_exception = None
 
     def put(self, value):
@@ -71,40 +172,11 @@ class BatchTextIteratorStreamer(TextIteratorStreamer):
             self.next_tokens_are_prompt = False
             return
 
-        printable_texts = list()
-        for idx in range(self.batch_size):
-            self.token_cache[idx].extend(value[idx].tolist())
-            text = self.tokenizer.decode(self.token_cache[idx], **self.decode_kwargs)
-
-            if text.endswith("\n"):
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-                # If the last token is a CJK character, we print the characters.
-            elif len(text) > 0 and self._is_chinese_char(ord(text[-1])):
-                printable_text = text[self.print_len[idx]:]
-                self.print_len[idx] += len(printable_text)
-            else:
-                printable_text = text[self.print_len[idx]:text.rfind(" ") + 1]
-                self.print_len[idx] += len(printable_text)
-            printable_texts.append(printable_text)
-
+        printable_texts = self.detokenizer.step(list(range(self.batch_size)), value.tolist())
         self.on_finalized_text(printable_texts)
 
     def end(self):
-        printable_texts = list()
-        for idx in range(self.batch_size):
-            if len(self.token_cache[idx]) > 0:
-                text = self.tokenizer.decode(
-                    self.token_cache[idx], **self.decode_kwargs
-                )
-                printable_text = text[self.print_len[idx]:]
-                self.token_cache[idx] = []
-                self.print_len[idx] = 0
-            else:
-                printable_text = ""
-            printable_texts.append(printable_text)
-
+        printable_texts = self.detokenizer.finish(list(range(self.batch_size)))
         self.next_tokens_are_prompt = True
         self.on_finalized_text(printable_texts, stream_end=True)
 
@@ -0,0 +1,313 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Streaming low-bit conversion: the model is built on meta device, checkpoint shards
+# are read tensor by tensor, and every decoder layer is quantized as soon as all of
+# its weights are loaded. Linear weights are packed in a bounded thread pool (the
+# ggml quantization is a ctypes call, which releases the GIL), and each full
+# precision weight is released right after it is packed, so the full precision
+# model never resides in memory at once.
+
+import os
+import json
+import torch
+import torch.nn as nn
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from ipex_llm.utils.common import invalidInputError
+from .utils import logger
+
+
+# `_optimize_pre` of these model types rewrites modules outside of decoder layers
+# or optimizes sub-models, it can only run on the whole loaded model, the other
+# model types only have per-module hooks (`_pre_optimize_hooks`)
+_UNSUPPORTED_MODEL_TYPES = {
+    "rwkv", "baichuan", "minicpmv", "megrezo", "internvl_chat", "qwen2_audio",
+}
+
+_HUB_KWARGS = ["cache_dir", "force_download", "proxies", "token", "use_auth_token",
+               "revision", "local_files_only", "subfolder"]
+
+# `from_pretrained` arguments which have no effect on a model loaded on cpu here
+_IGNORED_KWARGS = ["low_cpu_mem_usage", "device_map", "use_safetensors"]
+
+
+class QuantizePool:
+    """
+    Quantize `FP4Params` in place in a pool of `num_workers` threads.
+
+    At most `max_pending` weights are submitted but not packed yet, `submit` blocks
+    until the oldest one is done, which bounds the full precision weights in memory.
+    """
+    def __init__(self, num_workers: int, max_pending: Optional[int] = None):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.max_pending = max_pending or 2 * num_workers
+        self.pending = deque()
+
+    def submit(self, param, device):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(param.to, device))
+
+    def wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def shutdown(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown(wait=True)
+
+
+def resolve_checkpoint_files(pretrained_model_name_or_path, **hub_kwargs) -> Optional[List[str]]:
+    from transformers.utils import cached_file, SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME, \
+        WEIGHTS_INDEX_NAME, WEIGHTS_NAME
+
+    for index_name, weights_name in [(SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME),
+                                     (WEIGHTS_INDEX_NAME, WEIGHTS_NAME)]:
+        index_file = cached_file(pretrained_model_name_or_path, index_name,
+                                 _raise_exceptions_for_missing_entries=False, **hub_kwargs)
+        if index_file is not None:
+            with open(index_file, "r") as f:
+                shards = sorted(set(json.load(f)["weight_map"].values()))
+            return [cached_file(pretrained_model_name_or_path, shard, **hub_kwargs)
+                    for shard in shards]
+        weights_file = cached_file(pretrained_model_name_or_path, weights_name,
+                                   _raise_exceptions_for_missing_entries=False, **hub_kwargs)
+        if weights_file is not None:
+            return [weights_file]
+    return None
+
+
+def iter_checkpoint(checkpoint_file: str):
+    """Yield `(name, tensor)` of a checkpoint file without reading the whole file."""
+    if checkpoint_file.endswith(".safetensors"):
+        from safetensors import safe_open
+        with safe_open(checkpoint_file, framework="pt") as f:
+            for name in f.keys():
+                yield name, f.get_tensor(name)
+    else:
+        try:
+            state_dict = torch.load(checkpoint_file, map_location="cpu",
+                                    mmap=True, weights_only=True)
+        except (TypeError, RuntimeError):
+            # torch < 2.1 has no `mmap`, and legacy checkpoints cannot be mapped
+            state_dict = torch.load(checkpoint_file, map_location="cpu")
+        for name in list(state_dict.keys()):
+            yield name, state_dict.pop(name)
+
+
+def _find_decoder_layers(model: nn.Module):
+    # the decoder layers are the `ModuleList` holding most of the parameters,
+    # which also skips the expert lists nested in MoE layers
+    layers_name, layers, layers_numel = None, None, 0
+    for name, module in model.named_modules():
+        if isinstance(module, nn.ModuleList) and len(module) > 1:
+            numel = sum(p.numel() for p in module.parameters())
+            if numel > layers_numel:
+                layers_name, layers, layers_numel = name, module, numel
+    return layers_name, layers
+
+
+def _apply_outside_layers(model, layers: nn.ModuleList, hooks):
+    # apply hooks to the modules outside of decoder layers, which are already applied
+    # to every decoder layer once it is loaded
+    modules = layers._modules
+    layers._modules = type(modules)()
+    try:
+        for hook in hooks:
+            model.apply(hook)
+    finally:
+        layers._modules = modules
+
+
+def load_convert_streaming(model_cls, qtype, optimize_model,
+                           pretrained_model_name_or_path,
+                           modules_to_not_convert=None,
+                           cpu_embedding=False,
+                           lightweight_bmm=False,
+                           imatrix_data=None,
+                           embedding_qtype=None,
+                           enable_xetla=False,
+                           mixed_precision=False,
+                           num_workers=None,
+                           layer_hook=None,
+                           **kwargs):
+    """
+    Load and convert a model to low-bit layer by layer.
+
+    :param num_workers: number of quantization threads, defaults to
+                        ``IPEX_LLM_QUANTIZE_THREADS`` or ``min(8, cpu_count)``.
+    :param layer_hook: called as ``layer_hook(layer, name)`` once a decoder layer is
+                       converted and all of its weights are packed, e.g. to offload
+                       MoE experts before the next layers are loaded.
+    :return: the converted model, ``None`` if the model cannot be converted in
+             streaming mode and should be loaded by the default path.
+    """
+    from accelerate import init_empty_weights
+    from accelerate.utils import set_module_tensor_to_device
+    from transformers import AutoConfig, GenerationConfig
+    from .convert import _replace_with_low_bit_linear, convert_bigdl_other_module, \
+        _optimize_post, _pre_optimize_hooks, use_scale_search, get_enable_ipex
+
+    trust_remote_code = kwargs.pop("trust_remote_code", False)
+    torch_dtype = kwargs.pop("torch_dtype", "auto")
+    attn_implementation = kwargs.pop("attn_implementation", None)
+    hub_kwargs = {k: kwargs.pop(k) for k in _HUB_KWARGS if k in kwargs}
+    for k in _IGNORED_KWARGS:
+        kwargs.pop(k, None)
+
+    config, unused_kwargs = AutoConfig.from_pretrained(pretrained_model_name_or_path,
+                                                       trust_remote_code=trust_remote_code,
+                                                       return_unused_kwargs=True,
+                                                       **hub_kwargs, **kwargs)
+    if len(unused_kwargs) > 0:
+        logger.warning(f"Arguments {list(unused_kwargs.keys())} are not supported by "
+                       "streaming conversion and are ignored.")
+
+    model_type = getattr(config, "model_type", None)
+    if get_enable_ipex() or (optimize_model and model_type in _UNSUPPORTED_MODEL_TYPES) \
+            or (model_type == "qwen" and hasattr(config, "visual")):
+        logger.info(f"Streaming conversion does not support {model_type} yet, "
+                    "fallback to the default conversion.")
+        return None
+    checkpoint_files = resolve_checkpoint_files(pretrained_model_name_or_path, **hub_kwargs)
+    if checkpoint_files is None:
+        logger.info("No safetensors or pytorch checkpoint is found, "
+                    "fallback to the default conversion.")
+        return None
+
+    if torch_dtype == "auto":
+        dtype = getattr(config, "torch_dtype", None) or torch.float32
+    else:
+        dtype = torch_dtype or torch.float32
+    from_config_kwargs = {"torch_dtype": dtype, "trust_remote_code": trust_remote_code}
+    if attn_implementation is not None:
+        from_config_kwargs["attn_implementation"] = attn_implementation
+    with init_empty_weights():
+        model = model_cls.from_config(config, **from_config_kwargs)
+    model.eval()
+    try:
+        model.generation_config = GenerationConfig.from_pretrained(pretrained_model_name_or_path,
+                                                                   **hub_kwargs)
+    except OSError:
+        logger.info("Generation config file not found, using a generation config "
+                    "created from the model config.")
+
+    layers_name, layers = _find_decoder_layers(model)
+    if layers is None:
+        logger.info("No decoder layers are found, fallback to the default conversion.")
+        return None
+
+    modules_to_not_convert = [] if modules_to_not_convert is None else modules_to_not_convert
+    model_config = model.config
+    pre_optimize_hooks = _pre_optimize_hooks(model, qtype) if optimize_model else []
+    enable_scale_search = use_scale_search(model_config, qtype)
+    if num_workers is None:
+        num_workers = int(os.environ.get("IPEX_LLM_QUANTIZE_THREADS",
+                                         min(8, os.cpu_count() or 1)))
+    pool = QuantizePool(max(1, num_workers))
+
+    def convert(module, prefix_name):
+        _replace_with_low_bit_linear(
+            module, qtype, modules_to_not_convert,
+            cpu_embedding=cpu_embedding,
+            prefix_name=prefix_name,
+            imatrix_data=imatrix_data,
+            embedding_qtype=embedding_qtype,
+            model_config=model_config,
+            torch_dtype=torch_dtype,
+            enable_xetla=enable_xetla,
+            mixed_precision=mixed_precision,
+            enable_scale_search=enable_scale_search,
+            quantize_pool=pool,
+        )
+
+    def convert_layer(key):
+        converted.add(key)
+        for hook in pre_optimize_hooks:
+            layers._modules[key].apply(hook)
+        convert(layers._modules[key], f"{layers_name}.{key}")
+        if layer_hook is not None:
+            pool.wait()
+            layer_hook(layers._modules[key], f"{layers_name}.{key}")
+
+    # parameters of each decoder layer which are not loaded yet
+    layers_prefix = layers_name + "."
+    missing = {}
+    for key, layer in layers._modules.items():
+        missing[key] = set(f"{layers_prefix}{key}.{name}"
+                           for name, _ in layer.named_parameters())
+    converted = set()
+    expected_keys = set(model.state_dict(keep_vars=True).keys())
+    prefix = model.base_model_prefix
+    unexpected_keys = []
+
+    try:
+        for checkpoint_file in checkpoint_files:
+            for name, tensor in iter_checkpoint(checkpoint_file):
+                if name not in expected_keys:
+                    if f"{prefix}.{name}" in expected_keys:
+                        name = f"{prefix}.{name}"
+                    elif name.startswith(prefix + ".") and name[len(prefix) + 1:] in expected_keys:
+                        name = name[len(prefix) + 1:]
+                    else:
+                        unexpected_keys.append(name)
+                        continue
+                key = None
+                if name.startswith(layers_prefix):
+                    key = name[len(layers_prefix):].split(".", 1)[0]
+                    if key in converted:
+                        # e.g. a buffer stored after all parameters of its layer
+                        unexpected_keys.append(name)
+                        continue
+                set_module_tensor_to_device(model, name, "cpu", value=tensor)
+                del tensor
+
+                names = missing.get(key, None)
+                if names is not None:
+                    names.discard(name)
+                    if len(names) == 0:
+                        del missing[key]
+                        convert_layer(key)
+
+        model.tie_weights()
+        missing_keys = [name for name, param in model.named_parameters()
+                        if param.device.type == "meta"]
+        invalidInputError(len(missing_keys) == 0,
+                          f"Some weights are missing in {pretrained_model_name_or_path}: "
+                          f"{missing_keys}")
+        _apply_outside_layers(model, layers, pre_optimize_hooks)
+        # embedding, lm_head and other linears outside of decoder layers
+        convert(model, "")
+        pool.wait()
+    finally:
+        pool.shutdown()
+
+    if len(unexpected_keys) > 0:
+        logger.warning(f"Some weights of {pretrained_model_name_or_path} were not used: "
+                       f"{unexpected_keys}")
+
+    if torch_dtype == "auto":
+        convert_bigdl_other_module(model, torch.float32)
+    else:
+        convert_bigdl_other_module(model, torch_dtype)
+    if optimize_model:
+        model = _optimize_post(model, lightweight_bmm)
+    return model
@@ -18,20 +18,11 @@
 # physically located elsewhere.
 # Otherwise there would be module not found error in non-pip's setting as Python would
 # only search the first bigdl package and end up finding only one sub-package.
-import transformers
 
-trans_version = transformers.__version__
 
-if trans_version >= "4.47.0":
-    # TODO
-    pass
-elif trans_version >= "4.45.0":
-    from .benchmark_util_4_45 import BenchmarkWrapper
-elif trans_version >= "4.44.0":
-    from .benchmark_util_4_44 import BenchmarkWrapper
-elif trans_version >= "4.43.0":
-    from .benchmark_util_4_43 import BenchmarkWrapper
-elif trans_version >= "4.42.0":
-    from .benchmark_util_4_42 import BenchmarkWrapper
-else:
-    from .benchmark_util_4_29 import BenchmarkWrapper
+def __getattr__(name):
+    # imported lazily, so that importing `ipex_llm.utils.common` does not import torch
+    if name == "BenchmarkWrapper":
+        from .benchmark_util import BenchmarkWrapper
+        return BenchmarkWrapper
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,361 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+# Generation profiling is done with forward hooks instead of a copy of `generate`,
+# so it works with every transformers version and every `generate` implementation
+# (transformers, speculative decoding, prompt lookup, remote code models, ...).
+# Every forward of the wrapped model is one generation step, a step lasts from
+# the start of its forward to the start of the next one, so sampling and other
+# per-step overheads of `generate` are included.
+
+import os
+import csv
+import json
+import time
+import torch
+from typing import List, Optional
+
+
+_ATTENTION_NAMES = {"self_attn", "self_attention", "attention", "attn"}
+_MLP_NAMES = {"mlp", "feed_forward", "ffn", "block_sparse_moe"}
+_LM_HEAD_NAMES = {"lm_head", "output_layer", "embed_out"}
+LAYER_CATEGORIES = ["attention", "mlp", "lm_head"]
+
+
+def _get_device(model):
+    device = getattr(model, "device", None)
+    if isinstance(device, str):
+        device = torch.device(device)
+    return device if isinstance(device, torch.device) else torch.device("cpu")
+
+
+def _synchronize(device):
+    if device.type == "xpu":
+        torch.xpu.synchronize()
+    elif device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def _get_memory_gb(device) -> float:
+    if device.type == "xpu":
+        return torch.xpu.memory.memory_reserved(device) / (1024 ** 3)
+    if device.type == "cuda":
+        return torch.cuda.memory_reserved(device) / (1024 ** 3)
+    # resident set size of the process on cpu
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss / (1024 ** 3)
+    except ImportError:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 ** 3)
+        except (OSError, ValueError, AttributeError):
+            return 0.0
+
+
+def _classify(name: str) -> Optional[str]:
+    leaf = name.rsplit(".", 1)[-1]
+    if leaf in _ATTENTION_NAMES:
+        return "attention"
+    if leaf in _MLP_NAMES:
+        return "mlp"
+    if leaf in _LM_HEAD_NAMES:
+        return "lm_head"
+    return None
+
+
+class GenerationProfiler:
+    """
+    Profile one `generate` call of `model` at a time, e.g.
+
+        profiler = GenerationProfiler(model, profile_layers=True)
+        with profiler:
+            output = model.generate(input_ids, max_new_tokens=32)
+        profiler.count_tokens(input_ids, output)
+        profiler.export_json("profile.json")
+
+    :param profile_layers: also record the time of attention, MLP and lm_head modules
+                           in every step, which synchronizes the device around each of
+                           them and slows down generation on GPU.
+    """
+    def __init__(self, model, profile_layers: bool = False):
+        self.model = model
+        # e.g. deepspeed inference engine
+        self.module = model if isinstance(model, torch.nn.Module) else getattr(model, "module",
+                                                                               None)
+        self.profile_layers = profile_layers
+        self.device = _get_device(model)
+        self.handles = []
+        self.reset()
+
+    def reset(self):
+        self.step_starts = []
+        self.forward_ends = []
+        self.step_memory = []
+        self.layer_times = []
+        self.end_time = None
+        self.encoder_time = 0.0
+        self.batch_size = 0
+        self.num_input_tokens = 0
+        self.num_new_tokens = 0
+        self._starts = {}
+
+    def _on_step_begin(self, module, args):
+        _synchronize(self.device)
+        self.step_starts.append(time.perf_counter())
+        self.layer_times.append(dict.fromkeys(LAYER_CATEGORIES, 0.0))
+
+    def _on_step_end(self, module, args, output):
+        _synchronize(self.device)
+        self.forward_ends.append(time.perf_counter())
+        self.step_memory.append(_get_memory_gb(self.device))
+
+    def _on_module_begin(self, module, args):
+        if self.profile_layers:
+            _synchronize(self.device)
+        self._starts[id(module)] = time.perf_counter()
+
+    def _module_end_hook(self, category):
+        def hook(module, args, output):
+            if self.profile_layers:
+                _synchronize(self.device)
+            elapsed = time.perf_counter() - self._starts.pop(id(module), time.perf_counter())
+            if category == "encoder":
+                self.encoder_time += elapsed
+            elif len(self.layer_times) > 0:
+                self.layer_times[-1][category] += elapsed
+        return hook
+
+    def attach(self):
+        if self.module is None:
+            return
+        self.handles.append(self.module.register_forward_pre_hook(self._on_step_begin))
+        self.handles.append(self.module.register_forward_hook(self._on_step_end))
+
+        get_encoder = getattr(self.module, "get_encoder", None)
+        config = getattr(self.module, "config", None)
+        if getattr(config, "is_encoder_decoder", False) and callable(get_encoder):
+            encoder = get_encoder()
+            self.handles.append(encoder.register_forward_pre_hook(self._on_module_begin))
+            self.handles.append(encoder.register_forward_hook(self._module_end_hook("encoder")))
+
+        if self.profile_layers:
+            matched = []
+            for name, module in self.module.named_modules():
+                # e.g. the draft model of self-speculative decoding
+                if name.startswith("draft_model") or \
+                        any(name.startswith(prefix + ".") for prefix in matched):
+                    continue
+                category = _classify(name)
+                if category is not None:
+                    matched.append(name)
+                    self.handles.append(module.register_forward_pre_hook(self._on_module_begin))
+                    self.handles.append(module.register_forward_hook(
+                        self._module_end_hook(category)))
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def __enter__(self):
+        self.reset()
+        self.device = _get_device(self.model)
+        self.attach()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _synchronize(self.device)
+        self.end_time = time.perf_counter()
+        self.detach()
+
+    def count_tokens(self, input_ids, output_ids, is_encoder_decoder: bool = False):
+        """Count the tokens generated by the profiled call from its input and output."""
+        output_ids = getattr(output_ids, "sequences", output_ids)
+        if not isinstance(output_ids, torch.Tensor):
+            self.num_new_tokens = self.num_steps
+            return
+        self.batch_size = output_ids.size(0)
+        if isinstance(input_ids, torch.Tensor) and not is_encoder_decoder:
+            self.num_input_tokens = input_ids.size(-1)
+            self.num_new_tokens = output_ids.size(-1) - input_ids.size(-1)
+        else:
+            # only new tokens are returned, e.g. generation from `inputs_embeds`
+            self.num_new_tokens = output_ids.size(-1) if input_ids is None else self.num_steps
+
+    @property
+    def num_steps(self) -> int:
+        return len(self.step_starts)
+
+    def step_latencies(self) -> List[float]:
+        boundaries = self.step_starts + [self.end_time]
+        return [end - start for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+    @property
+    def first_token_latency(self) -> float:
+        return self.step_latencies()[0] if self.num_steps > 0 else 0.0
+
+    @property
+    def rest_token_latency(self) -> float:
+        """Mean latency of the tokens after the first one, a step may yield several tokens."""
+        if self.num_steps < 2 or self.num_new_tokens < 2:
+            return 0.0
+        return (self.end_time - self.step_starts[1]) / (self.num_new_tokens - 1)
+
+    @property
+    def peak_memory(self) -> float:
+        return max(self.step_memory, default=0.0)
+
+    def get_stats(self) -> dict:
+        latencies = self.step_latencies() if self.num_steps > 0 else []
+        total_time = sum(latencies)
+        rest_time = sum(latencies[1:])
+        layer_time = {
+            "first": self.layer_times[0] if self.layer_times else {},
+            "rest": {category: sum(t[category] for t in self.layer_times[1:])
+                     for category in LAYER_CATEGORIES} if self.num_steps > 1 else {},
+        }
+        config = getattr(self.module, "config", None)
+        return {
+            "model": getattr(config, "_name_or_path", "") or type(self.model).__name__,
+            "device": str(self.device),
+            "batch_size": self.batch_size,
+            "num_input_tokens": self.num_input_tokens,
+            "num_new_tokens": self.num_new_tokens,
+            "num_steps": self.num_steps,
+            "encoder_time": self.encoder_time,
+            "first_token_latency": self.first_token_latency,
+            "rest_token_latency": self.rest_token_latency,
+            "total_time": total_time,
+            "tokens_per_second": self.batch_size * self.num_new_tokens / total_time
+            if total_time > 0 else 0.0,
+            "rest_tokens_per_second": self.batch_size * (self.num_new_tokens - 1) / rest_time
+            if rest_time > 0 else 0.0,
+            "peak_memory_gb": self.peak_memory,
+            "layer_time": layer_time if self.profile_layers else {},
+            "step_latencies": latencies,
+            "step_memory_gb": self.step_memory,
+        }
+
+    def export_json(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.get_stats(), f, indent=2)
+
+    def export_csv(self, path: str):
+        """Export one row per generation step."""
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            header = ["step", "latency (s)", "forward (s)", "memory (GB)"]
+            if self.profile_layers:
+                header += [f"{category} (s)" for category in LAYER_CATEGORIES]
+            writer.writerow(header)
+            latencies = self.step_latencies() if self.num_steps > 0 else []
+            for step, latency in enumerate(latencies):
+                row = [step, latency, self.forward_ends[step] - self.step_starts[step],
+                       self.step_memory[step]]
+                if self.profile_layers:
+                    row += [self.layer_times[step][category] for category in LAYER_CATEGORIES]
+                writer.writerow(row)
+
+
+class BenchmarkWrapper:
+    """
+    Wrap a model to measure the first token latency, the mean latency of the rest
+    tokens and the peak memory of every `generate` call.
+
+    :param do_print: print the latencies after every `generate`.
+    :param verbose: also print the memory of every step.
+    :param profile_layers: also record attention, MLP and lm_head time of every step.
+    :param profile_dir: export the profile of every `generate` call to
+                        `profile_dir/generate_<n>.json` and `.csv`.
+    """
+
+    def __init__(self, model, do_print=False, verbose=False, profile_layers=False,
+                 profile_dir=None):
+        self.model = model
+        self.do_print = do_print
+        self.verbose = verbose
+        self.profile_dir = profile_dir
+        self.profiler = GenerationProfiler(model, profile_layers=profile_layers)
+        self.num_runs = 0
+        self.encoder_time = 0.0
+        self.first_cost = 0.0
+        self.rest_cost_mean = 0.0
+        self.peak_memory = 0.0
+
+    def __getattr__(self, attr):
+        if hasattr(self.model, attr):
+            return getattr(self.model, attr)
+        return object.__getattribute__(self, attr)
+
+    def prepare_inputs_for_generation(self, *args, **kwargs):
+        return self.model.prepare_inputs_for_generation(*args, **kwargs)
+
+    def __call__(self, *args, **kwargs):
+        return self.model(*args, **kwargs)
+
+    def generate(self, *args, **kwargs):
+        if len(args) > 0:
+            input_ids = args[0]
+        else:
+            input_ids = kwargs.get("inputs", kwargs.get("input_ids", None))
+        with self.profiler:
+            output = self.model.generate(*args, **kwargs)
+        config = getattr(self.model, "config", None)
+        self.profiler.count_tokens(input_ids, output,
+                                   getattr(config, "is_encoder_decoder", False))
+        self._update(self.profiler)
+        if self.profile_dir is not None:
+            os.makedirs(self.profile_dir, exist_ok=True)
+            path = os.path.join(self.profile_dir, f"generate_{self.num_runs}")
+            self.profiler.export_json(path + ".json")
+            self.profiler.export_csv(path + ".csv")
+        self.num_runs += 1
+        return output
+
+    def _update(self, profiler: GenerationProfiler):
+        self.encoder_time = profiler.encoder_time
+        if profiler.num_steps == 0:
+            # `generate` which does not call `forward`, e.g. NPU pipeline models,
+            # report their own latencies
+            self.first_cost = getattr(self.model, "first_cost",
+                                      getattr(self.model, "first_token_time", 0.0))
+            self.rest_cost_mean = getattr(self.model, "rest_cost_mean", 0.0)
+            return
+        self.first_cost = profiler.first_token_latency
+        self.rest_cost_mean = profiler.rest_token_latency
+        self.peak_memory = profiler.peak_memory
+
+        if self.do_print:
+            on_device = self.profiler.device.type in ["xpu", "cuda"]
+            if self.encoder_time > 0:
+                print(f"=====================encoder cost {self.encoder_time} s"
+                      "=======================")
+            if on_device:
+                print(f"=========First token cost {self.first_cost:.4f} s and "
+                      f"{profiler.step_memory[0]} GB=========")
+            else:
+                print(f"=========First token cost {self.first_cost:.4f} s=========")
+            if profiler.num_new_tokens > 1:
+                if on_device:
+                    print(f"=========Rest tokens cost average {self.rest_cost_mean:.4f} s "
+                          f"({profiler.num_new_tokens - 1} tokens in all) and "
+                          f"{max(profiler.step_memory[1:], default=0.0)} GB=========")
+                    if self.verbose:
+                        print(f"Peak memory for every token: {profiler.step_memory}")
+                else:
+                    print(f"=========Rest tokens cost average {self.rest_cost_mean:.4f} s "
+                          f"({profiler.num_new_tokens - 1} tokens in all)=========")
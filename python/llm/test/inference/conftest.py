@@ -0,0 +1,54 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+# must differ from the output size of every other linear layer, ipex-llm treats
+# a linear layer whose output size is the vocab size as the lm head
+TINY_VOCAB_SIZE = 96
+
+
+@pytest.fixture(scope="session")
+def tiny_llama():
+    """Factory of a randomly initialized 2-layer llama, the same weights on every call."""
+    from transformers import LlamaConfig, LlamaForCausalLM
+
+    def factory():
+        torch.manual_seed(0)
+        config = LlamaConfig(vocab_size=TINY_VOCAB_SIZE, hidden_size=64, intermediate_size=128,
+                             num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+                             pad_token_id=0, eos_token_id=None)
+        return LlamaForCausalLM(config).eval()
+    return factory
+
+
+@pytest.fixture(scope="session")
+def tiny_mixtral():
+    """Factory of a randomly initialized 3-layer mixtral with 8 experts, the same weights
+    on every call."""
+    from transformers import MixtralConfig, MixtralForCausalLM
+
+    def factory():
+        torch.manual_seed(0)
+        config = MixtralConfig(vocab_size=TINY_VOCAB_SIZE, hidden_size=64,
+                               intermediate_size=128, num_hidden_layers=3,
+                               num_attention_heads=4, num_key_value_heads=2,
+                               num_local_experts=8, num_experts_per_tok=2,
+                               pad_token_id=0, eos_token_id=None)
+        return MixtralForCausalLM(config).eval()
+    return factory
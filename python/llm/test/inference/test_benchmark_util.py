@@ -0,0 +1,85 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import csv
+import json
+import pytest
+import torch
+
+from ipex_llm.utils.benchmark_util import BenchmarkWrapper
+
+
+class Layer(torch.nn.Module):
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.self_attn = torch.nn.Linear(hidden_size, hidden_size)
+        self.mlp = torch.nn.Sequential(torch.nn.Linear(hidden_size, hidden_size),
+                                       torch.nn.ReLU())
+
+    def forward(self, x):
+        return self.mlp(self.self_attn(x))
+
+
+class ToyModel(torch.nn.Module):
+    def __init__(self, vocab_size=32, hidden_size=16):
+        super().__init__()
+        self.embed_tokens = torch.nn.Embedding(vocab_size, hidden_size)
+        self.layers = torch.nn.ModuleList([Layer(hidden_size) for _ in range(2)])
+        self.lm_head = torch.nn.Linear(hidden_size, vocab_size)
+
+    @property
+    def device(self):
+        return self.lm_head.weight.device
+
+    def forward(self, input_ids):
+        x = self.embed_tokens(input_ids)
+        for layer in self.layers:
+            x = layer(x)
+        return self.lm_head(x)
+
+    @torch.no_grad()
+    def generate(self, input_ids, max_new_tokens=4):
+        for _ in range(max_new_tokens):
+            next_ids = self(input_ids)[:, -1:].argmax(dim=-1)
+            input_ids = torch.cat((input_ids, next_ids), dim=-1)
+        return input_ids
+
+
+def test_benchmark_wrapper(tmp_path):
+    model = BenchmarkWrapper(ToyModel(), profile_layers=True, profile_dir=str(tmp_path))
+    input_ids = torch.randint(0, 32, (2, 5))
+    output = model.generate(input_ids, max_new_tokens=6)
+    assert output.shape == (2, 11)
+    assert model.first_cost > 0 and model.rest_cost_mean > 0
+
+    stats = model.profiler.get_stats()
+    assert stats["batch_size"] == 2
+    assert stats["num_new_tokens"] == 6 and stats["num_steps"] == 6
+    assert len(stats["step_latencies"]) == 6
+    assert set(stats["layer_time"]["rest"].keys()) == {"attention", "mlp", "lm_head"}
+    assert all(t > 0 for t in stats["layer_time"]["first"].values())
+
+    with open(tmp_path / "generate_0.json") as f:
+        assert json.load(f)["num_new_tokens"] == 6
+    with open(tmp_path / "generate_0.csv") as f:
+        assert len(list(csv.reader(f))) == 7
+    # hooks are only attached during generate
+    assert len(model.model._forward_hooks) == 0
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,80 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers.continuous_batching import ContinuousBatchScheduler, Sequence, \
+    sample_tokens
+
+
+def test_continuous_batching_matches_generate(tiny_llama):
+    model = tiny_llama()
+    prompts = [[1, 5, 7, 9], [1, 3], [1, 8, 8, 2, 4, 6, 10], [1, 11, 12]]
+    max_new_tokens = [6, 3, 8, 5]
+
+    expected = []
+    with torch.no_grad():
+        for prompt, n in zip(prompts, max_new_tokens):
+            output = model.generate(torch.tensor([prompt]), do_sample=False, max_new_tokens=n)
+            expected.append(output[0, len(prompt):].tolist())
+
+    scheduler = ContinuousBatchScheduler(model, max_num_seqs=3)
+    seqs = [Sequence(str(i), prompt, max_new_tokens=n)
+            for i, (prompt, n) in enumerate(zip(prompts, max_new_tokens))]
+    # the last request arrives while the others are already decoding
+    for seq in seqs[:-1]:
+        scheduler.add_sequence(seq)
+    scheduler.step()
+    scheduler.add_sequence(seqs[-1])
+    while scheduler.has_unfinished_sequences():
+        scheduler.step()
+
+    for seq, tokens in zip(seqs, expected):
+        assert seq.finish_reason == "length"
+        assert seq.output_ids == tokens
+
+
+def test_continuous_batching_stops_at_eos(tiny_llama):
+    model = tiny_llama()
+    scheduler = ContinuousBatchScheduler(model, max_num_seqs=2)
+    probe = Sequence("probe", [1, 5, 7], max_new_tokens=1)
+    scheduler.add_sequence(probe)
+    scheduler.step()
+    eos_token_id = probe.output_ids[0]
+
+    seq = Sequence("eos", [1, 5, 7], max_new_tokens=16, eos_token_id=eos_token_id)
+    scheduler.add_sequence(seq)
+    while scheduler.has_unfinished_sequences():
+        scheduler.step()
+    assert seq.finish_reason == "stop"
+    assert seq.output_ids == [eos_token_id]
+
+
+def test_sample_tokens_per_row_params():
+    logits = torch.tensor([[0.0, 5.0, 1.0, 2.0],
+                           [0.0, 5.0, 1.0, 2.0]])
+    next_tokens = sample_tokens(logits,
+                                do_sample=torch.tensor([False, True]),
+                                temperature=torch.tensor([1.0, 1.0]),
+                                top_k=torch.tensor([0, 1]),
+                                top_p=torch.tensor([1.0, 1.0]))
+    assert next_tokens.tolist() == [1, 1]
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
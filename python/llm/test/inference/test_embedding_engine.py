@@ -0,0 +1,58 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers.embedding_engine import EmbeddingEngine
+
+
+def masked_sum(input_ids, attention_mask):
+    # one row per sequence: [sum of ids, number of tokens, padded length]
+    return torch.stack([(input_ids * attention_mask).sum(dim=1),
+                        attention_mask.sum(dim=1),
+                        torch.full((input_ids.size(0),), input_ids.size(1))], dim=1)
+
+
+@pytest.mark.parametrize("cache_size", [0, 8])
+def test_embedding_engine_batching(cache_size):
+    engine = EmbeddingEngine(masked_sum, pad_token_id=7, max_batch_size=3,
+                             max_wait_ms=50, bucket_size=4, cache_size=cache_size)
+    batch_input_ids = [list(range(1, n + 1)) for n in [9, 1, 5, 2, 3, 10, 4, 1]]
+    embeddings = engine.embed(batch_input_ids)
+    for input_ids, embedding in zip(batch_input_ids, embeddings):
+        assert embedding[0].item() == sum(input_ids)
+        assert embedding[1].item() == len(input_ids)
+        # only sequences of the same bucket are padded together
+        assert (embedding[2].item() - 1) // 4 == (len(input_ids) - 1) // 4
+    assert engine.num_batches == 4
+
+    engine.embed(batch_input_ids[:2])
+    assert engine.num_cache_hits == (2 if cache_size > 0 else 0)
+
+
+def test_embedding_engine_error():
+    def fail(input_ids, attention_mask):
+        raise RuntimeError("forward failed")
+
+    engine = EmbeddingEngine(fail)
+    with pytest.raises(RuntimeError, match="forward failed"):
+        engine.embed([[1, 2, 3]])
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,349 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import struct
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.convert import ggml_convert_low_bit, \
+    replace_with_quantized_linear_for_module
+from ipex_llm.transformers.gguf.gguf import GGUFBlockTensor, GGUFFileLoader, \
+    GGUFTensorLoader
+from ipex_llm.transformers.low_bit_linear import LowBitLinear
+
+
+def _tensor_loader():
+    return GGUFTensorLoader(None, SimpleNamespace(infos=[], base_offset=0), num_threads=1)
+
+
+def _q4_0_blocks(rng, num_blocks):
+    # the first value of every block is -8, so that requantizing the dequantized block
+    # gives the same scale
+    d = rng.uniform(0.001, 0.02, num_blocks).astype(np.float16)
+    qs = rng.integers(0, 256, (num_blocks, 16), dtype=np.uint8)
+    qs[:, 0] &= 0xF0
+    return np.concatenate([d.reshape(-1, 1).view(np.uint8), qs], axis=1)
+
+
+def _q8_0_blocks(rng, num_blocks):
+    # the first value of every block is 127, the largest magnitude of a q8_0 block
+    d = rng.uniform(0.001, 0.02, num_blocks).astype(np.float16)
+    qs = rng.integers(-127, 128, (num_blocks, 32), dtype=np.int8)
+    qs[:, 0] = 127
+    return np.concatenate([d.reshape(-1, 1).view(np.uint8), qs.view(np.uint8)], axis=1)
+
+
+_BLOCKS = {
+    # gguf qtype: (ipex-llm low_bit, block builder)
+    2: ("sym_int4", _q4_0_blocks),
+    8: ("sym_int8", _q8_0_blocks),
+}
+
+
+def _block_tensor(gguf_qtype, out_features, in_features, seed=0):
+    low_bit, build = _BLOCKS[gguf_qtype]
+    loader = _tensor_loader()
+    rng = np.random.default_rng(seed)
+    blocks = build(rng, out_features * in_features // 32)
+    data = torch.from_numpy(blocks.reshape(out_features, -1))
+    return GGUFBlockTensor(data, ggml_tensor_qtype[low_bit], [out_features, in_features],
+                           loader.convert_funcs[gguf_qtype])
+
+
+class _Proj(torch.nn.Module):
+    def __init__(self, in_features, out_features):
+        super().__init__()
+        self.proj = torch.nn.Linear(in_features, out_features, bias=False)
+
+
+@pytest.mark.parametrize("gguf_qtype", list(_BLOCKS.keys()))
+def test_load_tensor_passes_through_blocks_of_the_same_shape(gguf_qtype):
+    loader = _tensor_loader()
+    tensor = _block_tensor(gguf_qtype, 16, 512)
+    loader.buffer = tensor.data.numpy().reshape(-1)
+    info = ("blk.0.ffn_up.weight", 2, [16, 512], gguf_qtype, 0)
+    qtype = ggml_tensor_qtype[_BLOCKS[gguf_qtype][0]]
+
+    name, loaded = loader._load_tensor(info, passthrough_qtype=qtype)
+    assert name == info[0]
+    if loader.is_passthrough(gguf_qtype, qtype):
+        assert isinstance(loaded, GGUFBlockTensor) and loaded.qtype == qtype
+        assert torch.equal(loaded.data, tensor.data)
+    else:
+        # e.g. ipex-llm sym_int4 blocks hold 64 values, gguf q4_0 blocks hold 32
+        assert torch.equal(loaded, tensor.dequantize())
+    # only a matching low-bit qtype passes the blocks through
+    _, loaded = loader._load_tensor(info, passthrough_qtype=ggml_tensor_qtype["asym_int4"])
+    assert torch.equal(loaded, tensor.dequantize())
+    _, loaded = loader._load_tensor(info)
+    assert torch.equal(loaded, tensor.dequantize())
+
+
+def _gguf_str(value):
+    data = value.encode()
+    return struct.pack("<Q", len(data)) + data
+
+
+def _write_gguf(path, tensors, alignment=64):
+    # a gguf v3 file with `(name, dims, gguf qtype, raw bytes)` tensors
+    kvs = [("general.architecture", 8, _gguf_str("llama")),
+           ("general.alignment", 4, struct.pack("<I", alignment))]
+    header = b"GGUF" + struct.pack("<IQQ", 3, len(tensors), len(kvs))
+    for key, value_type, value in kvs:
+        header += _gguf_str(key) + struct.pack("<i", value_type) + value
+    data = b""
+    for name, dims, qtype, raw in tensors:
+        header += _gguf_str(name) + struct.pack("<I", len(dims))
+        header += struct.pack(f"<{len(dims)}Q", *reversed(dims))
+        header += struct.pack("<iQ", qtype, len(data))
+        data += raw + b"\0" * (-len(raw) % alignment)
+    header += b"\0" * (-len(header) % alignment)
+    with open(path, "wb") as f:
+        f.write(header + data)
+
+
+def _permute(weight, n_head):
+    # the permutation of q_proj and k_proj weights in the gguf llama loader
+    rows, cols = weight.shape
+    return weight.reshape(n_head, rows // n_head // 2, 2, cols).swapaxes(1, 2).reshape(rows, cols)
+
+
+@pytest.mark.parametrize("num_threads", [2, 4])
+def test_load_while_process_with_threads(tmp_path, monkeypatch, num_threads):
+    # pass q4_0 blocks through whatever the block shape of this ipex-llm build is
+    monkeypatch.setattr(GGUFTensorLoader, "is_passthrough",
+                        lambda self, qtype, passthrough_qtype: qtype == 2)
+    rng = np.random.default_rng(num_threads)
+    q_blocks = _q4_0_blocks(rng, 64 * 256 // 32)
+    v_blocks = _q8_0_blocks(rng, 32 * 256 // 32)
+    k_weight = rng.standard_normal((32, 256)).astype(np.float16)
+    embd = rng.standard_normal((16, 256)).astype(np.float32)
+    norm = rng.standard_normal(256).astype(np.float32)
+    tensors = [
+        ("token_embd.weight", [16, 256], 0, embd.tobytes()),
+        ("blk.0.attn_q.weight", [64, 256], 2, q_blocks.tobytes()),
+        ("blk.0.attn_k.weight", [32, 256], 1, k_weight.tobytes()),
+        ("blk.0.attn_v.weight", [32, 256], 8, v_blocks.tobytes()),
+        ("blk.0.attn_norm.weight", [256], 0, norm.tobytes()),
+    ]
+    path = str(tmp_path / "tiny.gguf")
+    _write_gguf(path, tensors)
+
+    def load(num_threads):
+        loaded = []
+        loader = GGUFFileLoader(path, num_threads=num_threads)
+        assert loader.tensor_loader.num_threads == num_threads
+        loader.tensor_loader.load_while_process(
+            lambda name, tensor: loaded.append((name, tensor)),
+            passthrough_qtype=ggml_tensor_qtype["sym_int4"],
+            row_permutes={"attn_q.weight": 4, "attn_k.weight": 2})
+        return loaded
+
+    serial, threaded = load(1), load(num_threads)
+    names = [name for name, _, _, _ in tensors]
+    assert [name for name, _ in serial] == names
+    assert [name for name, _ in threaded] == names
+    for (name, expected), (_, tensor) in zip(serial, threaded):
+        if isinstance(expected, GGUFBlockTensor):
+            assert isinstance(tensor, GGUFBlockTensor), name
+            assert tensor.qtype == expected.qtype and tensor.shape == expected.shape
+            assert torch.equal(tensor.data, expected.data), name
+        else:
+            assert torch.equal(tensor, expected), name
+
+    loaded = dict(threaded)
+    converter = _tensor_loader()
+    q_proj = loaded["blk.0.attn_q.weight"]
+    assert isinstance(q_proj, GGUFBlockTensor) and q_proj.qtype == ggml_tensor_qtype["sym_int4"]
+    q_weight = converter.convert_q4_0_tensor(torch.from_numpy(q_blocks.reshape(-1)),
+                                             q_blocks.size, 2, [64, 256])
+    assert torch.equal(q_proj.dequantize(), _permute(q_weight, 4))
+    assert torch.equal(loaded["blk.0.attn_k.weight"], _permute(torch.from_numpy(k_weight), 2))
+    v_weight = converter.convert_q8_0_tensor(torch.from_numpy(v_blocks.reshape(-1)),
+                                             v_blocks.size, 2, [32, 256])
+    assert torch.equal(loaded["blk.0.attn_v.weight"], v_weight)
+    assert torch.equal(loaded["token_embd.weight"].reshape(16, 256), torch.from_numpy(embd))
+    assert torch.equal(loaded["blk.0.attn_norm.weight"], torch.from_numpy(norm))
+
+    # f32 tensors are views of the copy-on-write mapping, writes never reach the file
+    loaded["token_embd.weight"].zero_()
+    reloaded = dict(load(1))
+    assert torch.equal(reloaded["token_embd.weight"].reshape(16, 256), torch.from_numpy(embd))
+
+
+@pytest.mark.parametrize("gguf_qtype", list(_BLOCKS.keys()))
+def test_passthrough_blocks_match_requantized_weight(gguf_qtype):
+    out_features, in_features = 64, 512
+    tensor = _block_tensor(gguf_qtype, out_features, in_features)
+    if not _tensor_loader().is_passthrough(gguf_qtype, tensor.qtype):
+        pytest.skip("ipex-llm blocks of this qtype have another shape than gguf blocks")
+
+    with torch.device("meta"):
+        model = _Proj(in_features, out_features)
+    model = replace_with_quantized_linear_for_module(model, tensor.qtype, "proj.weight",
+                                                     tensor.data, tensor.shape)
+    assert isinstance(model.proj, LowBitLinear) and model.proj.qtype == tensor.qtype
+
+    expected = _Proj(in_features, out_features)
+    expected.proj.weight.data = tensor.dequantize().float()
+    expected = ggml_convert_low_bit(expected, tensor.qtype, optimize_model=False)
+
+    # the gguf blocks are the blocks ipex-llm builds for the same weight
+    assert torch.equal(model.proj.weight.data.view(torch.uint8),
+                       expected.proj.weight.data.view(torch.uint8))
+    x = torch.randn(3, in_features)
+    with torch.no_grad():
+        assert torch.equal(model.proj(x), expected.proj(x))
+
+
+@pytest.mark.parametrize("gguf_qtype", list(_BLOCKS.keys()))
+@pytest.mark.parametrize("n_head", [1, 4])
+def test_permute_rows_matches_float_permutation(gguf_qtype, n_head):
+    rows, cols = 64, 256
+    tensor = _block_tensor(gguf_qtype, rows, cols, seed=n_head)
+    expected = _permute(tensor.dequantize(), n_head)
+    permuted = tensor.permute_rows(n_head)
+    assert permuted.shape == tensor.shape
+    assert torch.equal(permuted.dequantize(), expected)
+
+
+def _half_bytes(value):
+    return np.array([value], dtype=np.float16).view(np.uint8)
+
+
+def _scale_min_k4(j, q):
+    # get_scale_min_k4 of llama.cpp ggml-quants.c
+    if j < 4:
+        return q[j] & 63, q[j + 4] & 63
+    return (q[j + 4] & 0xF) | ((q[j - 4] >> 6) << 4), (q[j + 4] >> 4) | ((q[j] >> 6) << 4)
+
+
+def _dequantize_q2_k(block):
+    # dequantize_row_q2_K of llama.cpp ggml-quants.c
+    scales, q = block[:16], block[16:80]
+    d, dmin = block[80:82].view(np.float16)[0], block[82:84].view(np.float16)[0]
+    y, i = [], 0
+    for n in range(2):
+        for shift in range(0, 8, 2):
+            for half in range(2):
+                sc = scales[i]
+                i += 1
+                for q_l in q[n * 32 + half * 16:n * 32 + half * 16 + 16]:
+                    y.append(float(d) * (sc & 0xF) * ((q_l >> shift) & 3)
+                             - float(dmin) * (sc >> 4))
+    return y
+
+
+def _dequantize_q3_k(block):
+    # dequantize_row_q3_K of llama.cpp ggml-quants.c
+    hm, q = block[:32], block[32:96]
+    d = block[108:110].view(np.float16)[0]
+    aux = block[96:108].copy().view(np.uint32)
+    kmask1, kmask2 = np.uint32(0x03030303), np.uint32(0x0f0f0f0f)
+    tmp = aux[2]
+    aux = np.array([(aux[0] & kmask2) | (((tmp >> 0) & kmask1) << 4),
+                    (aux[1] & kmask2) | (((tmp >> 2) & kmask1) << 4),
+                    ((aux[0] >> 4) & kmask2) | (((tmp >> 4) & kmask1) << 4),
+                    ((aux[1] >> 4) & kmask2) | (((tmp >> 6) & kmask1) << 4)], dtype=np.uint32)
+    scales = aux.view(np.int8)
+    y, i, m = [], 0, 1
+    for n in range(2):
+        for shift in range(0, 8, 2):
+            for half in range(2):
+                dl = float(d) * (int(scales[i]) - 32)
+                i += 1
+                for l in range(half * 16, half * 16 + 16):
+                    value = int((q[n * 32 + l] >> shift) & 3) - (0 if hm[l] & m else 4)
+                    y.append(dl * value)
+            m <<= 1
+    return y
+
+
+def _dequantize_q4_k(block):
+    # dequantize_row_q4_K of llama.cpp ggml-quants.c
+    d, dmin = block[:2].view(np.float16)[0], block[2:4].view(np.float16)[0]
+    scales, q = block[4:16], block[16:]
+    y = []
+    for j in range(4):
+        sc1, m1 = _scale_min_k4(2 * j, scales)
+        sc2, m2 = _scale_min_k4(2 * j + 1, scales)
+        y += [float(d) * sc1 * (q_l & 0xF) - float(dmin) * m1 for q_l in q[j * 32:j * 32 + 32]]
+        y += [float(d) * sc2 * (q_l >> 4) - float(dmin) * m2 for q_l in q[j * 32:j * 32 + 32]]
+    return y
+
+
+def _dequantize_q5_k(block):
+    # dequantize_row_q5_K of llama.cpp ggml-quants.c
+    d, dmin = block[:2].view(np.float16)[0], block[2:4].view(np.float16)[0]
+    scales, qh, ql = block[4:16], block[16:48], block[48:]
+    y, u1, u2 = [], 1, 2
+    for j in range(4):
+        sc1, m1 = _scale_min_k4(2 * j, scales)
+        sc2, m2 = _scale_min_k4(2 * j + 1, scales)
+        for l in range(32):
+            y.append(float(d) * sc1 * ((ql[j * 32 + l] & 0xF) + (16 if qh[l] & u1 else 0))
+                     - float(dmin) * m1)
+        for l in range(32):
+            y.append(float(d) * sc2 * ((ql[j * 32 + l] >> 4) + (16 if qh[l] & u2 else 0))
+                     - float(dmin) * m2)
+        u1 <<= 2
+        u2 <<= 2
+    return y
+
+
+_K_QUANTS = {
+    # gguf qtype: (offsets of the fp16 d and dmin, reference dequantization)
+    10: ([80, 82], _dequantize_q2_k),
+    11: ([108], _dequantize_q3_k),
+    12: ([0, 2], _dequantize_q4_k),
+    13: ([0, 2], _dequantize_q5_k),
+}
+
+
+@pytest.mark.parametrize("gguf_qtype", [10, 11, 12, 13])
+def test_k_quant_dequantization_matches_reference(gguf_qtype):
+    loader = _tensor_loader()
+    offsets, reference = _K_QUANTS[gguf_qtype]
+    rng = np.random.default_rng(gguf_qtype)
+    num_blocks = 3
+    blocks = rng.integers(0, 256, (num_blocks, loader.block_size[gguf_qtype]), dtype=np.uint8)
+    for offset in offsets:
+        blocks[:, offset:offset + 2] = _half_bytes(rng.uniform(0.01, 0.1))
+    # a block with known values: d = 1, dmin = 0.5, all scales and mins 1, quants 0
+    blocks[0] = 0
+    blocks[0, offsets[0]:offsets[0] + 2] = _half_bytes(1.0)
+    if len(offsets) > 1:
+        blocks[0, offsets[1]:offsets[1] + 2] = _half_bytes(0.5)
+
+    dims = [2, num_blocks * 128]
+    result = loader.convert_funcs[gguf_qtype](torch.from_numpy(blocks.reshape(-1)),
+                                              blocks.size, 2, dims)
+    assert list(result.shape) == dims
+    expected = np.array([y for block in blocks for y in reference(block)], dtype=np.float32)
+    np.testing.assert_allclose(result.float().reshape(-1).numpy(), expected,
+                               rtol=1e-5, atol=1e-6)
+    # zero quants and scales dequantize to 0, q3_k quants are offset by -4 times
+    # scale -32 without the high bit
+    first = result.reshape(-1)[:256]
+    if gguf_qtype == 11:
+        assert torch.all(first == 128)
+    else:
+        assert torch.all(first == 0)
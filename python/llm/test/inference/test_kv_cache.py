@@ -0,0 +1,279 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from transformers.cache_utils import DynamicCache
+
+from ipex_llm import optimize_model
+from ipex_llm.transformers.kv import DynamicNormalCache, DynamicPagedCache, DynamicSinkCache, \
+    KVBlockPool
+from ipex_llm.transformers.prefix_cache import PrefixCache
+
+
+def test_paged_cache_matches_normal_cache():
+    torch.manual_seed(0)
+    normal_cache = DynamicNormalCache()
+    paged_cache = DynamicPagedCache(block_size=4)
+    num_layers = 2
+    # prefill 7 tokens, then decode 10 tokens one by one across several blocks
+    for seq_len in [7] + [1] * 10:
+        for layer_idx in range(num_layers):
+            key = torch.randn(2, 3, seq_len, 8)
+            value = torch.randn(2, 3, seq_len, 8)
+            k_1, v_1 = normal_cache.update(key, value, layer_idx)
+            k_2, v_2 = paged_cache.update(key, value, layer_idx)
+            assert torch.equal(k_1, k_2)
+            assert torch.equal(v_1, v_2)
+    assert paged_cache.get_seq_length() == normal_cache.get_seq_length() == 17
+
+
+def test_paged_cache_returns_blocks_to_pool():
+    key = torch.randn(1, 2, 9, 4)
+    cache = DynamicPagedCache(block_size=4)
+    cache.update(key, key, 0)
+    pool = cache.pool
+    num_used_blocks = pool.num_used_blocks
+    assert num_used_blocks >= 3
+    cache.free()
+    assert pool.num_used_blocks == num_used_blocks - 3
+
+    # the next request reuses the freed blocks instead of growing the pool
+    num_blocks = pool.num_blocks
+    cache = DynamicPagedCache(block_size=4)
+    cache.update(key, key, 0)
+    assert pool.num_blocks == num_blocks
+    cache.free()
+
+
+
+def _paged_reference(query, keys, values, mask):
+    n_rep = query.size(1) // keys.size(1)
+    keys = keys.repeat_interleave(n_rep, dim=1)
+    values = values.repeat_interleave(n_rep, dim=1)
+    scores = query @ keys.transpose(-1, -2) / query.size(-1) ** 0.5 + mask
+    return scores.softmax(-1) @ values
+
+
+@pytest.mark.parametrize("padding", [False, True])
+def test_paged_attention_matches_attention_over_gathered_cache(padding, monkeypatch):
+    # a tiny initial pool makes the sequences span several chunks and block runs
+    monkeypatch.setattr(DynamicPagedCache, "INIT_NUM_BLOCKS", 2)
+    torch.manual_seed(0)
+    cache = DynamicPagedCache(block_size=3)
+    keys, values = torch.empty(2, 2, 0, 8), torch.empty(2, 2, 0, 8)
+    for seq_len in [7] + [1] * 10 + [4, 1]:
+        key, value = torch.randn(2, 2, seq_len, 8), torch.randn(2, 2, seq_len, 8)
+        query = torch.randn(2, 4, seq_len, 8)
+        keys, values = torch.cat([keys, key], dim=2), torch.cat([values, value], dim=2)
+        kv_len = keys.size(2)
+        causal = torch.arange(kv_len)[None, :] > torch.arange(kv_len - seq_len, kv_len)[:, None]
+        mask = torch.zeros(2, 1, seq_len, kv_len).masked_fill(causal, float("-inf"))
+        if padding:
+            mask[1, :, :, 1] = float("-inf")
+
+        cache.write(key, value, 0)
+        output = cache.attention(query, 0, mask if padding else None)
+        assert torch.allclose(output, _paged_reference(query, keys, values, mask), atol=1e-5)
+    assert len(cache.pool.chunk_sizes) > 1
+    cache.free()
+
+
+def test_block_pool_grows_without_moving_blocks():
+    pool = KVBlockPool(num_heads=2, head_dim=4, block_size=2, num_blocks=2,
+                       dtype=torch.float32, device=torch.device("cpu"))
+    k_chunks, v_chunks = pool.get_layer(0)
+    k_chunks[0].fill_(1)
+    data_ptr = k_chunks[0].data_ptr()
+    blocks = pool.allocate(2) + pool.allocate(5)
+    assert sorted(blocks) == list(range(7))
+    assert pool.num_blocks >= 7
+    # the first chunk is neither copied nor reallocated
+    assert k_chunks[0].data_ptr() == data_ptr
+    assert torch.equal(k_chunks[0], torch.ones_like(k_chunks[0]))
+    assert sum(chunk.size(0) for chunk in k_chunks) == pool.num_blocks
+    for block in blocks:
+        chunk_idx, offset = pool.locate(block)
+        assert pool.chunk_starts[chunk_idx] + offset == block
+        assert offset < k_chunks[chunk_idx].size(0)
+
+
+def test_optimized_model_generates_with_paged_cache(tiny_llama):
+    model = optimize_model(tiny_llama(), low_bit="sym_int4")
+    input_ids = torch.tensor([[1, 9, 17, 33, 5, 6, 7, 8]])
+    expected = model.generate(input_ids, do_sample=False, max_new_tokens=10)
+    cache = DynamicPagedCache(block_size=4)
+    output = model.generate(input_ids, do_sample=False, max_new_tokens=10,
+                            past_key_values=cache)
+    assert torch.equal(output, expected)
+    cache.free()
+
+
+
+def _rope(x, positions, inv_freq):
+    freqs = positions.float()[:, None] * inv_freq[None, :]
+    emb = torch.cat([freqs, freqs], dim=-1)
+    half = x.size(-1) // 2
+    rotated = torch.cat([-x[..., half:], x[..., :half]], dim=-1)
+    return x * emb.cos() + rotated * emb.sin()
+
+
+def _attention(query, key, value, causal_start):
+    scores = query @ key.transpose(-1, -2) / query.size(-1) ** 0.5
+    q_len, kv_len = scores.shape[-2:]
+    mask = torch.arange(kv_len)[None, :] > torch.arange(q_len)[:, None] + causal_start
+    return scores.masked_fill(mask, float("-inf")).softmax(-1) @ value
+
+
+@pytest.mark.parametrize("chunks", [[5] + [1] * 20,
+                                    [3, 4, 1, 1, 6, 1, 1, 1, 1, 2, 1, 1],
+                                    [1, 1, 20, 1, 1, 3, 9, 1]])
+def test_sink_cache_matches_streaming_llm(chunks):
+    torch.manual_seed(0)
+    window_length, num_sink_tokens, head_dim = 10, 2, 8
+    inv_freq = 1.0 / (10000 ** (torch.arange(0, head_dim, 2).float() / head_dim))
+    cache = DynamicSinkCache(window_length, num_sink_tokens)
+    # unrotated keys and values of the tokens kept by StreamingLLM
+    kept_keys, kept_values = torch.empty(1, 2, 0, head_dim), torch.empty(1, 2, 0, head_dim)
+    for seq_len in chunks:
+        key = torch.randn(1, 2, seq_len, head_dim)
+        value = torch.randn(1, 2, seq_len, head_dim)
+        query = torch.randn(1, 2, seq_len, head_dim)
+
+        # reference: evict the oldest recent tokens to make room for the chunk,
+        # keys and queries take their positions in the window
+        num_kept = kept_keys.size(2)
+        if num_kept + seq_len > window_length and seq_len <= window_length - num_sink_tokens:
+            num_evicted = num_kept + seq_len - window_length
+            index = list(range(num_sink_tokens)) + list(range(num_sink_tokens + num_evicted,
+                                                              num_kept))
+            kept_keys, kept_values = kept_keys[:, :, index], kept_values[:, :, index]
+        keys = torch.cat([kept_keys, key], dim=2)
+        values = torch.cat([kept_values, value], dim=2)
+        kv_len = keys.size(2)
+        positions = torch.arange(kv_len - seq_len, kv_len)
+        expected = _attention(_rope(query, positions, inv_freq),
+                              _rope(keys, torch.arange(kv_len), inv_freq),
+                              values, kv_len - seq_len)
+        if kv_len > window_length:
+            index = list(range(num_sink_tokens)) + list(range(kv_len - window_length
+                                                              + num_sink_tokens, kv_len))
+            keys, values = keys[:, :, index], values[:, :, index]
+        kept_keys, kept_values = keys, values
+
+        cache_position = cache.get_cache_position(seq_len)
+        assert torch.equal(cache_position, positions)
+        k, v = cache.update(_rope(key, cache_position, inv_freq), value, 0,
+                            {"inv_freq": inv_freq})
+        assert k.size(2) == kv_len
+        output = _attention(_rope(query, cache_position, inv_freq), k, v, kv_len - seq_len)
+        assert torch.allclose(output, expected, atol=1e-5)
+        assert cache.get_seq_length() == min(kv_len, window_length)
+        # the cache never grows beyond the window
+        assert cache.key_cache[0].size(2) == window_length
+    seen_tokens = cache._seen_tokens if hasattr(cache, "_seen_tokens") else cache.seen_tokens
+    assert seen_tokens == sum(chunks)
+
+
+def test_sink_cache_does_not_reallocate():
+    inv_freq = torch.ones(2)
+    cache = DynamicSinkCache(window_length=6, num_sink_tokens=2)
+    cache.update(torch.randn(1, 1, 6, 4), torch.randn(1, 1, 6, 4), 0, {"inv_freq": inv_freq})
+    data_ptrs = None
+    for _ in range(10):
+        k, v = cache.update(torch.randn(1, 1, 1, 4), torch.randn(1, 1, 1, 4), 0,
+                            {"inv_freq": inv_freq})
+        ptrs = (cache.key_cache[0].data_ptr(), cache.value_cache[0].data_ptr(),
+                k.data_ptr(), v.data_ptr())
+        assert data_ptrs is None or ptrs == data_ptrs
+        data_ptrs = ptrs
+
+
+def test_prefix_cache_reuses_shared_prompt(tiny_llama):
+    model = tiny_llama()
+    system_prompt = [1, 9, 17, 33, 5, 6, 7, 8]
+    prompts = [system_prompt + [40, 41], system_prompt + [50, 51, 52], system_prompt + [40, 41]]
+    prefix_cache = PrefixCache()
+    for prompt in prompts:
+        input_ids = torch.tensor([prompt])
+        expected = model.generate(input_ids, do_sample=False, max_new_tokens=5)
+        output = model.generate(input_ids, do_sample=False, max_new_tokens=5,
+                                prefix_cache=prefix_cache)
+        assert torch.equal(output, expected)
+
+    stats = prefix_cache.get_stats()
+    assert stats["num_requests"] == 3
+    assert stats["num_hits"] == 2
+    # the second prompt reuses the system prompt, the third one all but its last token
+    assert stats["num_saved_prefill_tokens"] == len(system_prompt) + len(prompts[2]) - 1
+
+
+def test_prefix_cache_evicts_least_recently_used(tiny_llama):
+    model = tiny_llama()
+    prefix_cache = PrefixCache()
+    prefix_cache.prefill(model, torch.tensor([[1, 2, 3, 4, 5]]))
+    one_prompt_bytes = prefix_cache.nbytes
+    prefix_cache.max_bytes = one_prompt_bytes * 3 // 2
+
+    prefix_cache.prefill(model, torch.tensor([[7, 8, 9, 10, 11]]))
+    assert prefix_cache.nbytes <= prefix_cache.max_bytes
+    assert prefix_cache.match([1, 2, 3, 4])[0] == 0
+    assert prefix_cache.match([7, 8, 9, 10])[0] == 4
+
+
+
+def _dynamic_cache(num_tokens):
+    cache = DynamicCache()
+    for layer_idx in range(2):
+        cache.update(torch.randn(1, 2, num_tokens, 4), torch.randn(1, 2, num_tokens, 4),
+                     layer_idx)
+    return cache
+
+
+def _stored_prompts(prefix_cache):
+    # walk the radix tree without touching it
+    prompts, stack = set(), [((), prefix_cache.root)]
+    while stack:
+        prefix, node = stack.pop()
+        prefix += node.tokens
+        if node.children:
+            stack.extend((prefix, child) for child in node.children.values())
+        elif node is not prefix_cache.root:
+            prompts.add(prefix)
+    return prompts
+
+
+def test_prefix_cache_evicts_leaves_in_lru_order():
+    prefix_cache = PrefixCache()
+    shared = (1, 2, 3, 4)
+    prompts = [shared + (5, 6), shared + (7, 8), (9, 10, 11)]
+    for prompt in prompts:
+        prefix_cache.insert(list(prompt), _dynamic_cache(len(prompt)))
+    # only touches the node of the shared prefix, it is used after the (9, 10, 11) leaf
+    prefix_cache.insert(list(shared), _dynamic_cache(len(shared)))
+    assert _stored_prompts(prefix_cache) == set(prompts)
+
+    # the shared prefix becomes a leaf once its children are evicted, and is evicted last
+    expected = [{prompts[1], prompts[2]}, {shared, prompts[2]}, {shared}, set()]
+    for stored in expected:
+        prefix_cache.max_bytes = prefix_cache.nbytes - 1
+        prefix_cache._evict()
+        assert _stored_prompts(prefix_cache) == stored
+    assert prefix_cache.nbytes == 0
+
+if __name__ == '__main__':
+    pytest.main([__file__])
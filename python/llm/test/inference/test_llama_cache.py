@@ -0,0 +1,154 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import os
+from collections import deque
+
+import numpy as np
+import pytest
+
+from ipex_llm.ggml.model.llama import llama_cpp
+from ipex_llm.ggml.model.llama.llama import LlamaCache, LlamaState, LogitsBuffer
+
+STATE_SIZE = 1024
+
+
+def _state(key):
+    eval_logits = LogitsBuffer(16, 4)
+    eval_logits.extend(np.full((len(key), 4), key[-1], dtype=np.single))
+    llama_state = (llama_cpp.c_uint8 * STATE_SIZE)(*([key[-1] % 256] * STATE_SIZE))
+    return LlamaState(eval_tokens=deque(key, maxlen=16), eval_logits=eval_logits,
+                      llama_state=llama_state, llama_state_size=STATE_SIZE)
+
+
+def _assert_state(state, key):
+    assert list(state.eval_tokens) == list(key)
+    assert state.eval_tokens.maxlen == 16
+    assert [row[0] for row in state.eval_logits] == [key[-1]] * len(key)
+    assert bytes(state.llama_state) == bytes([key[-1] % 256]) * STATE_SIZE
+
+
+def _spill_files(path):
+    return [name for name in os.listdir(path) if name.endswith(LlamaCache.SPILL_SUFFIX)]
+
+
+def test_llama_cache_longest_prefix():
+    cache = LlamaCache(capacity_bytes=10 * STATE_SIZE)
+    for key in [(1, 2, 3, 4), (1, 2, 5), (1, 2, 3, 6, 7), (8,)]:
+        cache[key] = _state(key)
+
+    # hit, the longest cached prefix of the prompt
+    _assert_state(cache[(1, 2, 3, 4, 9, 9)], (1, 2, 3, 4))
+    _assert_state(cache[(1, 2, 5)], (1, 2, 5))
+    _assert_state(cache[(8, 1)], (8,))
+    # a prompt ending inside an edge selects a key below it
+    assert cache[(1, 2, 3, 6)].eval_tokens[-1] == 7
+    assert list(cache[(1, 2, 3)].eval_tokens)[:3] == [1, 2, 3]
+    # miss
+    assert (9, 1) not in cache
+    assert (1, 2) in cache
+    with pytest.raises(Exception):
+        cache[(9, 1)]
+    assert cache.cache_size == 4 * STATE_SIZE
+
+
+def test_llama_cache_matches_brute_force(tmp_path):
+    from ipex_llm.ggml.model.llama.llama import Llama
+    rng = np.random.default_rng(0)
+    cache = LlamaCache(capacity_bytes=8 * STATE_SIZE, spill_dir=str(tmp_path))
+    keys = set()
+    for _ in range(200):
+        key = tuple(rng.integers(1, 4, rng.integers(1, 8)).tolist())
+        if rng.random() < 0.5 or len(keys) == 0:
+            cache[key] = _state(key)
+            keys.add(key)
+            continue
+        prefix_len = max(Llama.longest_token_prefix(k, key) for k in keys)
+        if prefix_len == 0:
+            assert key not in cache
+            continue
+        in_memory = [k for k in cache.cache_state
+                     if Llama.longest_token_prefix(k, key) == prefix_len]
+        state = cache[key]
+        found = tuple(state.eval_tokens)
+        assert Llama.longest_token_prefix(found, key) == prefix_len
+        assert len(in_memory) == 0 or found in in_memory
+        _assert_state(state, found)
+
+
+def test_llama_cache_eviction_without_spill():
+    cache = LlamaCache(capacity_bytes=2 * STATE_SIZE)
+    for key in [(1, 2, 3), (1, 2, 4), (5, 6)]:
+        cache[key] = _state(key)
+    assert cache.cache_size == 2 * STATE_SIZE
+    # the least recently used key is dropped and pruned from the index
+    _assert_state(cache[(1, 2, 3, 4)], (1, 2, 4))
+    assert (5, 6) in cache
+    cache[(7,)] = _state((7,))
+    assert (1, 2) in cache and (5,) not in cache
+
+
+def test_llama_cache_spill_and_reload(tmp_path):
+    spill_dir = str(tmp_path)
+    cache = LlamaCache(capacity_bytes=2 * STATE_SIZE, spill_dir=spill_dir)
+    keys = [(1, 2, 3), (1, 2, 4), (1, 2, 4, 5), (6, 7)]
+    for key in keys:
+        cache[key] = _state(key)
+    assert cache.cache_size == 2 * STATE_SIZE
+    assert list(cache.spilled.keys()) == keys[:2]
+    assert len(_spill_files(spill_dir)) == 2
+
+    # a key in memory is preferred to a spilled one sharing the same prefix
+    _assert_state(cache[(1, 2)], (1, 2, 4, 5))
+    # a spilled key is loaded back, its file is removed and the oldest state is spilled
+    _assert_state(cache[(1, 2, 3, 9)], (1, 2, 3))
+    assert (1, 2, 3) in cache.cache_state and (1, 2, 3) not in cache.spilled
+    assert list(cache.spilled.keys()) == [(1, 2, 4), (6, 7)]
+    assert len(_spill_files(spill_dir)) == 2
+
+    # a restarted cache indexes the spilled states and loads them on demand
+    restarted = LlamaCache(capacity_bytes=2 * STATE_SIZE, spill_dir=spill_dir)
+    assert restarted.cache_size == 0
+    assert sorted(restarted.spilled.keys()) == [(1, 2, 4), (6, 7)]
+    _assert_state(restarted[(6, 7, 8)], (6, 7))
+    _assert_state(restarted[(1, 2, 3)], (1, 2, 4))
+    assert sorted(restarted.cache_state.keys()) == [(1, 2, 4), (6, 7)]
+    assert len(restarted.spilled) == 0 and len(_spill_files(spill_dir)) == 0
+
+
+def test_llama_cache_spill_capacity(tmp_path):
+    spill_dir = str(tmp_path)
+    cache = LlamaCache(capacity_bytes=STATE_SIZE, spill_dir=spill_dir)
+    keys = [(i, i + 1) for i in range(1, 6)]
+    cache[keys[0]] = _state(keys[0])
+    cache[keys[1]] = _state(keys[1])
+    # spill files of these keys have the same size
+    file_size = cache.spill_size
+    cache.spill_capacity_bytes = int(2.5 * file_size)
+    for key in keys[2:]:
+        cache[key] = _state(key)
+    # one state in memory, the two most recently spilled on disk, the others dropped
+    assert list(cache.cache_state.keys()) == keys[-1:]
+    assert list(cache.spilled.keys()) == keys[-3:-1]
+    assert cache.spill_size == 2 * file_size
+    assert len(_spill_files(spill_dir)) == 2
+    assert keys[0] not in cache and keys[1] not in cache
+
+    # a restarted cache with a smaller bound deletes the least recently spilled file
+    restarted = LlamaCache(capacity_bytes=STATE_SIZE, spill_dir=spill_dir,
+                           spill_capacity_bytes=int(1.5 * file_size))
+    assert len(restarted.spilled) == 1 and len(_spill_files(spill_dir)) == 1
@@ -0,0 +1,80 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import pytest
+import torch
+
+from ipex_llm.transformers.lookup import NgramIndex
+
+
+def naive_match(tokens, max_ngram_size, num_output_tokens):
+    for ngram_size in range(min(max_ngram_size, len(tokens) - 1), 0, -1):
+        ngram = tokens[-ngram_size:]
+        for idx in range(len(tokens) - ngram_size):
+            if tokens[idx:idx + ngram_size] == ngram:
+                start = idx + ngram_size
+                return tokens[start:start + num_output_tokens]
+    return []
+
+
+@pytest.mark.parametrize("max_ngram_size", [1, 2, 3])
+def test_ngram_index_match(max_ngram_size):
+    random.seed(0)
+    sequences = [[random.randint(0, 7) for _ in range(length)] for length in [1, 5, 40, 300]]
+    # a small capacity so that the index grows while tokens are appended
+    index = NgramIndex(max_ngram_size, len(sequences), capacity=8)
+    for row, tokens in enumerate(sequences):
+        index.extend(row, torch.tensor(tokens[:3]))
+    for end in range(3, 300, 7):
+        for row, tokens in enumerate(sequences):
+            if index.lengths[row] < min(end, len(tokens)):
+                index.extend(row, torch.tensor(tokens[index.lengths[row]:end]))
+        candidates = index.match(num_output_tokens=4)
+        for row, tokens in enumerate(sequences):
+            expected = naive_match(tokens[:index.lengths[row]], max_ngram_size, 4)
+            assert candidates[row].tolist() == expected
+
+
+def test_batched_lookup_matches_generate(tmp_path, tiny_llama):
+    from ipex_llm.transformers import AutoModelForCausalLM
+    tiny_llama().save_pretrained(str(tmp_path))
+    model = AutoModelForCausalLM.from_pretrained(str(tmp_path), load_in_low_bit="sym_int4",
+                                                 torch_dtype=torch.float32)
+    random.seed(1)
+    # repeated n-grams in the prompts give candidates to verify
+    prompts = [[random.randint(2, 9) for _ in range(length)] for length in [24, 9, 17]]
+    max_len = max(len(prompt) for prompt in prompts)
+    input_ids = torch.zeros((len(prompts), max_len), dtype=torch.long)
+    attention_mask = torch.zeros_like(input_ids)
+    for row, prompt in enumerate(prompts):
+        input_ids[row, max_len - len(prompt):] = torch.tensor(prompt)
+        attention_mask[row, max_len - len(prompt):] = 1
+
+    output_ids = model.generate(input_ids, attention_mask=attention_mask, lookahead=3,
+                                do_sample=False, max_new_tokens=20)
+    # drafts are verified, not only the token generated by the first forward
+    assert model.n_drafted > 0 and model.n_matched > 0
+    # the same batch without lookup, low-bit kernels may round a batch differently from a
+    # single row
+    expected = model.generate(input_ids, attention_mask=attention_mask, do_sample=False,
+                              max_new_tokens=20)
+    assert output_ids.tolist() == expected.tolist()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,61 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+import ipex_llm.transformers.low_bit_linear as low_bit_linear
+from ipex_llm.ggml.quantize import ggml_tensor_qtype
+from ipex_llm.transformers.convert import ggml_convert_low_bit
+from ipex_llm.transformers.low_bit_linear import MatMulLowBitCPU, ggml_int4_convert_fp32
+
+
+def _low_bit_weight(out_features, in_features):
+    torch.manual_seed(0)
+    model = torch.nn.Sequential(torch.nn.Linear(in_features, out_features, bias=False))
+    model = ggml_convert_low_bit(model, ggml_tensor_qtype["sym_int4"], optimize_model=False)
+    weight = model[0].weight
+    dequantized = ggml_int4_convert_fp32(weight.data, weight._shape,
+                                         weight._shape[0] * weight._shape[1])
+    return weight, dequantized
+
+
+# tiles of 1 row, of 3 rows with a shorter last one, and of the whole weight
+@pytest.mark.parametrize("tile_numel", [128, 3 * 128, 1 << 20])
+def test_tiled_matmul_matches_dequantized_weight(tile_numel, monkeypatch):
+    monkeypatch.setattr(low_bit_linear, "LOW_BIT_TILE_NUMEL", tile_numel)
+    weight, dequantized = _low_bit_weight(out_features=40, in_features=128)
+    x = torch.randn(2, 5, 128, requires_grad=True)
+    output = MatMulLowBitCPU.apply(x, weight)
+    grad_output = torch.randn_like(output)
+    output.backward(grad_output)
+
+    assert torch.allclose(output, torch.matmul(x, dequantized.T), atol=1e-4)
+    assert torch.allclose(x.grad, torch.matmul(grad_output, dequantized), atol=1e-4)
+
+
+def test_tiled_matmul_bf16():
+    weight, dequantized = _low_bit_weight(out_features=96, in_features=64)
+    x = torch.randn(7, 64, dtype=torch.bfloat16, requires_grad=True)
+    output = MatMulLowBitCPU.apply(x, weight)
+    output.float().sum().backward()
+
+    assert output.dtype == x.grad.dtype == torch.bfloat16
+    expected = torch.matmul(x.float(), dequantized.T)
+    assert torch.allclose(output.float(), expected, atol=5e-2, rtol=2e-2)
+    expected_grad = dequantized.bfloat16().float().sum(dim=0).expand(7, -1)
+    assert torch.allclose(x.grad.float(), expected_grad, atol=5e-2, rtol=2e-2)
@@ -0,0 +1,66 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers.models.common import moe_group_forward
+
+
+class WeightedExpert(torch.nn.Module):
+    # called as `expert(x, weights)` like ipex-llm's mixtral experts
+    def __init__(self, hidden_size):
+        super().__init__()
+        self.proj = torch.nn.Linear(hidden_size, hidden_size)
+
+    def forward(self, x, routing_weights):
+        return routing_weights * torch.nn.functional.silu(self.proj(x))
+
+
+def _expert_loop(experts, hidden_states, routing_weights, selected_experts):
+    final_hidden_states = torch.zeros_like(hidden_states)
+    for expert_idx, expert in enumerate(experts):
+        top_x, idx = torch.where(selected_experts == expert_idx)
+        current_hidden_states = expert(hidden_states[top_x], routing_weights[top_x, idx, None])
+        final_hidden_states.index_add_(0, top_x, current_hidden_states)
+    return final_hidden_states
+
+
+@pytest.mark.parametrize("num_tokens", [2, 7, 64])
+@pytest.mark.parametrize("num_workers", ["0", "4"])
+def test_moe_group_forward_matches_expert_loop(num_tokens, num_workers, monkeypatch):
+    monkeypatch.setenv("IPEX_LLM_MOE_NUM_WORKERS", num_workers)
+    torch.manual_seed(0)
+    hidden_size, num_experts, top_k = 16, 8, 2
+    experts = torch.nn.ModuleList([WeightedExpert(hidden_size) for _ in range(num_experts)])
+    hidden_states = torch.randn(num_tokens, hidden_size)
+    router_logits = torch.randn(num_tokens, num_experts)
+    routing_weights, selected_experts = torch.topk(router_logits.softmax(-1), top_k, dim=-1)
+
+    with torch.no_grad():
+        expected = _expert_loop(experts, hidden_states, routing_weights, selected_experts)
+        output = moe_group_forward(experts, hidden_states, routing_weights, selected_experts,
+                                   expert_takes_weights=True)
+        assert torch.allclose(output, expected, atol=1e-6)
+
+        # experts which are called as `expert(x) * weights`, e.g. qwen2_moe
+        mlps = [expert.proj for expert in experts]
+        output = moe_group_forward(torch.nn.ModuleList(mlps), hidden_states, routing_weights,
+                                   selected_experts)
+        expected = _expert_loop([lambda x, w, mlp=mlp: mlp(x) * w for mlp in mlps],
+                                hidden_states, routing_weights, selected_experts)
+        assert torch.allclose(output, expected, atol=1e-6)
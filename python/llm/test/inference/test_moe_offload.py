@@ -0,0 +1,123 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm import optimize_model
+from ipex_llm.transformers.moe_offload import enable_expert_offload
+
+
+@pytest.fixture
+def low_bit_mixtral(tiny_mixtral):
+    return lambda: optimize_model(tiny_mixtral(), low_bit="sym_int4")
+
+
+@pytest.mark.parametrize("policy", ["lru", "lfu"])
+def test_expert_offload_matches_resident_experts(policy, tmp_path, low_bit_mixtral):
+    model = low_bit_mixtral()
+    input_ids = torch.tensor([[1, 9, 17, 33, 5, 6, 7, 8]])
+    with torch.no_grad():
+        expected_logits = model(input_ids).logits
+    expected = model.generate(input_ids, do_sample=False, max_new_tokens=8)
+
+    cache = enable_expert_offload(model, str(tmp_path), capacity=4, policy=policy)
+    with torch.no_grad():
+        logits = model(input_ids).logits
+    output = model.generate(input_ids, do_sample=False, max_new_tokens=8)
+    assert torch.allclose(logits, expected_logits, atol=1e-5)
+    assert torch.equal(output, expected)
+
+    stats = cache.get_stats()
+    assert stats["num_misses"] > 0
+    assert stats["num_evictions"] > 0
+    # 3 layers x 8 experts never fit, pinned experts may overflow the cache by one
+    assert stats["num_resident"] <= 4 + 1
+    num_needed = stats["num_hits"] + stats["num_prefetch_stalls"] + stats["num_misses"]
+    assert stats["hit_rate"] == stats["num_hits"] / num_needed
+
+
+def test_expert_store_is_reused(tmp_path, low_bit_mixtral):
+    model = low_bit_mixtral()
+    input_ids = torch.tensor([[3, 4, 5]])
+    expected = model.generate(input_ids, do_sample=False, max_new_tokens=4)
+    enable_expert_offload(model, str(tmp_path), capacity=16)
+
+    # a second model loads its experts from the file written by the first one
+    model = low_bit_mixtral()
+    cache = enable_expert_offload(model, str(tmp_path), capacity=16, prefetch=False)
+    output = model.generate(input_ids, do_sample=False, max_new_tokens=4)
+    assert torch.equal(output, expected)
+    assert cache.get_stats()["num_prefetches"] == 0
+
+
+def test_expert_store_is_written_while_streaming_load(tmp_path, tiny_mixtral, monkeypatch):
+    from ipex_llm.transformers import AutoModelForCausalLM, streaming_convert
+    from ipex_llm.transformers.moe_offload import ExpertStoreWriter
+
+    checkpoint = str(tmp_path / "checkpoint")
+    tiny_mixtral().save_pretrained(checkpoint, max_shard_size="200KB")
+    input_ids = torch.tensor([[3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14]])
+    model = AutoModelForCausalLM.from_pretrained(checkpoint, load_in_low_bit="sym_int4")
+    expected = model.generate(input_ids, do_sample=False, max_new_tokens=6)
+
+    # every block is written and released before the experts of the next layer are loaded
+    written = []
+    add_block = ExpertStoreWriter.add_block
+
+    def record_add_block(self, name, block, release=True):
+        assert all(p.numel() == 0 for b in written for p in b.experts.parameters())
+        written.append(block)
+        add_block(self, name, block, release)
+
+    monkeypatch.setattr(ExpertStoreWriter, "add_block", record_add_block)
+    # make sure the streaming path is taken, not the fallback to the default one
+    load_convert_streaming = streaming_convert.load_convert_streaming
+
+    def checked_load_convert_streaming(*args, **kwargs):
+        model = load_convert_streaming(*args, **kwargs)
+        assert model is not None
+        return model
+
+    monkeypatch.setattr(streaming_convert, "load_convert_streaming",
+                        checked_load_convert_streaming)
+    store = str(tmp_path / "experts")
+    model = AutoModelForCausalLM.from_pretrained(checkpoint, load_in_low_bit="sym_int4",
+                                                 streaming_convert=True,
+                                                 expert_offload_path=store)
+    assert len(written) == 3
+    assert all(p.numel() == 0 for p in written[-1].experts.parameters())
+
+    cache = enable_expert_offload(model, store, capacity=4)
+    output = model.generate(input_ids, do_sample=False, max_new_tokens=6)
+    assert torch.equal(output, expected)
+    assert cache.get_stats()["num_misses"] > 0
+
+
+def test_mismatched_expert_store_is_rejected(tmp_path, tiny_mixtral, low_bit_mixtral):
+    enable_expert_offload(low_bit_mixtral(), str(tmp_path), capacity=4)
+
+    model = low_bit_mixtral()
+    experts = model.model.layers[1].block_sparse_moe.experts
+    model.model.layers[1].block_sparse_moe.experts = torch.nn.ModuleList(list(experts)[:4])
+    with pytest.raises(RuntimeError, match="has 4 experts"):
+        enable_expert_offload(model, str(tmp_path), capacity=4)
+
+    # experts quantized to another low-bit type have other shapes
+    model = optimize_model(tiny_mixtral(), low_bit="sym_int8")
+    with pytest.raises(RuntimeError, match="does not match the model"):
+        enable_expert_offload(model, str(tmp_path), capacity=4)
@@ -0,0 +1,137 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+from peft import LoraConfig, get_peft_model
+
+from ipex_llm import optimize_model
+from ipex_llm.transformers.qlora import PeftModel, enable_multi_lora
+
+
+TARGET_MODULES = ["q_proj", "v_proj", "down_proj"]
+
+
+@pytest.fixture(scope="module")
+def low_bit_llama(tiny_llama):
+    # keep q/k/v separated, as adapters refer to them by name
+    return lambda: optimize_model(tiny_llama(), low_bit="sym_int4", optimize_llm=False)
+
+
+@pytest.fixture(scope="module")
+def adapters(tmp_path_factory, tiny_llama):
+    paths = {}
+    for seed, (name, rank, modules) in enumerate([("a", 4, TARGET_MODULES),
+                                                  ("b", 8, TARGET_MODULES),
+                                                  ("c", 2, ["q_proj"])]):
+        torch.manual_seed(seed + 1)
+        config = LoraConfig(r=rank, lora_alpha=16, target_modules=modules,
+                            init_lora_weights=False)
+        path = str(tmp_path_factory.mktemp(name))
+        get_peft_model(tiny_llama(), config).save_pretrained(path)
+        paths[name] = path
+    return paths
+
+
+def _single_adapter_logits(low_bit_llama, path, input_ids):
+    if path is None:
+        model = low_bit_llama()
+    else:
+        model = PeftModel.from_pretrained(low_bit_llama(), path)
+    with torch.no_grad():
+        return model(input_ids).logits
+
+
+def test_multi_lora_matches_single_adapter(adapters, low_bit_llama):
+    model = low_bit_llama()
+    registry = enable_multi_lora(model, TARGET_MODULES, max_rank=8, capacity=4)
+    for name, path in adapters.items():
+        registry.register(name, path)
+
+    names = ["a", "b", None, "c", "a"]
+    input_ids = torch.randint(1, model.config.vocab_size, (len(names), 6))
+    registry.set_adapters(names)
+    with torch.no_grad():
+        logits = model(input_ids).logits
+    for i, name in enumerate(names):
+        expected = _single_adapter_logits(low_bit_llama, adapters.get(name, None),
+                                          input_ids[i:i + 1])
+        assert torch.allclose(logits[i:i + 1], expected, atol=1e-4)
+
+    # without adapters the base model is used
+    registry.set_adapters(None)
+    with torch.no_grad():
+        logits = model(input_ids[:1]).logits
+    assert torch.allclose(logits, _single_adapter_logits(low_bit_llama, None, input_ids[:1]),
+                          atol=1e-5)
+
+
+def test_multi_lora_evicts_least_recently_used(adapters, low_bit_llama):
+    model = low_bit_llama()
+    registry = enable_multi_lora(model, TARGET_MODULES, max_rank=8, capacity=2)
+    for name, path in adapters.items():
+        registry.register(name, path)
+
+    registry.set_adapters(["a", "b"])
+    registry.set_adapters(["a"])
+    # "b" is the least recently used one
+    registry.set_adapters(["c", None])
+    assert set(registry.slots) == {"a", "c"}
+    assert registry.get_stats() == {"num_hits": 1, "num_loads": 3, "num_evictions": 1,
+                                    "num_loaded": 2}
+
+    # the slot of "b" is reused by "c", no weight of "b" is left in it
+    input_ids = torch.randint(1, model.config.vocab_size, (2, 6))
+    with torch.no_grad():
+        logits = model(input_ids).logits
+    expected = _single_adapter_logits(low_bit_llama, adapters["c"], input_ids[:1])
+    assert torch.allclose(logits[:1], expected, atol=1e-4)
+
+    with pytest.raises(Exception):
+        registry.set_adapters(["a", "b", "c"])
+
+
+def test_multi_lora_keeps_loaded_adapters_when_a_load_fails(adapters, low_bit_llama, tmp_path):
+    model = low_bit_llama()
+    registry = enable_multi_lora(model, TARGET_MODULES, max_rank=4, capacity=2)
+    for name, path in adapters.items():
+        registry.register(name, path)
+    registry.register("missing", str(tmp_path))
+
+    registry.set_adapters(["a", "c"])
+    # neither a missing adapter nor one of a too large rank evicts a loaded one
+    for name in ["missing", "b"]:
+        with pytest.raises(Exception):
+            registry.set_adapters([name])
+        assert dict(registry.slots) == {"a": 0, "c": 1}
+    assert registry.num_evictions == 0
+
+    # a released slot is reused before anything is evicted
+    registry.unload("a")
+    registry.set_adapters(["c", None])
+    registry.register("c", adapters["a"])
+    assert registry.free_slots == [0, 1]
+    registry.set_adapters(["c", "a"])
+    assert dict(registry.slots) == {"c": 0, "a": 1}
+    assert registry.num_evictions == 0
+
+    input_ids = torch.randint(1, model.config.vocab_size, (2, 6))
+    with torch.no_grad():
+        logits = model(input_ids).logits
+    for i in range(2):
+        expected = _single_adapter_logits(low_bit_llama, adapters["a"], input_ids[i:i + 1])
+        assert torch.allclose(logits[i:i + 1], expected, atol=1e-4)
@@ -38,7 +38,40 @@ class TestOptimizeAPI(unittest.TestCase):
         model = optimize_model(model, low_bit="sym_int4", optimize_llm=False)
         # result = model.transcribe(reservation_audio, verbose=True, language="English")
         # assert "Reservation" or "reservation" in result["text"]
-        
-        
+
+    def test_optimize_registry(self):
+        import importlib.util
+        from ipex_llm.transformers.convert import _PRE_OPTIMIZE_HOOKS, \
+            _POST_OPTIMIZE_FORWARDS, _import_models_module
+        entries = [(model_type, module_name, hook)
+                   for model_type, hooks in _PRE_OPTIMIZE_HOOKS.items()
+                   for module_name, hook in hooks]
+        entries += [(model_type, module_name, forward)
+                    for model_type, forwards in _POST_OPTIMIZE_FORWARDS.items()
+                    for _, module_name, forward in forwards]
+        num_checked = 0
+        for model_type, module_name, name in entries:
+            try:
+                module = _import_models_module(module_name)
+            except ModuleNotFoundError as e:
+                # e.g. `transformers.models.starcoder2` needs a newer transformers,
+                # or a dependency of remote code models which is not installed
+                assert not e.name.startswith("ipex_llm"), model_type
+                assert importlib.util.find_spec(e.name) is None, model_type
+                continue
+            assert callable(getattr(module, name)), model_type
+            num_checked += 1
+        assert num_checked > 0
+
+    def test_optimize_post_model_type(self):
+        from ipex_llm.transformers.convert import _post_optimize_forwards_type
+        assert _post_optimize_forwards_type("gptj") == "gptj"
+        assert _post_optimize_forwards_type("internlm2") == "internlm2"
+        # gptj and bloom also match model types containing their name
+        assert _post_optimize_forwards_type("bloomz") == "bloom"
+        assert _post_optimize_forwards_type("gptj_custom") == "gptj"
+        assert _post_optimize_forwards_type("llama") is None
+
+
 if __name__ == '__main__':
     pytest.main([__file__])
\ No newline at end of file
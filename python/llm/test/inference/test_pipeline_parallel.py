@@ -0,0 +1,253 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import asyncio
+import json
+import os
+import socket
+from types import SimpleNamespace
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from ipex_llm.transformers.pipeline_parallel import BatchTask, encode_batch_header, \
+    decode_batch_header, _parse_cpulist
+
+
+def _word_tokenizer(vocab_size):
+    # "w2 w17 w5" is tokenized to [2, 17, 5], 0 and 1 are the pad and eos tokens
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    vocab = {"<pad>": 0, "</s>": 1}
+    vocab.update({f"w{i}": i for i in range(2, vocab_size)})
+    tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="<pad>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="<pad>",
+                                   eos_token="</s>")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def _serve(worker, tokenizer, requests):
+    from ipex_llm.serving.fastapi.tgi_protocol import Parameters
+    from ipex_llm.transformers import pipeline_parallel
+    result_dict = {}
+    if worker.rank > 0:
+        # rank 0 never broadcasts an empty batch header, the harness uses one to stop
+        stopped = []
+        decode = pipeline_parallel.decode_batch_header
+
+        def decode_batch_header(header, max_num_seqs):
+            batch = decode(header, max_num_seqs)
+            stopped.append(batch is None)
+            return batch
+
+        pipeline_parallel.decode_batch_header = decode_batch_header
+        while len(stopped) == 0 or not stopped[-1]:
+            await worker.process_step(tokenizer, result_dict)
+        return result_dict
+
+    waiting = list(requests)
+    step = 0
+    while len(result_dict) < len(requests):
+        idle = not worker.has_waiting_requests() and \
+            all(batch is None for batch in worker.on_going_batches)
+        arrived = [request for request in waiting if request["step"] <= step]
+        if idle and len(arrived) == 0:
+            arrived = waiting[:1]
+        for request in arrived:
+            waiting.remove(request)
+            parameters = Parameters(**request["parameters"])
+            await worker.waiting_requests.put((request["request_id"], SimpleNamespace(
+                inputs=request["inputs"], parameters=parameters)))
+        await worker.process_step(tokenizer, result_dict)
+        step += 1
+    dist.broadcast(encode_batch_header(None, worker.max_num_seqs, worker.device), src=0)
+    return result_dict
+
+
+def _run_stage(rank, world_size, port, checkpoint, requests, max_num_seqs, output_file):
+    from ipex_llm.transformers import init_pipeline_parallel, PPModelWorker
+    os.environ.update({"MASTER_ADDR": "127.0.0.1", "MASTER_PORT": str(port),
+                       "RANK": str(rank), "WORLD_SIZE": str(world_size)})
+    init_pipeline_parallel("cpu", numa_binding=False)
+    worker = PPModelWorker(checkpoint, rank, world_size, "sym_int4", max_num_seqs,
+                           max_prefilled_seqs=0, torch_dtype=torch.float32)
+    torch.manual_seed(0)
+    tokenizer = _word_tokenizer(worker.model.config.vocab_size)
+    result_dict = asyncio.run(_serve(worker, tokenizer, requests))
+    if rank == 0:
+        with open(output_file, "w") as f:
+            json.dump(result_dict, f)
+    dist.destroy_process_group()
+
+
+def run_pipeline_serving(tmp_path, checkpoint, requests, max_num_seqs=4, world_size=2):
+    """
+    Serve `requests` with `world_size` PPModelWorker processes on CPU (gloo), a request
+    is queued at rank 0 before its `step`-th `process_step`.
+
+    :return: the text generated for every request id.
+    """
+    output_file = str(tmp_path / "results.json")
+    torch.multiprocessing.spawn(_run_stage, nprocs=world_size,
+                                args=(world_size, _free_port(), checkpoint, requests,
+                                      max_num_seqs, output_file))
+    with open(output_file) as f:
+        return json.load(f)
+
+
+def _reference_outputs(checkpoint, requests):
+    # one `generate` per request in a single process
+    from ipex_llm.transformers import AutoModelForCausalLM
+    model = AutoModelForCausalLM.from_pretrained(checkpoint, load_in_low_bit="sym_int4",
+                                                 optimize_model=True,
+                                                 torch_dtype=torch.float32)
+    tokenizer = _word_tokenizer(model.config.vocab_size)
+    eos_token_id = model.generation_config.eos_token_id
+    eos_token_id = [1] + ([] if eos_token_id is None else [eos_token_id])
+    outputs = {}
+    for request in requests:
+        input_ids = tokenizer(request["inputs"], return_tensors="pt").input_ids
+        output_ids = model.generate(input_ids, do_sample=False, eos_token_id=eos_token_id,
+                                    pad_token_id=0,
+                                    max_new_tokens=request["parameters"]["max_new_tokens"])
+        output_ids = output_ids[0, input_ids.size(1):].tolist()
+        if output_ids[-1] in eos_token_id:
+            # the eos token is not returned by the serving
+            output_ids = output_ids[:-1]
+        outputs[request["request_id"]] = tokenizer.decode(output_ids)
+    return outputs
+
+
+def _prompt(length):
+    return " ".join(f"w{t}" for t in torch.randint(2, 96, (length,)).tolist())
+
+
+@pytest.fixture(scope="module")
+def tiny_llama_checkpoint(tmp_path_factory, tiny_llama):
+    path = str(tmp_path_factory.mktemp("tiny_llama"))
+    tiny_llama().save_pretrained(path)
+    return path
+
+
+def test_pipeline_serving_matches_generate(tmp_path, tiny_llama_checkpoint):
+    torch.manual_seed(0)
+    requests = [{"request_id": str(i), "step": 0, "inputs": _prompt(length),
+                 "parameters": {"max_new_tokens": 8}}
+                for i, length in enumerate([5, 9, 3, 7])]
+    outputs = run_pipeline_serving(tmp_path, tiny_llama_checkpoint, requests)
+    assert outputs == _reference_outputs(tiny_llama_checkpoint, requests)
+
+
+@pytest.mark.parametrize("keep_indices", [None, [0, 2]])
+def test_batch_header_round_trip(keep_indices):
+    batch = BatchTask(batch_id="batch_7", request_ids=["a", "b"], max_tokens=32,
+                      batch_size=2, input_len=1, prompt_lengths=[5, 9], stopped=False,
+                      prefilled_index=2, partial_prefilling=0, seq_len=9,
+                      do_sample=[False, True], temperature=[1.0, 0.7], top_k=[0, 40],
+                      top_p=[1.0, 0.9], keep_indices=keep_indices)
+    header = encode_batch_header(batch, max_num_seqs=4, device="cpu")
+    decoded = decode_batch_header(header, max_num_seqs=4)
+
+    assert decoded.batch_id == batch.batch_id
+    assert decoded.request_ids == []
+    for name in ["max_tokens", "batch_size", "input_len", "prompt_lengths", "stopped",
+                 "prefilled_index", "partial_prefilling", "seq_len", "do_sample",
+                 "temperature", "top_k", "top_p", "keep_indices"]:
+        assert getattr(decoded, name) == getattr(batch, name), name
+    assert decode_batch_header(encode_batch_header(None, 4, "cpu"), 4) is None
+
+
+def test_parse_cpulist():
+    assert _parse_cpulist("0-3,8,10-11\n") == [0, 1, 2, 3, 8, 10, 11]
+    assert _parse_cpulist("") == []
+
+
+
+def test_pipeline_serving_retires_and_joins_rows(tmp_path, tiny_llama):
+    torch.manual_seed(1)
+    requests = [{"request_id": str(i), "step": step, "inputs": _prompt(length),
+                 "parameters": {"max_new_tokens": max_new_tokens}}
+                for i, (step, length, max_new_tokens) in enumerate([
+                    (0, 6, 12), (0, 9, 3), (0, 4, 12),
+                    # joins the free row and the row of the 2nd request once it finishes
+                    (4, 5, 6), (12, 8, 5),
+                    # longer than the running batch, waits for a new batch
+                    (12, 14, 4),
+                ])]
+    # pick as eos a token generated in the middle of the first request
+    model = tiny_llama()
+    checkpoint = str(tmp_path / "model")
+    model.save_pretrained(checkpoint)
+    output_ids = _word_tokenizer(96)(_reference_outputs(checkpoint, requests[:1])["0"]).input_ids
+    model.generation_config.eos_token_id = output_ids[4]
+    model.save_pretrained(checkpoint)
+
+    expected = _reference_outputs(checkpoint, requests)
+    assert len(expected["0"].split()) < 12
+    outputs = run_pipeline_serving(tmp_path, checkpoint, requests, max_num_seqs=4)
+    assert outputs == expected
+
+
+def test_pipeline_serving_samples_per_row(tmp_path, tiny_llama_checkpoint):
+    from ipex_llm.transformers import AutoModelForCausalLM
+    torch.manual_seed(2)
+    requests = [{"request_id": str(i), "step": 0, "inputs": _prompt(6),
+                 "parameters": dict(max_new_tokens=8, **parameters)}
+                for i, parameters in enumerate([
+                    {"do_sample": False},
+                    {"do_sample": True, "temperature": 0.5, "top_k": 1},
+                    {"do_sample": True, "temperature": 1.5, "top_k": 3},
+                    {"do_sample": True, "top_p": 0.3},
+                ])]
+    outputs = run_pipeline_serving(tmp_path, tiny_llama_checkpoint, requests)
+
+    # top_k=1 is greedy decoding whatever the temperature
+    greedy = _reference_outputs(tiny_llama_checkpoint, requests[:2])
+    assert outputs["0"] == greedy["0"] and outputs["1"] == greedy["1"]
+
+    # every sampled token is among the allowed ones of the same prefix
+    model = AutoModelForCausalLM.from_pretrained(tiny_llama_checkpoint,
+                                                 load_in_low_bit="sym_int4",
+                                                 optimize_model=True,
+                                                 torch_dtype=torch.float32)
+    tokenizer = _word_tokenizer(model.config.vocab_size)
+    for request_id, top_k, top_p in [("2", 3, 1.0), ("3", 0, 0.3)]:
+        prompt_ids = tokenizer(requests[int(request_id)]["inputs"]).input_ids
+        output_ids = tokenizer(outputs[request_id]).input_ids
+        assert 0 < len(output_ids) <= 8
+        for i, token_id in enumerate(output_ids):
+            with torch.no_grad():
+                logits = model(torch.tensor([prompt_ids + output_ids[:i]])).logits
+            probs = logits[0, -1].softmax(-1)
+            sorted_probs, sorted_ids = probs.sort(descending=True)
+            if top_k > 0:
+                allowed = sorted_ids[:top_k]
+            else:
+                # the smallest set of tokens whose probability reaches top_p
+                allowed = sorted_ids[sorted_probs.cumsum(0) - sorted_probs < top_p + 1e-4]
+            assert token_id in allowed.tolist()
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
@@ -0,0 +1,104 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import json
+import os
+
+import pytest
+import safetensors.torch as st
+import torch
+
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers.low_bit_linear import FP4Params
+from ipex_llm.transformers.qlora import LoraConfig, get_peft_model
+from ipex_llm.transformers.relora import find_lora_modules, lora_delta_weight, \
+    merge_and_save, sharded_paths
+
+
+def _lora_model(path):
+    model = AutoModelForCausalLM.from_pretrained(path, load_in_low_bit="nf4",
+                                                 optimize_model=False,
+                                                 torch_dtype=torch.float32,
+                                                 modules_to_not_convert=["lm_head"])
+    torch.manual_seed(1)
+    config = LoraConfig(r=4, lora_alpha=8, target_modules=["q_proj", "v_proj", "down_proj"],
+                        init_lora_weights=False)
+    return get_peft_model(model, config)
+
+
+def _sequential_merge_and_save(model, model_src, model_dst):
+    # the merge of a whole shard loaded in memory, one module after another
+    modules = find_lora_modules(model)
+    shard_paths = sharded_paths(model_src, modules.keys())
+    weights = {}
+    for shard_path in set(shard_paths.values()):
+        if shard_path.endswith(".safetensors"):
+            in_tensors = st.load_file(os.path.join(model_src, shard_path))
+        else:
+            in_tensors = torch.load(os.path.join(model_src, shard_path))
+        out_tensors = {}
+        for module_name, target in modules.items():
+            key = module_name + ".weight"
+            if shard_paths.get(key, None) != shard_path:
+                continue
+            new_weight = in_tensors[key].float() + lora_delta_weight(target, "cpu").float()
+            out_tensors[key] = new_weight.half()
+            weights[key] = FP4Params(new_weight, qtype=target.get_base_layer().qtype).to("cpu")
+        for name in in_tensors:
+            if name not in out_tensors:
+                out_tensors[name] = in_tensors[name].half()
+        out_name = shard_path.replace("pytorch_model", "model").replace(".bin", ".safetensors")
+        st.save_file(out_tensors, os.path.join(model_dst, out_name), metadata={"format": "pt"})
+    return weights
+
+
+@pytest.mark.parametrize("safe_serialization", [True, False])
+def test_merge_and_save_matches_sequential_merge(tmp_path, tiny_llama, safe_serialization):
+    src = str(tmp_path / "src")
+    tiny_llama().save_pretrained(src, max_shard_size="100KB",
+                                 safe_serialization=safe_serialization)
+
+    expected_dst = str(tmp_path / "expected")
+    os.makedirs(expected_dst)
+    expected_weights = _sequential_merge_and_save(_lora_model(src), src, expected_dst)
+    shard_names = sorted(os.listdir(expected_dst))
+    assert len(shard_names) > 1
+
+    for num_workers in [1, 4]:
+        model = _lora_model(src)
+        dst = str(tmp_path / f"merged_{num_workers}")
+        merge_and_save(model, src, dst, num_workers=num_workers)
+
+        assert sorted(name for name in os.listdir(dst) if not name.endswith(".json")) == \
+            shard_names
+        for name in shard_names:
+            merged = st.load_file(os.path.join(dst, name))
+            expected = st.load_file(os.path.join(expected_dst, name))
+            assert merged.keys() == expected.keys()
+            assert all(torch.equal(merged[key], expected[key]) for key in expected)
+        with open(os.path.join(dst, "model.safetensors.index.json")) as f:
+            weight_map = json.load(f)["weight_map"]
+        assert sorted(set(weight_map.values())) == shard_names
+
+        # the base layers hold the requantized merged weights
+        modules = find_lora_modules(model)
+        assert len(modules) == len(expected_weights)
+        for module_name, target in modules.items():
+            weight = target.get_base_layer().weight
+            expected = expected_weights[module_name + ".weight"]
+            assert isinstance(weight, FP4Params) and weight.qtype == expected.qtype
+            assert torch.equal(weight.data.view(torch.uint8), expected.data.view(torch.uint8))
@@ -0,0 +1,55 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+import pytest
+
+from ipex_llm.transformers.speculative import AdaptiveDraftPolicy, SpeculativeStats
+
+
+def test_speculative_stats():
+    stats = SpeculativeStats()
+    stats.record(4, 4, 0.04, 0.02)
+    stats.record(4, 1, 0.04, 0.02)
+    stats.record(2, 1, 0.02, 0.02)
+    assert stats.acceptance_histogram() == [0, 2, 0, 0, 1]
+    result = stats.get_stats()
+    assert result["acceptance_rate"] == pytest.approx(0.6)
+    assert result["mean_tokens_per_step"] == pytest.approx(3.0)
+    assert result["draft_time_ratio"] == pytest.approx(0.625)
+
+
+@pytest.mark.parametrize("alpha, expect_long", [(0.95, True), (0.2, False)])
+def test_adaptive_draft_policy(alpha, expect_long):
+    random.seed(0)
+    policy = AdaptiveDraftPolicy(min_step_draft=1, max_step_draft=12, explore=0.0)
+    for _ in range(200):
+        k = policy.next_draft_length()
+        n_matched = 0
+        while n_matched < k and random.random() < alpha:
+            n_matched += 1
+        # drafting is cheap compared to a verify forward
+        policy.update(k, n_matched, draft_time=0.002 * k, verify_time=0.03 + 0.001 * k)
+    assert policy.alpha == pytest.approx(alpha, abs=0.15)
+    if expect_long:
+        assert policy.next_draft_length() >= 8
+    else:
+        assert policy.next_draft_length() <= 3
+
+
+if __name__ == '__main__':
+    pytest.main([__file__])
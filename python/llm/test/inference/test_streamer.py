@@ -0,0 +1,128 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import random
+
+import pytest
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast
+
+from ipex_llm.transformers.streamer import BatchTextIteratorStreamer, IncrementalDetokenizer
+
+
+TEXTS = [
+    "The quick brown fox jumps over the lazy dog.\nIt was a sunny day.",
+    "今天天气很好，我们去公园散步吧。然后 we go home",
+    "naïve café déjà vu 😀 emoji and accents\n\nend",
+]
+
+
+def _tokenizer(kind):
+    if kind == "byte_level":
+        # a small vocab splits CJK characters and emojis into byte tokens
+        tokenizer = Tokenizer(models.BPE())
+        tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+        tokenizer.decoder = decoders.ByteLevel()
+        trainer = trainers.BpeTrainer(vocab_size=300,
+                                      initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    else:
+        # sentencepiece like, the leading space of a text is stripped by decoding
+        tokenizer = Tokenizer(models.BPE(unk_token="<unk>"))
+        tokenizer.pre_tokenizer = pre_tokenizers.Metaspace()
+        tokenizer.decoder = decoders.Metaspace()
+        trainer = trainers.BpeTrainer(vocab_size=200, special_tokens=["<unk>"])
+    tokenizer.train_from_iterator(TEXTS, trainer)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer)
+
+
+@pytest.mark.parametrize("kind", ["byte_level", "metaspace"])
+def test_incremental_detokenizer_matches_decode(kind):
+    tokenizer = _tokenizer(kind)
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    token_ids = [tokenizer.encode(text) for text in TEXTS]
+
+    windows = []
+    batch_decode = tokenizer.batch_decode
+
+    def record_batch_decode(sequences, **kwargs):
+        windows.extend(len(ids) for ids in sequences)
+        return batch_decode(sequences, **kwargs)
+
+    tokenizer.batch_decode = record_batch_decode
+
+    random.seed(0)
+    outputs = ["" for _ in TEXTS]
+    offsets = [0 for _ in TEXTS]
+    running = list(range(len(TEXTS)))
+    while len(running) > 0:
+        new_ids = []
+        for key in running:
+            num_tokens = random.randint(1, 3)
+            new_ids.append(token_ids[key][offsets[key]:offsets[key] + num_tokens])
+            offsets[key] += num_tokens
+        for key, text in zip(running, detokenizer.step(running, new_ids)):
+            assert "�" not in text
+            outputs[key] += text
+        finished = [key for key in running if offsets[key] >= len(token_ids[key])]
+        for key, text in zip(finished, detokenizer.finish(finished)):
+            outputs[key] += text
+        running = [key for key in running if key not in finished]
+
+    for output, ids in zip(outputs, token_ids):
+        assert output == tokenizer.decode(ids)
+    assert len(detokenizer.states) == 0
+    # every step only decodes the tokens since the last complete character instead of
+    # the whole sequence, byte tokens straddling CJK characters may hold back a few steps
+    assert max(windows) < max(len(ids) for ids in token_ids) // 2
+
+
+def test_incremental_detokenizer_flush_rules():
+    tokenizer = _tokenizer("byte_level")
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    # words are held back until they are complete
+    printed = [detokenizer.step(["a"], [[token_id]])[0]
+               for token_id in tokenizer.encode("hello world")]
+    assert "".join(printed) == "hello "
+    assert detokenizer.finish(["a"]) == ["world"]
+    # new lines and CJK characters are printed right away
+    printed = "".join(detokenizer.step(["b"], [tokenizer.encode("one two\n")]))
+    assert printed == "one two\n"
+    printed = "".join(detokenizer.step(["c"], [tokenizer.encode("今天")]))
+    assert printed == "今天"
+
+
+def test_batch_text_iterator_streamer():
+    tokenizer = _tokenizer("byte_level")
+    prompts = [tokenizer.encode("The quick"), tokenizer.encode("今天")]
+    outputs = [tokenizer.encode(" brown fox jumps\n"), tokenizer.encode("天气很好，我们")]
+    num_steps = max(len(ids) for ids in outputs)
+    # pad the shorter output, as generate does with eos
+    pad_token_id = tokenizer.encode(" ")[0]
+    outputs = [ids + [pad_token_id] * (num_steps - len(ids)) for ids in outputs]
+
+    streamer = BatchTextIteratorStreamer(batch_size=2, tokenizer=tokenizer, skip_prompt=True)
+    streamer.put(torch.tensor([prompts[0][:1], prompts[1][:1]]))
+    for step in range(num_steps):
+        streamer.put(torch.tensor([[ids[step]] for ids in outputs]))
+    streamer.end()
+
+    texts = ["", ""]
+    for printable_texts in streamer:
+        for i, text in enumerate(printable_texts):
+            texts[i] += text
+    assert texts == [tokenizer.decode(ids) for ids in outputs]
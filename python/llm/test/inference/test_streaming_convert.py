@@ -0,0 +1,65 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import pytest
+import torch
+
+from ipex_llm.transformers import AutoModelForCausalLM
+from ipex_llm.transformers import streaming_convert
+
+
+@pytest.mark.parametrize("safe_serialization", [True, False])
+@pytest.mark.parametrize("optimize_model", [True, False])
+def test_streaming_convert_matches_default_conversion(tmp_path, tiny_llama, monkeypatch,
+                                                      safe_serialization, optimize_model):
+    path = str(tmp_path)
+    tiny_llama().save_pretrained(path, max_shard_size="100KB",
+                                 safe_serialization=safe_serialization)
+
+    def from_pretrained(**kwargs):
+        return AutoModelForCausalLM.from_pretrained(path, load_in_low_bit="sym_int4",
+                                                    optimize_model=optimize_model,
+                                                    torch_dtype=torch.float32, **kwargs)
+
+    expected = from_pretrained()
+
+    streamed_layers = []
+
+    def on_layer(layer, name):
+        streamed_layers.append(name)
+
+    load_convert_streaming = streaming_convert.load_convert_streaming
+    monkeypatch.setattr(streaming_convert, "load_convert_streaming",
+                        lambda *args, layer_hook=None, **kwargs: load_convert_streaming(
+                            *args, layer_hook=on_layer, num_workers=2, **kwargs))
+    model = from_pretrained(streaming_convert=True)
+    assert streamed_layers == ["model.layers.0", "model.layers.1"]
+
+    state_dict = model.state_dict()
+    expected_state_dict = expected.state_dict()
+    assert state_dict.keys() == expected_state_dict.keys()
+    for name, value in expected_state_dict.items():
+        assert type(state_dict[name]) is type(value)
+        assert state_dict[name].dtype == value.dtype
+        # compare bits, quantized weights may hold NaN patterns
+        assert torch.equal(state_dict[name].view(torch.uint8), value.view(torch.uint8)), name
+
+    input_ids = torch.tensor([[1, 9, 17, 33, 5, 6, 7, 8, 2, 3, 4, 12]])
+    with torch.no_grad():
+        assert torch.equal(model(input_ids).logits, expected(input_ids).logits)
+    assert torch.equal(model.generate(input_ids, do_sample=False, max_new_tokens=8),
+                       expected.generate(input_ids, do_sample=False, max_new_tokens=8))
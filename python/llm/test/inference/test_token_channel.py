@@ -0,0 +1,83 @@
+#
+# Copyright 2016 The BigDL Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import asyncio
+import threading
+
+import pytest
+
+from ipex_llm.serving.fastapi.token_channel import TokenChannel
+
+
+async def _drain(channel, timeout=5):
+    items = []
+    while True:
+        item = await channel.get(timeout)
+        items.append(item)
+        if item[0] == 0:
+            return items
+
+
+def test_put_get_and_close_in_order():
+    async def run():
+        channel = TokenChannel()
+        channel.put(2, "a")
+        channel.put(1, "b")
+        channel.close()
+        return await _drain(channel)
+
+    assert asyncio.run(run()) == [(2, "a"), (1, "b"), (0, None)]
+
+
+def test_get_times_out_without_items():
+    async def run():
+        channel = TokenChannel()
+        with pytest.raises(asyncio.TimeoutError):
+            await channel.get(timeout=0.05)
+        # the channel still works after a timeout
+        channel.put(1, "a")
+        return await channel.get(timeout=1)
+
+    assert asyncio.run(run()) == (1, "a")
+
+
+def test_producer_threads_wake_waiting_consumers():
+    num_channels, num_items = 50, 100
+
+    def produce(channels):
+        for i in range(num_items):
+            for channel in channels:
+                channel.put(num_items - i, str(i))
+        for channel in channels:
+            channel.close()
+
+    async def run():
+        channels = [TokenChannel() for _ in range(num_channels)]
+        consumers = [asyncio.ensure_future(_drain(channel)) for channel in channels]
+        # let the consumers wait before anything is put
+        await asyncio.sleep(0.01)
+        producer = threading.Thread(target=produce, args=(channels,))
+        producer.start()
+        results = await asyncio.gather(*consumers)
+        producer.join()
+        return channels, results
+
+    channels, results = asyncio.run(run())
+    expected = [(num_items - i, str(i)) for i in range(num_items)] + [(0, None)]
+    assert all(items == expected for items in results)
+    # puts which arrive before the wake up runs share it
+    assert all(not channel.wakeup_pending for channel in channels)
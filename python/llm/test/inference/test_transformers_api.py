@@ -118,7 +118,9 @@ class TestTransformersAPI(unittest.TestCase):
     (AutoModel, AutoTokenizer, os.environ.get('ORIGINAL_CHATGLM2_6B_PATH')),
     (AutoModelForCausalLM, AutoTokenizer, os.environ.get('MISTRAL_ORIGIN_PATH')),
     ])
-def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer):
+@pytest.mark.parametrize('safe_serialization', [False, True])
+def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer,
+                                 safe_serialization):
     tokenizer = Tokenizer.from_pretrained(model_path, trust_remote_code=True)
     model = Model.from_pretrained(model_path,
                                   load_in_4bit=True,
@@ -126,7 +128,7 @@ def test_load_low_bit_completion(Model, Tokenizer, model_path, prompt, answer):
                                   trust_remote_code=True)
 
     with tempfile.TemporaryDirectory() as tempdir:
-        model.save_low_bit(tempdir)
+        model.save_low_bit(tempdir, safe_serialization=safe_serialization)
         loaded_model = Model.load_low_bit(tempdir,
                                           optimize_model=True,
                                           trust_remote_code=True)
@@ -17,6 +17,23 @@ fi
 export OMP_NUM_THREADS=$THREAD_NUM
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_transformers_api.py -v
 python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_optimize_model_api.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_continuous_batching.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_kv_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_pipeline_parallel.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_embedding_engine.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_lookup.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_speculative.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_benchmark_util.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_token_channel.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_streamer.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_moe_offload.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_moe_dispatch.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_low_bit_training.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_multi_lora.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_relora.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_streaming_convert.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_llama_cache.py -v
+python -m pytest -s ${LLM_INFERENCE_TEST_DIR}/test_gguf.py -v
 
 now=$(date "+%s")
 time=$((now-start))